@@ -31,10 +31,8 @@ unit-testing/
 """
 import CrawlConfig
 import CrawlMail
-import email.mime.text
 import os
 import pdb
-import smtplib
 import socket
 import util
 
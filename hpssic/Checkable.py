@@ -22,19 +22,24 @@ Note that directories are only used to find more files. A directory does not
 have a cos or a checksum.
 """
 import Alert
+import collections
+import contextlib
 import CrawlConfig
 import CrawlDBI
 import cv_lib
 import dbschem
+import digest
 import Dimension
+import dirtab
 import glob
 import hpss
+import itertools
 import os
 import pdb
-import pexpect
 import random
 import re
-import testhelp
+import sys
+import threading
 import time
 import util
 import util as U
@@ -55,6 +60,30 @@ class Checkable(object):
     type, and last_check. So directories will have a cos field, but it will
     always be empty.
     """
+    settable_attrl = ['rowid',
+                      'path',
+                      'type',
+                      'checksum',
+                      'cos',
+                      'cart',
+                      'ttypes',
+                      'dim',
+                      'fails',
+                      'reported',
+                      'last_check',
+                      'hashed',
+                      'hash_time',
+                      'probability',
+                      'in_db',
+                      'dirty']
+
+    # how many paths to ask about in one hashlist command
+    hashlist_batch = 100
+
+    # while a write_behind() block is running, the PersistBuffer collecting
+    # the updates persist() would otherwise make one at a time
+    buffer = None
+
     # -------------------------------------------------------------------------
     def __init__(self, *args, **kwargs):
         """
@@ -79,6 +108,10 @@ class Checkable(object):
         self.reported = 0
         # when was the last check of this file (epoch time)
         self.last_check = 0
+        # whether hsi last said the file has a checksum (None if we haven't
+        # asked) and when it said so
+        self.hashed = None
+        self.hash_time = 0
         # this item's row id in the database
         self.rowid = None
         # how likely are we to add an item to the sample?
@@ -91,40 +124,18 @@ class Checkable(object):
         self.args = args
 
         for k in kwargs:
-            if k not in ['rowid',
-                         'path',
-                         'type',
-                         'checksum',
-                         'cos',
-                         'cart',
-                         'ttypes',
-                         'dim',
-                         'fails',
-                         'reported',
-                         'last_check',
-                         'probability',
-                         'in_db',
-                         'dirty']:
+            if k not in self.settable_attrl:
                 raise StandardError("Attribute %s is invalid for Checkable" %
                                     k)
             setattr(self, k, kwargs[k])
-        for attr in ['checksum', 'fails', 'reported']:
+        for attr in ['checksum', 'fails', 'reported', 'hash_time']:
             if getattr(self, attr) is None:
                 setattr(self, attr, 0)
 
-        # Set up dimensions based on configuration. If no dimensions option is
-        # set in the configuration, we just leave the dimensions dict emtpy.
-        # Since this class is only used by the cv_plugin, it makes no sense for
-        # this code to be running if there is no cv section in the
-        # configuration, so we'll let that exception get thrown up the stack.
-        cfg = CrawlConfig.add_config()
-        self.dim = {}
-        try:
-            dim_l = util.csv_list(cfg.get('cv', 'dimensions'))
-            for dname in dim_l:
-                self.dim[dname] = Dimension.get_dim(dname)
-        except CrawlConfig.NoOptionError:
-            pass
+        # Set up dimensions based on configuration unless the caller handed us
+        # a dimension dict already computed for a batch of objects.
+        if 'dim' not in kwargs:
+            self.dim = Checkable.get_dims()
 
         super(Checkable, self).__init__()
 
@@ -146,12 +157,27 @@ class Checkable(object):
     def __eq__(self, other):
         """
         Two Checkable objects are equal if they are both instances of Checkable
-        and their path and type members are equal.
+        and their path and type members are equal. A CheckableRecord with the
+        same path and type also compares equal.
         """
-        return (isinstance(other, self.__class__) and
+        return (isinstance(other, (Checkable, CheckableRecord)) and
                 (self.path == other.path) and
                 (self.type == other.type))
 
+    # -------------------------------------------------------------------------
+    def __ne__(self, other):
+        """
+        Python 2 does not derive != from ==
+        """
+        return not self.__eq__(other)
+
+    # -------------------------------------------------------------------------
+    def __hash__(self):
+        """
+        Hash on the same fields __eq__ compares
+        """
+        return hash(self.key())
+
     # -------------------------------------------------------------------------
     def add_to_sample(self, hsi, already_hashed=False):
         """
@@ -181,6 +207,8 @@ class Checkable(object):
                 return "access denied"
             else:
                 CrawlConfig.log("completed hashcreate on %s", self.path)
+                self.set('hashed', 1)
+                self.set('hash_time', int(time.time()))
 
         if self.checksum == 0:
             for dn in self.dim:
@@ -216,9 +244,9 @@ class Checkable(object):
         """
         For a directory:
          - get a list of its contents if possible,
-         - create a Checkable object for each item and persist it to the
-           database
-         - return the list of Checkables found in the directory
+         - create a CheckableRecord for each item and persist them to the
+           database as a batch
+         - return the list of CheckableRecords found in the directory
         For a file:
          - if it already has a hash, add it to the sample if not already
            and verify it
@@ -228,7 +256,7 @@ class Checkable(object):
         which we should check files.
 
         potential outcomes            return
-         read a directory             list of Checkable objects
+         read a directory             list of CheckableRecord objects
          file checksum fail           Alert
          invalid Checkable type       raise StandardError
          access denied                "access denied"
@@ -263,13 +291,10 @@ class Checkable(object):
             if "Access denied" in rsp:
                 rval = "access denied"
             else:
-                for line in rsp.split("\n"):
-                    new = Checkable.fdparse(line)
-                    if new is not None:
-                        rval.append(new)
-                        new.load()
-                        new.persist()
-                        # returning list of items found in the directory
+                rval = CheckableRecord.from_lsp(rsp)
+                Checkable.persist_records(rval)
+                Checkable.harvest_hashes(h, rval)
+                # returning list of items found in the directory
         elif self.type == 'f':
             if self.cart is None:
                 self.populate_cart(h)
@@ -334,22 +359,23 @@ class Checkable(object):
 
         Field reported is 0 or 1 indicating whether we've reported
         """
-        dbschem.make_table("checkables")
+        dirtab.make_tables()
+        checkables_upgrade()
         if type(dataroot) == str:
             dataroot = [dataroot]
 
-        if type(dataroot) == list:
-            for root in dataroot:
-                r = Checkable(path=root, type='d', in_db=False, dirty=True)
-                r.load()
-                r.persist()
+        # Roots already in the table are left alone
+        if type(dataroot) == list and dataroot:
+            cls.persist_records([CheckableRecord(path=root, type='d')
+                                 for root in dataroot])
 
     # -----------------------------------------------------------------------------
     @classmethod
-    def fdparse(cls, value):
+    def fdparse(cls, value, record=False):
         """
         Parse a file or directory name and type ('f' or 'd') from hsi output.
-        Return the two values in a tuple if successful, or None if not.
+        Return a Checkable (or a CheckableRecord if record is True) if
+        successful, or None if not.
 
         In "ls -P" output, directory lines look like
 
@@ -370,6 +396,7 @@ class Checkable(object):
         The fields are separated by '\t', which is probably the easiest way to
         parse the line, especially when some values are missing.
         """
+        ctor = CheckableRecord if record else Checkable
         try:
             q = cls.rgxl
         except AttributeError:
@@ -397,12 +424,12 @@ class Checkable(object):
                 cos = cos.strip()
             else:
                 cos = ''
-            return Checkable(path=pname, type=ptype, cos=cos, cart=cart)
+            return ctor(path=pname, type=ptype, cos=cos, cart=cart)
         else:
             ltup = re.findall(cls.rgxl, value)
             if ltup:
                 (type, ign1, ign2, ign3, ign4, fname) = ltup[0]
-                return Checkable(path=fname, type=cls.map[type])
+                return ctor(path=fname, type=cls.map[type])
         return None
 
     # -------------------------------------------------------------------------
@@ -412,94 +439,80 @@ class Checkable(object):
         database row(s).
         """
         db = CrawlDBI.DBI(dbtype='crawler')
-        rv = db.select(table='checkables',
-                       fields=['rowid',
-                               'path',
-                               'type',
-                               'cos',
-                               'cart',
-                               'ttypes',
-                               'checksum',
-                               'last_check',
-                               'fails',
-                               'reported'
-                               ],
-                       where='path=?',
-                       data=(self.path,))
+        rv = dirtab.select_paths(db,
+                                 ['rowid',
+                                  'path',
+                                  'type',
+                                  'cos',
+                                  'cart',
+                                  'ttypes',
+                                  'checksum',
+                                  'last_check',
+                                  'fails',
+                                  'reported'
+                                  ],
+                                 [self.path])
         db.close()
         return rv
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get_dims(cls):
+        """
+        Return a dict of the Dimension objects named by the 'dimensions' option
+        in the cv section of the configuration. If no dimensions option is set,
+        the dict is empty. Since this class is only used by the cv_plugin, it
+        makes no sense for this code to be running if there is no cv section in
+        the configuration, so we'll let that exception get thrown up the stack.
+
+        Callers building many Checkables at once should call this once and pass
+        the result to each object as dim.
+        """
+        cfg = CrawlConfig.add_config()
+        rval = {}
+        try:
+            dim_l = util.csv_list(cfg.get('cv', 'dimensions'))
+            for dname in dim_l:
+                rval[dname] = Dimension.get_dim(dname)
+        except CrawlConfig.NoOptionError:
+            pass
+        return rval
+
     # -------------------------------------------------------------------------
     @classmethod
     def get_list(cls, how_many=-1, prob=0.1, rootlist=[]):
         """
         Return the current list of Checkables from the database.
+
+        The list is drawn from three sources in turn: the priority files
+        (all of them, however many that is), the items due for a recheck,
+        and the rest of the table in order of last check. A source is only
+        read if the ones before it leave room in the list. An item that
+        appears in more than one source is listed once, where it first
+        shows up.
         """
         if how_many < 0:
             cfg = CrawlConfig.add_config()
             how_many = int(cfg.get_d('cv', 'operations', '30'))
 
-        rval = Checkable.load_priority_list()
-        if how_many <= len(rval):
-            return rval
-
-        rval.extend(Checkable.load_recheck_list(how_many))
-        if how_many <= len(rval):
-            return rval
-
-        db = CrawlDBI.DBI(dbtype='crawler')
-        kw = {'table': 'checkables',
-              'fields': ['rowid',
-                         'path',
-                         'type',
-                         'cos',
-                         'cart',
-                         'ttypes',
-                         'checksum',
-                         'last_check',
-                         'fails',
-                         'reported'],
-              'orderby': 'last_check'}
-        if 0 < how_many:
-            kw['limit'] = how_many
-
-        rows = db.select(**kw)
-
-        # check whether any roots from rootlist are missing and if so, add them
-        # to the table
-        reselect = False
-        pathlist = [x[1] for x in rows]
-        for root in rootlist:
-            if root not in pathlist:
-                nr = Checkable(path=root, type='d')
-                nr.load()
-                nr.persist()
-                reselect = True
-
-        if reselect:
-            rows = db.select(**kw)
-
-        for row in rows:
-            tmp = list(row)
-            new = Checkable(rowid=tmp.pop(0),
-                            path=tmp.pop(0),
-                            type=tmp.pop(0),
-                            cos=tmp.pop(0),
-                            cart=tmp.pop(0),
-                            ttypes=tmp.pop(0),
-                            checksum=tmp.pop(0),
-                            last_check=tmp.pop(0),
-                            fails=tmp.pop(0),
-                            reported=tmp.pop(0),
-                            probability=prob,
-                            in_db=True,
-                            dirty=False)
-            if new not in rval:
-                rval.append(new)
-            if how_many <= len(rval):
-                break
+        rval = []
+        seen = set()
+        for item in Checkable.load_priority_list():
+            if item.key() not in seen:
+                seen.add(item.key())
+                rval.append(item)
+
+        if len(rval) < how_many:
+            rest = itertools.chain(
+                Checkable.load_recheck_list(how_many),
+                Checkable.iter_oldest(how_many, prob, rootlist))
+            for item in rest:
+                if item.key() not in seen:
+                    seen.add(item.key())
+                    rval.append(item)
+                    if how_many <= len(rval):
+                        break
 
-        db.close()
         CrawlConfig.log("returning %d items" % len(rval))
         return rval
 
@@ -524,13 +537,100 @@ class Checkable(object):
     def has_hash(self, h):
         """
         Return True if the current file has a hash, False otherwise.
+
+        If hsi has told us within cv/hash_cache_ttl (default 1 day) whether
+        the file has a hash, usually when its directory was listed (see
+        harvest_hashes()), we go by that. Otherwise we ask with hashlist and
+        remember the answer.
         """
+        cfg = CrawlConfig.get_config()
+        ttl = cfg.get_time('cv', 'hash_cache_ttl', 24*3600)
+        now = int(time.time())
+        if self.hashed is not None and now < self.hash_time + ttl:
+            return bool(self.hashed)
+
         rsp = h.hashlist(self.path)
-        if re.search("\n[0-9a-f]+\smd5\s%s" % self.path, rsp):
-            rval = True
-        else:
-            rval = False
-        return rval
+        hashed = hpss.hashlist_parse(rsp).get(self.path)
+        if hashed is None:
+            return False
+        self.set('hashed', int(hashed))
+        self.set('hash_time', now)
+        return hashed
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def iter_oldest(cls, how_many, prob, rootlist):
+        """
+        Generate Checkables for up to how_many rows of the table in order of
+        last check, or all of them if how_many is 0. Any roots in rootlist
+        that are missing from those rows are added to the table first. The
+        rows are read when the first item is wanted, and a Checkable is only
+        built for each row as it's taken.
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        kw = {'fields': CheckableRecord.fields,
+              'orderby': 'last_check, rowid'}
+        if 0 < how_many:
+            kw['limit'] = how_many
+
+        rows = dirtab.select(db, **kw)
+
+        # check whether any roots from rootlist are missing and if so, add them
+        # to the table
+        pathset = set([x[1] for x in rows])
+        missing = [root for root in rootlist if root not in pathset]
+        if missing:
+            Checkable.ex_nihilo(dataroot=missing)
+            rows = dirtab.select(db, **kw)
+        db.close()
+
+        dim = Checkable.get_dims()
+        for row in rows:
+            yield CheckableRecord.from_row(row).checkable(dim=dim,
+                                                          probability=prob,
+                                                          in_db=True,
+                                                          dirty=False)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def harvest_hashes(cls, h, reclist):
+        """
+        Ask hsi which of the files in *reclist* that we don't know to have a
+        checksum do have one, hashlist_batch paths per hashlist command, and
+        record the answers in the records and in the checkables table, so
+        has_hash() doesn't have to ask about each file when it's checked.
+        Files hsi reports an error for are left as they were.
+        """
+        pathl = [x.path for x in reclist if x.type == 'f' and not x.checksum]
+        found = {}
+        for idx in range(0, len(pathl), cls.hashlist_batch):
+            rsp = h.hashlist(pathl[idx:idx + cls.hashlist_batch])
+            found.update(hpss.hashlist_parse(rsp))
+        if not found:
+            return
+
+        now = int(time.time())
+        for rec in reclist:
+            if rec.path in found and rec.type == 'f':
+                rec.hashed = int(found[rec.path])
+                rec.hash_time = now
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        with db.transaction():
+            dirtab.update(db,
+                          fields=['hashed', 'hash_time'],
+                          where='path = ?',
+                          data=[(int(v), now, k)
+                                for (k, v) in found.items()])
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def key(self):
+        """
+        Return the (path, type) pair that identifies this item. Equal items
+        have the same key.
+        """
+        return (self.path, self.type)
 
     # -------------------------------------------------------------------------
     def load(self):
@@ -538,34 +638,14 @@ class Checkable(object):
         Read a checkable from the database and fill out the object
         """
         db = CrawlDBI.DBI(dbtype='crawler')
+        fields = ['rowid', 'path', 'type', 'cos', 'cart', 'ttypes', 'checksum',
+                  'last_check', 'fails', 'reported', 'hashed', 'hash_time']
         if self.rowid is not None:
-            rows = db.select(table='checkables',
-                             fields=['rowid',
-                                     'path',
-                                     'type',
-                                     'cos',
-                                     'cart',
-                                     'ttypes',
-                                     'checksum',
-                                     'last_check',
-                                     'fails',
-                                     'reported'],
-                             where="rowid = ?",
-                             data=(self.rowid,))
+            rows = dirtab.select(db, fields,
+                                 where="rowid = ?",
+                                 data=(self.rowid,))
         else:
-            rows = db.select(table='checkables',
-                             fields=['rowid',
-                                     'path',
-                                     'type',
-                                     'cos',
-                                     'cart',
-                                     'ttypes',
-                                     'checksum',
-                                     'last_check',
-                                     'fails',
-                                     'reported'],
-                             where="path = ?",
-                             data=(self.path,))
+            rows = dirtab.select_paths(db, fields, [self.path])
         if 0 == len(rows):
             self.in_db = False
         elif 1 == len(rows):
@@ -587,6 +667,8 @@ class Checkable(object):
                 self.reported = rz.pop(0)
             except IndexError:
                 self.reported = 0
+            self.hashed = rz.pop(0)
+            self.hash_time = rz.pop(0) or 0
             self.dirty = False
         else:
             raise StandardError("There appears to be more than one copy " +
@@ -614,40 +696,19 @@ class Checkable(object):
         limit = round(r_fraction * how_many)
 
         db = CrawlDBI.DBI(dbtype='crawler')
-        kw = {'table': 'checkables',
-              'fields': ['rowid',
-                         'path',
-                         'type',
-                         'cos',
-                         'cart',
-                         'ttypes',
-                         'checksum',
-                         'last_check',
-                         'fails',
-                         'reported'],
-              'where': 'checksum <> 0 and last_check < %d' % threshold,
-              'orderby': 'last_check',
-              'limit': limit}
-
-        rows = db.select(**kw)
+        rows = dirtab.select(db,
+                             CheckableRecord.fields,
+                             where='checksum <> 0 and last_check < %d' %
+                             threshold,
+                             orderby='last_check',
+                             limit=limit)
         db.close()
 
-        rval = []
-        for row in rows:
-            tmp = list(row)
-            new = Checkable(rowid=tmp.pop(0),
-                            path=tmp.pop(0),
-                            type=tmp.pop(0),
-                            cos=tmp.pop(0),
-                            cart=tmp.pop(0),
-                            ttypes=tmp.pop(0),
-                            checksum=tmp.pop(0),
-                            last_check=tmp.pop(0),
-                            fails=tmp.pop(0),
-                            reported=tmp.pop(0),
-                            in_db=True,
-                            dirty=False)
-            rval.append(new)
+        dim = Checkable.get_dims()
+        rval = [CheckableRecord.from_row(row).checkable(dim=dim,
+                                                        in_db=True,
+                                                        dirty=False)
+                for row in rows]
         return rval
 
     # -------------------------------------------------------------------------
@@ -667,11 +728,12 @@ class Checkable(object):
                             'completed',
                             U.pathjoin(U.dirname(priglob), 'completed'))
 
+        dim = Checkable.get_dims()
         for pripath in U.foldsort(glob.glob(priglob)):
             with open(pripath, 'r') as f:
                 for line in f.readlines():
                     path = line.strip()
-                    rval.append(Checkable(path=path, type='f'))
+                    rval.append(Checkable(path=path, type='f', dim=dim))
             os.rename(pripath, U.pathjoin(pricomp, U.basename(pripath)))
 
         return rval
@@ -688,13 +750,13 @@ class Checkable(object):
 
         If type == 'd' and cos != '', something is wrong. Throw an exception.
 
-        Otherwise, if rowid != None, update by rowid (setting last_check to 0
-        if type changes).
+        Otherwise, if the object came from the database with a rowid and has
+        changed, update its row by rowid.
 
-        If rowid == None, look the entry up by path. If more than one
-        occurrence exists, raise an exception. If only one occurrence exists,
-        update it (setting last_check to 0 if type changes). If no occurrence
-        exists, insert it.
+        If the object is not known to be in the database, or has changed and
+        we don't know its rowid, upsert it by path -- insert it, or update the
+        row with its path if there is one -- so there's no need to load() it
+        first.
         """
         if self.rowid is None and self.last_check != 0.0:
             raise StandardError("%s has rowid == None, last_check != 0.0" %
@@ -706,40 +768,23 @@ class Checkable(object):
         if self.type != 'f' and self.type != 'd':
             raise StandardError("%s has invalid type" % self)
 
-        db = CrawlDBI.DBI(dbtype='crawler')
-
         # Populate ttypes if appropriate
         if self.type == 'f' and self.ttypes is None and self.cart is not None:
             media = cv_lib.ttype_lookup(self.path, self.cart)
             if media is not None:
                 self.ttypes = ','.join([x[1] for x in media])
 
-        if not self.in_db:
-            # insert it
-            db.insert(table='checkables',
-                      fields=['path',
-                              'type',
-                              'cos',
-                              'cart',
-                              'ttypes',
-                              'checksum',
-                              'last_check',
-                              'fails',
-                              'reported'],
-                      data=[(self.path,
-                             self.type,
-                             self.cos,
-                             self.cart,
-                             self.ttypes,
-                             self.checksum,
-                             self.last_check,
-                             self.fails,
-                             self.reported)])
-            self.in_db = True
-        elif self.dirty or dirty:
-            # update it
-            if self.rowid is not None:
-                db.update(table='checkables',
+        # Updates wait in the write-behind buffer if there is one. The buffer
+        # reloads the Dimension objects when it writes them.
+        if self.in_db and Checkable.buffer is not None:
+            if self.dirty or dirty:
+                Checkable.buffer.add(self)
+            return
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        if not self.in_db or (self.rowid is None and (self.dirty or dirty)):
+            # insert it or update it by path
+            dirtab.upsert(db,
                           fields=['path',
                                   'type',
                                   'cos',
@@ -748,8 +793,9 @@ class Checkable(object):
                                   'checksum',
                                   'last_check',
                                   'fails',
-                                  'reported'],
-                          where="rowid = ?",
+                                  'reported',
+                                  'hashed',
+                                  'hash_time'],
                           data=[(self.path,
                                  self.type,
                                  self.cos,
@@ -759,46 +805,90 @@ class Checkable(object):
                                  self.last_check,
                                  self.fails,
                                  self.reported,
-                                 self.rowid)])
-            else:
-                db.update(table='checkables',
-                          fields=['type',
-                                  'cos',
-                                  'cart',
-                                  'ttypes',
-                                  'checksum',
-                                  'last_check',
-                                  'fails',
-                                  'reported'],
-                          where="path = ?",
-                          data=[(self.type,
-                                 self.cos,
-                                 self.cart,
-                                 self.ttypes,
-                                 self.checksum,
-                                 self.last_check,
-                                 self.fails,
-                                 self.reported,
-                                 self.path)])
+                                 self.hashed,
+                                 self.hash_time)])
+            self.in_db = True
+            self.dirty = False
+        elif self.dirty or dirty:
+            # update it
+            (fields, where, row) = self.update_args()
+            dirtab.update(db, fields=fields, where=where, data=[row])
             self.dirty = False
 
         for d in self.dim:
             self.dim[d].load()
         db.close()
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def persist_records(cls, reclist):
+        """
+        Persist a batch of CheckableRecord objects (typically the contents of a
+        directory) with one select to find the ones already in the database
+        and one multi-row insert for the rest. Records already in the database
+        are refreshed from their rows, as load() would do. Each new file record
+        with a non-empty cart gets its ttypes looked up, as persist() would do,
+        but all together (see cv_lib.ttype_bulk_lookup()). (An empty cart came
+        from the listing, so there's no point asking hsi for it again.) The
+        Dimension objects are reloaded once for the whole batch.
+        """
+        for rec in reclist:
+            if rec.path == '':
+                raise StandardError("%s has an empty path" % rec)
+            if rec.type == 'd' and rec.cos != '':
+                raise StandardError("%s has type 'd', non-empty cos" % rec)
+            if rec.type != 'f' and rec.type != 'd':
+                raise StandardError("%s has invalid type" % rec)
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        known = {}
+        for row in dirtab.select_paths(db, CheckableRecord.fields,
+                                       [x.path for x in reclist]):
+            known[row[1]] = row
+
+        new = []
+        for rec in reclist:
+            if rec.path in known:
+                rec.load_row(known[rec.path])
+            else:
+                new.append(rec)
+
+        # The media types of all the new files are looked up together
+        untyped = [x for x in new
+                   if x.type == 'f' and x.ttypes is None and x.cart]
+        if untyped:
+            media = cv_lib.ttype_bulk_lookup([(x.path, x.cart)
+                                              for x in untyped])
+            for rec in untyped:
+                if media[rec.path] is not None:
+                    rec.ttypes = ','.join([x[1] for x in media[rec.path]])
+
+        # A path another process added since the select (or that's in the
+        # list twice) is left as it is. With the rows in one transaction,
+        # sqlite commits once for the batch rather than once per row.
+        if new:
+            with db.transaction():
+                dirtab.upsert(db,
+                              fields=CheckableRecord.fields[1:],
+                              update_fields=[],
+                              data=[x.row()[1:] for x in new])
+
+        for d in cls.get_dims().values():
+            d.load()
+        db.close()
+
     # -------------------------------------------------------------------------
     def populate_cart(self, h):
         """
         Fill in the cart field
         """
         rsp = h.lsP(self.path)
-        tmp = Checkable.fdparse(rsp.split("\n")[1])
-        try:
-            self.cart = tmp.cart
-        except AttributeError:
+        cartl = util.lsp_columns(rsp)['cart']
+        if cartl and cartl[0] is not None:
+            self.cart = cartl[0]
+        else:
             self.cart = ''
-            CrawlConfig.log("%s <- Checkable.fdparse('%s')" %
-                            (tmp, rsp.split("\n")[1]))
+            CrawlConfig.log("no cart found in ls -P output '%s'" % rsp)
 
     # -------------------------------------------------------------------------
     def set(self, attrname, value):
@@ -808,10 +898,39 @@ class Checkable(object):
         setattr(self, attrname, value)
         self.dirty = True
 
+    # -------------------------------------------------------------------------
+    def update_args(self):
+        """
+        Return the fields, where clause, and data tuple for updating the
+        object's row in the checkables table -- by rowid if we know it,
+        otherwise by path
+        """
+        fields = ['type', 'cos', 'cart', 'ttypes', 'checksum', 'last_check',
+                  'fails', 'reported', 'hashed', 'hash_time']
+        row = tuple([getattr(self, x) for x in fields])
+        if self.rowid is not None:
+            return (['path'] + fields, "rowid = ?",
+                    (self.path,) + row + (self.rowid,))
+        else:
+            return (fields, "path = ?", row + (self.path,))
+
     # -------------------------------------------------------------------------
     def verify(self, h):
         """
-        Attempt to verify the current file.
+        Attempt to verify the current file. With verify_engine = stream in
+        the [cv] section, we compute the digests ourselves (see
+        stream_verify()). Otherwise, HPSS does it with hashverify.
+        """
+        cfg = CrawlConfig.get_config()
+        if cfg.get_d('cv', 'verify_engine', 'hsi') == 'stream':
+            return self.stream_verify(h)
+        return self.hsi_verify(h)
+
+    # -------------------------------------------------------------------------
+    def hsi_verify(self, h):
+        """
+        Have HPSS verify the current file with hashverify. The checksum may
+        be in any algorithm hsi knows (see hpss.HSI.hash_algorithm).
         """
         CrawlConfig.log("hsi(%d) attempting to verify %s" % (h.pid(),
                                                              self.path))
@@ -823,18 +942,568 @@ class Checkable(object):
             CrawlConfig.log("hashverify transfer incomplete on %s -- skipping"
                             % self.path)
             h.quit()
-        elif "%s: (md5) OK" % self.path in rsp:
+        elif re.search("%s: \(\w+\) OK" % re.escape(self.path), rsp):
             rval = "matched"
             CrawlConfig.log("hashverify matched on %s" % self.path)
         elif "no valid checksum found" in rsp:
-            if self.addable(self.cos):
-                rval = self.add_to_sample(h)
-            else:
-                self.set('checksum', 0)
-                rval = "skipped"
-                CrawlConfig.log("hashverify skipped %s" % self.path)
+            rval = self.no_checksum(h)
         else:
             rval = Alert.Alert("Checksum mismatch: %s" % rsp)
             CrawlConfig.log("hashverify generated 'Checksum mismatch' " +
                             "alert on %s" % self.path)
         return rval
+
+    # -------------------------------------------------------------------------
+    def no_checksum(self, h):
+        """
+        The file turned out to have no checksum when we went to verify it.
+        Record that so has_hash() doesn't go on believing it has one, then add
+        it to the sample if the dimensions agree, or skip it.
+        """
+        self.set('hashed', 0)
+        self.set('hash_time', int(time.time()))
+        if self.addable():
+            rval = self.add_to_sample(h)
+        else:
+            self.set('checksum', 0)
+            rval = "skipped"
+            CrawlConfig.log("hashverify skipped %s" % self.path)
+        return rval
+
+    # -------------------------------------------------------------------------
+    def stream_verify(self, h):
+        """
+        Verify the current file by streaming its content out of HPSS and
+        computing its digests here, in one pass, for the algorithm HPSS has
+        the checksum in plus the ones listed in cv/stream_digests (default
+        md5). All the digests are recorded in the digests table. The access
+        time is saved and restored around the read if reset_atime is set.
+
+        If HPSS has the checksum in an algorithm we can't compute, we fall
+        back to hashverify.
+        """
+        cfg = CrawlConfig.get_config()
+        stored = hpss.hashlist_values(h.hashlist(self.path)).get(self.path)
+        if stored is None:
+            return self.no_checksum(h)
+        (alg, value) = stored
+        if alg not in digest.algorithms:
+            CrawlConfig.log("can't compute %s for %s -- using hashverify" %
+                            (alg, self.path))
+            return self.hsi_verify(h)
+
+        names = set(util.csv_list(cfg.get_d('cv', 'stream_digests', 'md5')))
+        names.add(alg)
+        CrawlConfig.log("hsi(%d) streaming %s to compute %s" %
+                        (h.pid(), self.path, ", ".join(sorted(names))))
+        if h.reset_atime:
+            atimes = h.access_times([self.path])
+        try:
+            digests = digest.hsi_digests(self.path, names)
+        except hpss.HSIerror as e:
+            self.set('fails', self.fails + 1)
+            CrawlConfig.log("stream of %s incomplete -- skipping: %s" %
+                            (self.path, str(e)))
+            return "skipped"
+        finally:
+            if h.reset_atime:
+                h.restore_atimes(atimes)
+        digest.record(self.path, digests)
+
+        if digests[alg] == value:
+            rval = "matched"
+            CrawlConfig.log("stream %s matched on %s" % (alg, self.path))
+        else:
+            rval = Alert.Alert("Checksum mismatch: %s: (%s) stored %s, "
+                               "computed %s" %
+                               (self.path, alg, value, digests[alg]))
+            CrawlConfig.log("stream verify generated 'Checksum mismatch' " +
+                            "alert on %s" % self.path)
+        return rval
+
+
+# -----------------------------------------------------------------------------
+class PersistBuffer(object):
+    """
+    Collects the Checkables whose rows need updating and writes them in
+    batches: one transaction holding an executemany update for the items with
+    a rowid and another for the rest. The buffer is written when it holds
+    *count* items or *interval* seconds have passed since it was last written,
+    whichever comes first, so a crash can lose at most one batch of updates.
+    An item updated again before the buffer is written is only written once.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, count=None, interval=None):
+        """
+        Take count and interval from cv/persist_batch (default 100) and
+        cv/persist_interval (default 30s) unless they're passed in
+        """
+        cfg = CrawlConfig.get_config()
+        if count is None:
+            count = int(cfg.get_d('cv', 'persist_batch', '100'))
+        if interval is None:
+            interval = cfg.get_time('cv', 'persist_interval', 30)
+        self.count = count
+        self.interval = interval
+        self.pending = {}
+        self.flushes = 0
+        self.since = time.time()
+
+    # -------------------------------------------------------------------------
+    def add(self, item):
+        """
+        Queue *item* to be updated, then write the buffer if it's time
+        """
+        self.pending[item.rowid or item.path] = item
+        if (self.count <= len(self.pending) or
+                self.since + self.interval <= time.time()):
+            self.flush()
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """
+        Write the pending updates in one transaction and reload the Dimension
+        objects. If the write fails, the updates stay pending.
+        """
+        self.since = time.time()
+        if not self.pending:
+            return
+
+        batches = {}
+        for item in self.pending.values():
+            (fields, where, row) = item.update_args()
+            batches.setdefault((tuple(fields), where), []).append(row)
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        try:
+            db.batch(self.write, db, batches)
+        finally:
+            db.close()
+
+        for item in self.pending.values():
+            item.dirty = False
+        self.pending = {}
+        self.flushes += 1
+        for d in Checkable.get_dims().values():
+            d.load()
+
+    # -------------------------------------------------------------------------
+    def write(self, db, batches):
+        """
+        Run the updates in *batches*, a dict mapping (fields, where) to the
+        rows to update that way. DBI.batch() calls this in a transaction and
+        calls it again if the transaction loses a lock conflict.
+        """
+        for ((fields, where), rows) in batches.items():
+            dirtab.update(db, fields=list(fields), where=where, data=rows)
+
+
+# -----------------------------------------------------------------------------
+def checkables_upgrade():
+    """
+    Add any of the hash cache columns (hashed, hash_time) that are missing
+    from a checkables table created before they were defined
+    """
+    db = CrawlDBI.DBI(dbtype='crawler')
+    exists = db.table_exists(table='checkables')
+    db.close()
+    if not exists:
+        return
+    for fdef in dbschem.tdefs['checkables']['fields']:
+        if fdef.split()[0] in ['hashed', 'hash_time']:
+            dbschem.alter_table(table='checkables', addcol=fdef)
+
+
+# -----------------------------------------------------------------------------
+@contextlib.contextmanager
+def write_behind(count=None, interval=None):
+    """
+    Collect the updates Checkable.persist() makes in the body of a with
+    statement in a PersistBuffer (see above), writing whatever is left when
+    the body finishes, even by an exception.
+
+        with Checkable.write_behind():
+            for item in clist:
+                item.check()
+    """
+    buf = PersistBuffer(count, interval)
+    Checkable.buffer = buf
+    try:
+        yield buf
+    finally:
+        Checkable.buffer = None
+        buf.flush()
+
+
+# -----------------------------------------------------------------------------
+class CheckQueue(object):
+    """
+    The items for a cv run, handed out one at a time. Rather than reading the
+    whole list up front as get_list() does, the queue reads the table in
+    chunks of *chunk* rows (cv/fetch_chunk, default 100), in order of last
+    check. While the items of one chunk are being checked, the next chunk is
+    read by a background thread with its own database connection.
+
+    Items come out in the order get_list() would give them: the contents of
+    the priority files, then the items due for a recheck, then the rest of
+    the table. Items found in a directory during the run and never checked
+    before can be passed to add(), and they are handed out ahead of the
+    remaining rows, so a new directory's contents can be checked in the same
+    run. No item is handed out twice, and no more than *how_many* are handed
+    out in all.
+
+        queue = Checkable.CheckQueue(how_many=n_ops, prob=odds)
+        for item in queue:
+            result = item.check()
+            if type(result) == list:
+                queue.add(result)
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, how_many=-1, prob=0.1, rootlist=[], chunk=None):
+        """
+        Load the priority and recheck lists and the first chunk of rows. Any
+        roots in rootlist that are missing from the table are added to it.
+        As with get_list(), a missing table raises DBIerror.
+        """
+        cfg = CrawlConfig.get_config()
+        if how_many < 0:
+            how_many = int(cfg.get_d('cv', 'operations', '30'))
+        if chunk is None:
+            chunk = int(cfg.get_d('cv', 'fetch_chunk', '100'))
+        self.how_many = how_many
+        self.prob = prob
+        self.chunk = max(1, chunk)
+        self.dim = Checkable.get_dims()
+        self.seen = set()
+        self.handed = 0
+        self.chunks = 0
+        self.last = None
+        self.exhausted = False
+        self.thread = None
+        self.fetched = None
+
+        self.ready = collections.deque(Checkable.load_priority_list())
+        if len(self.ready) < how_many:
+            self.ready.extend(Checkable.load_recheck_list(how_many))
+        self.found = collections.deque()
+        self.rows = collections.deque()
+
+        rows = self.fetch(None, self.chunk)
+        pathset = set([x[1] for x in rows])
+        missing = [root for root in rootlist if root not in pathset]
+        if missing:
+            Checkable.ex_nihilo(dataroot=missing)
+            rows = self.fetch(None, self.chunk)
+        self.take(rows)
+
+    # -------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        The queue is its own iterator
+        """
+        return self
+
+    # -------------------------------------------------------------------------
+    def add(self, reclist):
+        """
+        Queue the items in *reclist* (CheckableRecords or Checkables, as
+        returned by Checkable.check() for a directory) that have never been
+        checked. They have been recorded in the table, but may not know their
+        rowids, which persist() needs once they're checked, so we look those
+        up.
+        """
+        new = [x for x in reclist
+               if x.last_check == 0 and x.key() not in self.seen]
+        nameless = dict([(x.path, x) for x in new if x.rowid is None])
+        if nameless:
+            db = CrawlDBI.DBI(dbtype='crawler')
+            for (path, rowid) in dirtab.select_paths(db, ['path', 'rowid'],
+                                                     nameless.keys()):
+                nameless[path].rowid = rowid
+            db.close()
+
+        for rec in new:
+            if isinstance(rec, CheckableRecord):
+                rec = rec.checkable(dim=self.dim,
+                                    probability=self.prob,
+                                    in_db=True,
+                                    dirty=False)
+            if rec.rowid is not None:
+                self.found.append(rec)
+
+    # -------------------------------------------------------------------------
+    def fetch(self, last, limit):
+        """
+        Return up to *limit* rows of the table following *last*, a
+        (last_check, rowid) pair, or from the top if *last* is None. Keying
+        on the last row rather than an offset means rows written by the run
+        in the meantime can't make us skip any.
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        kw = {'fields': CheckableRecord.fields,
+              'orderby': 'last_check, rowid',
+              'limit': limit}
+        if last is not None:
+            kw['where'] = ('last_check > ? or ' +
+                           '(last_check = ? and rowid > ?)')
+            kw['data'] = (last[0], last[0], last[1])
+        try:
+            return dirtab.select(db, **kw)
+        finally:
+            db.close()
+
+    # -------------------------------------------------------------------------
+    def next(self):
+        """
+        Return the next item to check, or raise StopIteration when there are
+        no more or how_many have been handed out
+        """
+        while self.handed < self.how_many:
+            if self.ready:
+                item = self.ready.popleft()
+            elif self.found:
+                item = self.found.popleft()
+            elif self.rows or self.refill():
+                rec = CheckableRecord.from_row(self.rows.popleft())
+                if rec.key() in self.seen:
+                    continue
+                item = rec.checkable(dim=self.dim,
+                                     probability=self.prob,
+                                     in_db=True,
+                                     dirty=False)
+            else:
+                break
+            if item.key() in self.seen:
+                continue
+            self.seen.add(item.key())
+            self.handed += 1
+            return item
+        self.wait()
+        raise StopIteration
+
+    # -------------------------------------------------------------------------
+    def prefetch(self):
+        """
+        Start reading the chunk after the current one in a background thread,
+        unless the table has run out or the items in hand are enough to
+        finish the run
+        """
+        wanted = (self.how_many - self.handed - len(self.ready) -
+                  len(self.rows))
+        if self.exhausted or self.thread is not None or wanted <= 0:
+            return
+
+        # ---------------------------------------------------------------------
+        def read(last, limit):
+            """
+            Fetch the rows, keeping any exception to raise in the main thread
+            """
+            try:
+                self.fetched = ('rows', self.fetch(last, limit))
+            except Exception:
+                self.fetched = ('error', sys.exc_info())
+
+        self.thread = threading.Thread(target=read,
+                                       args=(self.last,
+                                             min(self.chunk, wanted)))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # -------------------------------------------------------------------------
+    def refill(self):
+        """
+        Take the chunk the background thread read, reading it now if no
+        thread was started. Return True if there are rows to hand out.
+        """
+        if self.exhausted:
+            return False
+        if self.thread is None:
+            rows = self.fetch(self.last, self.chunk)
+        else:
+            self.thread.join()
+            self.thread = None
+            (kind, value) = self.fetched
+            self.fetched = None
+            if kind == 'error':
+                raise value[0], value[1], value[2]
+            rows = value
+        self.take(rows)
+        return 0 < len(self.rows)
+
+    # -------------------------------------------------------------------------
+    def take(self, rows):
+        """
+        Queue a chunk of *rows* and start reading the next one
+        """
+        self.chunks += 1
+        if not rows:
+            self.exhausted = True
+            return
+        self.rows.extend(rows)
+        rec = CheckableRecord.from_row(rows[-1])
+        self.last = (rec.last_check, rec.rowid)
+        self.prefetch()
+
+    # -------------------------------------------------------------------------
+    def wait(self):
+        """
+        Let a read still in progress finish, so its connection is closed
+        before the caller goes on
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.fetched = None
+
+
+# -----------------------------------------------------------------------------
+class CheckableRecord(object):
+    """
+    A compact stand-in for Checkable used where we handle many items at once
+    (directory listings, queue assembly, rows from the database). It carries
+    the fields stored in the checkables table and nothing else. Having
+    __slots__ and no __dict__, it is much smaller than a Checkable, and
+    building one does not validate arguments, read the configuration, or look
+    up Dimension objects.
+
+    When an item is actually going to be checked, .checkable() turns it into a
+    full Checkable, ideally with a dim dict computed once for the whole batch
+    by Checkable.get_dims().
+    """
+    __slots__ = ['rowid',
+                 'path',
+                 'type',
+                 'cos',
+                 'cart',
+                 'ttypes',
+                 'checksum',
+                 'last_check',
+                 'fails',
+                 'reported',
+                 'hashed',
+                 'hash_time']
+
+    # the columns of table checkables, in the order used by from_row and row
+    fields = list(__slots__)
+
+    # -------------------------------------------------------------------------
+    def __init__(self, rowid=None, path='---', type='-', cos='', cart=None,
+                 ttypes=None, checksum=0, last_check=0, fails=0, reported=0,
+                 hashed=None, hash_time=0):
+        """
+        Set the fields. Same defaults as Checkable.
+        """
+        self.rowid = rowid
+        self.path = path
+        self.type = type
+        self.cos = cos
+        self.cart = cart
+        self.ttypes = ttypes
+        self.checksum = checksum or 0
+        self.last_check = last_check
+        self.fails = fails or 0
+        self.reported = reported or 0
+        self.hashed = hashed
+        self.hash_time = hash_time or 0
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Return a human-readable representation of a CheckableRecord
+        """
+        return("CheckableRecord(rowid=%s, " % str(self.rowid) +
+               "path='%s', " % self.path +
+               "type='%s', " % self.type +
+               "cos='%s', " % self.cos +
+               "cart=%s, " % (self.cart if self.cart is None else "'%s'" %
+                              self.cart) +
+               "checksum=%d, " % self.checksum +
+               "last_check=%f)" % self.last_check)
+
+    # -------------------------------------------------------------------------
+    def __eq__(self, other):
+        """
+        Equal to any CheckableRecord or Checkable with the same path and type
+        """
+        return (isinstance(other, (Checkable, CheckableRecord)) and
+                (self.path == other.path) and
+                (self.type == other.type))
+
+    # -------------------------------------------------------------------------
+    def __ne__(self, other):
+        """
+        Python 2 does not derive != from ==
+        """
+        return not self.__eq__(other)
+
+    # -------------------------------------------------------------------------
+    def __hash__(self):
+        """
+        Hash on the same fields __eq__ compares
+        """
+        return hash(self.key())
+
+    # -------------------------------------------------------------------------
+    def checkable(self, dim=None, **kwargs):
+        """
+        Return a Checkable with this record's fields. Additional keyword
+        arguments (probability, in_db, dirty) are passed through. If dim is
+        None, the Checkable will compute its own.
+        """
+        if dim is not None:
+            kwargs['dim'] = dim
+        for attr in self.fields:
+            kwargs[attr] = getattr(self, attr)
+        return Checkable(**kwargs)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def from_lsp(cls, lspout):
+        """
+        Build a list of records from the output of an hsi 'ls -P' command,
+        one per file or directory listed
+        """
+        cols = util.lsp_columns(lspout)
+        return [cls(path=path, type=ptype, cos=cos, cart=cart)
+                for (ptype, path, cos, cart) in zip(cols['type'],
+                                                    cols['path'],
+                                                    cols['cos'],
+                                                    cols['cart'])]
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build a record from a database row with columns in the order of
+        CheckableRecord.fields
+        """
+        return cls(*row)
+
+    # -------------------------------------------------------------------------
+    def key(self):
+        """
+        Return the (path, type) pair that identifies this record
+        """
+        return (self.path, self.type)
+
+    # -------------------------------------------------------------------------
+    def load_row(self, row):
+        """
+        Overwrite our fields with the values in a database row
+        """
+        (self.rowid, self.path, self.type, self.cos, self.cart, self.ttypes,
+         self.checksum, self.last_check, self.fails, self.reported,
+         self.hashed, self.hash_time) = row
+        self.checksum = self.checksum or 0
+        self.fails = self.fails or 0
+        self.reported = self.reported or 0
+        self.hash_time = self.hash_time or 0
+
+    # -------------------------------------------------------------------------
+    def row(self):
+        """
+        Return our fields as a tuple in the order of CheckableRecord.fields
+        """
+        return (self.rowid, self.path, self.type, self.cos, self.cart,
+                self.ttypes, self.checksum, self.last_check, self.fails,
+                self.reported, self.hashed, self.hash_time)
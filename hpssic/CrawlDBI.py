@@ -5,27 +5,27 @@ import base64
 import contextlib
 import CrawlConfig
 import messages as MSG
+import metrics
 import pdb
+import re
 import sqlite3
 import string
 import sys
+import threading
 import time
 import util
 import warnings
 
-try:
-    import ibm_db as db2
-    import ibm_db_dbi
-    db2_available = True
-except ImportError:
-    db2_available = False
+# The database drivers are only imported when a DBI object for that dbtype
+# first uses them, so commands that never touch DB2 or MySQL don't pay for
+# loading them. We can tell whether they're installed without that.
+db2_available = util.module_available('ibm_db')
+db2 = util.LazyModule('ibm_db')
+ibm_db_dbi = util.LazyModule('ibm_db_dbi')
 
-try:
-    import MySQLdb as mysql
-    import _mysql_exceptions as mysql_exc
-    mysql_available = True
-except ImportError:
-    mysql_available = False
+mysql_available = util.module_available('MySQLdb')
+mysql = util.LazyModule('MySQLdb')
+mysql_exc = util.LazyModule('_mysql_exceptions')
 
 
 HPSS_SECTION = 'dbi-hpss'
@@ -41,6 +41,16 @@ class DBI_abstract(object):
     settable_attrl = ['cfg', 'dbname', 'host', 'username', 'password',
                       'tbl_prefix', 'timeout']
 
+    # what goes between the values and the where clause of an insert ...
+    # select with no table to select from (see upsert_emulate())
+    upsert_from = ''
+
+    # the label for the retry metrics, the configuration section holding the
+    # retry_* options, and the default for retry_max_delay (see retry())
+    backend = ''
+    cfg_section = CRWL_SECTION
+    retry_max_delay = 10.0
+
     # -------------------------------------------------------------------------
     def prefix(self, tabname):
         """
@@ -60,26 +70,141 @@ class DBI_abstract(object):
             return self.tbl_prefix + tabname
 
     # -------------------------------------------------------------------------
-    def retry(self, exception, payload, *args, **kwargs):
+    def upsert_check(self, table, key_fields, fields, update_fields, data):
+        """
+        DBI_abstract: Raise a DBIerror if the upsert() arguments are not
+        usable
+        """
+        if type(table) != str:
+            raise DBIerror("On upsert(), table name must be a string",
+                           dbname=self.dbname)
+        elif table == '':
+            raise DBIerror("On upsert(), table name must not be empty",
+                           dbname=self.dbname)
+        elif type(fields) != list or fields == []:
+            raise DBIerror("On upsert(), fields must be a non-empty list",
+                           dbname=self.dbname)
+        elif type(key_fields) != list or key_fields == []:
+            raise DBIerror("On upsert(), key_fields must be a non-empty list",
+                           dbname=self.dbname)
+        elif [x for x in key_fields if x not in fields]:
+            raise DBIerror("On upsert(), key_fields must all be in fields",
+                           dbname=self.dbname)
+        elif (update_fields is not None and
+              [x for x in update_fields if x not in fields]):
+            raise DBIerror("On upsert(), update_fields must all be in fields",
+                           dbname=self.dbname)
+        elif type(data) != list or data == []:
+            raise DBIerror("On upsert(), data must be a non-empty list",
+                           dbname=self.dbname)
+
+    # -------------------------------------------------------------------------
+    def upsert_emulate(self, cursor, table, key_fields, fields, update_fields,
+                       data, marker):
+        """
+        DBI_abstract: Do an upsert on a table with no unique key on
+        *key_fields* with two statements: an update of *update_fields* in the
+        rows that are there, then an insert of the rows whose keys are not
+        there. *marker* is the parameter placeholder.
+        """
+        kidx = [fields.index(x) for x in key_fields]
+        match = " and ".join(["%s = %s" % (x, marker) for x in key_fields])
+        if update_fields:
+            uidx = [fields.index(x) for x in update_fields]
+            cmd = ("update %s set " % table +
+                   ",".join(["%s = %s" % (x, marker) for x in update_fields]) +
+                   " where " + match)
+            cursor.executemany(cmd, [tuple([row[i] for i in uidx + kidx])
+                                     for row in data])
+        cmd = ("insert into %s(%s) " % (table, ",".join(fields)) +
+               "select %s " % ",".join([marker] * len(fields)) +
+               self.upsert_from +
+               "where not exists (select 1 from %s where %s)" % (table, match))
+        cursor.executemany(cmd, [tuple(row) + tuple([row[i] for i in kidx])
+                                 for row in data])
+
+    # -------------------------------------------------------------------------
+    def lock_conflict(self, err):
+        """
+        DBI_abstract: Return True if DBIerror *err* says a transaction lost a
+        deadlock or gave up waiting for a lock, so running it again may work.
+        The database specific classes know what that looks like.
         """
-        Call *payload*. If it does not throw an exception, we're done --
-        return. OTOH, if it does throw an exception, we call the database
-        specific err_handler(). It will either throw a DBIerror up the stack
-        and we're done, or it will sleep an appropriate amount of time and
-        return so we can keep trying again until the timeout expires.
+        return False
 
-        The timeout is set when the DBI object is instantiated.
+    # -------------------------------------------------------------------------
+    def retry(self, exception, payload, *args, **kwargs):
+        """
+        Call *payload* and return what it returns. If it throws *exception*
+        and the database specific retryable() says the error is transient, we
+        wait as long as the retry policy says (see retry_policy()) and call it
+        again, counting each retry in metric hpssic_db_retries_total. When the
+        policy says to give up, we raise a DBIerror. An error that isn't
+        transient goes to the database specific err_handler(), which raises a
+        DBIerror (a DBIerror is raised as it is).
+
+        If kwargs contains 'retryable', that is called instead of the database
+        specific one and is not passed on to *payload*.
         """
-        rval = None
-        done = False
+        retryable = kwargs.pop('retryable', self.retryable)
+        policy = self.retry_policy()
+        attempt = 0
         start = time.time()
-        while not done and time.time() - start < self.timeout:
+        while True:
             try:
-                rval = payload(*args, **kwargs)
-                done = True
+                return payload(*args, **kwargs)
             except exception as e:
-                self.err_handler(e)
-        return rval
+                if not retryable(e):
+                    if isinstance(e, DBIerror):
+                        raise
+                    self.err_handler(e)
+                    raise
+                attempt += 1
+                wait = policy.wait(attempt, time.time() - start)
+                if wait is None:
+                    metrics.inc('hpssic_db_retry_giveups_total',
+                                backend=self.backend)
+                    raise DBIerror(MSG.retry_gave_up_dS % (attempt, str(e)),
+                                   dbname=self.dbname)
+                if attempt == 1:
+                    CrawlConfig.log("%s: retrying after '%s'" %
+                                    (self.backend, str(e)))
+                metrics.inc('hpssic_db_retries_total', backend=self.backend)
+                time.sleep(wait)
+
+    # -------------------------------------------------------------------------
+    def retry_policy(self):
+        """
+        DBI_abstract: Return the util.RetryPolicy for this connection, set
+        from the retry_delay (default 0.1 seconds), retry_max_delay,
+        retry_jitter (default 0.5), and retry_max_attempts (default 0, no
+        limit) options in its configuration section and its timeout
+        """
+        if not hasattr(self, 'policy'):
+            cfg = getattr(self, 'cfg', None)
+            opts = {'retry_delay': 0.1,
+                    'retry_max_delay': self.retry_max_delay,
+                    'retry_jitter': 0.5,
+                    'retry_max_attempts': 0}
+            if cfg is not None:
+                for name in opts:
+                    opts[name] = cfg.get_d(self.cfg_section, name, opts[name])
+            self.policy = util.RetryPolicy(
+                delay=float(opts['retry_delay']),
+                max_delay=float(opts['retry_max_delay']),
+                jitter=float(opts['retry_jitter']),
+                max_attempts=int(opts['retry_max_attempts']),
+                timeout=getattr(self, 'timeout', 3600))
+        return self.policy
+
+    # -------------------------------------------------------------------------
+    def retryable(self, err):
+        """
+        DBI_abstract: Return True if *err*, raised by the database library, is
+        transient, so the operation is worth trying again. The database
+        specific classes know which errors those are.
+        """
+        return False
 
 
 # -----------------------------------------------------------------------------
@@ -94,7 +219,18 @@ class DBI(object):
 
     The DBI creates an internal object of the appropriate type and then
     forwards all method calls to it.
+
+    Class attribute op_counts tallies the select, insert, update, and delete
+    calls made through all DBI objects, keyed by (dbtype, operation) where
+    dbtype is 'crawler' or 'hpss'. See op_count(). Class attribute row_counts
+    likewise tallies the rows returned by selects and passed to inserts and
+    updates. See row_count(). Both are updated under _tally_lock, since a
+    background thread (see Checkable.CheckQueue) may be counting too.
     """
+    op_counts = {}
+    row_counts = {}
+    _tally_lock = threading.Lock()
+
     # -------------------------------------------------------------------------
     def __init__(self, *args, **kwargs):
         """
@@ -110,9 +246,9 @@ class DBI(object):
 
         The database-specific class should initialize a connection to the
         database, setting autocommit mode so that we don't have to commit every
-        little thing we do. If our operational mode ever becomes complicated
-        enough, we may need more control over commits but autocommit will do
-        for now.
+        little thing we do. Where a series of writes should be committed
+        together (or it's just too slow to commit each one), see transaction()
+        and batch().
         """
 
         # Valid arguments in kwargs are:
@@ -174,7 +310,11 @@ class DBI(object):
             okw['timeout'] = cfg.get_time(cfg_section, 'timeout', 3600)
 
         self.closed = False
-        if dbtype == 'sqlite':
+        self._txn_depth = 0
+        self.dbtype = kwargs['dbtype']
+        if dbtype == 'sqlite' and self.dbtype == 'hpss':
+            self._dbobj = DBIsqlite_db2(*args, **okw)
+        elif dbtype == 'sqlite':
             self._dbobj = DBIsqlite(*args, **okw)
         elif dbtype == 'mysql':
             self._dbobj = DBImysql(*args, **okw)
@@ -208,6 +348,50 @@ class DBI(object):
             raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
         return self._dbobj.alter(**kwargs)
 
+    # -------------------------------------------------------------------------
+    def batch(self, payload, *args, **kwargs):
+        """
+        DBI: Call *payload*(*args, **kwargs) in a transaction (see
+        transaction()) and return what it returns. If the database reports a
+        deadlock or a lock wait timeout, the transaction is rolled back and
+        run again after a pause, until the retry policy gives up (see
+        DBI_abstract.retry()). So *payload* should not do anything outside the
+        database that would matter if it were done twice.
+
+        Inside another transaction, *payload* is simply called, since part of
+        a transaction can't be run again on its own.
+        """
+        if self.closed:
+            raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
+        if self._txn_depth:
+            return payload(*args, **kwargs)
+
+        # ---------------------------------------------------------------------
+        def attempt():
+            """
+            Run the payload once in its own transaction
+            """
+            with self.transaction():
+                return payload(*args, **kwargs)
+
+        return self._dbobj.retry(DBIerror, attempt,
+                                 retryable=self._dbobj.lock_conflict)
+
+    # -------------------------------------------------------------------------
+    def in_transaction(self):
+        """
+        DBI: Return True inside the with statement of transaction() (or
+        batch()), where what we write can still be rolled back
+        """
+        return 0 < self._txn_depth
+
+    # -------------------------------------------------------------------------
+    def prefix(self, tabname):
+        """
+        DBI: Return *tabname* with the table prefix for this connection on it
+        """
+        return self._dbobj.prefix(tabname)
+
     # -------------------------------------------------------------------------
     def table_exists(self, **kwargs):
         """
@@ -259,7 +443,9 @@ class DBI(object):
         """
         if self.closed:
             raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
-        return self._dbobj.delete(**kwargs)
+        self.tally('delete')
+        with self.timer('delete', kwargs):
+            return self._dbobj.delete(**kwargs)
 
     # -------------------------------------------------------------------------
     def describe(self, **kwargs):
@@ -287,7 +473,10 @@ class DBI(object):
         """
         if self.closed:
             raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
-        return self._dbobj.insert(**kwargs)
+        data = kwargs.get('data', [])
+        self.tally('insert', len(data) if type(data) == list else 0)
+        with self.timer('insert', kwargs):
+            return self._dbobj.insert(**kwargs)
 
     # -------------------------------------------------------------------------
     def select(self, **kwargs):
@@ -307,7 +496,100 @@ class DBI(object):
         """
         if self.closed:
             raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
-        return self._dbobj.select(**kwargs)
+        with self.timer('select', kwargs):
+            rval = self._dbobj.select(**kwargs)
+        self.tally('select', len(rval))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def tally(self, operation, rows=0):
+        """
+        DBI: Count an operation in op_counts and the *rows* it handled in
+        row_counts
+        """
+        key = (self.dbtype, operation)
+        with DBI._tally_lock:
+            DBI.op_counts[key] = DBI.op_counts.get(key, 0) + 1
+            DBI.row_counts[key] = DBI.row_counts.get(key, 0) + rows
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def op_count(cls, dbtype=None, operation=None):
+        """
+        DBI: Return the number of operations counted so far, optionally only
+        those against *dbtype* ('crawler' or 'hpss') and/or of the kind named
+        by *operation* ('select', 'insert', 'update', 'upsert', or 'delete')
+        """
+        return sum([n for ((dbt, op), n) in cls.op_counts.items()
+                    if dbtype in (None, dbt) and operation in (None, op)])
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def row_count(cls, dbtype=None, operation=None):
+        """
+        DBI: Return the number of rows counted so far, optionally only those
+        for *dbtype* and/or *operation* as with op_count()
+        """
+        return sum([n for ((dbt, op), n) in cls.row_counts.items()
+                    if dbtype in (None, dbt) and operation in (None, op)])
+
+    # -------------------------------------------------------------------------
+    def timer(self, operation, kwargs):
+        """
+        DBI: Return a context that times *operation* on the table(s) named in
+        *kwargs* in the database latency metric. Joins are labeled with their
+        table names, without aliases, separated by commas.
+        """
+        table = kwargs.get('table', '')
+        if type(table) == list:
+            table = ",".join([x.split()[0] for x in table])
+        else:
+            table = str(table)
+        return metrics.timer('hpssic_db_query_seconds', dbtype=self.dbtype,
+                             table=table, operation=operation)
+
+    # -------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        DBI: Return a context in which the operations on this object make up
+        one transaction, committed when the with statement finishes, or rolled
+        back if it raises an exception:
+
+            with db.transaction():
+                db.insert(table='frontier', fields=['path'], data=subdirs)
+                db.delete(table='frontier', where='rowid = ?', data=(rowid,))
+
+        Besides making the writes all or nothing, this saves a commit (and a
+        sync to disk) per statement, or, on sqlite, per row of an insert or
+        update with several rows of data. A transaction started inside
+        another one simply becomes part of it.
+        """
+        if self.closed:
+            raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
+        if self._txn_depth:
+            self._txn_depth += 1
+            try:
+                yield self
+            finally:
+                self._txn_depth -= 1
+            return
+
+        self._dbobj.begin()
+        self._txn_depth = 1
+        try:
+            yield self
+            self._dbobj.commit()
+        except:
+            # raise the exception that got us here, not one from rollback()
+            (etype, evalue, etb) = sys.exc_info()
+            try:
+                self._dbobj.rollback()
+            except DBIerror:
+                pass
+            raise etype, evalue, etb
+        finally:
+            self._txn_depth = 0
 
     # -------------------------------------------------------------------------
     def update(self, **kwargs):
@@ -317,7 +599,35 @@ class DBI(object):
         """
         if self.closed:
             raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
-        return self._dbobj.update(**kwargs)
+        data = kwargs.get('data', [])
+        self.tally('update', len(data) if type(data) == list else 0)
+        with self.timer('update', kwargs):
+            return self._dbobj.update(**kwargs)
+
+    # -------------------------------------------------------------------------
+    def upsert(self, **kwargs):
+        """
+        DBI: Insert rows into the table, updating the rows whose keys are
+        already there instead. Fields is a list of field names and data is a
+        list of tuples, as for insert(). Key_fields lists the fields that
+        identify a row. Update_fields lists the fields to set in rows that are
+        already there -- by default, all the fields not in key_fields. With
+        update_fields=[], rows already there are left alone.
+
+        If the table has a primary key or unique index on exactly the
+        key_fields, this is one statement (INSERT ... ON CONFLICT on sqlite
+        3.24.0 and later, INSERT ... ON DUPLICATE KEY UPDATE on mysql). If
+        not, it is an update of the rows that are there followed by an insert
+        of the ones that aren't. On mysql, a table made before its text
+        columns in unique keys were created as varbinary (see
+        mysql_columns()) has no such key and gets the second treatment.
+        """
+        if self.closed:
+            raise DBIerror(MSG.db_closed, dbname=self._dbobj.dbname)
+        data = kwargs.get('data', [])
+        self.tally('upsert', len(data) if type(data) == list else 0)
+        with self.timer('upsert', kwargs):
+            return self._dbobj.upsert(**kwargs)
 
 
 # -----------------------------------------------------------------------------
@@ -343,6 +653,42 @@ class DBIerror(Exception):
 
 # -----------------------------------------------------------------------------
 class DBIsqlite(DBI_abstract):
+    """
+    DBIsqlite: Interface to an sqlite database file. The connection can be
+    tuned with these options in the configuration section for the database:
+
+        sqlite_profile       'fast' or 'safe' -- see profiles below
+        sqlite_busy_timeout  how long to wait for another connection to
+                             release a lock before giving an error (default
+                             5 seconds)
+        sqlite_journal_mode, sqlite_synchronous, sqlite_cache_size,
+        sqlite_mmap_size, sqlite_temp_store
+                             override the profile's setting of the pragma
+
+    Both profiles use write-ahead logging, which lets the report tools read
+    while cv and the crawler write. 'safe' still syncs every commit to disk.
+    'fast' syncs only at checkpoints, so a power failure can lose the last
+    few commits (but not corrupt the database), and it trades memory for
+    fewer reads. WAL needs the database on a local file system, not NFS.
+    Without sqlite_profile, sqlite's defaults are left alone.
+    """
+    backend = 'sqlite'
+    # INSERT ... ON CONFLICT came in with sqlite 3.24.0
+    on_conflict = sqlite3.sqlite_version_info >= (3, 24, 0)
+    pragma_list = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+                   'temp_store']
+    profiles = {'fast': {'journal_mode': 'wal',
+                         'synchronous': 'normal',
+                         'cache_size': '-65536',
+                         'mmap_size': '268435456',
+                         'temp_store': 'memory'},
+                'safe': {'journal_mode': 'wal',
+                         'synchronous': 'full',
+                         'cache_size': '-16384',
+                         'mmap_size': '0',
+                         'temp_store': 'default'},
+                }
+
     # -------------------------------------------------------------------------
     def __init__(self, *args, **kwargs):
         """
@@ -360,14 +706,25 @@ class DBIsqlite(DBI_abstract):
 
         if self.tbl_prefix != '':
             self.tbl_prefix = self.tbl_prefix.rstrip('_') + '_'
+        cfg = getattr(self, 'cfg', None)
+        if not hasattr(self, 'timeout'):
+            self.timeout = 3600
+        busy = 5
+        if cfg is not None:
+            busy = cfg.get_time(self.cfg_section, 'sqlite_busy_timeout', busy)
         try:
-            self.dbh = sqlite3.connect(self.dbname)
+            self.dbh = sqlite3.connect(self.dbname, timeout=busy)
             # set autocommit mode
             self.dbh.isolation_level = None
             self.table_exists(table="sqlite_master")
         except sqlite3.Error as e:
             raise DBIerror(''.join(e.args), dbname=self.dbname)
 
+        # switching to WAL needs a moment with no one else writing
+        for (name, value) in self.pragmas(cfg):
+            self.retry(sqlite3.Error, self.dbh.execute,
+                       "pragma %s = %s" % (name, value))
+
     # -------------------------------------------------------------------------
     def __repr__(self):
         """
@@ -383,6 +740,32 @@ class DBIsqlite(DBI_abstract):
         """
         raise DBIerror(''.join(err.args), dbname=self.dbname)
 
+    # -------------------------------------------------------------------------
+    def pragmas(self, cfg):
+        """
+        DBIsqlite: Return the (name, value) pragmas to set on the connection
+        according to the sqlite_* options in *cfg* (see the class docstring)
+        """
+        if cfg is None:
+            return []
+        profile = cfg.get_d(self.cfg_section, 'sqlite_profile', '')
+        if profile == '':
+            settings = {}
+        elif profile in self.profiles:
+            settings = dict(self.profiles[profile])
+        else:
+            raise DBIerror(MSG.sqlite_profile_S % profile, dbname=self.dbname)
+
+        for name in self.pragma_list:
+            value = cfg.get_d(self.cfg_section, 'sqlite_' + name, '')
+            if value != '':
+                settings[name] = value
+        for (name, value) in settings.items():
+            if not re.match(r"^-?\w+$", value):
+                raise DBIerror(MSG.sqlite_pragma_SS % (name, value),
+                               dbname=self.dbname)
+        return [(x, settings[x]) for x in self.pragma_list if x in settings]
+
     # -------------------------------------------------------------------------
     def alter(self, table='', addcol=None, dropcol=None, pos=None):
         """
@@ -654,7 +1037,7 @@ class DBIsqlite(DBI_abstract):
                 c.execute(cmd, data)
             else:
                 c.execute(cmd)
-            rv = c.fetchall()
+            rv = self.fetch(c)
             c.close()
             return rv
         # Translate any sqlite3 errors to DBIerror
@@ -662,6 +1045,14 @@ class DBIsqlite(DBI_abstract):
             raise DBIerror(''.join(e.args),
                            dbname=self.dbname)
 
+    # -------------------------------------------------------------------------
+    def fetch(self, cursor):
+        """
+        DBIsqlite: Return the rows from a select that has been run on
+        *cursor*
+        """
+        return cursor.fetchall()
+
     # -------------------------------------------------------------------------
     def table_exists(self, table=''):
         """
@@ -730,10 +1121,266 @@ class DBIsqlite(DBI_abstract):
             raise DBIerror(''.join(e.args),
                            dbname=self.dbname)
 
+    # -------------------------------------------------------------------------
+    def unique_key(self, table, fields):
+        """
+        DBIsqlite: Return True if *table* has a primary key or unique index on
+        exactly the columns in *fields*
+        """
+        want = sorted(fields)
+        tname = self.prefix(table)
+        try:
+            c = self.dbh.cursor()
+            c.execute("pragma table_info(%s)" % tname)
+            if want == sorted([x[1] for x in c.fetchall() if x[5]]):
+                return True
+            c.execute("pragma index_list(%s)" % tname)
+            for idx in [x[1] for x in c.fetchall() if x[2]]:
+                c.execute("pragma index_info(%s)" % idx)
+                if want == sorted([x[2] for x in c.fetchall()]):
+                    return True
+            c.close()
+        except sqlite3.Error as e:
+            raise DBIerror(''.join(e.args), dbname=self.dbname)
+        return False
+
+    # -------------------------------------------------------------------------
+    def upsert(self, table='', key_fields=[], fields=[], update_fields=None,
+               data=[]):
+        """
+        DBIsqlite: See DBI.upsert()
+        """
+        self.upsert_check(table, key_fields, fields, update_fields, data)
+        if update_fields is None:
+            update_fields = [x for x in fields if x not in key_fields]
+
+        try:
+            c = self.dbh.cursor()
+            if self.on_conflict and self.unique_key(table, key_fields):
+                cmd = ("insert into %s(%s) " % (self.prefix(table),
+                                                ",".join(fields)) +
+                       "values (%s) " % ",".join(["?"] * len(fields)) +
+                       "on conflict(%s) " % ",".join(key_fields))
+                if update_fields:
+                    cmd += "do update set " + ",".join(["%s=excluded.%s" %
+                                                        (x, x) for x in
+                                                        update_fields])
+                else:
+                    cmd += "do nothing"
+                c.executemany(cmd, data)
+            else:
+                self.upsert_emulate(c, self.prefix(table), key_fields, fields,
+                                    update_fields, data, '?')
+            c.close()
+        except sqlite3.Error as e:
+            raise DBIerror(''.join(e.args), dbname=self.dbname)
+
+    # -------------------------------------------------------------------------
+    def begin(self):
+        """
+        DBIsqlite: Start a transaction (see DBI.transaction()). Taking the
+        write lock now rather than at the first write keeps two transactions
+        from each reading and then deadlocking when they both want to write.
+        If another writer holds the lock past the busy timeout, we back off
+        and try again (see retryable()).
+        """
+        self.retry(sqlite3.Error, self.dbh.execute, "begin immediate")
+
+    # -------------------------------------------------------------------------
+    def commit(self):
+        """
+        DBIsqlite: Commit the transaction in progress. Without WAL, the
+        commit has to wait for readers to finish, so it may have to back off
+        and try again like begin().
+        """
+        self.retry(sqlite3.Error, self.dbh.execute, "commit")
+
+    # -------------------------------------------------------------------------
+    def lock_conflict(self, err):
+        """
+        DBIsqlite: See DBI_abstract.lock_conflict(). When another connection
+        holds the lock longer than the busy timeout, sqlite says "database is
+        locked" (or "database table is locked").
+        """
+        return "is locked" in err.value
+
+    # -------------------------------------------------------------------------
+    def retryable(self, err):
+        """
+        DBIsqlite: See DBI_abstract.retryable(). Another connection holding a
+        lock we need past the busy timeout is worth waiting out.
+        """
+        return (isinstance(err, sqlite3.OperationalError) and
+                "is locked" in ''.join(err.args))
+
+    # -------------------------------------------------------------------------
+    def rollback(self):
+        """
+        DBIsqlite: Roll back the transaction in progress
+        """
+        try:
+            self.dbh.execute("rollback")
+        except sqlite3.Error as e:
+            raise DBIerror(''.join(e.args), dbname=self.dbname)
+
+
+# -----------------------------------------------------------------------------
+class DBIsqlite_db2(DBIsqlite):
+    """
+    DBIsqlite_db2: Stands in for DBIdb2 when the HPSS tables are in an sqlite
+    database (see db2sim.py). Like DB2, it's read only, it takes a list of
+    tables to join, and it returns each row as a dict keyed by upper case
+    column name, with columns that are not named (like 'count(*)') keyed by
+    their position ('1', '2', ...).
+    """
+    cfg_section = HPSS_SECTION
+
+    # -------------------------------------------------------------------------
+    def __init__(self, *args, **kwargs):
+        """
+        DBIsqlite_db2: See DBI.__init__(). The table prefix is the DB2 schema
+        name, which sqlite has no use for, so prefix() strips it off. The
+        sqlite_* options come from the dbi-hpss section.
+        """
+        super(DBIsqlite_db2, self).__init__(*args, **kwargs)
+        if self.tbl_prefix != '':
+            self.tbl_prefix = self.tbl_prefix.rstrip('_') + '.'
+        self.dbh.text_factory = str
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        DBIsqlite_db2: See DBI.__repr__()
+        """
+        rv = "DBIsqlite_db2(dbname='%s')" % self.dbname
+        return rv
+
+    # -------------------------------------------------------------------------
+    def prefix(self, tabname):
+        """
+        DBIsqlite_db2: Drop the schema name ('hpss.') or the '@' from the
+        front of *tabname*
+        """
+        if tabname.startswith('@'):
+            return tabname[1:]
+
+        (schema, dot, name) = tabname.partition('.')
+        if dot and ' ' not in schema:
+            return name
+        return tabname
+
+    # -------------------------------------------------------------------------
+    def alter(self, table='', addcol=None, dropcol=None, pos=None):
+        """
+        DBIsqlite_db2: See DBIdb2.alter()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "ALTER")
+
+    # -------------------------------------------------------------------------
+    def create(self, table='', fields=[]):
+        """
+        DBIsqlite_db2: See DBIdb2.create()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "CREATE")
+
+    # -------------------------------------------------------------------------
+    def delete(self, **kwargs):
+        """
+        DBIsqlite_db2: See DBIdb2.delete()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "DELETE")
+
+    # -------------------------------------------------------------------------
+    def drop(self, table=''):
+        """
+        DBIsqlite_db2: See DBIdb2.drop()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "DROP")
+
+    # -------------------------------------------------------------------------
+    def fetch(self, cursor):
+        """
+        DBIsqlite_db2: Return the rows on *cursor* as DB2 would, as dicts.
+        Blobs (bitfile ids) come back as strings.
+        """
+        keys = []
+        for (idx, desc) in enumerate(cursor.description):
+            if re.match(r"^\w+$", desc[0]):
+                keys.append(desc[0].upper())
+            else:
+                keys.append(str(idx + 1))
+
+        rval = []
+        for row in cursor.fetchall():
+            rval.append(dict(zip(keys, [str(x) if type(x) == buffer else x
+                                        for x in row])))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def insert(self, table='', ignore=False, fields=[], data=[]):
+        """
+        DBIsqlite_db2: See DBIdb2.insert()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "INSERT")
+
+    # -------------------------------------------------------------------------
+    def select(self,
+               table='',
+               fields=[],
+               where='',
+               data=(),
+               groupby='',
+               orderby='',
+               limit=None):
+        """
+        DBIsqlite_db2: See DBIdb2.select(). Raw bitfile ids in *data* are
+        passed to sqlite as buffers so they will match the blobs in the
+        database.
+        """
+        if type(table) == list and table != []:
+            table = ",".join([self.prefix(x) for x in table])
+        if type(data) == tuple:
+            data = tuple([buffer(x) if type(x) == str and
+                          not all(c in string.printable for c in x) else x
+                          for x in data])
+        return super(DBIsqlite_db2, self).select(table=table,
+                                                 fields=fields,
+                                                 where=where,
+                                                 data=data,
+                                                 groupby=groupby,
+                                                 orderby=orderby,
+                                                 limit=limit)
+
+    # -------------------------------------------------------------------------
+    def update(self, table='', where='', fields=[], data=[]):
+        """
+        DBIsqlite_db2: See DBIdb2.update()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "UPDATE")
+
+    # -------------------------------------------------------------------------
+    def upsert(self, **kwargs):
+        """
+        DBIsqlite_db2: See DBIdb2.upsert()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "UPSERT")
+
+    # -------------------------------------------------------------------------
+    def begin(self):
+        """
+        DBIsqlite_db2: See DBIdb2.begin()
+        """
+        raise DBIerror(MSG.db2_unsupported_S % "TRANSACTION")
+
 
 if mysql_available:
     # -------------------------------------------------------------------------
     class DBImysql(DBI_abstract):
+        backend = 'mysql'
+        upsert_from = 'from dual '
+        # ER_TOO_LONG_KEY, "Specified key was too long"
+        key_too_long = 1071
+
         # ---------------------------------------------------------------------
         def __init__(self, *args, **kwargs):
             """
@@ -778,20 +1425,23 @@ if mysql_available:
         # ---------------------------------------------------------------------
         def err_handler(self, err):
             """
-            DBImysql: Error handler. If this returns, it should be called in a
-            loop to retry operations that are having transient failures.
+            DBImysql: Error handler. Convert *err* into a DBIerror.
             """
             if isinstance(err, mysql_exc.ProgrammingError):
                 raise DBIerror(str(err), dbname=self.dbname)
-            elif 1 < len(err.args) and err.args[0] in [1047, 2003]:
-                print("RETRY")
-                if not hasattr(self, 'sleeptime'):
-                    self.sleeptime = 0.1
-                time.sleep(self.sleeptime)
-                self.sleeptime = min(2*self.sleeptime, 10.0)
             else:
                 raise DBIerror("%d: %s" % err.args, dbname=self.dbname)
 
+        # ---------------------------------------------------------------------
+        def retryable(self, err):
+            """
+            DBImysql: See DBI_abstract.retryable(). Errors 1047 (unknown
+            command, while the server is starting up) and 2003 (can't connect)
+            are transient.
+            """
+            return (not isinstance(err, mysql_exc.ProgrammingError) and
+                    1 < len(err.args) and err.args[0] in [1047, 2003])
+
         # ---------------------------------------------------------------------
         def alter(self, table='', addcol=None, dropcol=None, pos=None):
             """
@@ -864,15 +1514,20 @@ if mysql_available:
                 raise DBIerror("On create(), table name must not be empty",
                                dbname=self.dbname)
 
-            # Construct and run the create statement
-            mysql_f = [x.replace('autoincrement', 'auto_increment')
-                       for x in fields]
+            # Construct and run the create statement. Where InnoDB can only
+            # index 767 bytes of a key (COMPACT or REDUNDANT rows, or
+            # innodb_large_prefix off), the keys on path are too long, so
+            # the table is made without them and upsert() emulates.
+            cmd = "create table %s(%%s) engine = innodb" % self.prefix(table)
             try:
-                cmd = ("create table %s(" % self.prefix(table) +
-                       ", ".join(mysql_f) +
-                       ") engine = innodb")
                 c = self.dbh.cursor()
-                c.execute(cmd)
+                try:
+                    c.execute(cmd % ", ".join(mysql_columns(fields)))
+                except mysql_exc.Error as e:
+                    if e.args[0] != self.key_too_long:
+                        raise
+                    c.execute(cmd % ", ".join(mysql_columns(fields,
+                                                            keys=False)))
 
             # Convert any db specific error into a DBIerror
             except mysql_exc.Error as e:
@@ -1175,10 +1830,101 @@ if mysql_available:
             except mysql_exc.Error as e:
                 self.err_handler(e)
 
+        # ---------------------------------------------------------------------
+        def unique_key(self, table, fields):
+            """
+            DBImysql: Return True if *table* has a primary key or unique index
+            on exactly the columns in *fields*
+            """
+            keys = {}
+            try:
+                c = self.dbh.cursor()
+                c.execute("show index from %s" % self.prefix(table))
+                for row in c.fetchall():
+                    if row[1] == 0:
+                        keys.setdefault(row[2], []).append(row[4])
+                c.close()
+            except mysql_exc.Error as e:
+                self.err_handler(e)
+            return sorted(fields) in [sorted(x) for x in keys.values()]
+
+        # ---------------------------------------------------------------------
+        def upsert(self, table='', key_fields=[], fields=[],
+                   update_fields=None, data=[]):
+            """
+            DBImysql: See DBI.upsert()
+            """
+            self.upsert_check(table, key_fields, fields, update_fields, data)
+            if update_fields is None:
+                update_fields = [x for x in fields if x not in key_fields]
+
+            try:
+                c = self.dbh.cursor()
+                if self.unique_key(table, key_fields):
+                    # with nothing to update, set a key field to itself so
+                    # the row is left alone
+                    sets = update_fields or key_fields[0:1]
+                    cmd = ("insert into %s(%s) " % (self.prefix(table),
+                                                    ",".join(fields)) +
+                           "values (%s) " % ",".join(["%s"] * len(fields)) +
+                           "on duplicate key update " +
+                           ",".join(["%s=values(%s)" % (x, x) for x in sets]))
+                    c.executemany(cmd, data)
+                else:
+                    self.upsert_emulate(c, self.prefix(table), key_fields,
+                                        fields, update_fields, data, '%s')
+                c.close()
+            except mysql_exc.Error as e:
+                self.err_handler(e)
+
+        # ---------------------------------------------------------------------
+        def begin(self):
+            """
+            DBImysql: Start a transaction (see DBI.transaction()). Autocommit
+            resumes when it is committed or rolled back.
+            """
+            try:
+                self.dbh.query("start transaction")
+            except mysql_exc.Error as e:
+                self.err_handler(e)
+
+        # ---------------------------------------------------------------------
+        def commit(self):
+            """
+            DBImysql: Commit the transaction in progress
+            """
+            try:
+                self.dbh.commit()
+            except mysql_exc.Error as e:
+                self.err_handler(e)
+
+        # ---------------------------------------------------------------------
+        def lock_conflict(self, err):
+            """
+            DBImysql: See DBI_abstract.lock_conflict(). InnoDB reports error
+            1213 when it picks a transaction to lose a deadlock and 1205 when
+            one times out waiting for a lock.
+            """
+            return err.value.split(':')[0] in ['1205', '1213']
+
+        # ---------------------------------------------------------------------
+        def rollback(self):
+            """
+            DBImysql: Roll back the transaction in progress
+            """
+            try:
+                self.dbh.rollback()
+            except mysql_exc.Error as e:
+                self.err_handler(e)
+
 
 if db2_available:
     # -----------------------------------------------------------------------------
     class DBIdb2(DBI_abstract):
+        backend = 'db2'
+        cfg_section = HPSS_SECTION
+        retry_max_delay = 60.0
+
         # -------------------------------------------------------------------------
         def __init__(self, *args, **kwargs):
             """
@@ -1244,16 +1990,20 @@ if db2_available:
                 raise DBIerror(message, dbname=self.dbname)
             elif isinstance(err, ibm_db_dbi.Error):
                 raise DBIerror("%d: %s" % err.args, dbname=self.dbname)
-            elif 'A communication error has been detected' in str(err):
-                if not hasattr(self, 'sleeptime'):
-                    self.sleeptime = 0.1
-                CrawlConfig.log('Riding out DB2 outage -- sleeping %f seconds'
-                                % self.sleeptime)
-                time.sleep(self.sleeptime)
-                self.sleeptime = min(2*self.sleeptime, 60.0)
             else:
                 raise DBIerror(str(err), dbname=self.dbname)
 
+        # ---------------------------------------------------------------------
+        def retryable(self, err):
+            """
+            DBIdb2: See DBI_abstract.retryable(). A communication error means
+            DB2 is down or out of reach. We ride out the outage, backing off
+            to a retry a minute (see retry_max_delay) so we don't add to the
+            load on the HPSS metadata server as it comes back.
+            """
+            return (not isinstance(err, ibm_db_dbi.Error) and
+                    'A communication error has been detected' in str(err))
+
         # ---------------------------------------------------------------------
         def __recognized_exception__(self, exc):
             """
@@ -1454,6 +2204,20 @@ if db2_available:
             """
             raise DBIerror(MSG.db2_unsupported_S % "UPDATE")
 
+        # ---------------------------------------------------------------------
+        def upsert(self, **kwargs):
+            """
+            DBIdb2: See DBI.upsert()
+            """
+            raise DBIerror(MSG.db2_unsupported_S % "UPSERT")
+
+        # ---------------------------------------------------------------------
+        def begin(self):
+            """
+            DBIdb2: See DBI.transaction()
+            """
+            raise DBIerror(MSG.db2_unsupported_S % "TRANSACTION")
+
         # ---------------------------------------------------------------------
         @classmethod
         def hexstr(cls, bfid):
@@ -1505,3 +2269,43 @@ def db_context(**kw):
     rval = DBI(**kw)
     yield rval
     rval.close()
+
+
+# -----------------------------------------------------------------------------
+def mysql_columns(fields, keys=True):
+    """
+    Return the column definitions in *fields* as MySQL wants them. MySQL
+    can't put a unique key on a text column without limiting the key to a
+    prefix of it, which would make paths that only differ past the prefix
+    collide. So a text column that is part of a unique key (path in
+    checkables and digests) is made varbinary(1023), long enough for any HPSS
+    path and short enough to index where InnoDB allows 3072 byte keys, and
+    the key is kept, so upsert() can use it. Being binary, the column is
+    compared byte for byte, so matching on it is case sensitive, as HPSS
+    paths are.
+
+    With *keys* False, for servers limited to 767 byte keys (see
+    DBImysql.create()), the text columns are left alone and the unique keys
+    that include them are left out instead.
+    """
+    keyed = set()
+    text = set()
+    for fdef in fields:
+        words = fdef.split()
+        if words[1:2] == ['text']:
+            text.add(words[0])
+        match = re.match(r"unique\s*\((.*)\)$", fdef.strip())
+        if match:
+            keyed.update([x.strip() for x in match.group(1).split(',')])
+
+    rval = []
+    for fdef in fields:
+        words = fdef.split()
+        match = re.match(r"unique\s*\((.*)\)$", fdef.strip())
+        if (match and not keys and
+                text & set([x.strip() for x in match.group(1).split(',')])):
+            continue
+        if keys and words[0] in keyed and words[0] in text:
+            fdef = " ".join([words[0], 'varbinary(1023)'] + words[2:])
+        rval.append(fdef.replace('autoincrement', 'auto_increment'))
+    return rval
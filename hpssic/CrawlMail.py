@@ -1,10 +1,11 @@
 import CrawlConfig
-import email.mime.text
 import messages as MSG
-import smtplib
 import socket
 import util
 
+email_text = util.LazyModule('email.mime.text')
+smtplib = util.LazyModule('smtplib')
+
 
 # -----------------------------------------------------------------------------
 def send(to='', subj='', msg='', sender='', cfg=None):
@@ -25,9 +26,9 @@ def send(to='', subj='', msg='', sender='', cfg=None):
 
     # Prepare a message object based on *msg*
     if msg:
-        payload = email.mime.text.MIMEText(msg)
+        payload = email_text.MIMEText(msg)
     else:
-        payload = email.mime.text.MIMEText(MSG.empty_message)
+        payload = email_text.MIMEText(MSG.empty_message)
 
     # Set the recipient address(es) based on *to*
     default_recip = 'hpssic@mailinator.com'
@@ -2,16 +2,29 @@
 Plugin class for HPSS integrity crawler
 
 This module contains the CrawlPlugin class.
+
+A plugin module is only imported again when its source has changed since we
+last imported it (or the plugin directory has moved), so reloading the
+configuration doesn't recompile every plugin or throw away what the plugin
+modules have cached. The crawler also checks the plugins' sources each time
+around its loop and reloads a plugin whose source has changed.
 """
 import copy
 import CrawlConfig
 import crawl_sublib
+import hashlib
+import metrics
+import os
 import re
 import shutil
 import sys
 import time
 import util
 
+# For each plugin module we've imported, keyed by module name, the stamp (see
+# source_stamp()) of its source file at the time
+sources = {}
+
 
 # -----------------------------------------------------------------------------
 class CrawlPlugin(object):
@@ -45,14 +58,23 @@ class CrawlPlugin(object):
     # -------------------------------------------------------------------------
     def fire(self):
         """
-        Run the plugin.
+        Run the plugin and record the firing, with measurements of what it
+        cost, in the history table and the metrics.
         """
         if self.firable:
             CrawlConfig.log("%s: firing" % self.name)
             # sys.modules[self.modname].main(self.cfg)
+            before = crawl_sublib.perf_sample()
             errors = self.plugin.main(self.cfg)
             self.last_fired = time.time()
-            crawl_sublib.record_history(self.name, self.last_fired, errors)
+            perf = crawl_sublib.perf_since(before)
+            crawl_sublib.record_history(self.name, self.last_fired, errors,
+                                        perf)
+            metrics.observe('hpssic_plugin_fire_seconds', perf['wall'],
+                            plugin=self.name)
+            metrics.inc('hpssic_items_total', perf['items'], plugin=self.name)
+            metrics.inc('hpssic_plugin_errors_total', errors or 0,
+                        plugin=self.name)
         elif self.cfg.getboolean('crawler', 'verbose'):
             CrawlConfig.log("%s: not firable" % self.name)
             self.last_fired = time.time()
@@ -85,19 +107,48 @@ class CrawlPlugin(object):
             sys.path.insert(0, self.plugin_dir)
 
         self.modname = self.cfg.get(self.name, 'module')
+        self.load_module(old_pdir)
 
-        if self.modname in sys.modules.keys():
-            filename = re.sub("\.pyc?", ".pyc",
-                              sys.modules[self.modname].__file__)
-            util.conditional_rm(filename)
+    # -------------------------------------------------------------------------
+    def load_module(self, old_pdir=None):
+        """
+        Import the plugin module, or reuse the one already imported if we
+        imported it, its source hasn't changed since, and the plugin
+        directory is still *old_pdir*. Return True if the module was
+        imported, False if it was reused.
+        """
+        loaded = self.loaded_module()
+        if (loaded is not None and
+                self.plugin_dir == old_pdir and
+                not self.source_changed(loaded)):
+            self.plugin = loaded
+            return False
 
-            del sys.modules[self.modname]
+        if loaded is not None:
+            # the .pyc may be newer than an edit made within the same second,
+            # so make sure the source is compiled again
+            filename = re.sub("\.pyc?$", ".pyc", loaded.__file__)
+            util.conditional_rm(filename)
+            del sys.modules[loaded.__name__]
 
         try:
             self.plugin = __import__(self.modname)
         except ImportError:
             H = __import__('hpssic.plugins.' + self.modname)
             self.plugin = getattr(H.plugins, self.modname)
+        sources[self.plugin.__name__] = source_stamp(self.plugin)
+        return True
+
+    # -------------------------------------------------------------------------
+    def loaded_module(self):
+        """
+        Return the plugin module if it has already been imported, from the
+        plugin directory or from hpssic.plugins, or None if it hasn't
+        """
+        for name in [self.modname, 'hpssic.plugins.' + self.modname]:
+            if sys.modules.get(name) is not None:
+                return sys.modules[name]
+        return None
 
     # -------------------------------------------------------------------------
     def load_history(self, *args):
@@ -118,6 +169,27 @@ class CrawlPlugin(object):
         """
         self.init_cfg_data(cfg=cfg)
 
+    # -------------------------------------------------------------------------
+    def source_changed(self, module=None):
+        """
+        Return True if the source of the plugin module (or *module*) is not
+        what it was when we imported it. The file is only read again if its
+        modification time or size has changed, and a file that was touched
+        without changing its content isn't counted as changed.
+        """
+        module = module or self.plugin
+        try:
+            before = sources[module.__name__]
+        except KeyError:
+            return True
+        now = source_stamp(module, before)
+        if now == before:
+            return False
+        changed = (now is None or before is None or now[2] != before[2])
+        if not changed:
+            sources[module.__name__] = now
+        return changed
+
     # -------------------------------------------------------------------------
     def time_to_fire(self):
         """
@@ -125,3 +197,23 @@ class CrawlPlugin(object):
         fire.
         """
         return(self.frequency < (time.time() - self.last_fired))
+
+
+# -----------------------------------------------------------------------------
+def source_stamp(module, previous=None):
+    """
+    Return (mtime, size, md5 hexdigest) for the source file of *module*, or
+    None if it can't be read. If the mtime and size match those in
+    *previous*, the file isn't read and *previous* is returned.
+    """
+    path = re.sub("\.py[co]$", ".py", module.__file__)
+    try:
+        st = os.stat(path)
+        if previous is not None and previous[:2] == (st.st_mtime,
+                                                     st.st_size):
+            return previous
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+    return (st.st_mtime, st.st_size, digest)
@@ -144,14 +144,14 @@ class Dimension(object):
         try:
             # populate the p_sum structure
             rows = self.db.select(table='checkables',
-                                  fields=["count(path)", dimname],
+                                  fields=["count(*)", dimname],
                                   where='type="f" and last_check <> 0',
                                   groupby=dimname)
             self.p_sum = self._compute_dict(rows)
 
             # populate the s_sum structure
             rows = self.db.select(table='checkables',
-                                  fields=["count(path)", dimname],
+                                  fields=["count(*)", dimname],
                                   where='type = "f" and checksum = 1',
                                   groupby=dimname)
             self.s_sum = self._compute_dict(rows)
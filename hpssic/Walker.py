@@ -0,0 +1,473 @@
+"""
+Breadth-first discovery of the HPSS namespace
+
+The cv plugin discovers the namespace as a side effect of checking
+directories, one directory per operation. A Walker lists directories in bulk
+instead: it starts from the dataroot, runs 'ls -P' on several directories per
+command over several hsi sessions at once (see hpss.HSImux), and persists
+what it finds in batches.
+
+Directories waiting to be listed are kept in the frontier table, so a walk
+that is interrupted picks up where it left off the next time it runs.
+
+An NSWalker gets the same information from the DB2 NSOBJECT and BITFILE
+tables, stepping through ranges of object ids and rebuilding paths from the
+parent ids, so discovery runs at database speed and doesn't use hsi at all.
+Which one make_walker() hands back depends on the cv/discovery setting.
+"""
+import Checkable
+import CrawlConfig
+import CrawlDBI
+import dbschem
+import dirtab
+import hpss
+import os
+import tcc_lib
+import time
+import util
+
+
+# -----------------------------------------------------------------------------
+def make_walker(**kwargs):
+    """
+    Return a Walker or an NSWalker, depending on whether the cv/discovery
+    option in the configuration is 'hsi' (the default) or 'db2'.
+    """
+    cfg = CrawlConfig.add_config()
+    discovery = cfg.get_d('cv', 'discovery', 'hsi')
+    if discovery == 'hsi':
+        rval = Walker(**kwargs)
+    elif discovery == 'db2':
+        rval = NSWalker(**kwargs)
+    else:
+        raise StandardError("cv/discovery must be 'hsi' or 'db2', not '%s'" %
+                            discovery)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+class Walker(object):
+    """
+    Walk the HPSS namespace breadth first, recording every file and directory
+    found in the checkables table.
+    """
+    settable_attrl = ['roots', 'sessions', 'batch', 'timeout']
+    # the cv option limiting the directories listed per firing
+    limit_option = 'walk_limit'
+    default_limit = 1000
+
+    # -------------------------------------------------------------------------
+    def __init__(self, *args, **kwargs):
+        """
+        Set up a walker. Anything not specified in the arguments is taken from
+        the cv section of the configuration:
+
+            roots     list of paths to start from  (dataroot)
+            sessions  how many hsi sessions to use (walk_sessions, 4)
+            batch     directories per 'ls -P'      (walk_batch, 10)
+            timeout   seconds to wait for output   (walk_timeout, 300)
+        """
+        for k in kwargs:
+            if k not in self.settable_attrl:
+                raise StandardError("Attribute %s is invalid for Walker" % k)
+            setattr(self, k, kwargs[k])
+
+        cfg = CrawlConfig.add_config()
+        if not hasattr(self, 'roots'):
+            self.roots = util.csv_list(cfg.get_d('cv', 'dataroot', '/'))
+        if not hasattr(self, 'sessions'):
+            self.sessions = int(cfg.get_d('cv', 'walk_sessions', '4'))
+        if not hasattr(self, 'batch'):
+            self.batch = int(cfg.get_d('cv', 'walk_batch', '10'))
+        if not hasattr(self, 'timeout'):
+            self.timeout = cfg.get_time('cv', 'walk_timeout', 300)
+
+        # statistics for the most recent run()
+        self.listed = 0
+        self.found = 0
+        self.errors = 0
+        self.commands = 0
+        self.sessions_opened = 0
+
+        self.last_rowid = 0
+        # (rowid, path) for directories to list again one at a time
+        self.retry = []
+
+    # -------------------------------------------------------------------------
+    def pending(self):
+        """
+        Return the number of directories in the frontier waiting to be listed
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        if not db.table_exists(table='frontier'):
+            rval = 0
+        else:
+            rows = db.select(table='frontier', fields=['count(*)'])
+            rval = rows[0][0]
+        db.close()
+        return rval
+
+    # -------------------------------------------------------------------------
+    def run(self, limit=0, until=None):
+        """
+        List directories from the frontier, adding the subdirectories found
+        to it, until the frontier is empty, *limit* directories have been
+        listed (if 0 < limit), or time.time() passes *until* (if not None).
+        Return the number of directories listed.
+
+        When the listing of a batch fails, each of its directories is listed
+        again by itself, so one bad directory doesn't hold up the rest.
+        Directories whose own listing fails stay in the frontier to be tried
+        again on the next run.
+        """
+        self.seed()
+        self.listed = self.found = self.errors = self.commands = 0
+        self.last_rowid = 0
+        self.retry = []
+
+        mux = hpss.HSImux(sessions=self.sessions, timeout=self.timeout)
+        inflight = {}
+        taken = 0
+        try:
+            while True:
+                while len(inflight) < 2 * self.sessions:
+                    if self.retry:
+                        dirl = [self.retry.pop(0)]
+                    elif ((limit <= 0 or taken < limit) and
+                          (until is None or time.time() < until)):
+                        count = self.batch
+                        if 0 < limit:
+                            count = min(count, limit - taken)
+                        dirl = self.take(count)
+                        if not dirl:
+                            break
+                        taken += len(dirl)
+                    else:
+                        break
+                    job = mux.lsP([path for (rowid, path) in dirl])
+                    inflight[job] = dirl
+                    self.commands += 1
+
+                if not inflight:
+                    break
+
+                for job in mux.poll(wait=1.0):
+                    if job in inflight:
+                        self.absorb(job, inflight.pop(job))
+        finally:
+            mux.quit()
+            self.sessions_opened = mux.opened
+
+        CrawlConfig.log("walk %s" % self.summary())
+        return self.listed
+
+    # -------------------------------------------------------------------------
+    def summary(self):
+        """
+        Describe what the most recent run() did
+        """
+        return ("listed %d directories (%d commands, %d hsi sessions), " %
+                (self.listed, self.commands, self.sessions_opened) +
+                "found %d items, %d errors, %d pending" %
+                (self.found, self.errors, self.pending()))
+
+    # -------------------------------------------------------------------------
+    def absorb(self, job, dirl):
+        """
+        Record what an 'ls -P' job found: persist the entries, queue the new
+        subdirectories, mark the listed directories checked, and remove them
+        from the frontier. If a job listing several directories failed, queue
+        them to be listed one at a time.
+        """
+        rsp = job.result()
+        if job.error:
+            CrawlConfig.log("walk: ls -P %s failed (%s)" %
+                            (" ".join([path for (rowid, path) in dirl]),
+                             job.error))
+            if 1 < len(dirl):
+                self.retry.extend(dirl)
+            else:
+                self.errors += 1
+            return
+
+        rlist = Checkable.CheckableRecord.from_lsp(rsp)
+        if rlist:
+            Checkable.Checkable.persist_records(rlist)
+
+        now = time.time()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        subdirs = [(r.path,) for r in rlist if r.type == 'd']
+        rowids = [rowid for (rowid, path) in dirl]
+        with db.transaction():
+            if subdirs:
+                db.insert(table='frontier', fields=['path'], data=subdirs)
+            dirtab.update(db,
+                          fields=['last_check'],
+                          where='path = ?',
+                          data=[(now, path) for (rowid, path) in dirl])
+            db.delete(table='frontier',
+                      where='rowid in (%s)' % ", ".join(["?"] * len(rowids)),
+                      data=tuple(rowids))
+        db.close()
+
+        self.listed += len(dirl)
+        self.found += len(rlist)
+
+    # -------------------------------------------------------------------------
+    def seed(self):
+        """
+        Make sure the frontier table exists. If it is empty, start a new walk
+        from the roots, making sure they are in the checkables table.
+        """
+        dbschem.make_table('frontier')
+        if 0 < self.pending():
+            return
+
+        Checkable.Checkable.ex_nihilo(dataroot=self.roots)
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.insert(table='frontier',
+                  fields=['path'],
+                  data=[(root,) for root in self.roots])
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def take(self, count):
+        """
+        Return up to *count* (rowid, path) tuples from the frontier, oldest
+        first, skipping any we've already taken in this run
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='frontier',
+                         fields=['rowid', 'path'],
+                         where='rowid > ?',
+                         data=(self.last_rowid,),
+                         orderby='rowid',
+                         limit=count)
+        db.close()
+        if rows:
+            self.last_rowid = rows[-1][0]
+        return [tuple(x) for x in rows]
+
+
+# -----------------------------------------------------------------------------
+class NSWalker(object):
+    """
+    Discover the HPSS namespace from the DB2 NSOBJECT and BITFILE tables,
+    recording every file and directory under the roots in the checkables
+    table.
+    """
+    settable_attrl = ['roots', 'chunk']
+    # the cv option limiting the object ids scanned per firing
+    limit_option = 'nswalk_limit'
+    default_limit = 100000
+    cache_max = 100000
+
+    # values of NSOBJECT.TYPE
+    ns_file = 1
+    ns_directory = 2
+
+    # -------------------------------------------------------------------------
+    def __init__(self, *args, **kwargs):
+        """
+        Set up a walker. Anything not specified in the arguments is taken from
+        the cv section of the configuration:
+
+            roots     list of paths to record items under  (dataroot)
+            chunk     object ids to read per query          (walk_chunk, 10000)
+        """
+        for k in kwargs:
+            if k not in self.settable_attrl:
+                raise StandardError("Attribute %s is invalid for NSWalker" % k)
+            setattr(self, k, kwargs[k])
+
+        cfg = CrawlConfig.add_config()
+        if not hasattr(self, 'roots'):
+            self.roots = util.csv_list(cfg.get_d('cv', 'dataroot', '/'))
+        if not hasattr(self, 'chunk'):
+            self.chunk = int(cfg.get_d('cv', 'walk_chunk', '10000'))
+
+        # object id -> path for the directories we've seen
+        self.paths = {}
+
+        # statistics for the most recent run()
+        self.scanned = 0
+        self.found = 0
+        self.queries = 0
+
+    # -------------------------------------------------------------------------
+    def next_id(self):
+        """
+        Return the object id where the next range starts, from the nsdisc
+        table. When the last range recorded reached the end of NSOBJECT, start
+        a new pass from 1.
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rval = 1
+        if db.table_exists(table='nsdisc'):
+            rows = db.select(table='nsdisc',
+                             fields=['high_nsobj_id'],
+                             orderby='rowid desc',
+                             limit=1)
+            if rows:
+                rval = int(rows[0][0]) + 1
+        db.close()
+        if tcc_lib.highest_nsobject_id() < rval:
+            rval = 1
+        return rval
+
+    # -------------------------------------------------------------------------
+    def path_of(self, object_id, db):
+        """
+        Return the path of directory *object_id*, looking up whatever part of
+        its ancestry isn't in the cache in NSOBJECT, as
+        tcc_lib.get_bitfile_path() does. Return None if the object isn't
+        there.
+        """
+        chain = []
+        oid = object_id
+        while oid not in self.paths:
+            rows = db.select(table='nsobject',
+                             fields=['parent_id', 'name'],
+                             where='object_id = ?',
+                             data=(oid,))
+            self.queries += 1
+            if not rows:
+                return None
+            if rows[0]['NAME'] == '/':
+                self.paths[oid] = '/'
+                break
+            chain.append((oid, rows[0]['NAME']))
+            oid = rows[0]['PARENT_ID']
+
+        path = self.paths[oid]
+        for (oid, name) in reversed(chain):
+            path = os.path.join(path, name)
+            self.remember(oid, path)
+        return path
+
+    # -------------------------------------------------------------------------
+    def pending(self):
+        """
+        Return the number of object ids left to scan in the current pass
+        """
+        return max(0, tcc_lib.highest_nsobject_id() - self.next_id() + 1)
+
+    # -------------------------------------------------------------------------
+    def remember(self, object_id, path):
+        """
+        Cache the path of a directory. If the cache has gotten too big, start
+        it over -- the ancestors we need again are cheap to look up.
+        """
+        if self.cache_max <= len(self.paths):
+            self.paths = {}
+        self.paths[object_id] = path
+
+    # -------------------------------------------------------------------------
+    def run(self, limit=0, until=None):
+        """
+        Scan NSOBJECT one chunk of object ids at a time from where the last
+        run left off, recording what's found under the roots, until the end
+        of the table, *limit* object ids have been scanned (if 0 < limit), or
+        time.time() passes *until* (if not None). Each chunk is recorded in
+        the nsdisc table as it's finished. Return the number of object ids
+        scanned.
+        """
+        self.scanned = self.found = self.queries = 0
+        dbschem.make_table('nsdisc')
+        low = self.next_id()
+        high_id = tcc_lib.highest_nsobject_id()
+
+        hdb = CrawlDBI.DBI(dbtype='hpss', dbname='sub')
+        try:
+            while (low <= high_id and
+                   (limit <= 0 or self.scanned < limit) and
+                   (until is None or time.time() < until)):
+                count = self.chunk
+                if 0 < limit:
+                    count = min(count, limit - self.scanned)
+                rlist = self.scan(hdb, low, low + count)
+                if rlist:
+                    Checkable.Checkable.persist_records(rlist)
+
+                db = CrawlDBI.DBI(dbtype='crawler')
+                db.insert(table='nsdisc',
+                          fields=['check_time', 'low_nsobj_id',
+                                  'high_nsobj_id', 'found'],
+                          data=[(int(time.time()), low, low + count - 1,
+                                 len(rlist))])
+                db.close()
+
+                self.scanned += count
+                self.found += len(rlist)
+                low += count
+        finally:
+            hdb.close()
+
+        CrawlConfig.log("nswalk %s" % self.summary())
+        return self.scanned
+
+    # -------------------------------------------------------------------------
+    def scan(self, db, low, high):
+        """
+        Read the objects with ids from *low* up to (but not including) *high*
+        from NSOBJECT. Directories and files are told apart by the object
+        type. Files get their cos from BITFILE. Symbolic links, hard links,
+        and junctions are skipped. Return CheckableRecords for the ones under
+        the roots.
+        """
+        dirs = db.select(table='nsobject',
+                         fields=['object_id', 'parent_id', 'name'],
+                         where='type = ? and ' +
+                               '? <= object_id and object_id < ?',
+                         data=(self.ns_directory, low, high),
+                         orderby='object_id')
+        files = db.select(table=['nsobject A', 'bitfile B'],
+                          fields=['A.object_id', 'A.parent_id', 'A.name',
+                                  'B.bfattr_cos_id'],
+                          where='A.type = ? and A.bitfile_id = B.bfid and ' +
+                                '? <= A.object_id and A.object_id < ?',
+                          data=(self.ns_file, low, high))
+        self.queries += 2
+
+        rval = []
+        for (rows, ftype) in [(dirs, 'd'), (files, 'f')]:
+            for row in rows:
+                if row['NAME'] == '/':
+                    path = '/'
+                else:
+                    parent = self.path_of(row['PARENT_ID'], db)
+                    if parent is None:
+                        continue
+                    path = os.path.join(parent, row['NAME'])
+                if ftype == 'd':
+                    self.remember(row['OBJECT_ID'], path)
+                if not self.under_roots(path):
+                    continue
+                if ftype == 'd':
+                    rval.append(Checkable.CheckableRecord(path=path, type='d'))
+                else:
+                    cos = str(row['BFATTR_COS_ID'])
+                    rval.append(Checkable.CheckableRecord(path=path,
+                                                          type='f',
+                                                          cos=cos))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def summary(self):
+        """
+        Describe what the most recent run() did
+        """
+        return ("scanned %d object ids (%d queries), " %
+                (self.scanned, self.queries) +
+                "found %d items, %d pending" % (self.found, self.pending()))
+
+    # -------------------------------------------------------------------------
+    def under_roots(self, path):
+        """
+        Return True if *path* is one of the roots or below one of them
+        """
+        for root in self.roots:
+            if (path == root or root == '/' or
+                    path.startswith(root.rstrip('/') + '/')):
+                return True
+        return False
@@ -0,0 +1,587 @@
+"""
+Benchmarks for measuring the performance of crawler components offline
+"""
+import Checkable
+import CrawlConfig
+import CrawlDBI
+import db2sim
+import hsisim
+import mpra_lib
+import optparse
+import os
+import pdb
+import random
+import shutil
+import subprocess
+import sys
+import tcc_lib
+import tempfile
+import time
+import util
+
+# The command line programs, with the module and prefix each dispatches to,
+# and the modules none of them should load just to start up
+startup_programs = {'crawl': ('hpssic.crawl', 'crl'),
+                    'cv': ('hpssic.cv', 'cvv'),
+                    'html': ('hpssic.html', 'htmp'),
+                    'mpra': ('hpssic.mpra', 'mprf'),
+                    'rpt': ('hpssic.rpt', 'rptx'),
+                    'tcc': ('hpssic.tcc', 'tccp')}
+startup_heavy = ['BaseHTTPServer', 'MySQLdb', 'email.mime.text', 'ibm_db',
+                 'pexpect', 'pytest', 'smtplib']
+startup_budget = 0.5
+
+# What each startup probe runs in a fresh interpreter
+startup_script = """
+import StringIO
+import sys
+import time
+start = time.time()
+from hpssic import util
+import %(module)s
+sys.stdout = StringIO.StringIO()
+util.dispatch(modname='%(module)s', prefix='%(prefix)s',
+              args=['%(program)s', 'help', '%(subcmd)s'])
+sys.stdout = sys.__stdout__
+print(time.time() - start)
+print(' '.join([m for m in %(heavy)r if sys.modules.get(m)]))
+"""
+
+
+# -----------------------------------------------------------------------------
+def bch_cv(args):
+    """cv - run the cv plugin against the hsi simulator
+
+    usage: bench cv [-d] [-k] [-r <rounds>] [-o <ops>] [-s <shape>]
+                    [-l <latency>] [-m <mount>] [-e <errors>] [-H <hashed>]
+                    [-w]
+
+    Set up a scratch database and an hsi simulator (see hsisim.py) with a
+    namespace of the given shape (depth,fanout,files), then fire
+    cv_plugin.main() <rounds> times with <ops> operations each. For each
+    round, report the items checked per second, the hsi sessions opened and
+    commands run, and the database operations issued. With -w, each round
+    starts with a namespace walk. With -k, keep the scratch directory.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-e', '--errors',
+                 action='store', default='0', dest='errors',
+                 help='fraction of transfers that fail')
+    p.add_option('-H', '--hashed',
+                 action='store', default='0.5', dest='hashed',
+                 help='fraction of files with a checksum to begin with')
+    p.add_option('-k', '--keep',
+                 action='store_true', default=False, dest='keep',
+                 help='keep the scratch directory')
+    p.add_option('-l', '--latency',
+                 action='store', default='0', dest='latency',
+                 help='seconds per hsi command')
+    p.add_option('-m', '--mount',
+                 action='store', default='0', dest='mount',
+                 help='seconds per cartridge mount')
+    p.add_option('-o', '--operations',
+                 action='store', default=100, dest='operations', type='int',
+                 help='operations per round')
+    p.add_option('-r', '--rounds',
+                 action='store', default=3, dest='rounds', type='int',
+                 help='how many times to fire the plugin')
+    p.add_option('-s', '--shape',
+                 action='store', default='2,4,10', dest='shape',
+                 help='depth,fanout,files of the simulated namespace')
+    p.add_option('-w', '--walk',
+                 action='store_true', default=False, dest='walk',
+                 help='walk the namespace at the start of each round')
+    (o, a) = p.parse_args(args)
+
+    if o.debug:
+        pdb.set_trace()
+
+    scratch = tempfile.mkdtemp(prefix='bench_cv.')
+    try:
+        simenv = {'HSISIM_SHAPE': o.shape,
+                  'HSISIM_LATENCY': o.latency,
+                  'HSISIM_MOUNT': o.mount,
+                  'HSISIM_ERRORS': o.errors,
+                  'HSISIM_HASHED': o.hashed}
+        for stats in cv_rounds(scratch, o.rounds, o.operations,
+                               simenv=simenv, walk=o.walk):
+            report("round %d" % stats['round'], stats['items'],
+                   stats['elapsed'])
+            print("%-20s %10d hsi sessions %6d hsi commands %6d db ops" %
+                  ("", stats['sessions'], stats['commands'],
+                   stats['db_ops']))
+    finally:
+        if o.keep:
+            print("scratch directory: %s" % scratch)
+        else:
+            shutil.rmtree(scratch)
+
+
+# -----------------------------------------------------------------------------
+def cv_rounds(scratch, rounds, operations, simenv={}, walk=False):
+    """
+    Fire cv_plugin.main() *rounds* times against the hsi simulator, with the
+    database, logs, and simulator state in directory *scratch* and the
+    simulator settings in *simenv*. After each round, yield a dict of
+    statistics:
+
+        round     the round number (starting at 1)
+        elapsed   wall clock seconds
+        items     checkables checked
+        sessions  hsi sessions opened
+        commands  hsi commands run
+        db_ops    select/insert/update/delete calls made through CrawlDBI
+    """
+    from hpssic.plugins import cv_plugin
+
+    root = simenv.get('HSISIM_ROOT', '/sim')
+    state = os.path.join(scratch, 'sim')
+    os.makedirs(state)
+    env = dict(simenv)
+    env['HSISIM_ROOT'] = root
+    env['HSISIM_STATE'] = state
+    env['PATH'] = hsisim.install(scratch) + ":" + os.getenv('PATH', '')
+
+    cfg = CrawlConfig.add_config(close=True,
+                                 dct={'crawler':
+                                      {'plugin-dir': scratch,
+                                       'plugins': 'cv',
+                                       'logpath': os.path.join(scratch,
+                                                               'bench.log')},
+                                      'dbi-crawler':
+                                      {'dbtype': 'sqlite',
+                                       'dbname': os.path.join(scratch,
+                                                              'bench.db'),
+                                       'tbl_prefix': 'bench'},
+                                      'checksum-verifier':
+                                      {'fail_report': os.path.join(scratch,
+                                                                   'fails')},
+                                      'cv':
+                                      {'fire': 'no',
+                                       'module': 'cv_plugin',
+                                       'dataroot': root,
+                                       'odds': '1.0',
+                                       'operations': str(operations),
+                                       'reset_atime': 'yes',
+                                       'hash_algorithm': 'md5',
+                                       'walk': 'yes' if walk else 'no'}})
+
+    saved = dict([(k, os.environ.get(k)) for k in env])
+    os.environ.update(env)
+    try:
+        Checkable.Checkable.ex_nihilo(dataroot=root)
+        for rnd in range(1, rounds + 1):
+            simlog = os.path.join(state, 'log')
+            log_start = os.path.getsize(simlog) \
+                if os.path.exists(simlog) else 0
+            db_start = CrawlDBI.DBI.op_count()
+            start = time.time()
+            cv_plugin.main(cfg)
+            elapsed = time.time() - start
+            db_ops = CrawlDBI.DBI.op_count() - db_start
+
+            db = CrawlDBI.DBI(dbtype='crawler')
+            rows = db.select(table='checkables',
+                             fields=['count(*)'],
+                             where='? <= last_check',
+                             data=(start,))
+            db.close()
+
+            events = []
+            if os.path.exists(simlog):
+                f = open(simlog, 'r')
+                f.seek(log_start)
+                events = [x.split()[1] for x in f.readlines()]
+                f.close()
+
+            yield {'round': rnd,
+                   'elapsed': elapsed,
+                   'items': rows[0][0],
+                   'sessions': events.count('start'),
+                   'commands': len([x for x in events
+                                    if x not in ['start', 'quit']]),
+                   'db_ops': db_ops}
+    finally:
+        for k in saved:
+            if saved[k] is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = saved[k]
+
+
+# -----------------------------------------------------------------------------
+def bch_lsp(args):
+    """lsp - time parsing a synthetic 'ls -P' listing
+
+    usage: bench lsp [-d] [-n <lines>] [-c]
+
+    Generate an 'ls -P' listing with <lines> entries (default 1000000) and
+    report how long util.lsp_columns() takes to parse it. With -c, also time
+    parsing the same listing a line at a time with Checkable.fdparse() for
+    comparison.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-c', '--compare',
+                 action='store_true', default=False, dest='compare',
+                 help='also time the line at a time parser')
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-n', '--lines',
+                 action='store', default=1000000, dest='lines', type='int',
+                 help='how many entries to generate')
+    (o, a) = p.parse_args(args)
+
+    if o.debug:
+        pdb.set_trace()
+
+    text = lsp_synth(o.lines)
+
+    start = time.time()
+    cols = util.lsp_columns(text)
+    report("lsp_columns", len(cols['path']), time.time() - start)
+
+    if o.compare:
+        start = time.time()
+        rlist = []
+        for line in text.split("\n"):
+            new = Checkable.Checkable.fdparse(line, record=True)
+            if new is not None:
+                rlist.append(new)
+        report("fdparse", len(rlist), time.time() - start)
+
+
+# -----------------------------------------------------------------------------
+def lsp_synth(count, root='/bench'):
+    """
+    Return the text of an hsi 'ls -P' listing with *count* entries under
+    *root*. Every tenth entry is a directory, every seventh file is empty (no
+    cart), and every thirteenth file has two copies (two carts).
+    """
+    dfmt = "DIRECTORY\t       %s/dir%07d\r\n"
+    ffmt = ("FILE\t%s/file%07d\t %d\t %d\t   3962+%d\t %s\t 5081\t 0\t" +
+            " %d\t       03/14/2003\t  07:12:43\t 03/19/2012\t 13:09:50\r\n")
+    lines = ["ls -P %s\r\n" % root]
+    for idx in xrange(count):
+        if idx % 10 == 0:
+            lines.append(dfmt % (root, idx))
+            continue
+        if idx % 7 == 0:
+            (size, cart, copies) = (0, '        ', 1)
+        elif idx % 13 == 0:
+            (size, cart, copies) = (idx, 'X%05d,Y%05d' % (idx % 99991,
+                                                          idx % 99989), 2)
+        else:
+            (size, cart, copies) = (idx, 'X%05d' % (idx % 99991), 1)
+        lines.append(ffmt % (root, idx, size, size, idx, cart, copies))
+    return ''.join(lines)
+
+
+# -----------------------------------------------------------------------------
+def bch_mpra(args):
+    """mpra - time the mpra queries against a simulated DB2
+
+    usage: bench mpra [-d] [-k] [-f <files>] [-r <rounds>]
+
+    Generate an sqlite stand-in for the HPSS DB2 tables (see db2sim.py) with
+    about <files> files (default 100000), then <rounds> times, report how
+    long mpra_lib.age() takes to list the migration records and to count the
+    purge records, and how long mpra_lib.xplocks() takes to find the expired
+    purge locks. With -k, keep the scratch directory.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-f', '--files',
+                 action='store', default=100000, dest='files', type='int',
+                 help='how many files in the simulated namespace')
+    p.add_option('-k', '--keep',
+                 action='store_true', default=False, dest='keep',
+                 help='keep the scratch directory')
+    p.add_option('-r', '--rounds',
+                 action='store', default=3, dest='rounds', type='int',
+                 help='how many times to run each query')
+    (o, a) = p.parse_args(args)
+
+    if o.debug:
+        pdb.set_trace()
+
+    scratch = tempfile.mkdtemp(prefix='bench_mpra.')
+    try:
+        hpss_setup(scratch, o.files)
+        for rnd in range(1, o.rounds + 1):
+            for stats in mpra_runs(scratch):
+                report("%s %d" % (stats['label'], rnd), stats['items'],
+                       stats['elapsed'])
+    finally:
+        if o.keep:
+            print("scratch directory: %s" % scratch)
+        else:
+            shutil.rmtree(scratch)
+
+
+# -----------------------------------------------------------------------------
+def bch_startup(args):
+    """startup - time how long each command line subcommand takes to start
+
+    usage: bench startup [-d] [-r <rounds>] [-b <seconds>] [<program> ...]
+
+    For each subcommand of the named programs (default: crawl, cv, html,
+    mpra, rpt, and tcc), start a fresh python <rounds> times (default 5),
+    import the program's module and dispatch 'help <subcommand>' the way the
+    script in bin does, and report the best time. Subcommands slower than
+    <seconds> (default 0.5), or that load one of the modules in
+    startup_heavy (pexpect, pytest, smtplib, the database drivers, ...) just
+    to start, are flagged.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-b', '--budget',
+                 action='store', default=startup_budget, dest='budget',
+                 type='float',
+                 help='seconds a subcommand may take to start')
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-r', '--rounds',
+                 action='store', default=5, dest='rounds', type='int',
+                 help='how many times to start each subcommand')
+    (o, a) = p.parse_args(args)
+
+    if o.debug:
+        pdb.set_trace()
+
+    over = 0
+    for program in a or sorted(startup_programs.keys()):
+        for subcmd in startup_subcommands(program):
+            (elapsed, loaded) = startup_probe(program, subcmd, o.rounds)
+            flag = ''
+            if o.budget < elapsed or loaded:
+                over += 1
+                flag = ' '.join(['OVER'] + loaded)
+            print("%-20s %8.1f ms %s" % ("%s %s" % (program, subcmd),
+                                         elapsed * 1000.0, flag))
+    if over:
+        print("%d subcommands over budget" % over)
+
+
+# -----------------------------------------------------------------------------
+def startup_probe(program, subcmd, rounds=1):
+    """
+    Time starting *subcmd* of *program* in a fresh python *rounds* times (see
+    startup_script) and return the best time in seconds, along with a list of
+    the startup_heavy modules it loaded. The time covers our imports and the
+    dispatch, not the interpreter starting up, which we can't do anything
+    about.
+    """
+    (module, prefix) = startup_programs[program]
+    script = startup_script % {'module': module, 'prefix': prefix,
+                               'program': program, 'subcmd': subcmd,
+                               'heavy': startup_heavy}
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ':'.join([util.dirname(os.path.abspath(__file__), 2)] +
+                                 [x for x in [os.getenv('PYTHONPATH')] if x])
+    best = None
+    for rnd in range(rounds):
+        proc = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                stdout=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            raise util.HpssicError("%s %s failed to start" % (program, subcmd))
+        lines = out.split("\n")
+        elapsed = float(lines[0])
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, lines[1].split())
+
+
+# -----------------------------------------------------------------------------
+def startup_subcommands(program):
+    """
+    Return the subcommands *program* dispatches to, in order
+    """
+    (module, prefix) = startup_programs[program]
+    __import__(module)
+    return sorted([x[len(prefix) + 1:] for x in dir(sys.modules[module])
+                   if x.startswith(prefix + '_')])
+
+
+# -----------------------------------------------------------------------------
+def bch_tcc(args):
+    """tcc - run the tcc plugin against a simulated DB2
+
+    usage: bench tcc [-d] [-k] [-f <files>] [-r <rounds>] [-o <ops>]
+                     [-p <paths>]
+
+    Generate an sqlite stand-in for the HPSS DB2 tables (see db2sim.py) with
+    about <files> files (default 100000), then fire tcc_plugin.main() <rounds>
+    times with <ops> operations each. For each round, report the name space
+    objects checked per second and the selects issued against the stand-in.
+    Then report how long tcc_lib.get_bitfile_path() takes for <paths> bitfiles
+    picked at random. With -k, keep the scratch directory.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-f', '--files',
+                 action='store', default=100000, dest='files', type='int',
+                 help='how many files in the simulated namespace')
+    p.add_option('-k', '--keep',
+                 action='store_true', default=False, dest='keep',
+                 help='keep the scratch directory')
+    p.add_option('-o', '--operations',
+                 action='store', default=1000, dest='operations', type='int',
+                 help='operations per round')
+    p.add_option('-p', '--paths',
+                 action='store', default=1000, dest='paths', type='int',
+                 help='how many bitfile paths to look up')
+    p.add_option('-r', '--rounds',
+                 action='store', default=3, dest='rounds', type='int',
+                 help='how many times to fire the plugin')
+    (o, a) = p.parse_args(args)
+
+    if o.debug:
+        pdb.set_trace()
+
+    scratch = tempfile.mkdtemp(prefix='bench_tcc.')
+    try:
+        cfg = hpss_setup(scratch, o.files)
+        for stats in tcc_rounds(cfg, o.rounds, o.operations):
+            report("round %d" % stats['round'], stats['items'],
+                   stats['elapsed'])
+            print("%-20s %10d reported %6d db2 selects" %
+                  ("", stats['reported'], stats['db_ops']))
+
+        (count, elapsed) = bitfile_paths(o.paths)
+        report("get_bitfile_path", count, elapsed)
+    finally:
+        if o.keep:
+            print("scratch directory: %s" % scratch)
+        else:
+            shutil.rmtree(scratch)
+
+
+# -----------------------------------------------------------------------------
+def bitfile_paths(count, seed=0):
+    """
+    Look up the paths of *count* bitfiles chosen at random with
+    tcc_lib.get_bitfile_path(). Return the number looked up and the time it
+    took.
+    """
+    db = CrawlDBI.DBI(dbtype='hpss', dbname='sub')
+    rows = db.select(table='bitfile', fields=['bfid'])
+    db.close()
+    bfl = random.Random(seed).sample([x['BFID'] for x in rows],
+                                     min(count, len(rows)))
+
+    start = time.time()
+    for bfid in bfl:
+        tcc_lib.get_bitfile_path(bfid)
+    return (len(bfl), time.time() - start)
+
+
+# -----------------------------------------------------------------------------
+def hpss_setup(scratch, files, short=0.01):
+    """
+    Generate a DB2 stand-in with about *files* files (see db2sim.generate())
+    in directory *scratch* and set up a configuration pointing the crawler at
+    it, with a scratch crawler database and report files alongside. Return
+    the configuration.
+    """
+    hpss_db = os.path.join(scratch, 'hpss.db')
+    db2sim.generate(hpss_db, files=files, short=short)
+    cfg = CrawlConfig.add_config(close=True,
+                                 dct={'crawler':
+                                      {'logpath': os.path.join(scratch,
+                                                               'bench.log')},
+                                      'dbi-crawler':
+                                      {'dbtype': 'sqlite',
+                                       'dbname': os.path.join(scratch,
+                                                              'bench.db'),
+                                       'tbl_prefix': 'bench'},
+                                      'dbi-hpss':
+                                      {'dbtype': 'sqlite',
+                                       'cfg': hpss_db,
+                                       'sub': hpss_db,
+                                       'tbl_prefix': 'hpss'},
+                                      'mpra':
+                                      {'lock_duration': '30',
+                                       'report_file': os.path.join(scratch,
+                                                                   'mpra')},
+                                      'tcc':
+                                      {'table_name': 'tcc_data',
+                                       'verbose': 'no',
+                                       'report_file': os.path.join(scratch,
+                                                                   'tcc')}})
+    return cfg
+
+
+# -----------------------------------------------------------------------------
+def mpra_runs(scratch):
+    """
+    Run the mpra queries once each against the DB2 stand-in set up by
+    hpss_setup(), writing the reports in *scratch*. For each, yield a dict
+    with its label, the records reported, and the elapsed wall clock seconds.
+    """
+    output = os.path.join(scratch, 'mpra')
+    start = time.time()
+    items = mpra_lib.age('migr', start=0, end=int(start), output=output)
+    yield {'label': 'age migr', 'items': items,
+           'elapsed': time.time() - start}
+
+    start = time.time()
+    items = mpra_lib.age('purge', start=0, end=int(start), count=True,
+                         output=output)
+    yield {'label': 'age purge count', 'items': items,
+           'elapsed': time.time() - start}
+
+    start = time.time()
+    items = mpra_lib.xplocks(output=output)
+    yield {'label': 'xplocks', 'items': items,
+           'elapsed': time.time() - start}
+
+
+# -----------------------------------------------------------------------------
+def tcc_rounds(cfg, rounds, operations):
+    """
+    Fire tcc_plugin.main() *rounds* times with *operations* operations against
+    the DB2 stand-in set up by hpss_setup(). After each round, yield a dict of
+    statistics:
+
+        round     the round number (starting at 1)
+        elapsed   wall clock seconds
+        items     name space objects checked
+        reported  bitfiles reported with the wrong number of copies
+        db_ops    selects issued against the stand-in
+    """
+    from hpssic.plugins import tcc_plugin
+
+    cfg.set('tcc', 'operations', str(operations))
+    for rnd in range(1, rounds + 1):
+        first = tcc_lib.get_next_nsobj_id(cfg)
+        db_start = CrawlDBI.DBI.op_count(dbtype='hpss')
+        start = time.time()
+        reported = tcc_plugin.main(cfg)
+        elapsed = time.time() - start
+        db_ops = CrawlDBI.DBI.op_count(dbtype='hpss') - db_start
+        last = tcc_lib.get_next_nsobj_id(cfg)
+        yield {'round': rnd,
+               'elapsed': elapsed,
+               'items': last - first if first < last else operations,
+               'reported': reported,
+               'db_ops': db_ops}
+
+
+# -----------------------------------------------------------------------------
+def report(label, count, elapsed):
+    """
+    Print a line showing how many items were handled in how much time and the
+    resulting rate
+    """
+    rate = count / elapsed if 0 < elapsed else 0.0
+    print("%-20s %10d items %10.3f s %12.1f items/s" %
+          (label, count, elapsed, rate))
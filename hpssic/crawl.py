@@ -5,6 +5,7 @@ import atexit
 import base64
 import copy
 import crawl_lib
+import crawl_sublib
 import CrawlConfig
 import CrawlDBI
 import CrawlMail
@@ -15,12 +16,12 @@ import dbschem
 import getpass
 import glob
 import messages as MSG
+import metrics
 import optparse
 import os
 import pdb
 import shutil
 import sys
-import testhelp
 import time
 from datetime import timedelta as td
 import traceback as tb
@@ -175,8 +176,11 @@ def crl_history(argv):
     --load {all,cv,mpra,tcc,rpt}
         Load the history table from listed plugin tables, log file
 
-    --show
-        Read the history table and report its contents.
+    --show {raw,count,byday,byweek,bymonth,perf}
+        Read the history table and report its contents. With 'perf', report
+        percentiles of each plugin's per-firing measurements (wall and cpu
+        seconds, hsi commands and their latency, database operations and rows,
+        items handled, and peak memory).
 
     --reset
         Drop the history table.
@@ -565,7 +569,7 @@ def history_show(rptfmt):
         func = globals()[funcname]
         func()
     else:
-        raise U.HpssicError(history_invalid_format_S % rptfmt)
+        raise U.HpssicError(MSG.history_invalid_format_S % rptfmt)
 
 
 # ------------------------------------------------------------------------------
@@ -649,6 +653,29 @@ def history_show_count():
     print("  %10s: %8d" % ("Total", total))
 
 
+# ------------------------------------------------------------------------------
+def history_show_perf():
+    """
+    For each plugin, report the 50th, 90th, and 99th percentiles and the
+    maximum of each measurement taken when it fired
+    """
+    crawl_sublib.history_upgrade()
+    rows = crawl_lib.retrieve_history(fields=['plugin'] +
+                                      crawl_sublib.perf_fields,
+                                      where='wall is not null')
+    fmt = "%-10s %-9s %6s %11s %11s %11s %11s"
+    print(fmt % ("Plugin", "Measure", "Fires", "p50", "p90", "p99", "max"))
+    for plugin in sorted(set([r[0] for r in rows])):
+        prows = [r for r in rows if r[0] == plugin]
+        for (idx, field) in enumerate(crawl_sublib.perf_fields):
+            vals = [r[idx + 1] for r in prows]
+            print(fmt % (plugin, field, len(vals),
+                         "%.2f" % U.percentile(vals, 50),
+                         "%.2f" % U.percentile(vals, 90),
+                         "%.2f" % U.percentile(vals, 99),
+                         "%.2f" % max(vals)))
+
+
 # ------------------------------------------------------------------------------
 def history_show_raw():
     """
@@ -995,6 +1022,11 @@ class CrawlDaemon(daemon.Daemon):
                         # self.dlog(hb_msg)
                         CrawlConfig.log(hb_msg)
 
+                    #
+                    # Write or serve the metrics if they're configured
+                    #
+                    metrics.export(self.cfg)
+
                     # CrawlConfig.log("check for config changes")
                     #
                     # If config file has changed, reload it.
@@ -1005,6 +1037,15 @@ class CrawlDaemon(daemon.Daemon):
                         self.cfg = CrawlConfig.get_config(reset=True)
                         break
 
+                    #
+                    # Reload any plugin whose source has changed
+                    #
+                    for p in plugin_d.values():
+                        if p.source_changed():
+                            CrawlConfig.log("plugin %s changed, reloading" %
+                                            p.name)
+                            p.reload(self.cfg)
+
                     # CrawlConfig.log("check for exit signal")
                     #
                     # Check for the exit signal
@@ -1,16 +1,96 @@
 import CrawlDBI
 import dbschem
+import hpss
+import resource
+import time
+
+
+perf_fields = ['wall', 'cpu', 'hsi_cmds', 'hsi_secs', 'db_ops', 'db_rows',
+               'items', 'maxrss']
+
+
+# -----------------------------------------------------------------------------
+def count_items(count=1):
+    """
+    Add *count* to the items handled by the plugin firing in progress. Plugins
+    call this so the history shows how much work each firing got done.
+    """
+    try:
+        count_items.total += count
+    except AttributeError:
+        count_items.total = count
+
+
+# -----------------------------------------------------------------------------
+def history_upgrade():
+    """
+    Add any of the measurement columns that are missing from a history table
+    created before they were defined
+    """
+    for fdef in dbschem.tdefs['history']['fields']:
+        if fdef.split()[0] in perf_fields:
+            dbschem.alter_table(table='history', addcol=fdef)
 
 
 # -----------------------------------------------------------------------------
-def record_history(name, when, errors):
+def perf_sample():
     """
-    Record a plugin name and runtime in the history table
+    Return a dict of the running totals we measure plugin firings with. For
+    each field in perf_fields:
+
+        wall      clock time
+        cpu       user + system cpu seconds used by this process
+        hsi_cmds  hsi commands sent (see hpss.HSI.send())
+        hsi_secs  seconds spent waiting for hsi commands to finish
+        db_ops    database operations (see CrawlDBI.DBI.op_count())
+        db_rows   rows selected, inserted, or updated
+        items     items handled by plugins (see count_items())
+        maxrss    peak resident set size of this process (KB)
+    """
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    rval = {'wall': time.time(),
+            'cpu': ru.ru_utime + ru.ru_stime,
+            'hsi_cmds': hpss.HSI.cmd_count,
+            'hsi_secs': hpss.HSI.cmd_secs,
+            'db_ops': CrawlDBI.DBI.op_count(),
+            'db_rows': CrawlDBI.DBI.row_count(),
+            'items': getattr(count_items, 'total', 0),
+            'maxrss': ru.ru_maxrss}
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def perf_since(before):
+    """
+    Return how much each of the totals in perf_sample() has grown since sample
+    *before* was taken. Since maxrss is a high water mark, it is reported as
+    is.
     """
+    after = perf_sample()
+    rval = dict([(k, after[k] - before[k]) for k in perf_fields])
+    rval['maxrss'] = after['maxrss']
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def record_history(name, when, errors, perf=None):
+    """
+    Record a plugin name and runtime in the history table, with the
+    measurements from perf_since() in *perf* if they're available
+    """
+    fields = ['plugin', 'runtime', 'errors']
+    data = [name, when, errors]
+    if perf is not None:
+        fields += perf_fields
+        data += [perf[x] for x in perf_fields]
+
     db = CrawlDBI.DBI(dbtype='crawler')
     if not db.table_exists(table='history'):
         dbschem.make_table('history')
-    db.insert(table='history',
-              fields=['plugin', 'runtime', 'errors'],
-              data=[(name, when, errors)])
+    try:
+        db.insert(table='history', fields=fields, data=[tuple(data)])
+    except CrawlDBI.DBIerror:
+        # The table may predate the measurement columns
+        history_upgrade()
+        db.insert(table='history', fields=fields, data=[tuple(data)])
     db.close()
@@ -6,16 +6,16 @@ import cv_lib
 import cv_sublib
 import dbschem
 import Dimension
-import hpss
+import dirtab
 import messages as MSG
 import optparse
 import os
 import pdb
-import pexpect
 from pprint import pprint
 import re
 import time
 import util as U
+import Walker
 
 prefix = "cvv"
 H = None
@@ -157,18 +157,18 @@ def cvv_popcart(argv):
         pdb.set_trace()
 
     if 0 < len(a):
-        b = ["'%s'" % x for x in a]
-        where = "path in (" + ','.join(b) + ")"
+        cond = []
     else:
-        where = "type = 'f'"
+        cond = ["type = 'f'"]
 
     if o.check:
-        where += " and last_check <> 0"
+        cond.append("last_check <> 0")
     if o.skip:
-        where += " and cart is null"
+        cond.append("cart is null")
+    where = " and ".join(cond)
 
     # get the list of paths and carts from the database
-    pc_l = cv_lib.prep_popcart(where, o.limit)
+    pc_l = cv_lib.prep_popcart(where, o.limit, paths=a)
 
     # generate an updated list from hsi
     upc_l = populate_cart_field(pc_l, o.limit, o.dryrun, o.verbose)
@@ -186,26 +186,19 @@ def cvv_popcart(argv):
 def populate_cart_field(pc_l, limit, dryrun, verbose):
     """
     We get a list of paths and carts. The cart values may be empty or None. We
-    talk to hsi to collect cart info for each of the paths, building a return
-    list. If 0 < limit, the list returned is limit elements long. If dryrun, we
-    just report what would happen without actually doing anything.
-
-    In the array of tuples returned, the cart value comes first so we can pass
-    the list to a db.update() call that is going to match on path.
+    collect cart info for all of the paths from hsi with batched 'ls -P'
+    commands on one session (see cv_lib.lsp_carts()) and return a list of
+    (path, db cart, hsi cart) tuples for the paths whose carts differ. If 0 <
+    limit, the list returned is no more than limit elements long. If dryrun,
+    we just report what would happen without actually doing anything.
     """
-    h = hpss.HSI(verbose=True)
+    carts = cv_lib.lsp_carts([path for (path, dcart) in pc_l])
     rval = []
     for path, dcart in pc_l:
-        info = h.lsP(path)
-        hcart = info.split("\t")[5].strip()
+        hcart = carts.get(path) or ''
         if dcart != hcart:
-            if 0 < limit:
-                try:
-                    populate_cart_field._count += 1
-                except AttributeError:
-                    populate_cart_field._count = 1
-                if 0 < limit and limit < populate_cart_field._count:
-                    return True
+            if 0 < limit and limit <= len(rval):
+                break
             rval.append((path, dcart, hcart))
         if verbose:
             if 60 < len(path):
@@ -215,7 +208,6 @@ def populate_cart_field(pc_l, limit, dryrun, verbose):
 
             print("%-60s %-8s %-10s" % (dpath, dcart, hcart))
 
-    h.quit()
     return rval
 
 
@@ -263,6 +255,41 @@ def cvv_report(argv):
     print dim['ttypes'].report()
 
 
+# -----------------------------------------------------------------------------
+def cvv_normalize(argv):
+    """normalize - convert checkables to the normalized path layout
+
+    usage: cv normalize [-d] [-c <chunk>]
+
+    Store each directory in checkables once, in the directories table, with
+    the rows of checkables pointing at their directories (see dirtab.py). The
+    rows keep their rowids. An interrupted conversion picks up where it left
+    off when this is run again. Once it's done, set path_layout = normalized
+    in the [cv] section.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-c', '--chunk',
+                 action='store', default=10000, dest='chunk', type='int',
+                 help='rows to copy per transaction')
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    try:
+        (o, a) = p.parse_args(argv)
+    except SystemExit:
+        return
+
+    if o.debug:
+        pdb.set_trace()
+
+    Checkable.checkables_upgrade()
+    start = time.time()
+    count = dirtab.migrate(chunk=o.chunk)
+    print("%d rows converted in %.1f seconds" % (count, time.time() - start))
+    if not dirtab.normalized():
+        print("Set path_layout = normalized in the [cv] section to use them")
+
+
 # -----------------------------------------------------------------------------
 def cvv_nulltest(argv):
     """nulltest - how do NULL values show up when queried?
@@ -513,16 +540,8 @@ def cvv_ttype_lookup(argv):
     if o.debug:
         pdb.set_trace()
 
-    clist = []
-    for path in a:
-        rows = cv_lib.tpop_select_by_paths(a)
-        clist.extend(rows)
-
-    rpt = {}
-    for r in clist:
-        path = r[0]
-        media = cv_lib.ttype_lookup(path)
-        rpt[path] = media
+    clist = cv_lib.tpop_select_by_paths(a)
+    rpt = cv_lib.ttype_bulk_lookup([(r[0], None) for r in clist])
 
     pwid = max([len(x) for x in rpt.keys()])
     for path in rpt.keys():
@@ -600,10 +619,9 @@ def cvv_ttype_populate(argv):
 
     # -------------------------------------------------------------------------
     def verify_update(path):
-        rows = db.select(table="checkables",
-                         fields=["path", "cart", "ttypes", "last_check"],
-                         where="path = ?",
-                         data=(path,))
+        rows = dirtab.select_paths(db,
+                                   ["path", "cart", "ttypes", "last_check"],
+                                   [path])
         report_updated_row_list(rows)
 
     p = optparse.OptionParser()
@@ -647,9 +665,14 @@ def cvv_ttype_populate(argv):
     if len(candlist) == 0:
         raise SystemExit("No rows found to be populated")
 
-    # okay, we have a list of candidates to work on. Take them one at a time. A
-    # single file can be spread across multiple tapes so cv_lib.ttype_lookup
-    # will return a list of cart, media type tuples.
+    # okay, we have a list of candidates to work on. Look up the carts and
+    # media types for all of them at once (one hsi session for the carts we
+    # don't have, one PVLPV query, one read of tape_types). A single file can
+    # be spread across multiple tapes so we get a list of cart, media type
+    # tuples for each path.
+    if 0 < o.limit:
+        candlist = candlist[:o.limit]
+    media = cv_lib.ttype_bulk_lookup([(row[0], row[3]) for row in candlist])
     scount = pcount = 0
     data = []
     for row in candlist:
@@ -658,7 +681,7 @@ def cvv_ttype_populate(argv):
             print("%-60s %s %-5s %-10s %d" % row)
 
         # get a list of cartnames and media type descriptions
-        cml = cv_lib.ttype_lookup(path, cart)
+        cml = media[path]
         if cml is None:
             print("No cart/media type found for %s" % path)
             scount += 1
@@ -732,6 +755,66 @@ def cvv_ttype_table(argv):
         tape_types_populate(hpssroot)
 
 
+# -----------------------------------------------------------------------------
+def cvv_walk(argv):
+    """walk - discover the HPSS namespace from dataroot
+
+    usage: cv walk [-d] [-l <limit>] [-s <sessions>] [-b <batch>] [-r]
+
+    With cv/discovery = hsi (the default), list directories breadth first
+    starting from the dataroot, several directories per 'ls -P' (-b) and
+    several hsi sessions at a time (-s). The directories still to be listed
+    are kept in the frontier table, so an interrupted walk resumes where it
+    left off. The limit is a count of directories.
+
+    With cv/discovery = db2, read NSOBJECT and BITFILE in chunks of -b object
+    ids. The ranges done are kept in the nsdisc table. The limit is a count
+    of object ids.
+
+    Either way, everything found under dataroot is recorded in the
+    checkables table. With -r/--restart, start over from the beginning.
+    """
+    p = optparse.OptionParser()
+    p.add_option('-b', '--batch',
+                 action='store', default=None, dest='batch', type='int',
+                 help='directories per ls -P or object ids per query')
+    p.add_option('-d', '--debug',
+                 action='store_true', default=False, dest='debug',
+                 help='run the debugger')
+    p.add_option('-l', '--limit',
+                 action='store', default=0, dest='limit', type='int',
+                 help='max directories or object ids to scan')
+    p.add_option('-r', '--restart',
+                 action='store_true', default=False, dest='restart',
+                 help='start a new walk from the beginning')
+    p.add_option('-s', '--sessions',
+                 action='store', default=None, dest='sessions', type='int',
+                 help='number of hsi sessions')
+    try:
+        (o, a) = p.parse_args(argv)
+    except SystemExit:
+        return
+
+    if o.debug:
+        pdb.set_trace()
+
+    cfg = CrawlConfig.add_config()
+    db2 = cfg.get_d('cv', 'discovery', 'hsi') == 'db2'
+    kw = {}
+    if o.batch is not None:
+        kw['chunk' if db2 else 'batch'] = o.batch
+    if o.sessions is not None and not db2:
+        kw['sessions'] = o.sessions
+
+    if o.restart:
+        dbschem.drop_table(table='nsdisc' if db2 else 'frontier')
+
+    w = Walker.make_walker(**kw)
+    start = time.time()
+    w.run(limit=o.limit)
+    print("%s in %.1f seconds" % (w.summary(), time.time() - start))
+
+
 # -----------------------------------------------------------------------------
 def tape_types_populate(hpssroot):
     """
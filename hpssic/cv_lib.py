@@ -1,5 +1,7 @@
+import CrawlConfig
 import CrawlDBI
 import dbschem
+import dirtab
 import hpss
 import messages as MSG
 import pdb
@@ -17,7 +19,7 @@ def get_checksum_count():
     db = CrawlDBI.DBI(dbtype="crawler")
     if db.table_exists(table="checkables"):
         rows = db.select(table='checkables',
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where="checksum = 1")
         checksums = rows[0][0]
     else:
@@ -51,9 +53,7 @@ def lookup_checksum_by_path(path):
     """
 
     db = CrawlDBI.DBI(dbtype="crawler")
-    rows = db.select(table="checkables",
-                     fields=["checksum"],
-                     where="path = '%s'" % path)
+    rows = dirtab.select_paths(db, ["checksum"], [path])
     if 0 == len(rows):
         rval = -1
     elif 1 == len(rows):
@@ -69,11 +69,10 @@ def lookup_nulls():
     Return records that contain NULL values
     """
     db = CrawlDBI.DBI(dbtype="crawler")
-    rval = db.select(table="checkables",
-                     fields=["rowid", "path", "type", "cos", "cart",
-                             "ttypes", "checksum", "last_check", "fails",
-                             "reported"],
-                     where="cos is NULL or cart is NULL or ttypes is NULL")
+    rval = dirtab.select(db,
+                         ["rowid", "path", "type", "cos", "cart", "ttypes",
+                          "checksum", "last_check", "fails", "reported"],
+                         where="cos is NULL or cart is NULL or ttypes is NULL")
     db.close()
     return rval
 
@@ -102,17 +101,49 @@ def lscos_show():
     return rval
 
 
+# -----------------------------------------------------------------------------
+def lsp_carts(paths, h=None):
+    """
+    Return a dict mapping each of *paths* that hsi lists as a file to its cart
+    ('' for an empty file, comma separated names for a file on more than one
+    cart). The paths are listed cv/lsp_batch (default 100) at a time with 'ls
+    -P' on one hsi session -- *h* if it's passed in, otherwise one we start
+    and quit here.
+    """
+    cfg = CrawlConfig.get_config()
+    batch = int(cfg.get_d('cv', 'lsp_batch', '100'))
+    paths = hpss.pathlist(list(paths))
+    rval = {}
+    if not paths:
+        return rval
+
+    own = h is None
+    if own:
+        h = hpss.HSI()
+    try:
+        for idx in range(0, len(paths), batch):
+            cols = U.lsp_columns(h.lsP(paths[idx:idx + batch]))
+            for (ftype, path, cart) in zip(cols['type'], cols['path'],
+                                           cols['cart']):
+                if ftype == 'f':
+                    rval[path] = cart
+    finally:
+        if own:
+            h.quit()
+    return rval
+
+
 # -----------------------------------------------------------------------------
 def nulls_from_checkables():
     """
     Return rows from table checkables that contain null values
     """
     db = CrawlDBI.DBI(dbtype="crawler")
-    rval = db.select(table="checkables",
-                     fields=["rowid", "path", "type", "cos", "cart",
-                             "ttypes", "checksum", "last_check", "fails",
-                             "reported"],
-                     where="fails is null or reported is null or cart is null")
+    rval = dirtab.select(db,
+                         ["rowid", "path", "type", "cos", "cart", "ttypes",
+                          "checksum", "last_check", "fails", "reported"],
+                         where="fails is null or reported is null or " +
+                         "cart is null")
     db.close()
     return rval
 
@@ -124,27 +155,28 @@ def popcart(pc_l):
     """
     hp_l = [(x[2], x[0]) for x in pc_l]
     db = CrawlDBI.DBI(dbtype="crawler")
-    db.update(table="checkables",
-              fields=["cart"],
-              where="path = ?",
-              data=hp_l)
+    with db.transaction():
+        dirtab.update(db, fields=["cart"], where="path = ?", data=hp_l)
     db.close()
 
 
 # -----------------------------------------------------------------------------
-def prep_popcart(where, limit):
+def prep_popcart(where, limit, paths=None):
     """
-    Get a list of paths and carts from database based on where. If 0 < limit,
-    no more than limit records will be retrieved.
+    Get a list of paths and carts from database based on where, for the
+    *paths* given if there are any. If 0 < limit, no more than limit records
+    will be retrieved.
     """
     db = CrawlDBI.DBI(dbtype="crawler")
-    kw = {}
-    if 0 < limit:
-        kw['limit'] = limit
-    rows = db.select(table="checkables",
-                     fields=["path", "cart"],
-                     where=where,
-                     **kw)
+    if paths:
+        rows = dirtab.select_paths(db, ["path", "cart"], paths, where=where)
+        if 0 < limit:
+            rows = rows[:limit]
+    else:
+        kw = {}
+        if 0 < limit:
+            kw['limit'] = limit
+        rows = dirtab.select(db, ["path", "cart"], where=where, **kw)
     db.close()
     return rows
 
@@ -155,10 +187,10 @@ def reset_path(pathname):
     Reset the fails and reported fields on a rows so it can be rechecked
     """
     db = CrawlDBI.DBI(dbtype="crawler")
-    db.update(table='checkables',
-              fields=['fails', 'reported'],
-              where="path = ?",
-              data=[(0, 0, o.pathname)])
+    dirtab.update(db,
+                  fields=['fails', 'reported'],
+                  where="path = ?",
+                  data=[(0, 0, pathname)])
     db.close()
 
 
@@ -191,10 +223,10 @@ def tpop_select_all(db=None):
     if db is None:
         db = CrawlDBI.DBI(dbtype='crawler')
         close = True
-    rval = db.select(table="checkables",
-                     fields=["path", "type", "ttypes", "cart", "last_check"],
-                     where="type = 'f' and " +
-                     "(ttypes is NULL or cart is NULL)")
+    rval = dirtab.select(db,
+                         ["path", "type", "ttypes", "cart", "last_check"],
+                         where="type = 'f' and " +
+                         "(ttypes is NULL or cart is NULL)")
     if close:
         db.close()
     return rval
@@ -214,15 +246,15 @@ def tpop_select_by_paths(path_l, db=None):
         close = True
     rval = []
     for path in path_l:
-        rows = db.select(table="checkables",
-                         fields=["path",
-                                 "type",
-                                 "ttypes",
-                                 "cart",
-                                 "last_check"],
-                         where="path like ? and type = 'f' and " +
-                         "(ttypes is NULL or cart is NULL)",
-                         data=(path,))
+        rows = dirtab.select_like(db,
+                                  ["path",
+                                   "type",
+                                   "ttypes",
+                                   "cart",
+                                   "last_check"],
+                                  path,
+                                  where="type = 'f' and " +
+                                  "(ttypes is NULL or cart is NULL)")
         rval.extend(rows)
     if close:
         db.close()
@@ -239,13 +271,39 @@ def tpop_update_by_path(data):
     """
     zdata = [(d[0], d[1], d[2]) for d in data]
     db = CrawlDBI.DBI(dbtype="crawler")
-    db.update(table="checkables",
-              fields=["ttypes", "cart"],
-              where="path = ?",
-              data=zdata)
+    with db.transaction():
+        dirtab.update(db, fields=["ttypes", "cart"], where="path = ?",
+                      data=zdata)
     db.close()
 
 
+# -----------------------------------------------------------------------------
+def ttype_bulk_lookup(pairs, h=None):
+    """
+    Do what ttype_lookup() does for a lot of paths at once. *pairs* holds
+    (path, cart) tuples, where cart is None or '' if we don't know it yet.
+    Return a dict mapping each path to a list of (cart, media description)
+    tuples, or to None if no cart was found for it.
+
+    The paths without a cart are listed with lsp_carts() on one hsi session
+    (*h* if it's passed in), then all the carts are looked up in PVLPV and
+    tape_types at once with ttype_carts_to_desc().
+    """
+    pairs = list(pairs)
+    found = lsp_carts([p for (p, c) in pairs if not c], h)
+    cartl = {}
+    for (path, cart) in pairs:
+        cart = cart or found.get(path)
+        cartl[path] = cart.split(',') if cart else []
+
+    desc = ttype_carts_to_desc(set([c for l in cartl.values() for c in l]))
+    rval = {}
+    for (path, carts) in cartl.items():
+        media = [(c, desc[c]) for c in carts if c in desc]
+        rval[path] = media or None
+    return rval
+
+
 # -----------------------------------------------------------------------------
 def ttype_lookup(pathname, cart=None):
     """
@@ -264,7 +322,8 @@ def ttype_lookup(pathname, cart=None):
         r = H.lsP(pathname)
         H.quit()
 
-        (type, name, cart, cos) = U.lsp_parse(r)
+        cartl = U.lsp_columns(r)['cart']
+        cart = cartl[0] if cartl else None
         if not cart:
             return None
 
@@ -280,11 +339,10 @@ def ttype_lookup(pathname, cart=None):
 
 
 # -----------------------------------------------------------------------------
-@U.memoize
 def ttype_cart_to_desc(cart):
     """
     Call ttype_cart_lookup and ttype_map_desc to go from cart to media
-    description
+    description. Both of them cache what they find.
     """
     (type, subtype) = ttype_cart_lookup(cart)
     desc = ttype_map_desc(type, subtype)
@@ -292,10 +350,61 @@ def ttype_cart_to_desc(cart):
 
 
 # -----------------------------------------------------------------------------
+def ttype_carts_to_desc(carts, chunk=500):
+    """
+    Return a dict mapping each cart name in *carts* to its media description.
+    The carts that ttype_cart_lookup() doesn't have cached are read from
+    PVLPV with one query per *chunk* carts -- usually just one -- and added
+    to its cache. If any of the media types is missing from ttype_map_desc()'s
+    cache, tape_types is read again (see ttype_preload()). Carts missing from
+    either table are left out.
+    """
+    ttype = {}
+    todo = []
+    for cart in sorted(set(carts)):
+        try:
+            ttype[cart] = ttype_cart_lookup.cache.get(cart)
+        except KeyError:
+            todo.append(cart)
+
+    if todo:
+        db = CrawlDBI.DBI(dbtype='hpss', dbname='cfg')
+    for idx in range(0, len(todo), chunk):
+        part = todo[idx:idx + chunk]
+        rows = db.select(table="pvlpv",
+                         fields=["phys_vol_id",
+                                 "phys_vol_type_type",
+                                 "phys_vol_type_subtype",
+                                 ],
+                         where="phys_vol_id in (%s)" %
+                         ", ".join(["?"] * len(part)),
+                         data=tuple(part))
+        for row in rows:
+            cart = row['PHYS_VOL_ID'].strip()
+            ttype[cart] = (row['PHYS_VOL_TYPE_TYPE'],
+                           row['PHYS_VOL_TYPE_SUBTYPE'])
+            ttype_cart_lookup.cache.put(cart, ttype[cart])
+    if todo:
+        db.close()
+
+    if [x for x in set(ttype.values()) if x not in ttype_map_desc.cache]:
+        ttype_preload()
+
+    rval = {}
+    for (cart, key) in ttype.items():
+        try:
+            rval[cart] = ttype_map_desc.cache.get(key)
+        except KeyError:
+            pass
+    return rval
+
+
+# -----------------------------------------------------------------------------
+@U.cached(size=10000, ttl=24*3600)
 def ttype_cart_lookup(cartname):
     """
     Look up *cartname* in HPSS table PVLPV and return the cartridge's media
-    type and subtype.
+    type and subtype. The answers are cached (see ttype_preload()).
     """
     db = CrawlDBI.DBI(dbtype='hpss', dbname='cfg')
     rows = db.select(table="pvlpv",
@@ -309,10 +418,12 @@ def ttype_cart_lookup(cartname):
 
 
 # -----------------------------------------------------------------------------
+@U.cached(ttl=24*3600)
 def ttype_map_desc(type, subtype):
     """
     Look up *type* and *subtype* in the crawler table tape_types and return
-    the corresponding media description.
+    the corresponding media description. The answers are cached, keyed on
+    (type, subtype) (see ttype_preload()).
     """
     db = CrawlDBI.DBI(dbtype='crawler')
     rows = db.select(table="tape_types",
@@ -345,9 +456,35 @@ def ttype_map_insert(TT):
                     tt_tups.append((k, l, '%s/%s' % (mtype, mstype)))
 
     db = CrawlDBI.DBI(dbtype="crawler")
-    db.insert(table='tape_types',
-              fields=['type', 'subtype', 'name'],
-              data=tt_tups)
+    with db.transaction():
+        db.insert(table='tape_types',
+                  fields=['type', 'subtype', 'name'],
+                  data=tt_tups)
+    db.close()
+
+
+# -----------------------------------------------------------------------------
+def ttype_preload(cfg=None):
+    """
+    Set the bounds of the media type caches from cfg if it's passed in --
+    cv/cart_cache_size (default 10000) and cv/cart_cache_ttl (default 1d)
+    for the PVLPV lookups, cv/ttype_cache_ttl (default 1d) for the
+    tape_types lookups -- and fill the tape_types cache with the whole table
+    in one query. The cv plugin calls this when it starts.
+    """
+    if cfg is not None:
+        ttype_cart_lookup.cache.configure(
+            size=int(cfg.get_d('cv', 'cart_cache_size', '10000')),
+            ttl=cfg.get_time('cv', 'cart_cache_ttl', 24*3600))
+        ttype_map_desc.cache.configure(
+            ttl=cfg.get_time('cv', 'ttype_cache_ttl', 24*3600))
+
+    db = CrawlDBI.DBI(dbtype='crawler')
+    if db.table_exists(table='tape_types'):
+        rows = db.select(table="tape_types",
+                         fields=["type", "subtype", "name"])
+        ttype_map_desc.cache.update([((t, st), name)
+                                     for (t, st, name) in rows])
     db.close()
 
 
@@ -357,18 +494,18 @@ def ttype_missing():
     Return a list of records where type = 'f' and ttype is null
     """
     db = CrawlDBI.DBI(dbtype='crawler')
-    rows = db.select(table='checkables',
-                     fields=['rowid',
-                             'path',
-                             'type',
-                             'cos',
-                             'cart',
-                             'ttypes',
-                             'checksum',
-                             'last_check',
-                             'fails',
-                             'reported'],
-                     where="type = 'f' and ttypes is null")
+    rows = dirtab.select(db,
+                         ['rowid',
+                          'path',
+                          'type',
+                          'cos',
+                          'cart',
+                          'ttypes',
+                          'checksum',
+                          'last_check',
+                          'fails',
+                          'reported'],
+                         where="type = 'f' and ttypes is null")
     db.close()
     return rows
 
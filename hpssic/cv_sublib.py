@@ -42,7 +42,7 @@ def load_history(filename):
     # -------------------------------------------------------------------------
     db = CrawlDBI.DBI(dbtype='crawler')
     runtime = error = None
-    with open(filename, 'r') as f:
+    with open(filename, 'r') as f, db.transaction():
         for line in f:
             if cv_fires(line):
                 runtime = U.epoch(line[0:18])
@@ -93,9 +93,11 @@ def lscos_populate():
                                                U.scale(m[7], kb=1024))
             data.append((cos, desc, copies, lo_i, hi_i))
 
-        db.insert(table=tabname,
-                  fields=['cos', 'name', 'copies', 'min_size', 'max_size'],
-                  data=data)
+        with db.transaction():
+            db.insert(table=tabname,
+                      fields=['cos', 'name', 'copies', 'min_size',
+                              'max_size'],
+                      data=data)
         rval = MSG.table_created_S % tabname
     else:
         rval = MSG.table_already_S % tabname
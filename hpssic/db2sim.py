@@ -0,0 +1,189 @@
+"""
+A stand-in for the HPSS DB2 tables, for measuring tcc and mpra without a live
+HPSS
+
+generate() writes an sqlite database holding the tables the crawler reads from
+DB2 -- NSOBJECT, BITFILE, BFTAPESEG, BFMIGRREC, BFPURGEREC, COS, HIER, and
+PVLPV -- filled with a synthetic namespace. Point the cfg and sub options of
+[dbi-hpss] at the file and set dbtype to sqlite:
+
+    [dbi-hpss]
+    dbtype = sqlite
+    cfg = /path/to/hpss.db
+    sub = /path/to/hpss.db
+    tbl_prefix = hpss
+
+and CrawlDBI.DBI(dbtype='hpss', ...) will hand back a DBIsqlite_db2 that
+answers selects the way DBIdb2 does.
+
+The proportions are scaled down from a production system with about 100
+million name space objects:
+
+  - about one object id in twenty is unused (the object was deleted)
+  - about one object in 25 is a directory and one object id in 100 is a
+    symbolic link
+  - about one file in 30 is empty and has no tape segments
+  - the rest have a tape segment at offset 0 for each copy their COS calls
+    for, except for a fraction (*short*, 0.01 by default) that are missing
+    one, which is what tcc is looking for; one file in ten has a second
+    segment further in
+  - about one file in 50 is waiting on migration and one in 100 on purge, a
+    tenth of those with a purge lock set
+
+The COS list matches hsisim.cos_list and the cartridge names match the ones
+hsisim makes up, so the two simulators can be used together.
+"""
+import CrawlDBI
+import hsisim
+import os
+import random
+import struct
+import time
+
+
+tables = {
+    'nsobject':   ['object_id            integer primary key',
+                   'parent_id            integer',
+                   'name                 text',
+                   'type                 integer',
+                   'bitfile_id           blob',
+                   ],
+    'bitfile':    ['bfid                 blob primary key',
+                   'bfattr_cos_id        integer',
+                   'bfattr_create_time   integer',
+                   'bfattr_data_len      integer',
+                   ],
+    'bftapeseg':  ['bfid                 blob',
+                   'bf_offset            integer',
+                   'storage_class        integer',
+                   'phys_vol_id          text',
+                   ],
+    'bfmigrrec':  ['bfid                 blob primary key',
+                   'record_create_time   integer',
+                   'migration_failure_count integer',
+                   ],
+    'bfpurgerec': ['bfid                 blob primary key',
+                   'record_create_time   integer',
+                   'record_lock_time     integer',
+                   ],
+    'cos':        ['cos_id               integer primary key',
+                   'hier_id              integer',
+                   'cos_name             text',
+                   ],
+    'hier':       ['hier_id              integer primary key',
+                   'slevel0_migrate_list_count integer',
+                   ],
+    'pvlpv':      ['phys_vol_id          text primary key',
+                   'phys_vol_type_type   integer',
+                   'phys_vol_type_subtype integer',
+                   ],
+    }
+
+indexes = ['create index nsobject_bitfile on nsobject(bitfile_id)',
+           'create index nsobject_parent on nsobject(parent_id, name)',
+           'create index bftapeseg_bfid on bftapeseg(bfid)']
+
+# values of NSOBJECT.TYPE
+NS_FILE = 1
+NS_DIRECTORY = 2
+NS_SYM_LINK = 3
+
+carts = ['S%05d' % x for x in range(997)]
+media = [(3, 0), (3, 1), (4, 0)]
+
+
+# -----------------------------------------------------------------------------
+def bfid(object_id, rng):
+    """
+    Make up a 32 byte bitfile id for *object_id*. The leading zeros make sure
+    it can't be mistaken for text.
+    """
+    rval = "\0\0\0\0" + struct.pack(">I", object_id)
+    rval += "".join([chr(rng.randrange(256)) for x in range(24)])
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def generate(path, files=10000, short=0.01, seed=0, now=None):
+    """
+    Write an sqlite database at *path* with about *files* files in it as
+    described above and return a dict giving the number of rows in each
+    table. An existing database at *path* is replaced. The same *seed* gets
+    the same database, except for the times, which are relative to *now*.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    now = int(now or time.time())
+    rng = random.Random(seed)
+
+    rows = dict([(tname, []) for tname in tables])
+    for (hier_id, cos) in enumerate(hsisim.cos_list):
+        rows['cos'].append((int(cos[0]), hier_id + 1, cos[1]))
+        rows['hier'].append((hier_id + 1, cos[2]))
+    for cart in carts:
+        rows['pvlpv'].append((cart,) + rng.choice(media))
+
+    rows['nsobject'].append((1, 0, '/', NS_DIRECTORY, None))
+    dirs = [1]
+    object_id = 1
+    while len(rows['bitfile']) < files:
+        object_id += 1
+        if rng.random() < 0.05:
+            continue
+        parent = rng.choice(dirs)
+        if object_id % 100 == 0:
+            rows['nsobject'].append((object_id, parent,
+                                     'l%07d' % object_id, NS_SYM_LINK, None))
+            continue
+        if rng.random() < 0.04:
+            dirs.append(object_id)
+            rows['nsobject'].append((object_id, parent,
+                                     'd%07d' % object_id, NS_DIRECTORY,
+                                     None))
+            continue
+
+        bf = bfid(object_id, rng)
+        cos = rng.choice(hsisim.cos_list)
+        created = now - rng.randrange(5 * 365 * 24 * 3600)
+        size = 0 if rng.random() < 0.033 else int(rng.expovariate(1e-8))
+        rows['nsobject'].append((object_id, parent, 'f%07d' % object_id,
+                                 NS_FILE, buffer(bf)))
+        rows['bitfile'].append((buffer(bf), int(cos[0]), created, size))
+        if 0 < size:
+            copies = cos[2]
+            if 1 < copies and rng.random() < short:
+                copies -= 1
+            for level in range(copies):
+                rows['bftapeseg'].append((buffer(bf), 0, level + 1,
+                                          rng.choice(carts)))
+            if rng.random() < 0.1:
+                rows['bftapeseg'].append((buffer(bf), size / 2, 1,
+                                          rng.choice(carts)))
+
+        pending = rng.random()
+        if pending < 0.02:
+            rows['bfmigrrec'].append((buffer(bf),
+                                      now - rng.randrange(30 * 24 * 3600),
+                                      rng.choice([0] * 9 + [1, 2, 3])))
+        elif pending < 0.03:
+            locked = now - rng.randrange(7200) if rng.random() < 0.1 else 0
+            rows['bfpurgerec'].append((buffer(bf),
+                                       now - rng.randrange(30 * 24 * 3600),
+                                       locked))
+
+    db = CrawlDBI.DBIsqlite(dbname=path, tbl_prefix='')
+    cursor = db.cursor()
+    cursor.execute("begin")
+    for tname in sorted(tables):
+        db.create(table=tname, fields=tables[tname])
+        if rows[tname]:
+            db.insert(table=tname,
+                      fields=[x.split()[0] for x in tables[tname]],
+                      data=rows[tname])
+    for cmd in indexes:
+        cursor.execute(cmd)
+    cursor.execute("commit")
+    cursor.close()
+    db.close()
+
+    return dict([(tname, len(rows[tname])) for tname in rows])
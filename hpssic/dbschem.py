@@ -18,13 +18,63 @@ tdefs = {
                               'checksum    int',
                               'last_check  int',
                               'fails       int',
-                              'reported    int'
+                              'reported    int',
+                              'hashed      int',
+                              'hash_time   int',
+                              'unique (path)'
                               ]
                    },
 
+    'cvstats':    {'fields': ['rowid       integer primary key autoincrement',
+                              'matches     int',
+                              'failures    int',
+                              ]
+                   },
+
+    # Digests computed while streaming a file's content for verification
+    # (see digest.py), one row per file and algorithm
+
+    'digests':    {'fields': ['rowid       integer primary key autoincrement',
+                              'path        text',
+                              'algorithm   varchar(16)',
+                              'digest      text',
+                              'computed    int',
+                              'unique (path, algorithm)'
+                              ]
+                   },
+
+    # With path_layout = normalized in [cv], each directory in checkables is
+    # stored once here and checkables holds dir_id and name in place of path
+    # (see dirtab.py)
+
+    'directories': {'fields': ['rowid       integer primary key autoincrement',
+                               'parent      int',
+                               'name        varchar(255)',
+                               'unique (parent, name)'
+                               ]
+                    },
+
+    'frontier':   {'fields': ['rowid       integer primary key autoincrement',
+                              'path        text',
+                              ]
+                   },
+
+    # The columns after errors measure the plugin's firing: wall clock and cpu
+    # seconds, hsi commands run and seconds spent waiting on them, database
+    # operations and rows, items handled, and peak resident set size (KB). See
+    # crawl_sublib.perf_sample().
+
     'history': {'fields':    ['plugin      varchar(32)',
                               'runtime     int',
                               'errors      int',
+                              'wall        double',
+                              'cpu         double',
+                              'hsi_cmds    int',
+                              'hsi_secs    double',
+                              'db_ops      int',
+                              'db_rows     int',
+                              'items       int',
+                              'maxrss      int',
                               'primary key (plugin, runtime)'
                               ]
                 },
@@ -50,6 +100,14 @@ tdefs = {
                               ]
                    },
 
+    'nsdisc':     {'fields': ['rowid       integer primary key autoincrement',
+                              'check_time  integer',
+                              'low_nsobj_id  integer',
+                              'high_nsobj_id integer',
+                              'found       integer',
+                              ]
+                   },
+
     'report':     {'fields': ['rowid       integer primary key autoincrement',
                               'report_time integer',
                               ]
@@ -102,8 +160,9 @@ def alter_table(table=None, addcol=None, dropcol=None, pos=None, cfg=None):
             # edit the error number off the front of the message
             rval = re.sub("\s*\d+:\s*", "", e.value)
         elif (addcol and
-              "Duplicate column name '%s'" % fieldname
-              in str(e)):
+              any([msg % fieldname in str(e)
+                   for msg in ["Duplicate column name '%s'",
+                               "duplicate column name: %s"]])):
             # edit the error number off the front of the message
             rval = re.sub("\s*\d+:\s*", "", e.value)
         else:
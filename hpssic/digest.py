@@ -0,0 +1,189 @@
+"""
+Compute several digests of a file's content in one pass
+
+hsi_digests() streams a file out of HPSS ('hsi get - : path') through a pipe
+and feeds each block to every digest we were asked for, so one read of the
+file (and one tape mount) gives us its md5, sha1, sha256, crc32, and adler32
+at once. The blocks are read into a single buffer that is reused for the
+whole file, and the digests are handed views into it rather than copies.
+
+Checkable.verify() uses this when verify_engine is 'stream' in the [cv]
+section: the digest matching the one HPSS has stored for the file decides
+whether it verifies, and all the digests computed are recorded in the
+digests table so a later change of algorithm doesn't need another read.
+"""
+import CrawlConfig
+import CrawlDBI
+import dbschem
+import hashlib
+import hpss
+import messages as MSG
+import re
+import subprocess
+import tempfile
+import time
+import zlib
+
+algorithms = ['adler32', 'crc32', 'md5', 'sha1', 'sha256']
+
+# hsi errors that are about the file rather than about reaching HPSS
+path_errs = "HPSS_E(NOENT|ACCES|PERM|ISDIR)"
+
+
+# -----------------------------------------------------------------------------
+class Checksum(object):
+    """
+    A running zlib checksum (crc32 or adler32) behind the update()/hexdigest()
+    interface of the hashlib objects
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, func, start):
+        """
+        *func* is zlib.crc32 or zlib.adler32 and *start* the value it starts
+        from
+        """
+        self.func = func
+        self.value = start
+
+    # -------------------------------------------------------------------------
+    def update(self, data):
+        """
+        Fold *data* into the checksum
+        """
+        self.value = self.func(data, self.value)
+
+    # -------------------------------------------------------------------------
+    def hexdigest(self):
+        """
+        Return the checksum as eight hex digits
+        """
+        return "%08x" % (self.value & 0xffffffff)
+
+
+# -----------------------------------------------------------------------------
+def new(name):
+    """
+    Return a digest object for algorithm *name*
+    """
+    if name == 'adler32':
+        return Checksum(zlib.adler32, 1)
+    elif name == 'crc32':
+        return Checksum(zlib.crc32, 0)
+    elif name in algorithms:
+        return hashlib.new(name)
+    raise StandardError(MSG.digest_unknown_S % name)
+
+
+# -----------------------------------------------------------------------------
+class MultiDigest(object):
+    """
+    Several digests of the same data, updated together
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, names):
+        """
+        Set up a digest for each algorithm in *names*
+        """
+        self.digests = dict([(name, new(name)) for name in names])
+        self.length = 0
+
+    # -------------------------------------------------------------------------
+    def update(self, buf, count):
+        """
+        Feed the first *count* bytes of bytearray *buf* to each digest without
+        copying them. The hashlib objects take a memoryview; zlib in this
+        python only takes the old style buffer, so the checksums get one of
+        those.
+        """
+        view = memoryview(buf)[:count]
+        zbuf = buffer(buf, 0, count)
+        for d in self.digests.values():
+            d.update(zbuf if isinstance(d, Checksum) else view)
+        self.length += count
+
+    # -------------------------------------------------------------------------
+    def read(self, infile, bufsize=1024 * 1024):
+        """
+        Digest everything that can be read from *infile*, reading it
+        *bufsize* bytes at a time into a buffer we reuse, and return the
+        number of bytes read
+        """
+        buf = bytearray(bufsize)
+        start = self.length
+        while True:
+            count = infile.readinto(buf)
+            if not count:
+                break
+            self.update(buf, count)
+        return self.length - start
+
+    # -------------------------------------------------------------------------
+    def hexdigests(self):
+        """
+        Return a dict mapping each algorithm name to its hex digest
+        """
+        return dict([(name, d.hexdigest())
+                     for (name, d) in self.digests.items()])
+
+
+# -----------------------------------------------------------------------------
+def hsi_digests(path, names, bufsize=None):
+    """
+    Stream *path* out of HPSS and return a dict of its digests for the
+    algorithms in *names*. The buffer size comes from cv/stream_buffer
+    (default 1mib) unless it's passed in. Raises HSIerror if hsi can't be
+    started or the transfer fails.
+    """
+    if bufsize is None:
+        cfg = CrawlConfig.get_config()
+        bufsize = cfg.get_size('cv', 'stream_buffer', 1024 * 1024)
+    md = MultiDigest(names)
+
+    if not hpss.breaker.allow():
+        raise hpss.HSIerror(MSG.hpss_unavailable)
+    hpss.maybe_update_hsi()
+    errs = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(["hsi", "-q", "get - : %s" % path],
+                                stdout=subprocess.PIPE, stderr=errs)
+    except OSError:
+        hpss.breaker.failure()
+        errs.close()
+        raise hpss.HSIerror(MSG.hpss_unavailable)
+    try:
+        md.read(proc.stdout, bufsize)
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    errs.seek(0)
+    msg = errs.read().strip()
+    errs.close()
+
+    # Tell the breaker how it went, as HSI.connect() does. An error about
+    # the file itself still means HPSS answered.
+    if rc == 0 or re.search(path_errs, msg):
+        hpss.breaker.success()
+    else:
+        hpss.breaker.failure()
+    if rc != 0:
+        raise hpss.HSIerror(MSG.hsi_get_failed_SS % (path, msg))
+    return md.hexdigests()
+
+
+# -----------------------------------------------------------------------------
+def record(path, digests, when=None):
+    """
+    Store the *digests* (a dict like hsi_digests() returns) computed for
+    *path* in the digests table, making the table if need be and replacing
+    any digests computed before
+    """
+    when = int(when or time.time())
+    db = CrawlDBI.DBI(dbtype='crawler')
+    if not db.table_exists(table='digests'):
+        db.create(table='digests', fields=dbschem.tdefs['digests']['fields'])
+    db.upsert(table='digests',
+              key_fields=['path', 'algorithm'],
+              fields=['path', 'algorithm', 'digest', 'computed'],
+              data=[(path, name, value, when)
+                    for (name, value) in sorted(digests.items())])
+    db.close()
@@ -0,0 +1,690 @@
+"""
+Optional normalized layout for the paths in the checkables table
+
+In the flat layout (the default), each row of checkables holds the full path
+of its file or directory, so with tens of millions of rows the table and its
+path index are mostly copies of the same directory prefixes. With
+
+    [cv]
+    path_layout = normalized
+
+each directory is stored once, in the directories table (rowid, parent,
+name), and each checkables row holds the rowid of its directory (dir_id) and
+its own name. The unique key on (dir_id, name) makes reading the contents of
+a directory an index range scan, as the one on (parent, name) does for its
+subdirectories.
+
+The routines here take and return full paths in either layout, so code that
+reads or writes checkables by path goes through them rather than the DBI:
+
+    select()        rows chosen without reference to the path
+    select_like()   rows whose path matches a 'like' pattern
+    select_paths()  rows for a list of paths
+    update()        DBI.update(), including by 'path = ?'
+    upsert()        DBI.upsert() keyed on the path
+
+'path' can be among the fields of any of them. Queries that don't involve the
+path (counts, updates by rowid) can use the DBI directly in either layout.
+'cv normalize' converts a flat table with migrate().
+
+A run keeps coming back to the same directories, so their paths are cached
+by rowid and their rowids by path, cv/dir_cache_size (default 100000) of
+each (see configure()).
+"""
+import CrawlConfig
+import CrawlDBI
+import dbschem
+import messages as MSG
+import re
+import util
+
+# how many values go in one 'in (...)' clause
+batch_size = 500
+
+# where migrate() keeps the rows of the flat table while it's being rebuilt
+holding = 'checkables_flat'
+
+# directory rowids by (database, path) and paths by (database, rowid)
+ids = util.Cache(size=100000)
+paths = util.Cache(size=100000)
+
+
+# -----------------------------------------------------------------------------
+def chunks(seq, size=None):
+    """
+    Yield successive pieces of list *seq* no longer than *size* (default
+    batch_size)
+    """
+    size = size or batch_size
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
+
+# -----------------------------------------------------------------------------
+def configure(cfg):
+    """
+    Set the bounds of the directory caches from cv/dir_cache_size in *cfg*
+    (default 100000). The cv plugin calls this when it starts.
+    """
+    size = int(cfg.get_d('cv', 'dir_cache_size', '100000'))
+    ids.configure(size=size)
+    paths.configure(size=size)
+
+
+# -----------------------------------------------------------------------------
+def conjoin(clause, where):
+    """
+    Return *clause* and'ed with *where*, if there is one
+    """
+    if where:
+        return "%s and (%s)" % (clause, where)
+    return clause
+
+
+# -----------------------------------------------------------------------------
+def dbkey(db):
+    """
+    Return what tells the directories table of *db* apart from others in the
+    caches
+    """
+    return (db.dbname, db.prefix('directories'))
+
+
+# -----------------------------------------------------------------------------
+def descendants(db, idents):
+    """
+    Return the set of the directory rowids in *idents* and all the
+    directories under them, a level at a time
+    """
+    rval = set(idents)
+    level = list(rval)
+    while level:
+        found = []
+        for part in chunks(level):
+            rows = db.select(table='directories',
+                             fields=['rowid'],
+                             where="parent in (%s)" %
+                             ", ".join(["?"] * len(part)),
+                             data=tuple(part))
+            found.extend([x[0] for x in rows if x[0] not in rval])
+        rval.update(found)
+        level = found
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def dir_id(db, key, dpath, create=False):
+    """
+    Return the rowid of directory *dpath* in the directories table, adding
+    it and any of its parents that aren't there if *create* is True, or None
+    if it isn't there. *key* is dbkey(db). The directory of a relative path
+    with no slash in it ('') is 0, and '/' is the row with parent 0.
+    """
+    if dpath == '':
+        return 0
+    try:
+        return ids.get((key, dpath))
+    except KeyError:
+        pass
+
+    if dpath == '/':
+        (parent, name) = (0, '/')
+    else:
+        (ppath, name) = split(dpath)
+        parent = dir_id(db, key, ppath, create)
+        if parent is None:
+            return None
+
+    kw = {'table': 'directories',
+          'fields': ['rowid'],
+          'where': 'parent = ? and name = ?',
+          'data': (parent, name)}
+    rows = db.select(**kw)
+    if not rows and create:
+        db.upsert(table='directories',
+                  key_fields=['parent', 'name'],
+                  fields=['parent', 'name'],
+                  update_fields=[],
+                  data=[(parent, name)])
+        rows = db.select(**kw)
+    if not rows:
+        return None
+
+    # A row we find inside a transaction may be one we added that is yet to
+    # be rolled back, so it's only remembered once it's been committed
+    if not db.in_transaction():
+        ids.put((key, dpath), rows[0][0])
+        paths.put((key, rows[0][0]), dpath)
+    return rows[0][0]
+
+
+# -----------------------------------------------------------------------------
+def dir_ids(db, dirpaths, create=False):
+    """
+    Return a dict mapping each of the directory paths in *dirpaths* to its
+    rowid in the directories table. Directories that aren't there are added
+    if *create* is True and left out otherwise.
+    """
+    key = dbkey(db)
+    rval = {}
+    for dpath in set(dirpaths):
+        ident = dir_id(db, key, dpath, create)
+        if ident is not None:
+            rval[dpath] = ident
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def dir_paths(db, idents):
+    """
+    Return a dict mapping each of the directory rowids in *idents* to its
+    path. The rows we need are read a level at a time.
+    """
+    key = dbkey(db)
+    rval = {0: ''}
+    rows = {}
+    todo = set(idents)
+    while todo:
+        wanted = []
+        for ident in todo:
+            if ident in rval or ident in rows:
+                continue
+            try:
+                rval[ident] = paths.get((key, ident))
+            except KeyError:
+                wanted.append(ident)
+        todo = set()
+        for part in chunks(wanted):
+            for (ident, parent, name) in db.select(
+                    table='directories',
+                    fields=['rowid', 'parent', 'name'],
+                    where="rowid in (%s)" % ", ".join(["?"] * len(part)),
+                    data=tuple(part)):
+                rows[ident] = (parent, name)
+                todo.add(parent)
+        missing = [x for x in wanted if x not in rows]
+        if missing:
+            raise StandardError(MSG.dir_missing_d % missing[0])
+
+    # -------------------------------------------------------------------------
+    def resolve(ident):
+        """
+        Return the path of directory *ident*, building it from its parent's
+        """
+        if ident not in rval:
+            (parent, name) = rows[ident]
+            rval[ident] = join(resolve(parent), name)
+            if not db.in_transaction():
+                paths.put((key, ident), rval[ident])
+                ids.put((key, rval[ident]), ident)
+        return rval[ident]
+
+    for ident in rows:
+        resolve(ident)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def fields():
+    """
+    Return the column definitions of the normalized checkables table: those
+    of the flat one (dbschem.tdefs) with dir_id and name in place of path
+    """
+    rval = []
+    for fdef in dbschem.tdefs['checkables']['fields']:
+        if fdef.split()[0] == 'path':
+            rval.extend(['dir_id      int', 'name        varchar(255)'])
+        elif fdef.replace(' ', '') == 'unique(path)':
+            rval.append('unique (dir_id, name)')
+        else:
+            rval.append(fdef)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def forget():
+    """
+    Empty the directory caches. A directories table that has just been made
+    can't have the rowids we remember for one that was dropped.
+    """
+    ids.invalidate()
+    paths.invalidate()
+
+
+# -----------------------------------------------------------------------------
+def join(dpath, name):
+    """
+    Return the path of *name* in directory *dpath* (the reverse of split())
+    """
+    if dpath == '':
+        return name
+    elif dpath == '/':
+        return '/' + name
+    return dpath + '/' + name
+
+
+# -----------------------------------------------------------------------------
+def layout(cfg=None):
+    """
+    Return the layout of the checkables table, 'flat' or 'normalized', from
+    path_layout in the [cv] section
+    """
+    cfg = cfg or CrawlConfig.get_config()
+    rval = cfg.get_d('cv', 'path_layout', 'flat')
+    if rval not in ['flat', 'normalized']:
+        raise StandardError(MSG.path_layout_unknown_S % rval)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def like_rgx(pattern):
+    """
+    Return a compiled regex that matches what sql 'like' *pattern* does,
+    except that '_' doesn't match a slash (see select_like()). Like sqlite's,
+    it ignores case.
+    """
+    rgx = ''
+    for char in pattern:
+        if char == '%':
+            rgx += '.*'
+        elif char == '_':
+            rgx += '[^/]'
+        else:
+            rgx += re.escape(char)
+    return re.compile(rgx + '$', re.IGNORECASE | re.DOTALL)
+
+
+# -----------------------------------------------------------------------------
+def like_dirs(db, pattern):
+    """
+    Return the rowids of the directories whose paths match 'like' *pattern*,
+    which has no '%' in it. Each component of the pattern is matched against
+    the subdirectories of the directories matching the ones before it.
+    """
+    if pattern == '':
+        return [0]
+    elif pattern == '/':
+        (parents, name) = ([0], '/')
+    else:
+        (ppat, name) = split(pattern)
+        parents = like_dirs(db, ppat)
+    rval = []
+    for part in chunks(parents):
+        rows = db.select(table='directories',
+                         fields=['rowid'],
+                         where="parent in (%s) and name like ?" %
+                         ", ".join(["?"] * len(part)),
+                         data=tuple(part) + (name,))
+        rval.extend([x[0] for x in rows])
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def make_dirs(db, dirpaths):
+    """
+    Return dir_ids() for *dirpaths*, adding the directories that aren't
+    there. Outside a transaction, they're added in one of their own and
+    remembered once it's committed.
+    """
+    if db.in_transaction():
+        return dir_ids(db, dirpaths, create=True)
+    with db.transaction():
+        rval = dir_ids(db, dirpaths, create=True)
+    key = dbkey(db)
+    for (dpath, ident) in rval.items():
+        ids.put((key, dpath), ident)
+        paths.put((key, ident), dpath)
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def make_tables(cfg=None):
+    """
+    Make the checkables table in the layout set by path_layout, and in the
+    normalized layout, the directories table, if they don't exist. Return
+    "Created" or "Already" for checkables, as dbschem.make_table() does.
+    Raise StandardError if the table that's there has the other layout.
+    """
+    db = CrawlDBI.DBI(dbtype='crawler', cfg=cfg)
+    try:
+        dirs = db.table_exists(table='directories')
+        exists = db.table_exists(table='checkables')
+        if layout(cfg) == 'flat':
+            if dirs:
+                raise StandardError(MSG.path_layout_normalized)
+            tdef = dbschem.tdefs['checkables']['fields']
+        else:
+            if exists and not dirs:
+                raise StandardError(MSG.path_layout_flat)
+            elif not dirs:
+                db.create(table='directories',
+                          fields=dbschem.tdefs['directories']['fields'])
+                forget()
+            tdef = fields()
+
+        if exists:
+            return "Already"
+        db.create(table='checkables', fields=tdef)
+        return "Created"
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+def migrate(chunk=10000, cfg=None):
+    """
+    Convert a flat checkables table to the normalized layout, keeping the
+    rowids, and return the number of rows converted. It goes in four steps,
+    and which tables exist says which step we're in, so if it's interrupted,
+    running it again picks up where it left off:
+
+        1. copy the rows of checkables into a holding table *chunk* at a
+           time (checkables and holding, no directories)
+        2. drop checkables (holding only)
+        3. make directories and the normalized checkables (holding,
+           directories, and maybe checkables)
+        4. copy the rows back *chunk* at a time with their paths split, then
+           drop the holding table (all three)
+
+    Steps 1 and 4 resume after the last rowid copied. If there's nothing to
+    convert, it returns 0. The flat table must have all the current columns
+    (see Checkable.checkables_upgrade()), and nothing else should be using
+    it while it's converted.
+    """
+    names = [x.split()[0] for x in dbschem.tdefs['checkables']['fields']
+             if not x.startswith('unique')]
+    db = CrawlDBI.DBI(dbtype='crawler', cfg=cfg)
+    try:
+        dirs = db.table_exists(table='directories')
+        flat = db.table_exists(table='checkables') and not dirs
+        if not db.table_exists(table=holding):
+            if not flat:
+                return 0
+            db.create(table=holding,
+                      fields=dbschem.tdefs['checkables']['fields'])
+
+        if flat:
+            migrate_copy(db, 'checkables', holding, names, chunk)
+            db.drop(table='checkables')
+        if not dirs:
+            forget()
+            db.create(table='directories',
+                      fields=dbschem.tdefs['directories']['fields'])
+        if not db.table_exists(table='checkables'):
+            db.create(table='checkables', fields=fields())
+
+        count = migrate_copy(db, holding, 'checkables', names, chunk)
+        db.drop(table=holding)
+        return count
+    finally:
+        db.close()
+
+
+# -----------------------------------------------------------------------------
+def migrate_copy(db, source, target, names, chunk):
+    """
+    Copy the rows of table *source* with rowids above the highest in
+    *target* into *target*, *chunk* at a time, one transaction per chunk, and
+    return how many were copied. Copying into checkables, the paths are
+    split and the directories added as we go.
+    """
+    last = db.select(table=target, fields=['max(rowid)'])[0][0] or 0
+    pidx = names.index('path')
+    count = 0
+    for rows in migrate_rows(db, source, names, last, chunk):
+        if target == 'checkables':
+            dirs = make_dirs(db, [split(x[pidx])[0] for x in rows])
+            (tfields, rows) = (replace_path(names),
+                               split_rows(dirs, rows, pidx))
+        else:
+            tfields = names
+        with db.transaction():
+            db.insert(table=target, fields=tfields, data=rows)
+        count += len(rows)
+    return count
+
+
+# -----------------------------------------------------------------------------
+def migrate_rows(db, table, names, last, chunk):
+    """
+    Yield the rows of *table* with rowids above *last*, *chunk* at a time in
+    rowid order, with the columns in *names*
+    """
+    while True:
+        rows = db.select(table=table,
+                         fields=names,
+                         where='rowid > ?',
+                         data=(last,),
+                         orderby='rowid',
+                         limit=chunk)
+        if not rows:
+            break
+        yield rows
+        last = rows[-1][0]
+
+
+# -----------------------------------------------------------------------------
+def normalized(cfg=None):
+    """
+    Return True if the checkables table has the normalized layout
+    """
+    return layout(cfg) == 'normalized'
+
+
+# -----------------------------------------------------------------------------
+def rebuild(db, rows, idx):
+    """
+    Turn the dir_id and name at *idx* and *idx* + 1 in each of *rows* into a
+    path and return the new rows
+    """
+    dirs = dir_paths(db, [x[idx] for x in rows])
+    return [tuple(row[:idx]) + (join(dirs[row[idx]], row[idx + 1]),) +
+            tuple(row[idx + 2:]) for row in rows]
+
+
+# -----------------------------------------------------------------------------
+def replace_path(fields):
+    """
+    Return *fields* with dir_id and name where 'path' is
+    """
+    if 'path' not in fields:
+        return list(fields)
+    idx = fields.index('path')
+    return list(fields[:idx]) + ['dir_id', 'name'] + list(fields[idx + 1:])
+
+
+# -----------------------------------------------------------------------------
+def select(db, fields, where='', data=(), **kwargs):
+    """
+    Like DBI.select() on checkables, with the path rebuilt if 'path' is one of
+    the *fields*. *where* and any orderby or groupby can't refer to the path
+    (see select_like() and select_paths()). Any other keyword arguments are
+    passed on.
+    """
+    if not normalized() or 'path' not in fields:
+        return db.select(table='checkables', fields=fields, where=where,
+                         data=data, **kwargs)
+    rows = db.select(table='checkables', fields=replace_path(fields),
+                     where=where, data=data, **kwargs)
+    return rebuild(db, rows, fields.index('path'))
+
+
+# -----------------------------------------------------------------------------
+def select_like(db, fields, pattern, where='', data=()):
+    """
+    Return the rows of checkables whose paths match sql 'like' *pattern* (and
+    *where*, if given, with *data*), with the columns in *fields*.
+
+    In the normalized layout, when the directory part of the pattern has no
+    '%', the directories matching it are found a component at a time and
+    only their rows (or, if the last component has a '%', which can match
+    across slashes, the rows of the directories under them too) are read.
+    Otherwise every row is read and the paths matched here. Since the
+    directories are matched a component at a time, '_' doesn't match a slash
+    in the normalized layout.
+    """
+    if not normalized():
+        return db.select(table='checkables', fields=fields,
+                         where=conjoin("path like ?", where),
+                         data=(pattern,) + data)
+
+    qfields = fields if 'path' in fields else list(fields) + ['path']
+    pidx = qfields.index('path')
+    (dpat, npat) = split(pattern)
+    if '%' in dpat:
+        rows = select(db, qfields, where=where, data=data)
+    else:
+        dirs = like_dirs(db, dpat)
+        if '%' in npat:
+            dirs = list(descendants(db, dirs))
+            clause = "dir_id in (%s)"
+            extra = ()
+        else:
+            clause = "dir_id in (%s) and name like ?"
+            extra = (npat,)
+        rows = []
+        for part in chunks(dirs):
+            rows.extend(select(db, qfields,
+                               where=conjoin(clause %
+                                             ", ".join(["?"] * len(part)),
+                                             where),
+                               data=tuple(part) + extra + data))
+
+    rgx = like_rgx(pattern)
+    rows = [x for x in rows if rgx.match(x[pidx])]
+    if qfields is not fields:
+        rows = [x[:-1] for x in rows]
+    return rows
+
+
+# -----------------------------------------------------------------------------
+def select_paths(db, fields, pathl, where='', data=()):
+    """
+    Return the rows of checkables for the paths in *pathl* (that also satisfy
+    *where*, if given, with *data*), with the columns in *fields*. In the
+    normalized layout, the paths are looked up a directory at a time.
+    """
+    rval = []
+    if not normalized():
+        for part in chunks(list(pathl)):
+            clause = "path in (%s)" % ", ".join(["?"] * len(part))
+            rval.extend(db.select(table='checkables',
+                                  fields=fields,
+                                  where=conjoin(clause, where),
+                                  data=tuple(part) + data))
+        return rval
+
+    names = {}
+    for path in pathl:
+        (dpath, name) = split(path)
+        names.setdefault(dpath, []).append(name)
+    dirs = dir_ids(db, names.keys())
+    for (dpath, namel) in names.items():
+        if dpath not in dirs:
+            continue
+        for part in chunks(namel):
+            clause = ("dir_id = ? and name in (%s)" %
+                      ", ".join(["?"] * len(part)))
+            rval.extend(select(db, fields,
+                               where=conjoin(clause, where),
+                               data=(dirs[dpath],) + tuple(part) + data))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def split(path):
+    """
+    Split *path* into its directory and its name. Unlike os.path.split(),
+    every path comes back together exactly with join().
+    """
+    idx = path.rfind('/')
+    if idx < 0 or path == '/':
+        return ('', path)
+    return (path[:idx] or '/', path[idx + 1:])
+
+
+# -----------------------------------------------------------------------------
+def split_rows(dirs, rows, idx):
+    """
+    Turn the path at *idx* in each of *rows* into its directory's rowid (from
+    dict *dirs*) and its name and return the new rows (the reverse of
+    rebuild())
+    """
+    rval = []
+    for row in rows:
+        (dpath, name) = split(row[idx])
+        rval.append(tuple(row[:idx]) + (dirs[dpath], name) +
+                    tuple(row[idx + 1:]))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def update(db, fields, where, data):
+    """
+    Like DBI.update() on checkables. In the normalized layout, 'path' among
+    the *fields* and a *where* of 'path = ?', with the path last in each row
+    of *data*, are turned into dir_id and name. Rows for paths in
+    directories we have never seen can't be in the table, so they're
+    dropped. Any other use of the path in *where* raises StandardError.
+    """
+    if not normalized():
+        db.update(table='checkables', fields=fields, where=where, data=data)
+        return
+
+    bypath = where.replace(' ', '') == 'path=?'
+    if not bypath and 'path' in where:
+        raise StandardError(MSG.path_where_S % where)
+    pidx = fields.index('path') if 'path' in fields else None
+
+    dirl = []
+    for row in data:
+        if bypath:
+            dirl.append(split(row[-1])[0])
+        if pidx is not None:
+            dirl.append(split(row[pidx])[0])
+    if pidx is None:
+        dirs = dir_ids(db, dirl)
+    else:
+        dirs = make_dirs(db, dirl)
+
+    rows = []
+    for row in data:
+        row = list(row)
+        if bypath:
+            (dpath, name) = split(row.pop())
+            if dpath not in dirs:
+                continue
+            row.extend([dirs[dpath], name])
+        if pidx is not None:
+            (dpath, name) = split(row[pidx])
+            row[pidx:pidx + 1] = [dirs[dpath], name]
+        rows.append(tuple(row))
+
+    if rows:
+        db.update(table='checkables', fields=replace_path(fields),
+                  where='dir_id = ? and name = ?' if bypath else where,
+                  data=rows)
+
+
+# -----------------------------------------------------------------------------
+def upsert(db, fields, data, update_fields=None):
+    """
+    Like DBI.upsert() on checkables keyed on the path, which must be one of
+    the *fields*. In the normalized layout, the path in each row of *data* is
+    turned into dir_id and name, adding any directories that are new, and
+    the rows are keyed on those.
+    """
+    if not normalized():
+        db.upsert(table='checkables', key_fields=['path'], fields=fields,
+                  update_fields=update_fields, data=data)
+        return
+
+    pidx = fields.index('path')
+    dirs = make_dirs(db, [split(x[pidx])[0] for x in data])
+    if update_fields is not None:
+        update_fields = replace_path(update_fields)
+    db.upsert(table='checkables',
+              key_fields=['dir_id', 'name'],
+              fields=replace_path(fields),
+              update_fields=update_fields,
+              data=split_rows(dirs, data, pidx))
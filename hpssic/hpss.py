@@ -1,14 +1,24 @@
+import collections
 import CrawlConfig
 from hpssic import messages as MSG
+import metrics
 import os
-import pexpect
 import pwd
 import re
+import select
 import sys
 import time
 import traceback as tb
 import util
 
+pexpect = util.LazyModule('pexpect')
+
+# month names mapped to month numbers, and the pattern for the access time
+# (and the path, if there is one) in a line of 'ls -lDTr' output
+month = util.month_dict()
+atime_rgx = re.compile('(' + '|'.join(month.keys()) + ')' +
+                       "\s+(\d+)\s+(\d+):(\d+):(\d+)\s+(\d+)[ \t]*(\S*)")
+
 
 # -----------------------------------------------------------------------------
 class HSIerror(Exception):
@@ -30,6 +40,150 @@ class HSIerror(Exception):
         return "%s" % (str(self.value))
 
 
+# -----------------------------------------------------------------------------
+class CircuitBreaker(object):
+    """
+    Keep track of whether HPSS is answering so that, once it has stopped,
+    callers find out at once rather than each waiting out its own connect
+    attempt.
+
+    The breaker starts out closed. After *failures* connect attempts in a row
+    fail, it opens and allow() returns False for *cooldown* seconds. When that
+    has passed, it goes half open and allow() lets a single probe through. If
+    the probe connects, the breaker closes again. If it fails, the breaker
+    opens for twice as long as before, up to *max_cooldown* seconds.
+
+    The settings come from the [crawler] section of the configuration:
+
+        hsi_breaker_failures = 3
+        hsi_breaker_cooldown = 60s
+        hsi_breaker_max_cooldown = 1hr
+
+    They are read again when the configuration is reloaded.
+
+    There is one breaker per process, hpss.breaker, which HSI.connect() and
+    HSImux consult and update. Plugins can call breaker.is_open() to skip a
+    run that would need HPSS.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Start out closed with the settings to be read on first use
+        """
+        self.source = None
+        self.loadtime = None
+        self.failures = 3
+        self.cooldown = 60
+        self.max_cooldown = 3600
+        self.reset()
+
+    # -------------------------------------------------------------------------
+    def allow(self, now=None):
+        """
+        Return True if a connect attempt may go ahead. In the half open state,
+        only one attempt is allowed until it succeeds or fails. If the probe's
+        owner never reports back, another probe is allowed after the current
+        cool-down.
+        """
+        now = now or time.time()
+        if self.opened is None:
+            return True
+        if now < self.opened + self.wait:
+            return False
+        if self.probing and now < self.probing + self.wait:
+            return False
+        self.probing = now
+        return True
+
+    # -------------------------------------------------------------------------
+    def configure(self):
+        """
+        Read the settings from the configuration if it has been replaced or
+        reloaded since we last read them, so the crawler picks up changes to
+        crawl.cfg without a restart
+        """
+        cfg = CrawlConfig.get_config()
+        if cfg is self.source and cfg.loadtime == self.loadtime:
+            return
+        self.failures = max(1, int(cfg.get_d('crawler',
+                                             'hsi_breaker_failures', 3)))
+        self.cooldown = cfg.get_time('crawler', 'hsi_breaker_cooldown', 60)
+        self.max_cooldown = cfg.get_time('crawler', 'hsi_breaker_max_cooldown',
+                                         3600)
+        self.source = cfg
+        self.loadtime = cfg.loadtime
+
+    # -------------------------------------------------------------------------
+    def failure(self, now=None):
+        """
+        Count a failed connect attempt, opening the breaker if there have
+        been enough of them in a row or if the attempt was the half open
+        probe
+        """
+        now = now or time.time()
+        self.configure()
+        self.count += 1
+        if self.opened is not None:
+            if self.probing is None:
+                # a session started before the breaker opened
+                return
+            self.wait = min(self.wait * 2, self.max_cooldown)
+        elif self.count < self.failures:
+            return
+        else:
+            self.wait = self.cooldown
+        self.opened = now
+        self.probing = None
+        CrawlConfig.log(MSG.hsi_breaker_open_dd % (self.count, self.wait))
+        metrics.gauge('hpssic_hsi_breaker_open', 1)
+
+    # -------------------------------------------------------------------------
+    def is_open(self, now=None):
+        """
+        Return True if a connect attempt would be refused right now. Unlike
+        allow(), this does not use up the half open probe.
+        """
+        now = now or time.time()
+        if self.opened is None:
+            return False
+        if now < self.opened + self.wait:
+            return True
+        return self.probing is not None and now < self.probing + self.wait
+
+    # -------------------------------------------------------------------------
+    def remaining(self, now=None):
+        """
+        Return the number of seconds until the breaker will half open
+        """
+        now = now or time.time()
+        if self.opened is None:
+            return 0
+        return max(0, self.opened + self.wait - now)
+
+    # -------------------------------------------------------------------------
+    def reset(self):
+        """
+        Close the breaker and forget past failures
+        """
+        self.count = 0
+        self.opened = None
+        self.probing = None
+        self.wait = 0
+
+    # -------------------------------------------------------------------------
+    def success(self):
+        """
+        Record a successful connect, closing the breaker
+        """
+        if self.opened is not None:
+            CrawlConfig.log(MSG.hsi_breaker_closed)
+            metrics.gauge('hpssic_hsi_breaker_open', 0)
+        self.reset()
+
+
+breaker = CircuitBreaker()
+
+
 # -----------------------------------------------------------------------------
 def maybe_update_hsi():
     """
@@ -67,6 +221,15 @@ class HSI(object):
                "checksum not set",
                "HPSS_ESYSTEM"]
 
+    # commands sent and the seconds spent waiting for them to finish, summed
+    # over all sessions
+    cmd_count = 0
+    cmd_secs = 0.0
+
+    # how many paths to list, or touch commands to send, on one line when
+    # saving and restoring access times
+    atime_batch = 50
+
     # -------------------------------------------------------------------------
     def __init__(self, connect=True, *args, **kwargs):
         """
@@ -76,6 +239,8 @@ class HSI(object):
         self.verbose = False
         self.unavailable = False
         self.xobj = None
+        self.sent = None
+        self.sent_cmd = ''
         self.timeout = 60
 
         cmdopts = " ".join(args)
@@ -89,6 +254,15 @@ class HSI(object):
         if not hasattr(self, 'hash_algorithm'):
             self.hash_algorithm = cfg.get_d('cv', 'hash_algorithm', None)
 
+        # A verbose session's transcript goes next to the crawler log unless
+        # hsi_log in [crawler] says otherwise
+        if not hasattr(self, 'logpath'):
+            self.logpath = cfg.get_d('crawler', 'hsi_log', '')
+            if self.logpath == '':
+                logdir = os.path.dirname(cfg.get_d('crawler', 'logpath',
+                                                   util.default_logpath()))
+                self.logpath = os.path.join(logdir, 'hsi.out')
+
         maybe_update_hsi()
         self.cmd = "hsi " + cmdopts
         if connect:
@@ -106,21 +280,52 @@ class HSI(object):
         """
         Change directories in HPSS
         """
-        self.xobj.sendline("cd %s" % dirname)
-        self.xobj.expect(self.prompt)
+        self.send("cd %s" % dirname)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
-    def connect(self):
+    def connect(self, wait=True):
         """
-        Connect to HPSS
+        Connect to HPSS. If wait is False, just start the hsi process and
+        leave it to the caller to look for the first prompt (see HSImux).
+
+        While the circuit breaker is open, this raises HSIerror at once
+        without starting hsi.
         """
-        self.xobj = pexpect.spawn(self.cmd, timeout=self.timeout)
+        if not breaker.allow():
+            raise HSIerror(MSG.hpss_unavailable)
+        try:
+            self.xobj = pexpect.spawn(self.cmd, timeout=self.timeout)
+        except (OSError, pexpect.ExceptionPexpect):
+            breaker.failure()
+            raise
         if self.verbose:
-            self.xobj.logfile = open("hsi.out", 'a')
-        which = self.xobj.expect([self.prompt, pexpect.EOF] + self.hsierrs)
+            self.xobj.logfile = open(self.logpath, 'a')
+        if not wait:
+            return
+        which = self.xobj.expect([self.prompt, pexpect.EOF, pexpect.TIMEOUT] +
+                                 self.hsierrs)
         if 0 != which or self.unavailable:
-            raise HSIerror("HPSS Unavailable")
+            breaker.failure()
+            raise HSIerror(MSG.hpss_unavailable)
+        breaker.success()
+
+    # -------------------------------------------------------------------------
+    def expect(self, pattern, **kwargs):
+        """
+        Wait for *pattern* in the session's output. If the wait ends other than
+        by timing out, the command sent last is done and its latency is added
+        to HSI.cmd_secs and the hsi command latency metric.
+        """
+        which = self.xobj.expect(pattern, **kwargs)
+        if self.xobj.match is not pexpect.TIMEOUT and self.sent is not None:
+            secs = time.time() - self.sent
+            HSI.cmd_secs += secs
+            metrics.observe('hpssic_hsi_command_seconds', secs,
+                            command=self.sent_cmd)
+            self.sent = None
+        return which
 
     # -------------------------------------------------------------------------
     def hashcreate(self, pathnames):
@@ -129,43 +334,37 @@ class HSI(object):
         string containing one or more space separated file paths, or a list of
         one or more file paths. If it has type unicode, it will be encoded to
         'ascii' before being treated as a string.
+
+        If reset_atime is set, the access times of all the files are captured
+        before the first hashcreate and restored after the last one (see
+        access_times() and restore_atimes()).
         """
-        if type(pathnames) == str:
-            pathlist = pathnames.split()
-        elif type(pathnames) == list:
-            pathlist = pathnames
-        elif type(pathnames) == unicode:
-            pathlist = pathnames.encode('ascii', 'ignore').split()
-        else:
-            raise HSIerror("%s: Invalid argument (%s: '%s')" %
-                           (util.my_name(), type(pathnames), pathnames))
+        paths = pathlist(pathnames)
         rval = ""
-        for path in pathlist:
-            if self.reset_atime:
-                prev_time = self.access_time(path)
-
+        if self.reset_atime:
+            atimes = self.access_times(paths)
+        for path in paths:
             if self.hash_algorithm is None:
                 cmd = "hashcreate %s" % path
             else:
                 cmd = "hashcreate -H %s %s" % (self.hash_algorithm, path)
-            self.xobj.sendline(cmd)
-            which = self.xobj.expect([self.prompt, pexpect.TIMEOUT] +
-                                     self.hsierrs)
+            self.send(cmd)
+            which = self.expect([self.prompt, pexpect.TIMEOUT] +
+                                self.hsierrs)
             while which == 1 and 1 < len(self.xobj.before):
                 CrawlConfig.log("got a timeout, continuing because before " +
                                 "is not empty and does not contain an error")
                 rval += self.xobj.before
-                which = self.xobj.expect([self.prompt, pexpect.TIMEOUT] +
-                                         self.hsierrs)
+                which = self.expect([self.prompt, pexpect.TIMEOUT] +
+                                    self.hsierrs)
             rval += self.xobj.before
             if 1 == which:
                 rval += " TIMEOUT"
             elif 0 != which:
                 rval += " ERROR"
 
-            if self.reset_atime:
-                self.touch(path, when=prev_time)
-
+        if self.reset_atime:
+            self.restore_atimes(atimes)
         return rval
 
     # -------------------------------------------------------------------------
@@ -175,18 +374,10 @@ class HSI(object):
         string containing one or more space separated file paths, or a list of
         one or more file paths.
         """
-        if type(pathnames) == str:
-            pargs = pathnames
-        elif type(pathnames) == list:
-            pargs = " ".join(pathnames)
-        elif type(pathnames) == unicode:
-            pargs = pathname.encode('ascii', 'ignore')
-        else:
-            raise HSIerror("%s: Invalid argument (%s: '%s')" %
-                           (util.my_name(), type(pathnames), pathnames))
+        pargs = " ".join(pathlist(pathnames))
 
-        self.xobj.sendline("hashdelete %s" % pargs)
-        self.xobj.expect(self.prompt)
+        self.send("hashdelete %s" % pargs)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -196,18 +387,10 @@ class HSI(object):
         string containing one or more space separated file paths, or a list of
         one or more file paths.
         """
-        if type(pathnames) == str:
-            pargs = pathnames
-        elif type(pathnames) == list:
-            pargs = " ".join(pathnames)
-        elif type(pathnames) == unicode:
-            pargs = pathnames.encode('ascii', 'ignore')
-        else:
-            raise HSIerror("%s: Invalid argument (%s: '%s')" %
-                           (util.my_name(), type(pathnames), pathnames))
+        pargs = " ".join(pathlist(pathnames))
 
-        self.xobj.sendline("hashlist %s" % pargs)
-        self.xobj.expect(self.prompt)
+        self.send("hashlist %s" % pargs)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -216,39 +399,33 @@ class HSI(object):
         Argument pathnames should reference be one or more files. It may be a
         string containing one or more space separated file paths, or a list of
         one or more file paths.
+
+        If reset_atime is set, the access times are handled as in
+        hashcreate().
         """
-        if type(pathnames) == str:
-            pathlist = pathnames.split()
-        elif type(pathnames) == list:
-            pathlist = pathnames
-        elif type(pathnames) == unicode:
-            pathlist = pathnames.encode('ascii', 'ignore').split()
-        else:
-            raise HSIerror("%s: Invalid argument (%s: '%s')" %
-                           (util.my_name(), type(pathnames), pathnames))
+        paths = pathlist(pathnames)
 
         rval = ""
-        for path in pathlist:
-            if self.reset_atime:
-                prev_time = self.access_time(path)
-
-            self.xobj.sendline("hashverify %s" % path)
-            which = self.xobj.expect([self.prompt, pexpect.TIMEOUT] +
-                                     self.hsierrs)
+        if self.reset_atime:
+            atimes = self.access_times(paths)
+        for path in paths:
+            self.send("hashverify %s" % path)
+            which = self.expect([self.prompt, pexpect.TIMEOUT] +
+                                self.hsierrs)
             while which == 1 and 1 < len(self.xobj.before):
                 CrawlConfig.log("got a timeout, continuing because before " +
                                 "is not empty and does not contain an error")
                 rval += self.xobj.before
-                which = self.xobj.expect([self.prompt, pexpect.TIMEOUT] +
-                                         self.hsierrs)
+                which = self.expect([self.prompt, pexpect.TIMEOUT] +
+                                    self.hsierrs)
             rval += self.xobj.before
             if 1 == which:
                 rval += " TIMEOUT"
             elif 0 != which:
                 rval += " ERROR"
 
-            if self.reset_atime:
-                self.touch(path, when=prev_time)
+        if self.reset_atime:
+            self.restore_atimes(atimes)
         return rval
 
     # -------------------------------------------------------------------------
@@ -256,43 +433,28 @@ class HSI(object):
         """
         Call ls_access() and convert the result to an epoch time
         """
-        result = self.ls_access(pathname)
-
-        # get the list of month names and corresponding month numbers
-        month = util.month_dict()
-
-        # build the regular expression and parse the string
-        rgx = ('(' + '|'.join(month.keys()) + ')' +
-               "\s+(\d+)\s+(\d+):(\d+):(\d+)\s+(\d+)")
-        x = re.findall(rgx, result)
-
-        # peel the list
-        z = x[0]
-
-        # convert the matches to ints and put them in the proper order
-        # (y, m, d, h, m, s)
-        dt = [int(x) for x in
-              [z[5], month[z[0]], z[1], z[2], z[3], z[4], 0, 0, 0]]
-
-        # construct a candidate date
-        epoch = time.mktime(dt)
-
-        # run it through localtime to find out whether DST is set or not
-        q = time.localtime(epoch)
-        dt[-1] = q[-1]
+        return atime_parse(self.ls_access(pathname))
 
-        # now compute the correct epoch time with the correct dst setting
-        epoch = time.mktime(dt)
-
-        return epoch
+    # -------------------------------------------------------------------------
+    def access_times(self, pathlist):
+        """
+        Return a dict mapping the paths in *pathlist* to their access times,
+        listing atime_batch of them per 'ls -lDTr'. Paths hsi can't list are
+        left out.
+        """
+        rval = {}
+        for idx in range(0, len(pathlist), self.atime_batch):
+            part = pathlist[idx:idx + self.atime_batch]
+            rval.update(atimes_parse(self.ls_access(" ".join(part))))
+        return rval
 
     # -------------------------------------------------------------------------
     def ls_access(self, pathname=''):
         """
         Return the result of 'ls -lDTr *pathname*'
         """
-        self.xobj.sendline("ls -lDTr %s" % pathname)
-        self.xobj.expect(self.prompt)
+        self.send("ls -lDTr %s" % pathname)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -300,8 +462,8 @@ class HSI(object):
         """
         Retrieve the COS descriptive info from HPSS and return it
         """
-        self.xobj.sendline("lscos")
-        self.xobj.expect(self.prompt)
+        self.send("lscos")
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -311,18 +473,10 @@ class HSI(object):
         string containing zero or more space separated file paths, or a list of
         zero or more file paths.
         """
-        if type(pathnames) == str:
-            parg = pathnames
-        elif type(pathnames) == list:
-            parg = " ".join(pathnames)
-        elif type(pathnames) == unicode:
-            parg = pathnames.encode('ascii', 'ignore')
-        else:
-            raise HSIerror("%s: Invalid argument (%s: '%s')" %
-                           (util.my_name(), type(pathnames), pathnames))
+        parg = " ".join(pathlist(pathnames))
 
-        self.xobj.sendline("ls -P %s" % parg)
-        self.xobj.expect(self.prompt)
+        self.send("ls -P %s" % parg)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -349,6 +503,37 @@ class HSI(object):
             for line in tbstr.split("\n"):
                 CrawlConfig.log(line)
 
+    # -------------------------------------------------------------------------
+    def restore_atimes(self, atimes):
+        """
+        Set the access time of each path in dict *atimes* back to the time it
+        maps to. Paths with the same time share a touch command, and the
+        commands go atime_batch to a line, separated by ';', so hsi runs them
+        all in one round trip.
+        """
+        groups = {}
+        for (path, when) in atimes.items():
+            groups.setdefault(when, []).append(path)
+        cmds = ["touch -a -t %s %s" % (self.touch_format(when),
+                                       " ".join(sorted(paths)))
+                for (when, paths) in sorted(groups.items())]
+        rval = ""
+        for idx in range(0, len(cmds), self.atime_batch):
+            self.send(" ; ".join(cmds[idx:idx + self.atime_batch]))
+            self.expect(self.prompt)
+            rval += self.xobj.before
+        return rval
+
+    # -------------------------------------------------------------------------
+    def send(self, cmd):
+        """
+        Send *cmd* to hsi, counting it in HSI.cmd_count
+        """
+        self.xobj.sendline(cmd)
+        self.sent = time.time()
+        self.sent_cmd = (cmd.split() or [''])[0]
+        HSI.cmd_count += 1
+
     # -------------------------------------------------------------------------
     def touch(self, filename, when=None):
         """
@@ -358,8 +543,8 @@ class HSI(object):
             return ""
 
         cmd = "touch -a -t %s %s" % (self.touch_format(when), filename)
-        self.xobj.sendline(cmd)
-        self.xobj.expect(self.prompt)
+        self.send(cmd)
+        self.expect(self.prompt)
         return self.xobj.before
 
     # -------------------------------------------------------------------------
@@ -368,3 +553,549 @@ class HSI(object):
         Return *when* in the format touch expects
         """
         return time.strftime("%Y%m%d%H%M.%S", time.localtime(when))
+
+
+# -----------------------------------------------------------------------------
+def atime_epoch(z):
+    """
+    Convert the groups matched by atime_rgx to an epoch time
+    """
+    # convert the matches to ints and put them in the proper order
+    # (y, m, d, h, m, s)
+    dt = [int(x) for x in
+          [z[5], month[z[0]], z[1], z[2], z[3], z[4], 0, 0, 0]]
+
+    # construct a candidate date
+    epoch = time.mktime(dt)
+
+    # run it through localtime to find out whether DST is set or not
+    q = time.localtime(epoch)
+    dt[-1] = q[-1]
+
+    # now compute the correct epoch time with the correct dst setting
+    epoch = time.mktime(dt)
+
+    return epoch
+
+
+# -----------------------------------------------------------------------------
+def atime_parse(result):
+    """
+    Convert the access time in the output of 'ls -lDTr' to an epoch time
+    """
+    return atime_epoch(atime_rgx.findall(result)[0])
+
+
+# -----------------------------------------------------------------------------
+def atimes_parse(result):
+    """
+    Return a dict mapping each path in the output of 'ls -lDTr' on several
+    paths to its access time as an epoch time
+    """
+    return dict([(m.group(7), atime_epoch(m.groups()))
+                 for m in atime_rgx.finditer(result) if m.group(7)])
+
+
+# -----------------------------------------------------------------------------
+def hashlist_parse(result):
+    """
+    Return a dict mapping each path in the output of 'hashlist' to True if it
+    has a checksum or False if hsi says '(none)'. Paths hsi reported an error
+    for are left out.
+    """
+    rval = {}
+    for line in result.splitlines():
+        m = re.match("\s*([0-9a-f]{8,})\s+\w+\s+(\S+)", line)
+        if m:
+            rval[m.group(2)] = True
+            continue
+        m = re.match("\s*\(none\)\s+(\S+)", line)
+        if m:
+            rval[m.group(1)] = False
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def hashlist_values(result):
+    """
+    Return a dict mapping each path in the output of 'hashlist' that has a
+    checksum to a tuple (algorithm, hex digest)
+    """
+    rval = {}
+    for line in result.splitlines():
+        m = re.match("\s*([0-9a-f]{8,})\s+(\w+)\s+(\S+)", line)
+        if m:
+            rval[m.group(3)] = (m.group(2), m.group(1))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+def pathlist(pathnames):
+    """
+    Argument pathnames may be a string containing space separated file paths,
+    a list of file paths, or a unicode string (encoded to 'ascii' before being
+    treated as a string). Return the paths as a list of strings.
+    """
+    if type(pathnames) == str:
+        rval = pathnames.split()
+    elif type(pathnames) == list:
+        rval = [p.encode('ascii', 'ignore') if type(p) == unicode else p
+                for p in pathnames]
+    elif type(pathnames) == unicode:
+        rval = pathnames.encode('ascii', 'ignore').split()
+    else:
+        # name the method that was handed the bad argument
+        raise HSIerror("%s: Invalid argument (%s: '%s')" %
+                       (sys._getframe(1).f_code.co_name, type(pathnames),
+                        pathnames))
+    return rval
+
+
+# -----------------------------------------------------------------------------
+class HSIjob(object):
+    """
+    A command (or a short sequence of commands) submitted to an HSImux. Like a
+    future, a job can be asked whether it's done() and its output collected
+    with result(), which will drive the HSImux until the job finishes if
+    necessary.
+
+    Each step is a tuple (cmd, keep). Cmd is either a command string or a
+    callable that takes the job and returns a command string (or None to skip
+    the step). If keep is True, the step's output goes into the job's result.
+    Once a step fails with an error or timeout, the remaining steps are
+    skipped.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, mux, steps, timeout):
+        """
+        Set up a queued job
+        """
+        self.mux = mux
+        self.steps = steps
+        self.timeout = timeout
+        self.outputs = []
+        self.output = ''
+        self.error = ''
+        self.status = 'queued'
+        self.hsi = None
+        self.deadline = None
+        self.seen = 0
+        self.draining = False
+        self.started = None
+        self.finished = None
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Return a human-readable representation of the job
+        """
+        return "HSIjob(%s, status=%s%s)" % (
+            [x[0] for x in self.steps if not callable(x[0])],
+            self.status,
+            ", error=%s" % self.error if self.error else '')
+
+    # -------------------------------------------------------------------------
+    def done(self):
+        """
+        Return True if the job has finished, successfully or not
+        """
+        return self.status == 'done'
+
+    # -------------------------------------------------------------------------
+    def elapsed(self):
+        """
+        Return how long the job ran (or has been running) in seconds
+        """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    # -------------------------------------------------------------------------
+    def result(self, timeout=None):
+        """
+        Wait for the job to finish if necessary and return its output. As with
+        the HSI methods, the output ends with ' TIMEOUT' or ' ERROR' if the
+        command did not complete normally. If *timeout* (seconds) passes
+        before the job finishes, the output so far is returned.
+        """
+        if not self.done():
+            self.mux.wait([self], timeout=timeout)
+        return self.output
+
+
+# -----------------------------------------------------------------------------
+class HSImux(object):
+    """
+    Drive several hsi sessions from a single thread. Commands are queued as
+    HSIjob objects and handed to idle sessions. poll() uses select() to see
+    which sessions have output waiting, so one process can keep many
+    hashverify or hashcreate operations in flight at the same time.
+
+        mux = hpss.HSImux(sessions=8)
+        jobs = mux.hashverify(pathlist)
+        for job in mux.as_completed(jobs):
+            print job.result()
+        mux.quit()
+
+    Each command gets its own timeout. The clock restarts whenever the command
+    produces more output, so a long transfer that is still reporting progress
+    is not cut off. A session whose command times out or whose hsi process
+    exits is closed and replaced as needed. If a session cannot connect, no
+    more are started and queued jobs fail with ' ERROR' once the remaining
+    sessions are gone.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, sessions=4, timeout=60, *args, **kwargs):
+        """
+        Set up the multiplexor. Sessions are started as work arrives, up to
+        *sessions* of them. *timeout* is the default per-command timeout.
+        Other arguments are passed to the HSI constructor.
+        """
+        self.size = sessions
+        self.timeout = timeout
+        self.args = args
+        self.kwargs = kwargs
+
+        cfg = CrawlConfig.get_config()
+        if 'reset_atime' not in kwargs:
+            self.kwargs['reset_atime'] = cfg.getboolean('cv', 'reset_atime')
+        if 'hash_algorithm' not in kwargs:
+            self.kwargs['hash_algorithm'] = cfg.get_d('cv', 'hash_algorithm',
+                                                      None)
+        self.reset_atime = self.kwargs['reset_atime']
+        self.hash_algorithm = self.kwargs['hash_algorithm']
+
+        self.queue = collections.deque()
+        self.idle = []
+        self.busy = {}
+        self.connecting = {}
+        self.unavailable = False
+        self.opened = 0
+
+    # -------------------------------------------------------------------------
+    def as_completed(self, jobs):
+        """
+        Generate the jobs in *jobs* in the order they finish
+        """
+        pending = list(jobs)
+        while pending:
+            for job in [x for x in pending if x.done()]:
+                pending.remove(job)
+                yield job
+            if pending:
+                self.poll(wait=1.0)
+
+    # -------------------------------------------------------------------------
+    def hashcreate(self, pathnames, timeout=None):
+        """
+        Queue a hashcreate for each path in *pathnames* and return the list of
+        jobs
+        """
+        if self.hash_algorithm is None:
+            fmt = "hashcreate %s"
+        else:
+            fmt = "hashcreate -H %s %%s" % self.hash_algorithm
+        return [self.submit(self.atime_steps(path, fmt % path), timeout)
+                for path in pathlist(pathnames)]
+
+    # -------------------------------------------------------------------------
+    def hashlist(self, pathnames, timeout=None):
+        """
+        Queue one hashlist command for all of *pathnames* and return the job
+        """
+        return self.submit("hashlist %s" % " ".join(pathlist(pathnames)),
+                           timeout)
+
+    # -------------------------------------------------------------------------
+    def hashverify(self, pathnames, timeout=None):
+        """
+        Queue a hashverify for each path in *pathnames* and return the list of
+        jobs
+        """
+        return [self.submit(self.atime_steps(path, "hashverify %s" % path),
+                            timeout)
+                for path in pathlist(pathnames)]
+
+    # -------------------------------------------------------------------------
+    def lsP(self, pathnames='', timeout=None):
+        """
+        Queue one 'ls -P' command for all of *pathnames* and return the job
+        """
+        return self.submit("ls -P %s" % " ".join(pathlist(pathnames)),
+                           timeout)
+
+    # -------------------------------------------------------------------------
+    def atime_steps(self, path, cmd):
+        """
+        Return the steps for running *cmd* on *path*. If reset_atime is set,
+        the access time of *path* is captured before *cmd* and restored after,
+        as HSI.hashcreate() and HSI.hashverify() do.
+        """
+        if not self.reset_atime:
+            return [(cmd, True)]
+
+        def restore(job):
+            try:
+                when = atime_parse(job.outputs[0])
+            except (IndexError, KeyError, ValueError):
+                return None
+            return "touch -a -t %s %s" % (job.hsi.touch_format(when), path)
+
+        return [("ls -lDTr %s" % path, False), (cmd, True), (restore, False)]
+
+    # -------------------------------------------------------------------------
+    def outstanding(self):
+        """
+        Return the number of jobs queued or running
+        """
+        return len(self.queue) + len(self.busy)
+
+    # -------------------------------------------------------------------------
+    def poll(self, wait=0.0):
+        """
+        Wait up to *wait* seconds (None means until something happens) for
+        output from any session, process what arrived, hand queued jobs to
+        idle sessions, and return the list of jobs that finished.
+        """
+        finished = []
+        self.dispatch(finished)
+        if not self.busy and not self.connecting:
+            return finished
+
+        now = time.time()
+        deadlines = [j.deadline for (h, j) in self.busy.values()]
+        deadlines.extend([d for (h, d) in self.connecting.values()])
+        wait = max(0.0, min(deadlines) - now) if wait is None else \
+            max(0.0, min([wait] + [d - now for d in deadlines]))
+
+        # output already read into a pexpect buffer but not yet examined won't
+        # make select() fire, so we look at those sessions right away
+        buffered = [fd for (fd, (h, j)) in self.busy.items()
+                    if j.seen < len(h.xobj.buffer)]
+        if buffered:
+            wait = 0.0
+
+        fdl = self.busy.keys() + self.connecting.keys()
+        try:
+            (ready, w, x) = select.select(fdl, [], [], wait)
+        except select.error:
+            ready = []
+        ready.extend(buffered)
+
+        now = time.time()
+        for fd in self.connecting.keys():
+            (h, deadline) = self.connecting[fd]
+            if fd in ready or deadline < now:
+                self.connected(fd, h, deadline, now)
+
+        for fd in self.busy.keys():
+            (h, job) = self.busy[fd]
+            if fd in ready or job.deadline < now:
+                self.advance(fd, h, job, now, finished)
+
+        self.dispatch(finished)
+        return finished
+
+    # -------------------------------------------------------------------------
+    def quit(self):
+        """
+        Shut down all the sessions. Jobs still queued or running fail with
+        ' ERROR'.
+        """
+        for (h, job) in self.busy.values():
+            self.finish(job, 'ERROR', [])
+            self.close(h)
+        for (h, deadline) in self.connecting.values():
+            self.close(h)
+        for h in self.idle:
+            h.quit()
+        while self.queue:
+            self.finish(self.queue.popleft(), 'ERROR', [])
+        self.busy = {}
+        self.connecting = {}
+        self.idle = []
+
+    # -------------------------------------------------------------------------
+    def submit(self, steps, timeout=None):
+        """
+        Queue a job and return it. *steps* is a command string or a list of
+        steps as described in HSIjob.
+        """
+        if type(steps) == str:
+            steps = [(steps, True)]
+        job = HSIjob(self, steps, timeout or self.timeout)
+        self.queue.append(job)
+        self.dispatch([])
+        return job
+
+    # -------------------------------------------------------------------------
+    def wait(self, jobs=None, timeout=None):
+        """
+        Drive the sessions until all of *jobs* (default: everything queued or
+        running) are done or *timeout* seconds have passed. Return the list of
+        jobs that finished.
+        """
+        if jobs is None:
+            jobs = list(self.queue) + [j for (h, j) in self.busy.values()]
+        if timeout is not None:
+            end = time.time() + timeout
+        while not all([j.done() for j in jobs]):
+            if timeout is None:
+                self.poll(wait=1.0)
+            elif time.time() < end:
+                self.poll(wait=min(1.0, end - time.time()))
+            else:
+                break
+        return [j for j in jobs if j.done()]
+
+    # -------------------------------------------------------------------------
+    def advance(self, fd, h, job, now, finished):
+        """
+        Look for the end of the current step of *job* in the output of session
+        *h* and start the next step if there is one.
+        """
+        which = h.expect([h.prompt, pexpect.TIMEOUT, pexpect.EOF] +
+                         h.hsierrs, timeout=0)
+        if 1 == which:
+            if job.seen < len(h.xobj.buffer):
+                job.seen = len(h.xobj.buffer)
+                job.deadline = now + job.timeout
+            elif job.deadline < now:
+                job.outputs.append(h.xobj.buffer)
+                del self.busy[fd]
+                self.close(h)
+                self.finish(job, 'TIMEOUT', finished)
+            return
+
+        job.seen = 0
+        if 0 == which:
+            if job.draining:
+                job.outputs[-1] += h.xobj.before
+                job.draining = False
+                del self.busy[fd]
+                self.idle.append(h)
+                self.finish(job, 'ERROR', finished)
+                return
+            job.outputs.append(h.xobj.before)
+            if not self.start_step(h, job, now):
+                del self.busy[fd]
+                self.idle.append(h)
+                self.finish(job, '', finished)
+        elif 2 == which:
+            job.outputs.append(h.xobj.before)
+            del self.busy[fd]
+            self.close(h)
+            self.finish(job, 'ERROR', finished)
+        else:
+            # an hsi error message -- wait for the prompt that follows it so
+            # the session is ready for the next command
+            job.outputs.append(h.xobj.before + h.xobj.after)
+            job.draining = True
+            job.deadline = now + job.timeout
+
+    # -------------------------------------------------------------------------
+    def close(self, h):
+        """
+        Get rid of a session that is not responding properly
+        """
+        try:
+            h.xobj.close(force=True)
+        except (OSError, pexpect.ExceptionPexpect) as e:
+            CrawlConfig.log("Ignoring '%s' closing hsi" % str(e))
+
+    # -------------------------------------------------------------------------
+    def connected(self, fd, h, deadline, now):
+        """
+        See whether a starting session has given us its first prompt
+        """
+        which = h.xobj.expect([h.prompt, pexpect.TIMEOUT, pexpect.EOF] +
+                              h.hsierrs, timeout=0)
+        if 1 == which and now <= deadline:
+            return
+        del self.connecting[fd]
+        if 0 == which:
+            breaker.success()
+            self.idle.append(h)
+        else:
+            CrawlConfig.log("hsi session failed to connect: %s" %
+                            h.xobj.before)
+            breaker.failure()
+            self.close(h)
+            self.unavailable = True
+
+    # -------------------------------------------------------------------------
+    def dispatch(self, finished):
+        """
+        Hand queued jobs to idle sessions, start more sessions if there is
+        work waiting and room for them, and fail the queue if HPSS is
+        unavailable and no sessions are left to do the work.
+        """
+        now = time.time()
+        while self.queue and self.idle:
+            h = self.idle.pop()
+            job = self.queue.popleft()
+            job.hsi = h
+            job.status = 'running'
+            job.started = now
+            if self.start_step(h, job, now):
+                self.busy[h.xobj.child_fd] = (h, job)
+            else:
+                self.idle.append(h)
+                self.finish(job, '', finished)
+
+        sessions = len(self.idle) + len(self.busy) + len(self.connecting)
+        while (not self.unavailable and
+               len(self.connecting) < len(self.queue) and
+               sessions < self.size):
+            try:
+                h = HSI(False, *self.args, **self.kwargs)
+                h.connect(wait=False)
+                self.connecting[h.xobj.child_fd] = (h, now + h.timeout)
+                self.opened += 1
+                sessions += 1
+            except (HSIerror, OSError, pexpect.ExceptionPexpect) as e:
+                CrawlConfig.log("unable to start hsi: %s" % str(e))
+                self.unavailable = True
+
+        if self.unavailable and 0 == sessions:
+            while self.queue:
+                job = self.queue.popleft()
+                job.outputs.append(MSG.hpss_unavailable)
+                self.finish(job, 'ERROR', finished)
+
+        metrics.gauge('hpssic_queue_depth', self.outstanding(), queue='hsimux')
+
+    # -------------------------------------------------------------------------
+    def finish(self, job, error, finished):
+        """
+        Mark *job* done, assemble its output, and add it to *finished*
+        """
+        kept = [out for (out, step) in zip(job.outputs, job.steps) if step[1]]
+        job.output = "".join(kept)
+        if error:
+            # make sure the output of the step that failed is reported
+            if job.outputs and not job.steps[len(job.outputs) - 1][1]:
+                job.output += job.outputs[-1]
+            job.error = error
+            job.output += " " + error
+        job.status = 'done'
+        job.finished = time.time()
+        finished.append(job)
+
+    # -------------------------------------------------------------------------
+    def start_step(self, h, job, now):
+        """
+        Send the next command of *job* to session *h*. Return False if there
+        are no more steps.
+        """
+        while len(job.outputs) < len(job.steps):
+            (cmd, keep) = job.steps[len(job.outputs)]
+            if callable(cmd):
+                cmd = cmd(job)
+            if cmd is None:
+                job.outputs.append('')
+                continue
+            h.send(cmd)
+            job.deadline = now + job.timeout
+            return True
+        return False
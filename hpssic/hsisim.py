@@ -0,0 +1,503 @@
+"""
+A stand-in for hsi, for measuring the crawler without a live HPSS
+
+The simulator speaks enough of hsi's protocol for the crawler -- the prompt,
+'ls -P', 'ls -lDTr', 'touch', 'hashlist', 'hashcreate', 'hashverify',
+'get', 'lscos', 'cd', and 'quit' -- against a synthetic namespace computed
+from the path names, so there's nothing to set up but the shape of the tree.
+Several commands can be given on one line, separated by ';'. Commands given
+on the command line ('hsi -q "get - : /sim/f0000"') are run without the
+banner or prompt, as hsi does, which is how a file's content is streamed.
+
+install() writes 'hsi' wrappers that run the simulator where hpss.HSI will
+find them. The simulator takes its settings from the environment:
+
+    HSISIM_ROOT     top of the namespace (/sim)
+    HSISIM_SHAPE    depth,fanout,files: how many levels of directories below
+                    the root, how many subdirectories in each directory above
+                    the bottom level, and how many files in every directory
+                    (2,4,10)
+    HSISIM_LATENCY  seconds each command takes (0)
+    HSISIM_MOUNT    seconds to mount a cartridge, paid by hashcreate and
+                    hashverify when the file is not on the cartridge the
+                    session last used (0)
+    HSISIM_ERRORS   fraction of hashcreate and hashverify commands that fail
+                    with a transfer error (0)
+    HSISIM_HASHED   fraction of files that have a checksum to begin with (0)
+    HSISIM_CARTS    'yes' to show cartridge names in 'ls -P' output (no)
+    HSISIM_STATE    directory where sessions share the checksums created
+                    with hashcreate and log their commands (none: checksums
+                    last as long as the session and nothing is logged)
+"""
+import hashlib
+import os
+import random
+import sys
+import time
+import zlib
+
+cos_list = [('5081', 'X_Tape_1_Copy', 1, '0', '16MB'),
+            ('6001', 'Sim_Disk_1_Copy', 1, '0', '1GB'),
+            ('6002', 'Sim_Tape_2_Copy', 2, '0', '64GB'),
+            ('6003', 'Sim_Tape_3_Copy', 3, '0', '1TB')]
+
+
+# -----------------------------------------------------------------------------
+def install(where):
+    """
+    Write an hsi wrapper that runs the simulator into *where*/bin and
+    *where*/sources/hpss/bin (so hpss.maybe_update_hsi() finds a source copy
+    that matches) and return the string to put on the front of $PATH.
+    """
+    pkgroot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = "\n".join(["#!" + sys.executable,
+                        "BINARYVERSION='hsisim'",
+                        "import sys",
+                        "sys.path.insert(0, %r)" % pkgroot,
+                        "from hpssic import hsisim",
+                        "hsisim.main()",
+                        ""])
+    rval = []
+    for sub in ["bin", "sources/hpss/bin"]:
+        dname = os.path.join(where, sub)
+        if not os.path.isdir(dname):
+            os.makedirs(dname)
+        fname = os.path.join(dname, "hsi")
+        f = open(fname, 'w')
+        f.write(script)
+        f.close()
+        os.chmod(fname, 0755)
+        rval.append(dname)
+    return ":".join(rval)
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Run a simulated hsi session on stdin/stdout, or just the command given
+    on the command line
+    """
+    s = Session(os.environ)
+    args = [x for x in sys.argv[1:] if not x.startswith('-')]
+    if args:
+        sys.exit(s.run_line(" ".join(args), sys.stdout, sys.stderr))
+    s.run(sys.stdin, sys.stdout)
+
+
+# -----------------------------------------------------------------------------
+class Namespace(object):
+    """
+    The synthetic namespace. Directories are named d00, d01, ...; files are
+    named f0000, f0001, .... Everything about a file (size, cos, cartridge,
+    whether it starts out with a checksum) is derived from a hash of its
+    path, so every session sees the same tree. A file's content is its path
+    repeated out to its size, and its checksum is the md5 of that.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, root='/sim', depth=2, fanout=4, files=10, hashed=0.0,
+                 carts=False):
+        """
+        Set up the shape of the tree
+        """
+        self.root = root.rstrip('/') or '/'
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.hashed = hashed
+        self.carts = carts
+
+    # -------------------------------------------------------------------------
+    def attrs(self, path):
+        """
+        Return a dict of the attributes of file *path*
+        """
+        crc = zlib.crc32(path) & 0xffffffff
+        cos = cos_list[crc % len(cos_list)][0]
+        rval = {'size': 0 if crc % 7 == 0 else crc % 1000000,
+                'cos': cos,
+                'cart': 'S%05d' % (crc % 997),
+                'hashed': (crc % 10000) < self.hashed * 10000}
+        return rval
+
+    # -------------------------------------------------------------------------
+    def content(self, path):
+        """
+        Return the content of file *path*
+        """
+        size = self.attrs(path)['size']
+        line = path + "\n"
+        return (line * (size // len(line) + 1))[:size]
+
+    # -------------------------------------------------------------------------
+    def digest(self, path):
+        """
+        Return the md5 checksum of file *path*
+        """
+        return hashlib.md5(self.content(path)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def kind(self, path):
+        """
+        Return 'd' if *path* is a directory in the namespace, 'f' if it's a
+        file, or None if it isn't there
+        """
+        path = path.rstrip('/') or '/'
+        if path == self.root:
+            return 'd'
+        prefix = self.root.rstrip('/') + '/'
+        if not path.startswith(prefix):
+            return None
+        names = path[len(prefix):].split('/')
+        for (level, name) in enumerate(names):
+            last = level == len(names) - 1
+            if name.startswith('d') and level < self.depth:
+                if not self.index_ok(name[1:], self.fanout):
+                    return None
+                if last:
+                    return 'd'
+            elif name.startswith('f') and last:
+                return 'f' if self.index_ok(name[1:], self.files) else None
+            else:
+                return None
+        return None
+
+    # -------------------------------------------------------------------------
+    def index_ok(self, digits, limit):
+        """
+        Return True if *digits* is a number less than *limit*
+        """
+        return digits.isdigit() and int(digits) < limit
+
+    # -------------------------------------------------------------------------
+    def listing(self, path):
+        """
+        Return the list of (type, path) entries in directory *path*
+        """
+        path = path.rstrip('/') or '/'
+        base = path.rstrip('/')
+        rval = []
+        if path == self.root:
+            level = 0
+        else:
+            level = len(path[len(self.root.rstrip('/')) + 1:].split('/'))
+        if level < self.depth:
+            rval.extend([('d', "%s/d%02d" % (base, idx))
+                         for idx in range(self.fanout)])
+        rval.extend([('f', "%s/f%04d" % (base, idx))
+                     for idx in range(self.files)])
+        return rval
+
+    # -------------------------------------------------------------------------
+    def lsp_line(self, ftype, path):
+        """
+        Return the 'ls -P' line for *path*
+        """
+        if ftype == 'd':
+            return "DIRECTORY\t%s\n" % path
+        a = self.attrs(path)
+        if a['size'] == 0 or not self.carts:
+            cart = ' '
+        else:
+            cart = a['cart']
+        return ("FILE\t%s\t%d\t%d\t0+0\t%s\t%s\t0\t1\t" %
+                (path, a['size'], a['size'], cart, a['cos']) +
+                "01/02/2014\t03:04:05\t01/02/2014\t03:04:05\n")
+
+    # -------------------------------------------------------------------------
+    def total(self):
+        """
+        Return the number of (directories, files) in the tree, not counting
+        the root
+        """
+        dirs = sum([self.fanout ** n for n in range(1, self.depth + 1)])
+        return (dirs, (dirs + 1) * self.files)
+
+
+# -----------------------------------------------------------------------------
+class Session(object):
+    """
+    One simulated hsi process
+    """
+    prompt = "O:[%s]: "
+
+    # -------------------------------------------------------------------------
+    def __init__(self, env):
+        """
+        Take the settings from *env* (normally os.environ)
+        """
+        (depth, fanout, files) = [int(x) for x in
+                                  env.get('HSISIM_SHAPE', '2,4,10').split(',')]
+        self.ns = Namespace(root=env.get('HSISIM_ROOT', '/sim'),
+                            depth=depth, fanout=fanout, files=files,
+                            hashed=float(env.get('HSISIM_HASHED', '0')),
+                            carts=env.get('HSISIM_CARTS', 'no') == 'yes')
+        self.latency = float(env.get('HSISIM_LATENCY', '0'))
+        self.mount = float(env.get('HSISIM_MOUNT', '0'))
+        self.errors = float(env.get('HSISIM_ERRORS', '0'))
+        self.state = env.get('HSISIM_STATE', None)
+        self.rng = random.Random(os.getpid())
+        self.cwd = self.ns.root
+        self.mounted = None
+        self.created = set()
+        self.created_size = 0
+        self.status = 0
+
+    # -------------------------------------------------------------------------
+    def run(self, infile, outfile):
+        """
+        Read commands from *infile* and write the responses to *outfile* until
+        'quit' or EOF
+        """
+        self.log("start")
+        outfile.write("Username: sim  UID: 0  Acct: 0(sim)  " +
+                      "Copies: 1 Firewall: off [hsi.5.0.2.p5 simulated]\n")
+        outfile.write(self.prompt % self.cwd)
+        outfile.flush()
+        done = False
+        while not done:
+            line = infile.readline()
+            if not line:
+                break
+            # as with hsi, several commands can share a line, separated by ';'
+            for cmd in [x.split() for x in line.split(';')]:
+                if not cmd:
+                    continue
+                if cmd[0] in ['quit', 'exit', 'bye', 'end']:
+                    done = True
+                    break
+                self.log(cmd[0])
+                if 0 < self.latency:
+                    time.sleep(self.latency)
+                handler = getattr(self, 'do_' + cmd[0], None)
+                if handler is None:
+                    outfile.write("*** Unrecognized command: '%s'\n" %
+                                  cmd[0])
+                else:
+                    outfile.write(handler(cmd[1:]))
+            if not done:
+                outfile.write(self.prompt % self.cwd)
+                outfile.flush()
+        self.log("quit")
+
+    # -------------------------------------------------------------------------
+    def do_cd(self, args):
+        """
+        Change the working directory
+        """
+        if args and self.ns.kind(args[0]) == 'd':
+            self.cwd = args[0]
+            return ""
+        return "*** cd: No such file or directory [-2: HPSS_ENOENT]\n"
+
+    # -------------------------------------------------------------------------
+    def run_line(self, line, outfile, errfile):
+        """
+        Run the commands in *line* without the banner or prompts, writing
+        the output to *outfile* and any errors to *errfile*, and return the
+        exit status: 0 if everything worked, 1 if not
+        """
+        self.status = 0
+        self.log("start")
+        for cmd in [x.split() for x in line.split(';')]:
+            if not cmd:
+                continue
+            self.log(cmd[0])
+            if 0 < self.latency:
+                time.sleep(self.latency)
+            handler = getattr(self, 'do_' + cmd[0], None)
+            if handler is None:
+                errfile.write("*** Unrecognized command: '%s'\n" % cmd[0])
+                self.status = 1
+                continue
+            output = handler(cmd[1:])
+            if self.status == 0:
+                outfile.write(output)
+            else:
+                errfile.write(output)
+        outfile.flush()
+        self.log("quit")
+        return self.status
+
+    # -------------------------------------------------------------------------
+    def do_get(self, args):
+        """
+        Handle 'get - : path', giving back the file's content. A failure sets
+        the session's status.
+        """
+        if args[:2] != ['-', ':'] or len(args) != 3:
+            self.status = 1
+            return "*** get: only 'get - : path' is simulated\n"
+        path = args[2]
+        if self.ns.kind(path) != 'f':
+            self.status = 1
+            return self.enoent(path)
+        elif self.fail(path):
+            self.status = 1
+            return "Error -5 on transfer of %s\n" % path
+        return self.ns.content(path)
+
+    # -------------------------------------------------------------------------
+    def do_hashcreate(self, args):
+        """
+        Make up a checksum for the file and remember it
+        """
+        path = args[-1]
+        if self.ns.kind(path) != 'f':
+            return self.enoent(path)
+        if self.fail(path):
+            return "Error -5 on transfer of %s\n" % path
+        self.remember(path)
+        return "%s md5 %s (%s)\n" % (self.ns.digest(path), path, "hashcreate")
+
+    # -------------------------------------------------------------------------
+    def do_hashlist(self, args):
+        """
+        Show the checksums of the files that have them
+        """
+        rval = ""
+        for path in args:
+            if self.ns.kind(path) != 'f':
+                rval += self.enoent(path)
+            elif self.has_hash(path):
+                rval += "%s md5 %s (hashlist)\n" % (self.ns.digest(path),
+                                                    path)
+            else:
+                rval += "(none)  %s\n" % path
+        return rval
+
+    # -------------------------------------------------------------------------
+    def do_hashverify(self, args):
+        """
+        Verify a file's checksum
+        """
+        rval = ""
+        for path in args:
+            if self.ns.kind(path) != 'f':
+                rval += self.enoent(path)
+            elif not self.has_hash(path):
+                rval += "%s: no valid checksum found\n" % path
+            elif self.fail(path):
+                rval += "Error -5 on transfer of %s\n" % path
+            else:
+                rval += "%s: (md5) OK\n" % path
+        return rval
+
+    # -------------------------------------------------------------------------
+    def do_ls(self, args):
+        """
+        Handle 'ls -P' and 'ls -lDTr'
+        """
+        opts = [x for x in args if x.startswith('-')]
+        paths = [x for x in args if not x.startswith('-')] or [self.cwd]
+        rval = ""
+        for path in paths:
+            kind = self.ns.kind(path)
+            if kind is None:
+                rval += self.enoent(path)
+            elif '-P' in opts:
+                if kind == 'd':
+                    for (ftype, fpath) in self.ns.listing(path):
+                        rval += self.ns.lsp_line(ftype, fpath)
+                else:
+                    rval += self.ns.lsp_line(kind, path)
+            else:
+                size = 0 if kind == 'd' else self.ns.attrs(path)['size']
+                rval += ("%s  1 sim  sim  %d Jan 02 03:04:05 2014 %s\n" %
+                         ("drwx------" if kind == 'd' else "-rw-------",
+                          size, path))
+        return rval
+
+    # -------------------------------------------------------------------------
+    def do_lscos(self, args):
+        """
+        Describe the classes of service that files in the namespace use
+        """
+        rule = "---- " + "-" * 30 + " ---- ------ --- " + "-" * 18
+        rval = ("COS  Name                           Type Copies Acc " +
+                "File Size Range\n" + rule + "\n")
+        for (cos, name, copies, lo, hi) in cos_list:
+            rval += ("%4s %-30s  A   %d  ALL  %s - %s\n" %
+                     (cos, name, copies, lo, hi))
+        return rval + rule + "\n"
+
+    # -------------------------------------------------------------------------
+    def do_touch(self, args):
+        """
+        Accept atime updates without doing anything
+        """
+        return ""
+
+    # -------------------------------------------------------------------------
+    def enoent(self, path):
+        """
+        The message hsi gives for a path that doesn't exist
+        """
+        return ("*** hpss_Lstat: No such file or directory " +
+                "[-2: HPSS_ENOENT]\n    %s\n" % path)
+
+    # -------------------------------------------------------------------------
+    def fail(self, path):
+        """
+        Pay for mounting the file's cartridge if it isn't the one this session
+        has mounted, then decide whether this transfer fails
+        """
+        cart = self.ns.attrs(path)['cart']
+        if cart != self.mounted:
+            if 0 < self.mount:
+                time.sleep(self.mount)
+            self.mounted = cart
+        return 0 < self.errors and self.rng.random() < self.errors
+
+    # -------------------------------------------------------------------------
+    def has_hash(self, path):
+        """
+        Return True if *path* has a checksum, either from the start or from a
+        hashcreate in this or some other session
+        """
+        if self.ns.attrs(path)['hashed']:
+            return True
+        self.refresh()
+        return path in self.created
+
+    # -------------------------------------------------------------------------
+    def log(self, what):
+        """
+        Record a session event in the shared log, if there is one
+        """
+        if self.state is None:
+            return
+        f = open(os.path.join(self.state, 'log'), 'a')
+        f.write("%d %s\n" % (os.getpid(), what))
+        f.close()
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+        Pick up the checksums other sessions have created since we last
+        looked
+        """
+        if self.state is None:
+            return
+        fname = os.path.join(self.state, 'hashes')
+        if not os.path.exists(fname):
+            return
+        if os.path.getsize(fname) <= self.created_size:
+            return
+        f = open(fname, 'r')
+        f.seek(self.created_size)
+        data = f.read()
+        f.close()
+        data = data[:data.rfind("\n") + 1]
+        self.created_size += len(data)
+        self.created.update(data.split())
+
+    # -------------------------------------------------------------------------
+    def remember(self, path):
+        """
+        Record that *path* now has a checksum
+        """
+        self.created.add(path)
+        if self.state is not None:
+            f = open(os.path.join(self.state, 'hashes'), 'a')
+            f.write(path + "\n")
+            f.close()
@@ -71,13 +71,13 @@ def get_html_cv_report(db, last_rpt_time):
 
         # get the population and sample entries added since the last report
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where=dim['pop'],
                          data=(last_rpt_time,))
         (c_pop_size) = rows[0]
 
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where=dim['samp'],
                          data=(last_rpt_time,))
         (c_sample_size) = rows[0]
@@ -27,6 +27,10 @@ default_mail_subject = ("HPSS Integrity Crawler ALERT")
 
 default_piddir = ("/tmp/crawler")
 
+digest_unknown_S = ("'%s' is not a digest algorithm we can compute")
+
+dir_missing_d = ("Directory %d is not in the directories table")
+
 drop_table_string = ("On drop(), table name must be a string")
 
 drop_table_empty = ("On drop(), table name must not be empty")
@@ -57,6 +61,13 @@ history_reset_dryrun_SSS = """
 
 hpss_unavailable = ("HPSS Unavailable")
 
+hsi_breaker_closed = ("hsi connected again, HPSS circuit breaker closed")
+
+hsi_breaker_open_dd = ("%d hsi connect failures in a row, HPSS circuit " +
+                       "breaker open for %d seconds")
+
+hsi_get_failed_SS = ("hsi get of %s failed: %s")
+
 hsi_wrap_ood = ("The hsi wrapper is out of date but cannot be updated" +
                 " due to lack of write permission")
 
@@ -132,6 +143,24 @@ only_one = ("Only one of --show, --drop, or --pop is allowed")
 password_missing_rgx = ('Security processing failed with reason "\d" ' +
                         '\("PASSWORD MISSING"\)')
 
+path_layout_flat = ("The checkables table has the flat path layout " +
+                    "(run 'cv normalize' to convert it)")
+
+path_layout_normalized = ("The checkables table has the normalized path " +
+                          "layout (set path_layout = normalized in [cv])")
+
+path_layout_unknown_S = ("path_layout must be 'flat' or 'normalized', " +
+                         "not '%s'")
+
+path_where_S = ("Paths in checkables can only be updated by 'path = ?', " +
+                "not '%s'")
+
+retry_gave_up_dS = ("Giving up after %d tries: %s")
+
+sqlite_pragma_SS = ("Invalid value for sqlite_%s: '%s'")
+
+sqlite_profile_S = ("sqlite_profile must be 'fast' or 'safe', not '%s'")
+
 table_already_mysql = ("1050: Table 'test_create_already' already exists")
 
 table_already_sqlite = ("table test_create_already already exists")
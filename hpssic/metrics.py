@@ -0,0 +1,276 @@
+"""
+Counters, gauges, and latency histograms describing what the crawler is
+doing, rendered in the Prometheus text exposition format
+
+The code doing the work updates the values as it goes:
+
+    hpssic_hsi_breaker_open               1 while the hsi circuit breaker is
+                                          open (hpss.CircuitBreaker)
+    hpssic_hsi_command_seconds{command}   hsi command latency (hpss.HSI)
+    hpssic_db_query_seconds{dbtype,table,operation}
+                                          database call latency (CrawlDBI.DBI)
+    hpssic_db_retries_total{backend}      database operations retried after a
+                                          transient error (CrawlDBI)
+    hpssic_db_retry_giveups_total{backend}
+                                          retries abandoned
+    hpssic_plugin_fire_seconds{plugin}    plugin run time (CrawlPlugin.fire)
+    hpssic_plugin_errors_total{plugin}    errors reported by plugin runs
+    hpssic_items_total{plugin}            items handled by plugin runs --
+                                          rate() of this gives items/second
+    hpssic_queue_depth{queue}             jobs queued or running (HSImux)
+
+The crawler daemon calls export() once a second. If metrics_file is set in
+the [crawler] section, the values are written to that file every
+metrics_interval (default 60 seconds) for the node_exporter textfile
+collector to pick up. If metrics_port is set, they are also served at
+http://<metrics_addr>:<metrics_port>/metrics, where metrics_addr defaults to
+127.0.0.1.
+"""
+import contextlib
+import CrawlConfig
+import os
+import socket
+import threading
+import time
+import util
+
+buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, 30.0, 60.0, 300.0, 900.0]
+
+described = {
+    'hpssic_db_query_seconds': ('histogram',
+                                'Seconds spent in database calls'),
+    'hpssic_db_retries_total': ('counter',
+                                'Database operations retried after a '
+                                'transient error'),
+    'hpssic_db_retry_giveups_total': ('counter',
+                                      'Database operations abandoned after '
+                                      'retrying'),
+    'hpssic_hsi_breaker_open': ('gauge',
+                                'Whether hsi connects are being held off '
+                                'after repeated failures'),
+    'hpssic_hsi_command_seconds': ('histogram',
+                                   'Seconds from sending an hsi command to '
+                                   'seeing the prompt again'),
+    'hpssic_items_total': ('counter', 'Items handled by plugin runs'),
+    'hpssic_plugin_errors_total': ('counter',
+                                   'Errors reported by plugin runs'),
+    'hpssic_plugin_fire_seconds': ('histogram', 'Seconds per plugin run'),
+    'hpssic_queue_depth': ('gauge', 'Jobs queued or running'),
+    }
+
+# The HTTP server reads the values from its own thread, so updates and
+# rendering take the lock. Each value is keyed by (name, labels), where labels
+# is a sorted tuple of (label, value) pairs. Counters and gauges hold a
+# number, histograms a list of per-bucket counts followed by the sum and the
+# count of the observations.
+lock = threading.Lock()
+values = {}
+
+# Only the daemon serving metrics needs the HTTP server code
+BaseHTTPServer = util.LazyModule('BaseHTTPServer')
+
+
+# -----------------------------------------------------------------------------
+def export(cfg, now=None):
+    """
+    Start the HTTP server if metrics_port is set and it isn't running, and
+    write the metrics file if metrics_file is set and metrics_interval has
+    passed since it was last written. Failures are logged rather than raised
+    so they can't stop the crawler, and a server that fails to start is not
+    tried again.
+    """
+    now = now or time.time()
+    port = cfg.get_d('crawler', 'metrics_port', '')
+    if port and not hasattr(export, '_server'):
+        addr = cfg.get_d('crawler', 'metrics_addr', '127.0.0.1')
+        try:
+            export._server = serve(int(port), addr)
+            CrawlConfig.log("serving metrics at http://%s:%s/metrics" %
+                            (addr, port))
+        except (ValueError, socket.error) as e:
+            export._server = None
+            CrawlConfig.log("unable to serve metrics on port %s: %s" %
+                            (port, str(e)))
+
+    path = cfg.get_d('crawler', 'metrics_file', '')
+    interval = cfg.get_time('crawler', 'metrics_interval', 60)
+    if path and getattr(export, '_written', 0) + interval <= now:
+        export._written = now
+        try:
+            write(path)
+        except (IOError, OSError) as e:
+            CrawlConfig.log("unable to write metrics to %s: %s" %
+                            (path, str(e)))
+
+
+# -----------------------------------------------------------------------------
+def gauge(name, value, **labels):
+    """
+    Set gauge *name* with *labels* to *value*
+    """
+    with lock:
+        values[(name, tuple(sorted(labels.items())))] = value
+
+
+# -----------------------------------------------------------------------------
+def handler_class():
+    """
+    Return the request handler class for the metrics server, defining it the
+    first time we're called. It's built here rather than at the top level so
+    BaseHTTPServer is only loaded when a server is started.
+    """
+    if hasattr(handler_class, '_class'):
+        return handler_class._class
+
+    # -------------------------------------------------------------------------
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        Answer GET /metrics with the rendered values
+        """
+        # ---------------------------------------------------------------------
+        def do_GET(self):
+            """
+            Send the metrics, or 404 for any other path
+            """
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # ---------------------------------------------------------------------
+        def log_message(self, format, *args):
+            """
+            Keep scrapes out of stderr, which the daemon has closed anyway
+            """
+            pass
+
+    handler_class._class = MetricsHandler
+    return MetricsHandler
+
+
+# -----------------------------------------------------------------------------
+def inc(name, amount=1, **labels):
+    """
+    Add *amount* to counter *name* with *labels*
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = values.get(key, 0) + amount
+
+
+# -----------------------------------------------------------------------------
+def label_str(labels, extra=()):
+    """
+    Format *labels* (and any *extra* pairs) as {name="value",...}, escaping
+    the values as the text format requires
+    """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    esc = lambda v: (str(v).replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+    return "{%s}" % ",".join(['%s="%s"' % (k, esc(v)) for (k, v) in pairs])
+
+
+# -----------------------------------------------------------------------------
+def observe(name, value, **labels):
+    """
+    Count *value* in histogram *name* with *labels*
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        hist = values.setdefault(key, [0] * (len(buckets) + 2))
+        for (idx, bound) in enumerate(buckets):
+            if value <= bound:
+                hist[idx] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+
+# -----------------------------------------------------------------------------
+def render():
+    """
+    Return the current values in the Prometheus text format
+    """
+    with lock:
+        items = sorted([(k, v if type(v) != list else v[:])
+                        for (k, v) in values.items()])
+    rval = []
+    last = None
+    for ((name, labels), value) in items:
+        (mtype, helptext) = described.get(name, ('untyped', name))
+        if name != last:
+            rval.append("# HELP %s %s" % (name, helptext))
+            rval.append("# TYPE %s %s" % (name, mtype))
+            last = name
+        if type(value) != list:
+            rval.append("%s%s %s" % (name, label_str(labels), repr(value)))
+            continue
+        total = 0
+        for (bound, count) in zip(buckets, value):
+            total += count
+            rval.append("%s_bucket%s %d" %
+                        (name, label_str(labels, [('le', repr(bound))]),
+                         total))
+        rval.append("%s_bucket%s %d" %
+                    (name, label_str(labels, [('le', '+Inf')]), value[-1]))
+        rval.append("%s_sum%s %s" % (name, label_str(labels), repr(value[-2])))
+        rval.append("%s_count%s %d" % (name, label_str(labels), value[-1]))
+    return "".join([line + "\n" for line in rval])
+
+
+# -----------------------------------------------------------------------------
+def reset():
+    """
+    Forget all the values (for testing)
+    """
+    with lock:
+        values.clear()
+
+
+# -----------------------------------------------------------------------------
+def serve(port, addr='127.0.0.1'):
+    """
+    Serve the metrics over HTTP on *addr*:*port* from a daemon thread and
+    return the server. Port 0 picks a free port, which can be found in
+    server.server_port.
+    """
+    server = BaseHTTPServer.HTTPServer((addr, port), handler_class())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# -----------------------------------------------------------------------------
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Observe the time spent in the body of a with statement in histogram
+    *name* with *labels*, whether or not the body raises an exception
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+# -----------------------------------------------------------------------------
+def write(path):
+    """
+    Write the metrics to *path*. The textfile collector may read the file at
+    any moment, so we write a temporary file next to it and rename it into
+    place.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.rename(tmp, path)
@@ -9,6 +9,7 @@ import pdb
 import re
 import rpt_lib
 import sys
+import tcc_lib
 import time
 import util
 
@@ -273,7 +274,7 @@ def mprf_migr_recs(args):
         if o.count:
             print("Records found: %d" % row['1'])
         else:
-            print("%s %s %d" % (CrawlDBI.DBIdb2.hexstr(row['BFID']),
+            print("%s %s %d" % (tcc_lib.hexstr(row['BFID']),
                                 util.ymdhms(row['RECORD_CREATE_TIME']),
                                 row['MIGRATION_FAILURE_COUNT']))
 
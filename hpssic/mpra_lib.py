@@ -114,7 +114,7 @@ def age_report(table, age, count, result, f, path=False):
         f.write("Migration Records Older Than %s\n" % dhms(age))
         f.write("%-67s %-18s %s\n" % ("BFID", "Created", "MigrFails"))
         for row in result:
-            f.write("%s %s %9d\n" % (CrawlDBI.DBIdb2.hexstr(row['BFID']),
+            f.write("%s %s %9d\n" % (tcc_lib.hexstr(row['BFID']),
                                      util.ymdhms(row['RECORD_CREATE_TIME']),
                                      row['MIGRATION_FAILURE_COUNT']))
             if path:
@@ -124,7 +124,7 @@ def age_report(table, age, count, result, f, path=False):
         f.write("Purge Records Older Than %s\n" % dhms(age))
         f.write("%-67s %-18s\n" % ("BFID", "Created"))
         for row in result:
-            f.write("%s %s\n" % (CrawlDBI.DBIdb2.hexstr(row['BFID']),
+            f.write("%s %s\n" % (tcc_lib.hexstr(row['BFID']),
                                  util.ymdhms(row['RECORD_CREATE_TIME'])))
             if path:
                 path = tcc_lib.get_bitfile_path(row['BFID'])
@@ -240,7 +240,7 @@ def xplocks(output=None, mark=False):
         for r in rows:
             if (lock_min * 60) < (now - r['RECORD_LOCK_TIME']):
                 hits += 1
-                f.write("   %s  %s\n" % (CrawlDBI.DBIdb2.hexstr(r['BFID']),
+                f.write("   %s  %s\n" % (tcc_lib.hexstr(r['BFID']),
                                          util.ymdhms(r['RECORD_LOCK_TIME'])))
 
     if mark:
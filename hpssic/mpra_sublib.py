@@ -10,10 +10,11 @@ def load_history():
     db = CrawlDBI.DBI(dbtype='crawler')
     rows = db.select(table='mpra',
                      fields=['type', 'scan_time', 'hits'])
-    db.insert(table='history',
-              ignore=True,
-              fields=['plugin', 'runtime', 'errors'],
-              data=list(rows))
+    with db.transaction():
+        db.insert(table='history',
+                  ignore=True,
+                  fields=['plugin', 'runtime', 'errors'],
+                  data=list(rows))
     db.close()
 
 
@@ -2,14 +2,18 @@ from hpssic import Alert
 from hpssic import Checkable
 from hpssic import CrawlConfig
 from hpssic import CrawlDBI
+from hpssic import crawl_sublib
 from hpssic import cv_lib
 from hpssic import Dimension
+from hpssic import dirtab
+from hpssic import hpss
 import os
 import pdb
 import pexpect
 import sys
 import time
 from hpssic import util
+from hpssic import Walker
 
 plugin_name = 'cv'
 
@@ -19,8 +23,17 @@ def main(cfg):
     """
     Main entry point for the cv plugin
     """
-    # Get stuff we need -- the logger object, dataroot, etc.
     CrawlConfig.log("firing up")
+
+    # If hsi has been failing to connect, don't wait on it again until the
+    # circuit breaker says it's time to try
+    if hpss.breaker.is_open():
+        CrawlConfig.log("HPSS is not available, skipping this run " +
+                        "(next try in %d seconds)" %
+                        hpss.breaker.remaining())
+        return 0
+
+    # Get stuff we need -- the logger object, dataroot, etc.
     plugdir = cfg.get('crawler', 'plugin-dir')
     dataroot = util.csv_list(cfg.get(plugin_name, 'dataroot'))
     odds = cfg.getfloat(plugin_name, 'odds')
@@ -30,38 +43,53 @@ def main(cfg):
     (t_checksums, t_matches, t_failures) = get_stats()
     (checksums, matches, failures) = (0, 0, 0)
 
-    # Fetch the list of HPSS objects that we're looking at from the
-    # database
+    # If namespace walking is turned on, list some more directories in bulk
+    # before we pick the items to check
+    if cfg.getboolean(plugin_name, 'walk'):
+        w = Walker.make_walker(roots=dataroot)
+        w.run(limit=int(cfg.get_d(plugin_name, w.limit_option,
+                                  str(w.default_limit))))
+
+    # Load the media types and bound the media type and directory caches for
+    # this run
+    cv_lib.ttype_preload(cfg)
+    dirtab.configure(cfg)
+
+    # Set up the queue of HPSS objects that we're looking at. It reads the
+    # database a chunk at a time as we go.
+    Checkable.checkables_upgrade()
     try:
-        clist = Checkable.Checkable.get_list(prob=odds, rootlist=dataroot)
+        queue = Checkable.CheckQueue(how_many=n_ops, prob=odds,
+                                     rootlist=dataroot)
     except CrawlDBI.DBIerror as e:
         if any([util.rgxin(msg, str(e))
                 for msg in ["no such table: checkables",
                             "Table '.*' doesn't exist"]]):
             CrawlConfig.log("calling ex_nihilo")
             Checkable.Checkable.ex_nihilo(dataroot=dataroot)
-            clist = Checkable.Checkable.get_list(prob=odds)
+            queue = Checkable.CheckQueue(how_many=n_ops, prob=odds)
         else:
             raise
     except StandardError as e:
         if 'Please call .ex_nihilo()' in str(e):
             CrawlConfig.log("calling ex_nihilo")
             Checkable.Checkable.ex_nihilo(dataroot=dataroot)
-            clist = Checkable.Checkable.get_list(prob=odds)
+            queue = Checkable.CheckQueue(how_many=n_ops, prob=odds)
         else:
             raise
 
-    # We're going to process n_ops things in the HPSS namespace
-    for op in range(n_ops):
-        # if the list from the database is empty, there's nothing to do
-        if 0 < len(clist):
-            # but it's not, so grab the first item and check it
-            item = clist.pop(0)
+    # We're going to process up to n_ops things in the HPSS namespace. The
+    # updates to the items checked are written in batches as we go, and the
+    # last batch when we're done.
+    with Checkable.write_behind():
+        for item in queue:
             CrawlConfig.log("[%d] checking %s" % (item.rowid, item))
             ilist = item.check()
+            crawl_sublib.count_items()
 
             # Expected outcomes that check can return:
-            #  list of Checkables: read dir or checksummed files (may be empty)
+            #  list of Checkables: read dir or checksummed files (may be
+            #                      empty)
             #  Alert:              checksum verify failed
             #  'access denied':    unaccessible directory
             #  'matched':          a checksum was verified
@@ -95,6 +123,7 @@ def main(cfg):
                     if 'f' == n.type and n.checksum != 0:
                         CrawlConfig.log(".. previously checksummed")
                         # checksums += 1
+                queue.add(ilist)
             elif isinstance(ilist, Checkable.Checkable):
                 CrawlConfig.log("Checkable returned - file checksummed" +
                                 " - %s, %s" % (ilist.path, ilist.checksum))
@@ -107,6 +136,12 @@ def main(cfg):
                 CrawlConfig.log("unexpected return val from " +
                                 "Checkable.check: %s: %r" %
                                 (type(ilist), ilist))
+        queue.wait()
+
+    stats = cv_lib.ttype_cart_lookup.cache.stats()
+    CrawlConfig.log("cart cache: %(hits)d hits, %(misses)d misses, "
+                    "%(evictions)d evictions, %(expirations)d expired, "
+                    "%(entries)d entries" % stats)
 
     # Report the statistics in the log
     # ** For checksums, we report the current total minus the previous
@@ -1,4 +1,5 @@
 from hpssic import CrawlConfig
+from hpssic import crawl_sublib
 from hpssic import mpra_lib
 import time
 from hpssic import util
@@ -36,4 +37,5 @@ def main(cfg):
     CrawlConfig.log("found %d expired purge locks" % result)
     rval += result
 
+    crawl_sublib.count_items(rval)
     return rval
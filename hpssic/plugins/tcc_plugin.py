@@ -1,6 +1,7 @@
 import base64
 from hpssic import CrawlConfig
 from hpssic import CrawlDBI
+from hpssic import crawl_sublib
 import glob
 from hpssic import hpss
 import os
@@ -26,7 +27,7 @@ def main(cfg):
     CrawlConfig.log("tape-copy-checker: firing up for %d items" % how_many)
 
     # retrieve COS info
-    cosinfo = tcc_lib.get_cos_info()
+    cosinfo = tcc_lib.cos_preload(cfg)
 
     # check for priority file(s)
     pri_glob = cfg.get_d(tcc_lib.sectname(), 'priority', '')
@@ -49,46 +50,48 @@ def main(cfg):
         pass
 
     CrawlConfig.log("got %d bitfiles" % len(bfl))
+    crawl_sublib.count_items(len(bfl))
 
+    # the checked ids are recorded together at the end, even when a check
+    # fails partway through, so the next fire picks up after them
     errcount = 0
-    if len(bfl) == 0:
-        for oid in range(next_nsobj_id, next_nsobj_id+how_many):
-            tcc_lib.record_checked_ids(cfg, oid, oid, 1, 0)
-            if cfg.getboolean(tcc_lib.sectname(), 'verbose'):
-                CrawlConfig.log("Object %d is not complete" % oid)
-                errcount += 1
-    else:
-        # for each bitfile, if it does not have the right number of copies,
-        # report it
-        for bf in bfl:
-            correct = 1
-            error = 0
-            if bf['SC_COUNT'] != cosinfo[bf['BFATTR_COS_ID']]:
-                tcc_lib.tcc_report(bf, cosinfo)
-                correct = 0
-                error = 1
-                CrawlConfig.log("%s %s %d != %d" %
-                                (bf['OBJECT_ID'],
-                                 tcc_lib.hexstr(bf['BFID']),
-                                 bf['SC_COUNT'],
-                                 cosinfo[bf['BFATTR_COS_ID']]))
-            elif cfg.getboolean(tcc_lib.sectname(), 'verbose'):
-                CrawlConfig.log("%s %s %d == %d" %
-                                (bf['OBJECT_ID'],
-                                 tcc_lib.hexstr(bf['BFID']),
-                                 bf['SC_COUNT'],
-                                 cosinfo[bf['BFATTR_COS_ID']]))
-
-            last_obj_id = int(bf['OBJECT_ID'])
-            tcc_lib.record_checked_ids(cfg,
-                                       last_obj_id,
-                                       last_obj_id,
-                                       correct,
-                                       error)
-            errcount += error
-
-        CrawlConfig.log("last nsobject in range: %d" % last_obj_id)
-
+    checked = []
+    try:
+        if len(bfl) == 0:
+            for oid in range(next_nsobj_id, next_nsobj_id+how_many):
+                checked.append((oid, oid, 1, 0))
+                if cfg.getboolean(tcc_lib.sectname(), 'verbose'):
+                    CrawlConfig.log("Object %d is not complete" % oid)
+                    errcount += 1
+        else:
+            # for each bitfile, if it does not have the right number of
+            # copies, report it
+            for bf in bfl:
+                correct = 1
+                error = 0
+                if bf['SC_COUNT'] != cosinfo[bf['BFATTR_COS_ID']]:
+                    tcc_lib.tcc_report(bf, cosinfo)
+                    correct = 0
+                    error = 1
+                    CrawlConfig.log("%s %s %d != %d" %
+                                    (bf['OBJECT_ID'],
+                                     tcc_lib.hexstr(bf['BFID']),
+                                     bf['SC_COUNT'],
+                                     cosinfo[bf['BFATTR_COS_ID']]))
+                elif cfg.getboolean(tcc_lib.sectname(), 'verbose'):
+                    CrawlConfig.log("%s %s %d == %d" %
+                                    (bf['OBJECT_ID'],
+                                     tcc_lib.hexstr(bf['BFID']),
+                                     bf['SC_COUNT'],
+                                     cosinfo[bf['BFATTR_COS_ID']]))
+
+                last_obj_id = int(bf['OBJECT_ID'])
+                checked.append((last_obj_id, last_obj_id, correct, error))
+                errcount += error
+
+            CrawlConfig.log("last nsobject in range: %d" % last_obj_id)
+    finally:
+        tcc_lib.record_checked_list(cfg, checked)
     return errcount
 
 
@@ -2,10 +2,8 @@ import CrawlConfig
 import CrawlDBI
 import dbschem
 import Dimension
-import email.mime.text
 import pdb
 import rpt_sublib
-import smtplib
 import time
 import util
 
@@ -25,13 +23,13 @@ def get_cv_report(db, last_rpt_time):
 
         # get the population and sample entries added since the last report
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where='type = "f" and ? < last_check',
                          data=(last_rpt_time,))
         (c_pop_size) = rows[0]
 
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where='type = "f" and checksum = 1 and ' +
                                '? < last_check',
                          data=(last_rpt_time,))
@@ -49,7 +47,7 @@ def get_cv_report(db, last_rpt_time):
 
         # get the population and sample entries added since the last report
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where='type = "f" and ' +
                                'ttypes is not null and ' +
                                '? < last_check',
@@ -57,7 +55,7 @@ def get_cv_report(db, last_rpt_time):
         (c_pop_size) = rows[0]
 
         rows = db.select(table="checkables",
-                         fields=["count(path)"],
+                         fields=["count(*)"],
                          where='type = "f" and ttypes is not null and ' +
                                'checksum = 1 and ? < last_check',
                          data=(last_rpt_time,))
@@ -35,8 +35,9 @@ def load_history():
     rows = db.select(table='report',
                      fields=['report_time'])
     insert_data = [('report', x[0], 0) for x in rows]
-    db.insert(table='history',
-              ignore=True,
-              fields=['plugin', 'runtime', 'errors'],
-              data=insert_data)
+    with db.transaction():
+        db.insert(table='history',
+                  ignore=True,
+                  fields=['plugin', 'runtime', 'errors'],
+                  data=insert_data)
     db.close()
@@ -6,6 +6,7 @@ import dbschem
 import messages as MSG
 import os
 import pdb
+import string
 import sys
 import time
 import util
@@ -77,7 +78,8 @@ def nsobject_lookup(start_id, id_count, dbh=None):
     if local_connect:
         dbh.close()
 
-    rval = [CrawlDBI.DBIdb2.hexstr(z['BITFILE_ID']) for z in bflist]
+    rval = [hexstr(z['BITFILE_ID']) for z in bflist
+            if z['BITFILE_ID'] is not None]
     return rval
 
 
@@ -152,7 +154,7 @@ def by_bitfile_id(bfid):
     """
     Get info about a bitfile from DB2 returning a dict.
     """
-    bfid_val = CrawlDBI.DBIdb2.hexval(bfid)
+    bfid_val = hexval(bfid)
     db = CrawlDBI.DBI(dbtype='hpss', dbname='sub')
     rval = db.select(table=['nsobject A',
                             'bitfile B',
@@ -178,10 +180,24 @@ def by_bitfile_id(bfid):
 
 
 # -----------------------------------------------------------------------------
-@U.memoize
-def get_cos_info(obarg=None):
+def cos_preload(cfg):
     """
-    Read COS info from tables COS and HIER in the DB2 database
+    Set how long the COS info is cached from tcc/cos_cache_ttl (default 1h)
+    and return it, reading it from DB2 if the cached copy is older than that.
+    The tcc plugin calls this when it starts, so a long running crawler sees
+    COS changes.
+    """
+    get_cos_info.cache.configure(ttl=cfg.get_time(sectname(),
+                                                  'cos_cache_ttl', 3600))
+    return get_cos_info()
+
+
+# -----------------------------------------------------------------------------
+@U.cached(ttl=3600)
+def get_cos_info():
+    """
+    Read COS info from tables COS and HIER in the DB2 database. The result is
+    cached (see cos_preload()).
     """
     db = CrawlDBI.DBI(dbtype='hpss', dbname='cfg')
     rows = db.select(table=['cos A', 'hier B'],
@@ -216,7 +232,7 @@ def get_next_nsobj_id(cfg):
             rval = 1
         else:
             rows = db.select(table=tabname,
-                             fields=['high_nsobj_id'],
+                             fields=['max(high_nsobj_id)'],
                              where='check_time = ?',
                              data=(max_time,))
             rval = int(rows[0][0]) + 1
@@ -245,6 +261,26 @@ def hexstr_uq(bfid):
     return rval.upper()
 
 
+# -----------------------------------------------------------------------------
+def hexval(bfid_str):
+    """
+    Convert a quoted or unquoted hexadecimal string as presented by DB2 into a
+    raw bitfile id.
+    """
+    bfid_low = bfid_str.lower()
+    if bfid_low.startswith("x'"):
+        rval = bfid_low.strip("x'").decode("hex")
+    elif all(c in string.hexdigits for c in bfid_str):
+        rval = bfid_str.decode("hex")
+    elif (bfid_low.startswith("x") and
+          all(c in string.hexdigits for c in bfid_low[1:])):
+        rval = bfid_low[1:].decode("hex")
+    else:
+        rval = bfid_str
+
+    return rval
+
+
 # -----------------------------------------------------------------------------
 def highest_nsobject_id():
     """
@@ -296,19 +332,33 @@ def record_checked_ids(cfg, low, high, correct, error):
 
        (<time>, <hit-id>, <hit-id>, 0, 1)
     """
+    record_checked_list(cfg, [(low, high, correct, error)])
+
+
+# -----------------------------------------------------------------------------
+def record_checked_list(cfg, checked):
+    """
+    Save a list of (<low-id>, <high-id>, <correct>, <error>) tuples as
+    described for record_checked_ids() with the same check time, in one
+    transaction.
+    """
+    if not checked:
+        return
     tabname = cfg.get(sectname(), 'table_name')
 
     result = dbschem.make_table(tabname)
     ts = int(time.time())
-    CrawlConfig.log("recording checked ids %d to %d at %d" % (low, high, ts))
+    CrawlConfig.log("recording checked ids %d to %d at %d" %
+                    (checked[0][0], checked[-1][1], ts))
     db = CrawlDBI.DBI(dbtype="crawler")
-    db.insert(table=tabname,
-              fields=['check_time',
-                      'low_nsobj_id',
-                      'high_nsobj_id',
-                      'correct',
-                      'error'],
-              data=[(ts, low, high, correct, error)])
+    with db.transaction():
+        db.insert(table=tabname,
+                  fields=['check_time',
+                          'low_nsobj_id',
+                          'high_nsobj_id',
+                          'correct',
+                          'error'],
+                  data=[(ts,) + tuple(x) for x in checked])
     db.close()
 
 
@@ -12,10 +12,11 @@ def load_history():
                      fields=['check_time', 'sum(error)'],
                      groupby='check_time')
     insert_data = [('tcc', x[0], x[1]) for x in rows]
-    db.insert(table='history',
-              ignore=True,
-              fields=['plugin', 'runtime', 'errors'],
-              data=insert_data)
+    with db.transaction():
+        db.insert(table='history',
+                  ignore=True,
+                  fields=['plugin', 'runtime', 'errors'],
+                  data=insert_data)
     db.close()
 
 
@@ -1,3 +1,4 @@
+from hpssic import bench
 import inspect
 from hpssic import messages as MSG
 import os
@@ -105,6 +106,60 @@ class ScriptBase(th.HelpedTestCase):
                             "Expected '%s' in '%s'" % (item, result))
 
 
+# -----------------------------------------------------------------------------
+class Test_BENCH(ScriptBase):
+    # -------------------------------------------------------------------------
+    def test_bench_help(self):
+        """
+        Test_BENCH:
+        """
+        super(Test_BENCH, self).script_help("bench",
+                                            ["cv - ",
+                                             "lsp - ",
+                                             "mpra - ",
+                                             "startup - ",
+                                             "tcc - ",
+                                             ])
+
+    # -------------------------------------------------------------------------
+    def test_bench_startup(self):
+        """
+        Test_BENCH: Starting a subcommand of each program should take less
+        than bench.startup_budget and not load pexpect, pytest, smtplib, the
+        database drivers, or anything else in bench.startup_heavy
+        """
+        for (program, subcmd) in [('crawl', 'status'),
+                                  ('crawl', 'log'),
+                                  ('cv', 'report'),
+                                  ('html', 'report'),
+                                  ('mpra', 'epoch'),
+                                  ('rpt', 'report'),
+                                  ('tcc', 'report')]:
+            self.assertTrue(subcmd in bench.startup_subcommands(program),
+                            "Expected '%s' to be a %s subcommand" %
+                            (subcmd, program))
+            (elapsed, loaded) = bench.startup_probe(program, subcmd, rounds=3)
+            self.expected([], loaded)
+            self.assertTrue(elapsed < bench.startup_budget,
+                            "%s %s took %.3f seconds to start, budget %.3f" %
+                            (program, subcmd, elapsed, bench.startup_budget))
+
+    # -------------------------------------------------------------------------
+    def test_bench_which_command(self):
+        """
+        Test_BENCH:
+        """
+        super(Test_BENCH, self).script_which_command("bench")
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.skipif(not os.path.exists('.git'), reason="Not a git repo")
+    def test_bench_which_module(self):
+        """
+        Test_BENCH:
+        """
+        super(Test_BENCH, self).script_which_module("hpssic.bench")
+
+
 # -----------------------------------------------------------------------------
 class Test_CRAWL(ScriptBase):
     # -------------------------------------------------------------------------
@@ -166,6 +221,7 @@ class Test_CV(ScriptBase):
         """
         super(Test_CV, self).script_help("cv",
                                          ["fail_reset - ",
+                                          "normalize - ",
                                           "nulltest - ",
                                           "report - ",
                                           "show_next - ",
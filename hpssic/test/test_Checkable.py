@@ -2,12 +2,18 @@
 Tests for Checkable.py
 """
 from hpssic.Checkable import Checkable
+from hpssic.Checkable import CheckableRecord
+from hpssic.Checkable import checkables_upgrade
+from hpssic.Checkable import CheckQueue
+from hpssic.Checkable import write_behind
+from hpssic import bench
 import copy
 from hpssic import CrawlConfig
 from hpssic import CrawlDBI
 from hpssic import cv_lib
 from hpssic import dbschem
 from hpssic import Dimension
+from hpssic import hsisim
 from hpssic import messages as MSG
 import os
 import pdb
@@ -191,6 +197,21 @@ class CheckableTest(testhelp.HelpedTestCase):
                              type='f',
                              last_check=72)
 
+    # -------------------------------------------------------------------------
+    def test_ctor_dim(self):
+        """
+        If the caller passes in a dim dict, the constructor should use it
+        rather than building its own from the configuration
+        """
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        dim = {}
+        x = Checkable(path='/one/two', type='f', dim=dim)
+        y = Checkable(path='/one/three', type='f', dim=dim)
+        self.assertTrue(x.dim is dim,
+                        "Expected the dim dict passed in to be used")
+        self.assertTrue(x.dim is y.dim,
+                        "Expected both objects to share one dim dict")
+
     # -------------------------------------------------------------------------
     def test_eq(self):
         """
@@ -639,6 +660,110 @@ class CheckableTest(testhelp.HelpedTestCase):
             self.expected(tdcopy[idx][2], item.cos)
             self.expected(tdcopy[idx][3], item.last_check)
 
+    # -------------------------------------------------------------------------
+    def test_get_list_dedup(self):
+        """
+        An item that comes up in more than one of the priority file, the
+        recheck list, and the table should be listed once, where it first
+        appears
+        """
+        self.dbgfunc()
+        pri_pending = self.tmpdir('pending')
+        pri_complete = self.tmpdir('completed')
+        for path in [pri_pending, pri_complete]:
+            if not os.path.exists(path):
+                os.mkdir(path)
+        util.write_file(U.pathjoin(pri_pending, 'dups'),
+                        content=['/xyz', '/new', '/xyz'])
+
+        cfg = copy.deepcopy(self.cfg_dict())
+        cfg['cv'].update({'priority': U.pathjoin(pri_pending, '*'),
+                          'completed': pri_complete,
+                          'recheck_fraction': '0.5',
+                          'recheck_age': '10s'})
+        CrawlConfig.add_config(close=True, dct=cfg)
+
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.insert(table='checkables',
+                  fields=['path', 'type', 'cos', 'last_check', 'checksum'],
+                  data=[x + (int(x[0] == '/abc/foo'),)
+                        for x in self.testdata[1:]])
+        db.close()
+
+        x = Checkable.get_list(how_many=6)
+        self.expected(['/xyz', '/new', '/abc/foo', '/', '/abc', '/abc/bar'],
+                      [item.path for item in x])
+        self.expected(len(x), len(set(x)))
+
+    # -------------------------------------------------------------------------
+    def test_queue_add(self):
+        """
+        Never checked items passed to CheckQueue.add() should be handed out
+        ahead of the rest of the table, with their rowids filled in, while
+        items already seen or checked before are left alone
+        """
+        self.dbgfunc()
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.insert(table='checkables',
+                  fields=['path', 'type', 'cos', 'last_check'],
+                  data=self.testdata[1:])
+        db.close()
+
+        queue = CheckQueue(how_many=5, chunk=2)
+        self.expected('/', queue.next().path)
+        found = [CheckableRecord(path='/new1', type='f'),
+                 CheckableRecord(path='/new2', type='d'),
+                 CheckableRecord(path='/', type='d'),
+                 CheckableRecord(path='/xyz', type='f', last_check=92)]
+        Checkable.persist_records(found)
+        queue.add(found)
+        x = list(queue)
+        self.expected(['/new1', '/new2', '/abc/foo', '/abc'],
+                      [item.path for item in x])
+        self.assertTrue(all([item.rowid is not None for item in x]),
+                        "Expected rowids for all items: %s" % x)
+
+    # -------------------------------------------------------------------------
+    def test_queue_chunks(self):
+        """
+        CheckQueue should hand out what get_list() returns, in the same order,
+        while reading the table a chunk at a time
+        """
+        self.dbgfunc()
+        cfg = self.cfg_dict()
+        cfg['cv'].update({'recheck_fraction': '0.5',
+                          'recheck_age': '10s'})
+        CrawlConfig.add_config(close=True, dct=cfg)
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+        data = [('/d%03d' % x, 'f', '', 1000 + x % 7,
+                 int(x % 10 == 0)) for x in range(40)]
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.insert(table='checkables',
+                  fields=['path', 'type', 'cos', 'last_check', 'checksum'],
+                  data=data)
+        db.close()
+
+        exp = Checkable.get_list(how_many=30)
+        queue = CheckQueue(how_many=30, chunk=4)
+        self.expected([x.path for x in exp], [x.path for x in queue])
+        self.assertTrue(5 < queue.chunks,
+                        "Expected several chunks, got %d" % queue.chunks)
+
+        queue = CheckQueue(how_many=50, chunk=8,
+                           rootlist=['/d000', '/newroot'])
+        paths = [x.path for x in queue]
+        self.expected(42, len(paths))
+        self.expected(42, len(set(paths)))
+        self.assertTrue('/newroot' in paths,
+                        "Expected the missing root to be added: %s" % paths)
+        self.expected(True, queue.exhausted)
+
     # -------------------------------------------------------------------------
     def test_get_list_newroot(self):
         """
@@ -760,6 +885,198 @@ class CheckableTest(testhelp.HelpedTestCase):
                 self.assertPathNotPresent(z['ppath'])
                 self.assertPathPresent(z['cpath'])
 
+    # -------------------------------------------------------------------------
+    def test_harvest_hashes(self):
+        """
+        harvest_hashes() should ask about the files in batches and record
+        the answers, and has_hash() should go by a fresh answer without
+        asking hsi again, but ask again once the answer is stale
+        """
+        self.dbgfunc()
+        cfg = self.cfg_dict()
+        cfg['cv']['hash_cache_ttl'] = '1h'
+        CrawlConfig.add_config(close=True, dct=cfg)
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+
+        # -------------------------------------------------------------------
+        class FakeHSI(object):
+            """
+            Answer hashlist as hsi would: files with odd numbers have
+            checksums, the rest don't, and f007 gets an error
+            """
+            def __init__(self):
+                """
+                Start with no commands seen
+                """
+                self.cmds = []
+
+            def hashlist(self, paths):
+                """
+                Record the command and make up the output
+                """
+                if isinstance(paths, basestring):
+                    paths = paths.split()
+                self.cmds.append(paths)
+                rval = ""
+                for path in paths:
+                    if path.endswith('7'):
+                        rval += "*** hashlist: %s: error\r\n" % path
+                    elif int(path[-1]) % 2:
+                        rval += "%s md5 %s (hashlist)\r\n" % ('a1' * 16, path)
+                    else:
+                        rval += "(none)  %s\r\n" % path
+                return rval
+
+        recs = [CheckableRecord(path='/h/f%03d' % x, type='f')
+                for x in range(10)]
+        recs.append(CheckableRecord(path='/h/sub', type='d'))
+        recs[5].checksum = 1
+        Checkable.persist_records(recs)
+        h = FakeHSI()
+        batch = Checkable.hashlist_batch
+        try:
+            Checkable.hashlist_batch = 4
+            Checkable.harvest_hashes(h, recs)
+        finally:
+            Checkable.hashlist_batch = batch
+        self.expected(3, len(h.cmds))
+        self.expected(9, sum([len(x) for x in h.cmds]))
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='checkables',
+                         fields=['path', 'hashed', 'hash_time'],
+                         where="path like '/h/%'",
+                         orderby='path')
+        db.close()
+        self.expected([0, 1, 0, 1, 0, None, 0, None, 0, 1, None],
+                      [x[1] for x in rows])
+        self.expected(1, recs[1].hashed)
+        self.assertTrue(time.time() - 10 < rows[0][2],
+                        "Expected a recent hash_time: %s" % str(rows[0]))
+
+        h.cmds = []
+        item = Checkable(path='/h/f001', type='f')
+        item.load()
+        self.expected(True, item.has_hash(h))
+        item = Checkable(path='/h/f002', type='f')
+        item.load()
+        self.expected(False, item.has_hash(h))
+        self.expected([], h.cmds)
+
+        item.hash_time -= 7200
+        self.expected(False, item.has_hash(h))
+        item = Checkable(path='/h/f007', type='f')
+        item.load()
+        self.expected(True, item.has_hash(h) is False)
+        self.expected([['/h/f002'], ['/h/f007']], h.cmds)
+
+    # -------------------------------------------------------------------------
+    def test_hsi_verify_alg(self):
+        """
+        hsi_verify() should take a file whose checksum hashverify reports
+        OK in an algorithm other than md5 as matched, not as a mismatch
+        """
+        self.dbgfunc()
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+
+        # -------------------------------------------------------------------
+        class FakeVerifyHSI(object):
+            """
+            Answer hashverify as hsi does for a file with a sha1 checksum
+            """
+            def pid(self):
+                """
+                Any process id will do
+                """
+                return 17
+
+            def hashverify(self, path):
+                """
+                Report the sha1 checksum OK
+                """
+                return "%s: (sha1) OK\r\n" % path
+
+        item = Checkable(path='/h/sha1only', type='f')
+        self.expected("matched", item.hsi_verify(FakeVerifyHSI()))
+
+    # -------------------------------------------------------------------------
+    def test_no_checksum_cache(self):
+        """
+        When hashverify finds no checksum on a file we had cached as hashed,
+        the cache should say it isn't, until a hashcreate makes one
+        """
+        self.dbgfunc()
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        U.conditional_rm(self.dbname())
+        Checkable.ex_nihilo()
+
+        # -------------------------------------------------------------------
+        class FakeCreateHSI(object):
+            """
+            Answer hashverify and hashcreate as hsi does for a file with no
+            checksum
+            """
+            def pid(self):
+                """
+                Any process id will do
+                """
+                return 17
+
+            def hashverify(self, path):
+                """
+                Report no checksum
+                """
+                return "%s: no valid checksum found\r\n" % path
+
+            def hashcreate(self, path):
+                """
+                Make one up
+                """
+                return "%s md5 %s (hashcreate)\r\n" % ('a1' * 16, path)
+
+        then = int(time.time()) - 60
+        item = Checkable(path='/h/nohash', type='f', hashed=1,
+                         hash_time=then, probability=0.0)
+        self.expected("skipped", item.hsi_verify(FakeCreateHSI()))
+        self.expected(0, item.hashed)
+        self.assertTrue(then < item.hash_time,
+                        "Expected hash_time to be updated")
+        self.expected(False, item.has_hash(FakeCreateHSI()))
+
+        item.probability = 1.0
+        self.expected("checksummed", item.hsi_verify(FakeCreateHSI()))
+        self.expected(1, item.hashed)
+
+    # -------------------------------------------------------------------------
+    def test_upgrade(self):
+        """
+        checkables_upgrade() should add the hash cache columns to a table
+        created without them, so the table can be read again
+        """
+        self.dbgfunc()
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        U.conditional_rm(self.dbname())
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.create(table='checkables',
+                  fields=[x for x in dbschem.tdefs['checkables']['fields']
+                          if x.split()[0] not in ['hashed', 'hash_time']])
+        db.insert(table='checkables',
+                  fields=['path', 'type', 'cos', 'last_check'],
+                  data=[('/', 'd', '', 0)])
+        db.close()
+
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             "no such column: hashed",
+                             Checkable.get_list)
+        checkables_upgrade()
+        checkables_upgrade()
+        x = Checkable.get_list()
+        self.expected(['/'], [item.path for item in x])
+        self.expected(None, x[0].hashed)
+
     # -------------------------------------------------------------------------
     def test_path_like(self):
         """
@@ -773,7 +1090,7 @@ class CheckableTest(testhelp.HelpedTestCase):
         with CrawlDBI.db_context(dbtype='crawler') as db:
             db.insert(table='checkables',
                       fields=['path', 'type', 'cos', 'last_check'],
-                      data=self.testdata)
+                      data=self.testdata[1:])
 
             path = 'abc%'
             self.assertRaisesMsg(U.HpssicError,
@@ -811,6 +1128,63 @@ class CheckableTest(testhelp.HelpedTestCase):
             self.expected_in(td[2], r)
             self.expected_in(td[3], r)
 
+    # -------------------------------------------------------------------------
+    def test_ttype_bulk_lookup(self):
+        """
+        cv_lib.ttype_bulk_lookup() should find the carts it isn't given with
+        batched 'ls -P' commands on one hsi session and describe each cart as
+        the single cart lookups do, giving None for a path with no cart
+        """
+        self.dbgfunc()
+        scratch = self.tmpdir('bulk')
+        if not os.path.isdir(scratch):
+            os.makedirs(scratch)
+        cfg = bench.hpss_setup(scratch, 100)
+        cv_lib.ttype_cart_lookup.cache.invalidate()
+        cv_lib.ttype_map_desc.cache.invalidate()
+        cfg.add_section('cv')
+        cfg.set('cv', 'lsp_batch', '4')
+        dbschem.make_table('tape_types')
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.insert(table='tape_types',
+                  fields=['type', 'subtype', 'name'],
+                  data=[(3, 0, 'Tape 3/0'), (3, 1, 'Tape 3/1'),
+                        (4, 0, 'Tape 4/0')])
+        db.close()
+
+        paths = ['/sim/d00/f%04d' % x for x in range(7)] + ['/sim/f0099']
+        binpath = hsisim.install(self.tmpdir('sim'))
+        with U.tmpenv('PATH', binpath + ":" + os.getenv('PATH')):
+            with U.tmpenv('HSISIM_STATE', scratch):
+                with U.tmpenv('HSISIM_CARTS', 'yes'):
+                    result = cv_lib.ttype_bulk_lookup(
+                        [(x, None) for x in paths] +
+                        [('/sim/known', 'S00001,S00002')])
+
+        ns = hsisim.Namespace(carts=True)
+        for path in paths[:-1]:
+            a = ns.attrs(path)
+            if a['size'] == 0:
+                self.expected(None, result[path])
+            else:
+                self.expected([(a['cart'],
+                                cv_lib.ttype_cart_to_desc(a['cart']))],
+                              result[path])
+        self.expected(None, result['/sim/f0099'])
+        self.expected(['S00001', 'S00002'],
+                      [x[0] for x in result['/sim/known']])
+
+        # the carts are cached now, so asking again doesn't read PVLPV
+        before = cv_lib.ttype_cart_lookup.cache.stats()
+        cv_lib.ttype_carts_to_desc(['S00001', 'S00002'])
+        after = cv_lib.ttype_cart_lookup.cache.stats()
+        self.expected(2, after['hits'] - before['hits'])
+        self.expected(0, after['misses'] - before['misses'])
+
+        log = U.contents(os.path.join(scratch, 'log'))
+        self.expected(1, log.count(" start"))
+        self.expected(2, log.count(" ls"))
+
     # -------------------------------------------------------------------------
     def test_persist_last_check(self):
         """
@@ -839,6 +1213,7 @@ class CheckableTest(testhelp.HelpedTestCase):
         self.dbgfunc()
         util.conditional_rm(self.dbname())
         CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        self.db_legacy_table()
         Checkable.ex_nihilo()
         self.db_duplicates()
         x = Checkable.get_list()
@@ -1010,6 +1385,7 @@ class CheckableTest(testhelp.HelpedTestCase):
         """
         util.conditional_rm(self.dbname())
         CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        self.db_legacy_table()
         Checkable.ex_nihilo()
         self.db_add_one(path=self.testpath, type='f')
         self.db_add_one(path=self.testpath, type='f')
@@ -1051,6 +1427,27 @@ class CheckableTest(testhelp.HelpedTestCase):
         self.expected(self.testpath, x[1].path)
         self.expected(0, x[1].last_check)
 
+    # -------------------------------------------------------------------------
+    def test_persist_file_upsert(self):
+        """
+        Send in a file whose path is already in the database without loading
+        it first (rowid == None, last_check == 0, type == 'f'). The existing
+        row should be updated rather than a second one added.
+        """
+        util.conditional_rm(self.dbname())
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        Checkable.ex_nihilo()
+        self.db_add_one(path=self.testpath, type='f', cos='6001')
+
+        foo = Checkable(path=self.testpath, type='f', cos='6002')
+        foo.persist()
+        self.expected(True, foo.in_db)
+
+        x = Checkable.get_list()
+        self.expected(2, len(x))
+        self.expected(self.testpath, x[1].path)
+        self.expected('6002', x[1].cos)
+
     # -------------------------------------------------------------------------
     def test_persist_file_exist_df(self):
         """
@@ -1158,6 +1555,131 @@ class CheckableTest(testhelp.HelpedTestCase):
         self.expected(2, len(x))
         self.expected(util.ymdhms(now), util.ymdhms(x[1].last_check))
 
+    # -------------------------------------------------------------------------
+    def test_persist_records(self):
+        """
+        Checkable.persist_records() should insert the records that are not in
+        the database and refresh the ones that are from their rows
+        """
+        util.conditional_rm(self.dbname())
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        Checkable.ex_nihilo()
+        self.db_add_one(path='/abc/old', last_check=17)
+
+        rlist = [CheckableRecord(path='/abc/old', type='f'),
+                 CheckableRecord(path='/abc/new', type='f', cos='6001',
+                                 cart=''),
+                 CheckableRecord(path='/abc/sub', type='d')]
+        Checkable.persist_records(rlist)
+
+        self.unexpected(None, rlist[0].rowid)
+        self.expected(17, rlist[0].last_check)
+
+        x = Checkable.get_list()
+        self.expected(4, len(x))
+        for rec in rlist:
+            self.expected_in(rec, x)
+        self.expected(1, len([c for c in x if c.path == '/abc/old']))
+
+    # -------------------------------------------------------------------------
+    def test_persist_records_invalid(self):
+        """
+        Checkable.persist_records() should reject a directory with a cos
+        """
+        util.conditional_rm(self.dbname())
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        Checkable.ex_nihilo()
+        self.assertRaisesMsg(StandardError,
+                             "has type 'd', non-empty cos",
+                             Checkable.persist_records,
+                             [CheckableRecord(path='/abc', type='d',
+                                              cos='6001')])
+
+    # -------------------------------------------------------------------------
+    def test_record_checkable(self):
+        """
+        CheckableRecord.checkable() should give us a Checkable with the same
+        fields, the extra attributes passed in, and the dim dict we supplied
+        """
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        dim = {}
+        rec = CheckableRecord.from_row((12, '/abc/def', 'f', '6001', 'X0001',
+                                        None, 1, 32.0, 2, 0))
+        x = rec.checkable(dim=dim, probability=0.5, in_db=True)
+        self.assertTrue(isinstance(x, Checkable),
+                        "Expected a Checkable, got %s" % type(x))
+        for attr in CheckableRecord.fields:
+            self.expected(getattr(rec, attr), getattr(x, attr))
+        self.expected(0.5, x.probability)
+        self.expected(True, x.in_db)
+        self.assertTrue(x.dim is dim, "Expected the dim dict passed in")
+
+    # -------------------------------------------------------------------------
+    def test_record_ctor(self):
+        """
+        A CheckableRecord should have the same defaults as a Checkable and no
+        per-instance __dict__
+        """
+        x = CheckableRecord()
+        self.expected('---', x.path)
+        self.expected('-', x.type)
+        self.expected('', x.cos)
+        self.expected(None, x.cart)
+        self.expected(0, x.checksum)
+        self.expected(0, x.last_check)
+        self.expected(0, x.fails)
+        self.expected(None, x.rowid)
+        self.assertFalse(hasattr(x, '__dict__'),
+                         "CheckableRecord should not have a __dict__")
+        self.assertRaises(AttributeError, setattr, x, 'probability', 0.3)
+
+    # -------------------------------------------------------------------------
+    def test_record_eq(self):
+        """
+        A CheckableRecord compares equal to a record or Checkable with the same
+        path and type, and hashes on those fields
+        """
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        a = CheckableRecord(path='/abc/def', type='f', cos='6001')
+        b = CheckableRecord(path='/abc/def', type='f', cos='6002')
+        c = CheckableRecord(path='/abc/def', type='d')
+        self.expected(a, b)
+        self.unexpected(a, c)
+        self.expected(hash(a), hash(b))
+        self.expected(1, len(set([a, b])))
+        x = Checkable(path='/abc/def', type='f')
+        self.assertTrue(a == x, "Expected %s == %s" % (a, x))
+        self.assertTrue(x == a, "Expected %s == %s" % (x, a))
+        self.assertFalse(a == '/abc/def', "Expected record != string")
+
+    # -------------------------------------------------------------------------
+    def test_record_from_lsp(self):
+        """
+        CheckableRecord.from_lsp() should return one record per entry in the
+        ls -P output, with path, type, cos, and cart set
+        """
+        lspout = ("ls -P /home/tpb\r\n" +
+                  "DIRECTORY\t       /home/tpb/apache\r\n" +
+                  "FILE\t /home/tpb/LoadL_admin\t 88787\t   88787\t   " +
+                  "3962+411820\t X0352700\t 5081\t 0\t 1\t       " +
+                  "03/14/2003\t  07:12:43\t 03/19/2012\t 13:09:50\r\n" +
+                  "O:[/home/tpb]: ")
+        x = CheckableRecord.from_lsp(lspout)
+        self.expected(2, len(x))
+        self.expected(('/home/tpb/apache', 'd', '', None),
+                      (x[0].path, x[0].type, x[0].cos, x[0].cart))
+        self.expected(('/home/tpb/LoadL_admin', 'f', '5081', 'X0352700'),
+                      (x[1].path, x[1].type, x[1].cos, x[1].cart))
+
+    # -------------------------------------------------------------------------
+    def test_record_row(self):
+        """
+        CheckableRecord.row() should return what from_row() was given
+        """
+        row = (12, '/abc/def', 'f', '6001', 'X0001', 'STK', 1, 32.0, 2, 0,
+               1, 1400000000)
+        self.expected(row, CheckableRecord.from_row(row).row())
+
     # -------------------------------------------------------------------------
     def test_repr(self):
         """
@@ -1175,6 +1697,76 @@ class CheckableTest(testhelp.HelpedTestCase):
         x = eval(exp)
         self.expected(exp, x.__repr__())
 
+    # -------------------------------------------------------------------------
+    def test_write_behind(self):
+        """
+        Inside write_behind(), persist() should hold updates until the buffer
+        is full, write an item updated twice once, insert new items right
+        away, and write what's left at the end of the block
+        """
+        util.conditional_rm(self.dbname())
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        Checkable.ex_nihilo()
+        for path in ['/abc/a', '/abc/b', '/abc/c']:
+            self.db_add_one(path=path)
+        items = dict([(x.path, x) for x in Checkable.get_list()])
+
+        with write_behind(count=3, interval=3600) as buf:
+            self.expected(buf, Checkable.buffer)
+            for (path, when) in [('/abc/a', 11), ('/abc/a', 12),
+                                 ('/abc/b', 13)]:
+                items[path].set('last_check', when)
+                items[path].persist()
+            self.expected(2, len(buf.pending))
+            self.expected(0, self.db_last_check('/abc/a'))
+
+            items['/abc/c'].set('last_check', 14)
+            items['/abc/c'].persist()
+            self.expected(1, buf.flushes)
+            self.expected([12, 13, 14],
+                          [self.db_last_check(x)
+                           for x in ['/abc/a', '/abc/b', '/abc/c']])
+            self.expected(False, items['/abc/a'].dirty)
+
+            items['/'].set('last_check', 15)
+            items['/'].persist()
+            new = Checkable(path='/abc/d', type='f')
+            new.persist()
+            self.expected(0, self.db_last_check('/abc/d'))
+            self.expected(0, self.db_last_check('/'))
+
+        self.expected(None, Checkable.buffer)
+        self.expected(2, buf.flushes)
+        self.expected(15, self.db_last_check('/'))
+
+    # -------------------------------------------------------------------------
+    def test_write_behind_interval(self):
+        """
+        The buffer should be written when its interval has passed even if it
+        isn't full, and the updates should be written if the block raises an
+        exception
+        """
+        util.conditional_rm(self.dbname())
+        CrawlConfig.add_config(close=True, dct=self.cfg_dict())
+        Checkable.ex_nihilo()
+        self.db_add_one(path='/abc/a')
+        items = dict([(x.path, x) for x in Checkable.get_list()])
+
+        with write_behind(count=100, interval=0) as buf:
+            items['/abc/a'].set('last_check', 21)
+            items['/abc/a'].persist()
+            self.expected(1, buf.flushes)
+            self.expected(21, self.db_last_check('/abc/a'))
+
+        try:
+            with write_behind(count=100, interval=3600) as buf:
+                items['/'].set('last_check', 22)
+                items['/'].persist()
+                raise StandardError("interrupted")
+        except StandardError:
+            pass
+        self.expected(22, self.db_last_check('/'))
+
     # -------------------------------------------------------------------------
     def db_add_one(self,
                    path=testpath,
@@ -1190,6 +1782,31 @@ class CheckableTest(testhelp.HelpedTestCase):
                   data=[(path, type, cos, last_check)])
         db.close()
 
+    # -------------------------------------------------------------------------
+    def db_last_check(self, path):
+        """
+        Return the last_check value stored for *path*
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='checkables',
+                         fields=['last_check'],
+                         where='path = ?',
+                         data=(path,))
+        db.close()
+        return rows[0][0]
+
+    # -------------------------------------------------------------------------
+    def db_legacy_table(self):
+        """
+        Create the checkables table as it was before path was made unique, so
+        it can hold duplicates.
+        """
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.create(table='checkables',
+                  fields=[x for x in dbschem.tdefs['checkables']['fields']
+                          if not x.startswith('unique')])
+        db.close()
+
     # -------------------------------------------------------------------------
     def db_duplicates(self):
         """
@@ -19,6 +19,8 @@ from hpssic import cv_sublib
 from hpssic import dbschem
 from hpssic import hpss
 from hpssic import messages as MSG
+from hpssic import metrics
+import mock
 import os
 import pdb
 import pytest
@@ -26,6 +28,8 @@ import sqlite3
 import socket
 import sys
 from hpssic import testhelp
+import threading
+import time
 import traceback as tb
 from hpssic import util
 import warnings
@@ -200,6 +204,41 @@ class DBITest(DBITestRoot):
                              data=[('a', 'b', 'c'),
                                    ('x', 'y', 'z')])
 
+    # -------------------------------------------------------------------------
+    def test_mysql_columns(self):
+        """
+        DBITest: The MySQL DDL should keep the unique keys on path in the
+        digests and checkables tables, making path a column MySQL can index,
+        and leave text columns that aren't in a key alone. Without keys, the
+        ones on text columns should be left out.
+        """
+        self.dbgfunc()
+        self.expected(['rowid       integer primary key auto_increment',
+                       'path varbinary(1023)',
+                       'algorithm   varchar(16)',
+                       'digest      text',
+                       'computed    int',
+                       'unique (path, algorithm)'],
+                      CrawlDBI.mysql_columns(
+                          dbschem.tdefs['digests']['fields']))
+
+        cols = CrawlDBI.mysql_columns(dbschem.tdefs['checkables']['fields'])
+        for col in ['path varbinary(1023)', 'type        text',
+                    'unique (path)']:
+            self.assertTrue(col in cols, "'%s' not in %s" % (col, cols))
+
+        cols = CrawlDBI.mysql_columns(dbschem.tdefs['frontier']['fields'])
+        self.assertTrue('path        text' in cols,
+                        "path should be left as text in %s" % cols)
+
+        self.expected(['rowid       integer primary key auto_increment',
+                       'path        text',
+                       'algorithm   varchar(16)',
+                       'digest      text',
+                       'computed    int'],
+                      CrawlDBI.mysql_columns(
+                          dbschem.tdefs['digests']['fields'], keys=False))
+
     # -------------------------------------------------------------------------
     def test_ctor_sqlite(self):
         """
@@ -220,6 +259,350 @@ class DBITest(DBITestRoot):
         self.assertTrue(isinstance(a._dbobj, CrawlDBI.DBIsqlite),
                         "Expected %s to be a DBIsqlite object" % a._dbobj)
 
+    # -------------------------------------------------------------------------
+    def test_op_count(self):
+        """
+        DBITest: Each select, insert, update, and delete should be counted in
+        DBI.op_counts by dbtype and operation
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='op_count', fields=['name text', 'size int'])
+        before = (CrawlDBI.DBI.op_count(),
+                  CrawlDBI.DBI.op_count(dbtype='crawler', operation='insert'),
+                  CrawlDBI.DBI.op_count(dbtype='hpss'))
+        a.insert(table='op_count', fields=['name', 'size'],
+                 data=[('one', 1), ('two', 2)])
+        a.update(table='op_count', fields=['size'], where='name = ?',
+                 data=[(3, 'two')])
+        a.select(table='op_count', fields=['name'])
+        a.delete(table='op_count', where='name = ?', data=('one',))
+        a.close()
+        after = (CrawlDBI.DBI.op_count(),
+                 CrawlDBI.DBI.op_count(dbtype='crawler', operation='insert'),
+                 CrawlDBI.DBI.op_count(dbtype='hpss'))
+        self.expected((4, 1, 0),
+                      tuple([x - y for (x, y) in zip(after, before)]))
+
+    # -------------------------------------------------------------------------
+    def test_op_count_threads(self):
+        """
+        DBITest: Operations counted by several threads at once should all be
+        counted
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        before = (CrawlDBI.DBI.op_count(operation='tally_test'),
+                  CrawlDBI.DBI.row_count(operation='tally_test'))
+
+        # ---------------------------------------------------------------------
+        def count_many():
+            """
+            Count a lot of operations as fast as we can
+            """
+            for x in range(5000):
+                a.tally('tally_test', 2)
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            tl = [threading.Thread(target=count_many) for x in range(4)]
+            for t in tl:
+                t.start()
+            for t in tl:
+                t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        a.close()
+        after = (CrawlDBI.DBI.op_count(operation='tally_test'),
+                 CrawlDBI.DBI.row_count(operation='tally_test'))
+        self.expected((20000, 40000),
+                      tuple([x - y for (x, y) in zip(after, before)]))
+
+    # -------------------------------------------------------------------------
+    def test_row_count(self):
+        """
+        DBITest: The rows returned by selects and passed to inserts and updates
+        should be counted in DBI.row_counts by dbtype and operation
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='row_count', fields=['name text', 'size int'])
+        before = (CrawlDBI.DBI.row_count(dbtype='crawler'),
+                  CrawlDBI.DBI.row_count(dbtype='crawler', operation='select'),
+                  CrawlDBI.DBI.row_count(dbtype='hpss'))
+        a.insert(table='row_count', fields=['name', 'size'],
+                 data=[('one', 1), ('two', 2), ('three', 3)])
+        a.update(table='row_count', fields=['size'], where='name = ?',
+                 data=[(4, 'two')])
+        a.select(table='row_count', fields=['name'], where='size < 4')
+        a.close()
+        after = (CrawlDBI.DBI.row_count(dbtype='crawler'),
+                 CrawlDBI.DBI.row_count(dbtype='crawler', operation='select'),
+                 CrawlDBI.DBI.row_count(dbtype='hpss'))
+        self.expected((6, 2, 0),
+                      tuple([x - y for (x, y) in zip(after, before)]))
+
+    # -------------------------------------------------------------------------
+    def test_upsert(self):
+        """
+        DBITest: upsert() should insert the rows whose keys are new and update
+        the others, whether or not the table has a unique key on the key
+        fields, and leave existing rows alone when update_fields is empty
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='ups_keyed', fields=['name text primary key',
+                                            'size int', 'note text'])
+        a.create(table='ups_plain', fields=['name text', 'size int',
+                                            'note text'])
+        fields = ['name', 'size', 'note']
+        for table in ['ups_keyed', 'ups_plain']:
+            a.insert(table=table, fields=['name', 'size', 'note'],
+                     data=[('one', 1, 'a'), ('two', 2, 'b')])
+            a.upsert(table=table, key_fields=['name'],
+                     fields=['name', 'size', 'note'],
+                     update_fields=['size'],
+                     data=[('two', 22, 'x'), ('three', 3, 'c')])
+            self.expected([('one', 1, 'a'), ('two', 22, 'b'),
+                           ('three', 3, 'c')],
+                          a.select(table=table, fields=fields,
+                                   orderby='rowid'))
+
+            a.upsert(table=table, key_fields=['name'],
+                     fields=['name', 'size', 'note'],
+                     data=[('one', 11, 'aa')])
+            a.upsert(table=table, key_fields=['name'],
+                     fields=['name', 'size', 'note'],
+                     update_fields=[],
+                     data=[('two', 0, ''), ('four', 4, 'd')])
+            self.expected([('one', 11, 'aa'), ('two', 22, 'b'),
+                           ('three', 3, 'c'), ('four', 4, 'd')],
+                          a.select(table=table, fields=fields,
+                                   orderby='rowid'))
+
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             "On upsert(), key_fields must all be in fields",
+                             a.upsert,
+                             table='ups_keyed',
+                             key_fields=['name'],
+                             fields=['size'],
+                             data=[(5,)])
+        a.close()
+
+    # -------------------------------------------------------------------------
+    def test_upsert_old_sqlite(self):
+        """
+        DBITest: With an sqlite older than 3.24.0, which has no ON CONFLICT,
+        upsert() should fall back to update-then-insert even when the table
+        has a unique key
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='ups_keyed', fields=['name text primary key',
+                                            'size int'])
+        a.insert(table='ups_keyed', fields=['name', 'size'],
+                 data=[('one', 1), ('two', 2)])
+        sq = CrawlDBI.DBIsqlite
+        with mock.patch.object(sq, 'on_conflict', False):
+            with mock.patch.object(sq, 'upsert_emulate',
+                                   wraps=a._dbobj.upsert_emulate) as emu:
+                a.upsert(table='ups_keyed', key_fields=['name'],
+                         fields=['name', 'size'],
+                         data=[('two', 22), ('three', 3)])
+        self.assertTrue(emu.called, "upsert_emulate() was not called")
+        self.expected([('one', 1), ('two', 22), ('three', 3)],
+                      a.select(table='ups_keyed', fields=['name', 'size'],
+                               orderby='rowid'))
+        a.close()
+
+    # -------------------------------------------------------------------------
+    def test_transaction(self):
+        """
+        DBITest: Writes in a transaction() should be invisible to other
+        connections until the with statement finishes and should be rolled
+        back if it raises an exception. A nested transaction is part of the
+        outer one.
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        b = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='txn', fields=['name text'])
+        with a.transaction():
+            a.insert(table='txn', fields=['name'], data=[('one',), ('two',)])
+            with a.transaction():
+                a.insert(table='txn', fields=['name'], data=[('three',)])
+            self.expected([], b.select(table='txn', fields=['name']))
+        self.expected(3, len(b.select(table='txn', fields=['name'])))
+
+        try:
+            with a.transaction():
+                a.insert(table='txn', fields=['name'], data=[('four',)])
+                with a.transaction():
+                    a.delete(table='txn', where="name = 'one'")
+                raise StandardError("give up")
+        except StandardError as e:
+            self.expected("give up", str(e))
+        self.expected([('one',), ('two',), ('three',)],
+                      a.select(table='txn', fields=['name'], orderby='rowid'))
+        a.close()
+        b.close()
+
+    # -------------------------------------------------------------------------
+    def test_batch(self):
+        """
+        DBITest: batch() should run its payload in a transaction and return
+        what it returns, running it again after a lock conflict but not after
+        any other error
+        """
+        util.conditional_rm(self.dbname())
+        a = CrawlDBI.DBI(cfg=make_tcfg('sqlite', self), dbtype='crawler')
+        a.create(table='txn', fields=['name text'])
+        calls = []
+
+        def payload(name, fail):
+            """
+            Insert *name*, then fail the first time with error *fail*
+            """
+            calls.append(name)
+            a.insert(table='txn', fields=['name'], data=[(name,)])
+            if fail and len(calls) == 1:
+                raise CrawlDBI.DBIerror(fail)
+            return len(calls)
+
+        self.expected(2, a.batch(payload, 'one', 'database is locked'))
+        self.expected([('one',)], a.select(table='txn', fields=['name']))
+
+        del calls[:]
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             "no such column",
+                             a.batch,
+                             payload, 'two', 'no such column')
+        self.expected(['two'], calls)
+        self.expected([('one',)], a.select(table='txn', fields=['name']))
+        a.close()
+
+    # -------------------------------------------------------------------------
+    def test_retry(self):
+        """
+        DBITest: retry() should try again after a transient error, counting
+        the retries in the metrics, give up after retry_max_attempts tries,
+        and raise anything else right away
+        """
+        util.conditional_rm(self.dbname())
+        cfg = make_tcfg('sqlite', self)
+        cfg.set('dbi-crawler', 'retry_delay', '0.001')
+        cfg.set('dbi-crawler', 'retry_max_attempts', '3')
+        a = CrawlDBI.DBI(cfg=cfg, dbtype='crawler')
+        errors = []
+
+        def payload(fails, msg):
+            """
+            Fail with *msg* the first *fails* times we're called
+            """
+            errors.append(msg)
+            if len(errors) <= fails:
+                raise sqlite3.OperationalError(msg)
+            return len(errors)
+
+        metrics.reset()
+        self.expected(3, a._dbobj.retry(sqlite3.Error, payload, 2,
+                                        "database is locked"))
+        self.expected_in('hpssic_db_retries_total{backend="sqlite"} 2',
+                         metrics.render())
+
+        del errors[:]
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             MSG.retry_gave_up_dS % (3, "database is locked"),
+                             a._dbobj.retry,
+                             sqlite3.Error, payload, 5, "database is locked")
+        self.expected(3, len(errors))
+
+        del errors[:]
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             "no such table: nowhere",
+                             a._dbobj.retry,
+                             sqlite3.Error, payload, 5,
+                             "no such table: nowhere")
+        self.expected(1, len(errors))
+        a.close()
+
+    # -------------------------------------------------------------------------
+    def test_sqlite_profile(self):
+        """
+        DBITest: sqlite_profile should set the pragmas of its profile on the
+        connection, with sqlite_<pragma> options overriding them, and a bad
+        profile or pragma value should be rejected
+        """
+        util.conditional_rm(self.dbname())
+        cfg = make_tcfg('sqlite', self)
+        cfg.set('dbi-crawler', 'sqlite_profile', 'fast')
+        cfg.set('dbi-crawler', 'sqlite_cache_size', '-2000')
+        a = CrawlDBI.DBI(cfg=cfg, dbtype='crawler')
+        c = a.cursor()
+        got = []
+        for pragma in ['journal_mode', 'synchronous', 'cache_size',
+                       'mmap_size', 'temp_store']:
+            c.execute("pragma %s" % pragma)
+            got.append(c.fetchone()[0])
+        c.close()
+        a.close()
+        self.expected([u'wal', 1, -2000, 268435456, 2], got)
+
+        cfg.set('dbi-crawler', 'sqlite_profile', 'reckless')
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             MSG.sqlite_profile_S % 'reckless',
+                             CrawlDBI.DBI,
+                             cfg=cfg,
+                             dbtype='crawler')
+        cfg.set('dbi-crawler', 'sqlite_profile', 'safe')
+        cfg.set('dbi-crawler', 'sqlite_synchronous', 'off; drop table x')
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             MSG.sqlite_pragma_SS % ('synchronous',
+                                                     'off; drop table x'),
+                             CrawlDBI.DBI,
+                             cfg=cfg,
+                             dbtype='crawler')
+
+    # -------------------------------------------------------------------------
+    def test_sqlite_locked(self):
+        """
+        DBITest: With another connection holding the write lock past the busy
+        timeout, a transaction should wait for it rather than fail
+        """
+        util.conditional_rm(self.dbname())
+        cfg = make_tcfg('sqlite', self)
+        cfg.set('dbi-crawler', 'sqlite_profile', 'safe')
+        cfg.set('dbi-crawler', 'sqlite_busy_timeout', '0')
+        a = CrawlDBI.DBI(cfg=cfg, dbtype='crawler')
+        a.create(table='locked', fields=['name text'])
+        locked = threading.Event()
+
+        def hold():
+            """
+            Hold the write lock on a connection of our own for a moment
+            """
+            b = CrawlDBI.DBI(cfg=cfg, dbtype='crawler')
+            with b.transaction():
+                b.insert(table='locked', fields=['name'], data=[('b',)])
+                locked.set()
+                time.sleep(0.3)
+            b.close()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        locked.wait(5.0)
+        start = time.time()
+        with a.transaction():
+            a.insert(table='locked', fields=['name'], data=[('a',)])
+        holder.join()
+        self.assertTrue(0.1 < time.time() - start,
+                        "Expected to wait for the lock")
+        self.expected([('b',), ('a',)],
+                      a.select(table='locked', fields=['name'],
+                               orderby='rowid'))
+        a.close()
+
 
 # -----------------------------------------------------------------------------
 class DBI_in_Base(object):
@@ -348,8 +731,11 @@ class DBI_in_Base(object):
         a = self.DBI()
         dirl = [q for q in dir(a) if not q.startswith('_')]
         xattr_req = ['alter', 'close', 'create', 'dbname', 'delete',
-                     'describe', 'drop', 'closed',
-                     'insert', 'select', 'table_exists', 'update', 'cursor']
+                     'describe', 'drop', 'closed', 'dbtype',
+                     'insert', 'select', 'table_exists', 'update', 'cursor',
+                     'op_count', 'op_counts', 'row_count', 'row_counts',
+                     'tally', 'timer', 'transaction', 'batch', 'upsert',
+                     'in_transaction', 'prefix']
         xattr_allowed = ['alter']
 
         for attr in dirl:
@@ -2021,6 +2407,31 @@ class DBImysqlTest(DBI_in_Base, DBI_out_Base, DBITestRoot):
         if not pytest.config.getvalue("keep"):
             dbschem.drop_tables_matching("test_%")
 
+    # -------------------------------------------------------------------------
+    def test_create_path_keys(self):
+        """
+        DBImysqlTest: The checkables and digests tables should be created on
+        this server whatever its index limit, and upsert() should update
+        rows by path on them
+        """
+        self.dbgfunc()
+        db = self.DBI()
+        for tname in ['checkables', 'digests']:
+            db.create(table='pk_' + tname,
+                      fields=dbschem.tdefs[tname]['fields'])
+        db.upsert(table='pk_digests', key_fields=['path', 'algorithm'],
+                  fields=['path', 'algorithm', 'digest', 'computed'],
+                  data=[('/a/b', 'md5', 'abc', 1),
+                        ('/a/c', 'md5', 'def', 1)])
+        db.upsert(table='pk_digests', key_fields=['path', 'algorithm'],
+                  fields=['path', 'algorithm', 'digest', 'computed'],
+                  data=[('/a/b', 'md5', 'xyz', 2)])
+        rows = db.select(table='pk_digests', fields=['path', 'digest'],
+                         orderby='path')
+        db.close()
+        self.expected([('/a/b', 'xyz'), ('/a/c', 'def')],
+                      [tuple(x) for x in rows])
+
     # -------------------------------------------------------------------------
     def test_alter_add_after(self):
         """
@@ -4,13 +4,18 @@ Plugin class for HPSS integrity crawler
 This module contains the CrawlPlugin and CrawlPluginTest classes.
 """
 import copy
+from hpssic import crawl
+from hpssic import crawl_sublib
 from hpssic import CrawlConfig
+from hpssic import CrawlDBI
 from hpssic import CrawlPlugin
+from hpssic import dbschem
 import os
 import pdb
 import pexpect
 import pytest
 import re
+import StringIO
 import sys
 from hpssic import testhelp
 import time
@@ -43,6 +48,54 @@ class CrawlPluginTest(testhelp.HelpedTestCase):
         self.assertPathPresent(logpath)
         self.expected_in('firing', U.contents(logpath))
 
+    # -------------------------------------------------------------------------
+    def test_fire_history(self):
+        """
+        Firing the plugin should record its measurements in the history table,
+        adding the columns for them if the table doesn't have them yet, and
+        'crawl history --show perf' should report them
+        """
+        self.dbgfunc()
+        pname = U.my_name()
+        self.make_plugin(pname)
+        c = self.make_cfg(pname)
+        U.conditional_rm(c.get('dbi-crawler', 'dbname'))
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.create(table='history', fields=dbschem.tdefs['history']['fields']
+                  [0:3])
+        db.close()
+
+        p = CrawlPlugin.CrawlPlugin(pname, c)
+        p.fire()
+        crawl_sublib.count_items(5)
+        p.fire()
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='history',
+                         fields=['plugin', 'wall', 'items', 'db_ops',
+                                 'maxrss'])
+        db.close()
+        self.expected(2, len(rows))
+        for row in rows:
+            self.expected(pname, row[0])
+            self.assertTrue(0 <= row[1], "Expected wall >= 0: %s" % str(row))
+            self.assertTrue(0 < row[4], "Expected maxrss > 0: %s" % str(row))
+        self.expected([0, 0], [row[2] for row in rows])
+
+        out = StringIO.StringIO()
+        saved = sys.stdout
+        sys.stdout = out
+        try:
+            crawl.history_show_perf()
+        finally:
+            sys.stdout = saved
+        lines = out.getvalue().split("\n")
+        self.expected_in("^Plugin +Measure +Fires +p50 +p90 +p99 +max",
+                         lines[0])
+        self.expected(len(crawl_sublib.perf_fields),
+                      len([x for x in lines if x.startswith(pname)]))
+        self.expected_in("%s +wall +2 " % pname, out.getvalue())
+
     # -------------------------------------------------------------------------
     def test_init_fire_false(self):
         """
@@ -378,6 +431,85 @@ class CrawlPluginTest(testhelp.HelpedTestCase):
                         "expected '%s' to match sys.modules[%s].__file__" %
                         (rgx, pname))
 
+    # -------------------------------------------------------------------------
+    def test_reload_source(self):
+        """
+        Changing a plugin's source should be noticed by source_changed(), and
+        reloading should import it again even though the configuration hasn't
+        changed
+        """
+        self.dbgfunc()
+        if self.plugin_dir() not in sys.path:
+            sys.path.insert(0, self.plugin_dir())
+        pname = 'z' + U.my_name()
+        self.make_plugin(pname)
+        c = self.make_cfg(pname)
+        p = CrawlPlugin.CrawlPlugin(pname, c)
+        first = p.plugin
+        self.assertFalse(p.source_changed(),
+                         "Expected source_changed() to be False")
+
+        with open('%s/%s.py' % (self.plugin_dir(), pname), 'a') as f:
+            f.write("\ndef added():\n    pass\n")
+        self.assertTrue(p.source_changed(),
+                        "Expected source_changed() to be True")
+
+        p.reload(c)
+        self.assertFalse(first is p.plugin,
+                         "Expected the plugin module to be imported again")
+        self.assertTrue('added' in dir(p.plugin),
+                        "expected 'added' in %s" % dir(p.plugin))
+        self.assertFalse(p.source_changed(),
+                         "Expected source_changed() to be False after reload")
+
+    # -------------------------------------------------------------------------
+    def test_reload_touched(self):
+        """
+        A plugin whose source was touched without changing its content should
+        not count as changed or be imported again
+        """
+        self.dbgfunc()
+        if self.plugin_dir() not in sys.path:
+            sys.path.insert(0, self.plugin_dir())
+        pname = 'z' + U.my_name()
+        self.make_plugin(pname)
+        c = self.make_cfg(pname)
+        p = CrawlPlugin.CrawlPlugin(pname, c)
+        first = p.plugin
+
+        path = '%s/%s.py' % (self.plugin_dir(), pname)
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+        self.assertFalse(p.source_changed(),
+                         "Expected source_changed() to be False")
+        p.reload(c)
+        self.assertTrue(first is p.plugin,
+                        "Expected the loaded plugin module to be reused")
+
+    # -------------------------------------------------------------------------
+    def test_reload_unchanged(self):
+        """
+        Reloading a plugin after a configuration change should reuse the
+        module already imported, keeping anything it has cached, as long as
+        its source hasn't changed
+        """
+        self.dbgfunc()
+        if self.plugin_dir() not in sys.path:
+            sys.path.insert(0, self.plugin_dir())
+        pname = 'z' + U.my_name()
+        self.make_plugin(pname)
+        c = self.make_cfg(pname, freq='72')
+        p = CrawlPlugin.CrawlPlugin(pname, c)
+        p.plugin._cached = 'still here'
+
+        c.set(pname, 'frequency', '19')
+        p.reload(c)
+        self.expected(19, p.frequency)
+        self.expected('still here', getattr(p.plugin, '_cached', None))
+        self.assertTrue(p.plugin is sys.modules[pname],
+                        "Expected %s to be the module in sys.modules" %
+                        p.plugin)
+
     # -------------------------------------------------------------------------
     def test_time_to_fire_false(self):
         """
@@ -0,0 +1,351 @@
+"""
+Tests for Walker.py
+"""
+from hpssic.Checkable import Checkable
+from hpssic import CrawlConfig
+from hpssic import CrawlDBI
+from hpssic import dbschem
+from hpssic import tcc_lib
+from hpssic import testhelp
+from hpssic import util
+from hpssic import util as U
+from hpssic import Walker
+import os
+import pdb
+import sys
+import time
+
+
+# -----------------------------------------------------------------------------
+class FakeNSDB(object):
+    """
+    Stands in for a connection to the HPSS DB2 database, answering the
+    selects NSWalker makes from a list of NSOBJECT rows. Each row is
+    (object_id, parent_id, name, type, cos), with cos None for objects that
+    have no bitfile.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, rows):
+        """
+        Remember the rows and count the selects
+        """
+        self.rows = rows
+        self.selects = 0
+
+    # -------------------------------------------------------------------------
+    def select(self, table='', fields=[], where='', data=(), orderby=''):
+        """
+        Return dicts with DB2 style upper case keys, as DBIdb2 would
+        """
+        self.selects += 1
+        if 'object_id = ?' in where:
+            return [{'PARENT_ID': p, 'NAME': n}
+                    for (o, p, n, t, c) in self.rows if o == data[0]]
+        (otype, low, high) = data
+        files = type(table) == list
+        return [{'OBJECT_ID': o, 'PARENT_ID': p, 'NAME': n,
+                 'BFATTR_COS_ID': c}
+                for (o, p, n, t, c) in self.rows
+                if low <= o < high and t == otype and
+                (c is not None or not files)]
+
+
+# -----------------------------------------------------------------------------
+class NSWalkerTest(testhelp.HelpedTestCase):
+    """
+    Tests for Walker.NSWalker that don't need a DB2 database
+    """
+    nsrows = [(1, 1, '/', 2, None),
+              (2, 1, 'home', 2, None),
+              (3, 2, 'tpb', 2, None),
+              (4, 1, 'tmp', 2, None),
+              (5, 3, 'big', 1, 6001),
+              (6, 4, 'scratch', 1, 6002),
+              (7, 3, 'sub', 2, None),
+              (8, 7, 'small', 1, 6003),
+              (9, 3, 'link', 3, None)]
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Set up the config
+        """
+        super(NSWalkerTest, self).setUp()
+        util.conditional_rm(self.dbname())
+        cfg = {'dbi-crawler': {'dbtype': 'sqlite',
+                               'dbname': self.dbname(),
+                               'tbl_prefix': 'test'},
+               'crawler': {'logpath': self.tmpdir("test.log")},
+               'cv': {'fire': 'no',
+                      'dataroot': '/home/tpb',
+                      'discovery': 'db2'}
+               }
+        CrawlConfig.add_config(close=True, dct=cfg)
+
+    # -------------------------------------------------------------------------
+    def test_make_walker(self):
+        """
+        make_walker() should pick the class from cv/discovery, each with its
+        own option limiting a firing's walk, and complain about values it
+        doesn't know
+        """
+        self.dbgfunc()
+        w = Walker.make_walker(chunk=5)
+        self.expected(Walker.NSWalker, type(w))
+        self.expected(['/home/tpb'], w.roots)
+        self.expected(5, w.chunk)
+        self.expected('nswalk_limit', w.limit_option)
+
+        cfg = CrawlConfig.add_config()
+        cfg.set('cv', 'discovery', 'hsi')
+        w = Walker.make_walker()
+        self.expected(Walker.Walker, type(w))
+        self.expected('walk_limit', w.limit_option)
+
+        cfg.set('cv', 'discovery', 'ldap')
+        self.assertRaisesMsg(StandardError,
+                             "cv/discovery must be 'hsi' or 'db2', not 'ldap'",
+                             Walker.make_walker)
+
+    # -------------------------------------------------------------------------
+    def test_next_id(self):
+        """
+        next_id() should start after the last range in the nsdisc table, and
+        wrap back to 1 after the highest object id
+        """
+        self.dbgfunc()
+        tcc_lib.highest_nsobject_id._max_obj_id = 250
+        tcc_lib.highest_nsobject_id._when = time.time()
+        try:
+            w = Walker.NSWalker()
+            self.expected(1, w.next_id())
+            self.expected(250, w.pending())
+
+            dbschem.make_table('nsdisc')
+            db = CrawlDBI.DBI(dbtype='crawler')
+            db.insert(table='nsdisc',
+                      fields=['check_time', 'low_nsobj_id', 'high_nsobj_id',
+                              'found'],
+                      data=[(17, 1, 100, 3), (18, 101, 200, 7)])
+            self.expected(201, w.next_id())
+            self.expected(50, w.pending())
+
+            db.insert(table='nsdisc',
+                      fields=['check_time', 'low_nsobj_id', 'high_nsobj_id',
+                              'found'],
+                      data=[(19, 201, 300, 0)])
+            db.close()
+            self.expected(1, w.next_id())
+        finally:
+            del tcc_lib.highest_nsobject_id._max_obj_id
+            del tcc_lib.highest_nsobject_id._when
+
+    # -------------------------------------------------------------------------
+    def test_path_of(self):
+        """
+        path_of() should build a path from the parent ids, caching each
+        ancestor so it's only looked up once
+        """
+        self.dbgfunc()
+        db = FakeNSDB(self.nsrows)
+        w = Walker.NSWalker()
+        self.expected('/home/tpb/sub', w.path_of(7, db))
+        self.expected(4, db.selects)
+        self.expected('/home/tpb', w.path_of(3, db))
+        self.expected('/home', w.path_of(2, db))
+        self.expected(4, db.selects)
+        self.expected(None, w.path_of(99, db))
+
+    # -------------------------------------------------------------------------
+    def test_scan(self):
+        """
+        scan() should return records for the objects in its range that are
+        under the roots, files with their cos, and skip the symbolic link
+        """
+        self.dbgfunc()
+        db = FakeNSDB(self.nsrows)
+        w = Walker.NSWalker()
+        rlist = w.scan(db, 1, 10)
+        self.expected(['/home/tpb', '/home/tpb/sub', '/home/tpb/big',
+                       '/home/tpb/sub/small'],
+                      [r.path for r in rlist])
+        self.expected(['d', 'd', 'f', 'f'], [r.type for r in rlist])
+        self.expected(['', '', '6001', '6003'], [r.cos for r in rlist])
+
+        # the directories in the range are cached, so the files don't need
+        # any more lookups
+        self.expected(2, db.selects)
+
+        self.expected([], w.scan(db, 4, 5))
+
+
+# -----------------------------------------------------------------------------
+class WalkerTest(testhelp.HelpedTestCase):
+    """
+    Tests for Walker.Walker, run against a fake hsi that makes up a directory
+    tree. Every directory less than two levels below /walk holds directories
+    d0 and d1 and files f0 and f1. The directories at the bottom hold just the
+    two files. Listing a path containing 'bad' fails.
+    """
+    fake = "\n".join(["#!" + sys.executable,
+                      "BINARYVERSION='0.0'",
+                      "import sys",
+                      "out = sys.stdout",
+                      "fmt = ('FILE\\t%s\\t0\\t0\\t0\\t \\t6001\\t0\\t1\\t' +",
+                      "       '05/15/2007\\t03:06:39\\t02/11/2009\\t' +",
+                      "       '11:06:31\\n')",
+                      "out.write('fake hsi\\nO:[/walk]: ')",
+                      "out.flush()",
+                      "while True:",
+                      "    line = sys.stdin.readline()",
+                      "    if not line or line.startswith('quit'):",
+                      "        break",
+                      "    cmd = line.split()",
+                      "    if cmd[0] == 'ls':",
+                      "        if [p for p in cmd[2:] if 'bad' in p]:",
+                      "            out.write('HPSS_ESYSTEM\\n')",
+                      "            cmd = []",
+                      "        for path in cmd[2:]:",
+                      "            if path.count('/') < 3:",
+                      "                for d in ['d0', 'd1']:",
+                      "                    out.write('DIRECTORY\\t%s/%s\\n' %",
+                      "                              (path, d))",
+                      "            for f in ['f0', 'f1']:",
+                      "                out.write(fmt % (path + '/' + f))",
+                      "    out.write('O:[/walk]: ')",
+                      "    out.flush()",
+                      ""])
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Write the fake hsi in two places so maybe_update_hsi() finds a source
+        copy that matches the one in $PATH, and set up the config
+        """
+        super(WalkerTest, self).setUp()
+        bindir = self.tmpdir("bin")
+        srcdir = self.tmpdir("sources/hpss/bin")
+        for dname in [bindir, srcdir]:
+            if not os.path.isdir(dname):
+                os.makedirs(dname)
+            util.write_file(U.pathjoin(dname, 'hsi'), 0755, self.fake)
+        self.path = ":".join([bindir, srcdir, os.getenv('PATH')])
+        util.conditional_rm(self.dbname())
+        cfg = {'dbi-crawler': {'dbtype': 'sqlite',
+                               'dbname': self.dbname(),
+                               'tbl_prefix': 'test'},
+               'crawler': {'logpath': self.tmpdir("test.log")},
+               'cv': {'fire': 'no',
+                      'reset_atime': 'no',
+                      'dataroot': '/walk',
+                      'walk_sessions': '2',
+                      'walk_batch': '2',
+                      'walk_timeout': '10'}
+               }
+        CrawlConfig.add_config(close=True, dct=cfg)
+
+    # -------------------------------------------------------------------------
+    def test_ctor(self):
+        """
+        Walker() should take its settings from the config unless they are
+        passed in, and reject attributes it doesn't know
+        """
+        self.dbgfunc()
+        w = Walker.Walker()
+        self.expected(['/walk'], w.roots)
+        self.expected(2, w.sessions)
+        self.expected(2, w.batch)
+        self.expected(10, w.timeout)
+
+        w = Walker.Walker(roots=['/other'], batch=7)
+        self.expected(['/other'], w.roots)
+        self.expected(7, w.batch)
+
+        self.assertRaisesMsg(StandardError,
+                             "Attribute xyzzy is invalid for Walker",
+                             Walker.Walker, xyzzy=3)
+
+    # -------------------------------------------------------------------------
+    def test_run_error(self):
+        """
+        A directory whose listing fails should be counted as an error and
+        stay in the frontier while the rest of the tree is walked
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            Checkable.ex_nihilo(dataroot=['/walk'])
+            w = Walker.Walker(roots=['/walk', '/walk/bad'], batch=1)
+            w.run()
+        self.expected(7, w.listed)
+        self.expected(1, w.errors)
+        self.expected(1, w.pending())
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='frontier', fields=['path'])
+        db.close()
+        self.expected([('/walk/bad',)], [tuple(x) for x in rows])
+
+    # -------------------------------------------------------------------------
+    def test_run_error_batch(self):
+        """
+        When the listing of a batch fails, the directories in it should be
+        listed one at a time, so only the bad one stays in the frontier
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            Checkable.ex_nihilo(dataroot=['/walk'])
+            w = Walker.Walker(roots=['/walk/bad', '/walk'], batch=2)
+            w.run()
+        self.expected(7, w.listed)
+        self.expected(1, w.errors)
+        self.expected(1, w.pending())
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='frontier', fields=['path'])
+        db.close()
+        self.expected([('/walk/bad',)], [tuple(x) for x in rows])
+
+    # -------------------------------------------------------------------------
+    def test_run_full(self):
+        """
+        A walk with no limit should list every directory in the tree and
+        record everything in it in the checkables table
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            w = Walker.Walker()
+            w.run()
+        self.expected(7, w.listed)
+        self.expected(20, w.found)
+        self.expected(0, w.errors)
+        self.expected(0, w.pending())
+        self.assertTrue(w.commands < w.listed,
+                        "Expected batched commands, got %d for %d dirs" %
+                        (w.commands, w.listed))
+
+        clist = Checkable.get_list()
+        self.expected(21, len(clist))
+        self.expected(7, len([c for c in clist if c.type == 'd']))
+        self.expected([], [c.path for c in clist
+                           if c.type == 'd' and c.last_check == 0])
+        self.expected_in('/walk/d1/d0/f1', [c.path for c in clist])
+
+    # -------------------------------------------------------------------------
+    def test_run_resume(self):
+        """
+        A walk stopped by its limit should leave the rest of the tree in the
+        frontier, and the next walk should pick up where it left off
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            w = Walker.Walker()
+            self.expected(3, w.run(limit=3))
+            self.expected(4, w.pending())
+
+            w = Walker.Walker()
+            self.expected(4, w.run())
+        self.expected(0, w.pending())
+
+        clist = Checkable.get_list()
+        self.expected(21, len(clist))
+        self.expected(21, len(set([c.path for c in clist])))
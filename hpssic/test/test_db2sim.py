@@ -0,0 +1,193 @@
+"""
+Tests for db2sim.py and the DBIsqlite_db2 class that reads what it writes
+"""
+from hpssic import bench
+from hpssic import CrawlConfig
+from hpssic import CrawlDBI
+from hpssic import crawl_sublib
+from hpssic import db2sim
+from hpssic import hsisim
+from hpssic import messages as MSG
+from hpssic.plugins import tcc_plugin
+from hpssic import tcc_lib
+from hpssic import testhelp
+from hpssic import util as U
+from hpssic import Walker
+import mock
+import os
+import pdb
+
+
+# -----------------------------------------------------------------------------
+class db2simTest(testhelp.HelpedTestCase):
+    """
+    Tests for the DB2 simulator
+    """
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Generate a small stand-in database and point the config at it
+        """
+        super(db2simTest, self).setUp()
+        self.scratch = self.tmpdir('db2sim')
+        if not os.path.isdir(self.scratch):
+            os.makedirs(self.scratch)
+        self.cfg = bench.hpss_setup(self.scratch, 500, short=0.2)
+
+    # -------------------------------------------------------------------------
+    def test_generate(self):
+        """
+        generate() should make the tables in the expected proportions and
+        make the same ones again from the same seed
+        """
+        self.dbgfunc()
+        path = os.path.join(self.scratch, 'gen.db')
+        counts = db2sim.generate(path, files=1000, now=1400000000)
+        self.expected(1000, counts['bitfile'])
+        self.assertTrue(1000 < counts['nsobject'] < 1100,
+                        "Expected a few directories: %s" % counts)
+        self.assertTrue(1000 < counts['bftapeseg'],
+                        "Expected more segments than files: %s" % counts)
+        self.expected(len(hsisim.cos_list), counts['cos'])
+        self.expected(len(db2sim.carts), counts['pvlpv'])
+
+        first = U.contents(path)
+        self.expected(counts, db2sim.generate(path, files=1000,
+                                              now=1400000000))
+        self.expected(first, U.contents(path))
+
+    # -------------------------------------------------------------------------
+    def test_select(self):
+        """
+        Through DBI(dbtype='hpss'), the stand-in should return rows as DB2
+        does, as dicts with upper case keys and positions for unnamed
+        columns, and accept tables with the schema name on the front
+        """
+        self.dbgfunc()
+        db = CrawlDBI.DBI(dbtype='hpss', dbname='sub')
+        self.expected("DBIsqlite_db2", db._dbobj.__class__.__name__)
+        rows = db.select(table='hpss.nsobject',
+                         fields=['object_id', 'parent_id', 'name'],
+                         where="name = '/'")
+        self.expected([{'OBJECT_ID': 1, 'PARENT_ID': 0, 'NAME': '/'}], rows)
+
+        rows = db.select(table=['nsobject A', 'bitfile B'],
+                         fields=['count(*)', 'max(A.object_id) as top'],
+                         where='A.bitfile_id = B.bfid')
+        self.expected(500, rows[0]['1'])
+        self.expected(tcc_lib.max_nsobj_id(), rows[0]['TOP'])
+
+        rows = db.select(table='bitfile', fields=['bfid'], limit=1)
+        bfid = rows[0]['BFID']
+        self.expected(str, type(bfid))
+        self.expected(32, len(bfid))
+        rows = db.select(table='nsobject',
+                         fields=['object_id'],
+                         where='bitfile_id = ?',
+                         data=(bfid,))
+        self.expected(1, len(rows))
+
+        self.assertTrue(db.table_exists(table='bftapeseg'),
+                        "Expected table bftapeseg to exist")
+        self.assertRaisesMsg(CrawlDBI.DBIerror,
+                             MSG.db2_unsupported_S % "INSERT",
+                             db.insert,
+                             table='cos',
+                             fields=['cos_id'],
+                             data=[(17,)])
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def test_nswalk(self):
+        """
+        NSWalker.scan() should find every file and directory in the stand-in
+        by its object type and leave out the symbolic links
+        """
+        self.dbgfunc()
+        db = CrawlDBI.DBI(dbtype='hpss', dbname='sub')
+        w = Walker.NSWalker(roots=['/'])
+        rlist = w.scan(db, 1, tcc_lib.max_nsobj_id() + 1)
+        db.close()
+        self.expected(500, len([x for x in rlist if x.type == 'f']))
+        self.assertTrue(0 < len([x for x in rlist if x.type == 'd']),
+                        "Expected some directories")
+        links = [x.path for x in rlist
+                 if os.path.basename(x.path).startswith('l')]
+        self.expected([], links)
+
+    # -------------------------------------------------------------------------
+    def test_tcc(self):
+        """
+        The tcc plugin should make its way through the object ids and report
+        the bitfiles that are short a copy
+        """
+        self.dbgfunc()
+        stats = list(bench.tcc_rounds(self.cfg, 2, 100))
+        self.expected([1, 2], [x['round'] for x in stats])
+        for x in stats:
+            self.assertTrue(90 < x['items'] <= 100,
+                            "Expected about 100 objects checked: %s" % x)
+            self.assertTrue(0 < x['db_ops'],
+                            "Expected some selects: %s" % x)
+        self.assertTrue(0 < sum([x['reported'] for x in stats]),
+                        "Expected some bitfiles reported: %s" % stats)
+
+        rpt = U.contents(self.cfg.get('tcc', 'report_file'))
+        self.expected_in(" 600[23] +[23] +[12] /", rpt)
+
+        (count, elapsed) = bench.bitfile_paths(10)
+        self.expected(10, count)
+
+    # -------------------------------------------------------------------------
+    def test_tcc_interrupted(self):
+        """
+        When a tcc fire dies partway through, the ids it checked before that
+        should still be recorded so the next fire starts after them
+        """
+        self.dbgfunc()
+        self.cfg.set('tcc', 'operations', '100')
+        with mock.patch.object(tcc_lib, 'tcc_report',
+                               side_effect=StandardError('report failed')):
+            self.assertRaisesMsg(StandardError, 'report failed',
+                                 tcc_plugin.main, self.cfg)
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='tcc_data', fields=['count(*)', 'sum(error)'])
+        db.close()
+        self.assertTrue(0 < rows[0][0], "Expected some checked ids recorded")
+        self.expected(0, rows[0][1])
+        self.assertTrue(1 < tcc_lib.get_next_nsobj_id(self.cfg),
+                        "Expected the next fire to start past id 1")
+
+    # -------------------------------------------------------------------------
+    def test_tcc_items(self):
+        """
+        The tcc plugin should count the bitfiles it checked (one row each in
+        its table) as its items, not the object ids it asked for
+        """
+        self.dbgfunc()
+        crawl_sublib.count_items.total = 0
+        stats = list(bench.tcc_rounds(self.cfg, 1, 100))
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='tcc_data', fields=['count(*)'])
+        db.close()
+        self.expected(rows[0][0], crawl_sublib.count_items.total)
+        self.assertTrue(crawl_sublib.count_items.total < stats[0]['items'],
+                        "Expected fewer bitfiles than object ids: %s" %
+                        stats)
+
+    # -------------------------------------------------------------------------
+    def test_mpra(self):
+        """
+        The mpra queries should each run and report, and age() should find
+        some migration records to list
+        """
+        self.dbgfunc()
+        stats = list(bench.mpra_runs(self.scratch))
+        self.expected(['age migr', 'age purge count', 'xplocks'],
+                      [x['label'] for x in stats])
+        self.assertTrue(0 < stats[0]['items'],
+                        "Expected some migration records: %s" % stats)
+        rpt = U.contents(os.path.join(self.scratch, 'mpra'))
+        self.expected_in("Migration Records Older Than", rpt)
+        self.expected_in("purge records older than ", rpt)
+        self.expected_in("x'[0-9A-F]{64}' \d{4}\.\d{4} ", rpt)
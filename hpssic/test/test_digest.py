@@ -0,0 +1,162 @@
+"""
+Tests for digest.py
+"""
+from hpssic.Checkable import Checkable
+from hpssic import CrawlConfig
+from hpssic import CrawlDBI
+from hpssic import digest
+from hpssic import hpss
+from hpssic import hsisim
+from hpssic import messages as MSG
+from hpssic import testhelp
+from hpssic import util as U
+import contextlib
+import hashlib
+import os
+import pdb
+import time
+import zlib
+
+
+# -----------------------------------------------------------------------------
+class digestTest(testhelp.HelpedTestCase):
+    """
+    Tests for computing digests in one pass
+    """
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Point the config at a fresh database and reset the hsi circuit
+        breaker
+        """
+        super(digestTest, self).setUp()
+        U.conditional_rm(self.dbname())
+        hpss.breaker = hpss.CircuitBreaker()
+        self.cfg = {'dbi-crawler': {'dbtype': 'sqlite',
+                                    'dbname': self.dbname(),
+                                    'tbl_prefix': 'test'},
+                    'crawler': {'logpath': self.tmpdir('test.log')},
+                    'cv': {'fire': 'no',
+                           'verify_engine': 'stream',
+                           'stream_digests': 'sha1, crc32'}}
+        CrawlConfig.add_config(close=True, dct=self.cfg)
+
+    # -------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def simulator(self):
+        """
+        Install the hsi simulator and run the body of a with statement with
+        it first in $PATH, every file having a checksum
+        """
+        binpath = hsisim.install(self.tmpdir('sim'))
+        with U.tmpenv('PATH', binpath + ":" + os.getenv('PATH')):
+            with U.tmpenv('HSISIM_STATE', self.tmpdir()):
+                with U.tmpenv('HSISIM_HASHED', '1'):
+                    yield
+
+    # -------------------------------------------------------------------------
+    def test_multi(self):
+        """
+        MultiDigest.read() should give the same digests as computing each one
+        over the whole content, however small the buffer
+        """
+        self.dbgfunc()
+        data = "".join([chr(x % 251) for x in range(10000)])
+        fname = self.tmpdir('data')
+        with open(fname, 'wb') as f:
+            f.write(data)
+        md = digest.MultiDigest(digest.algorithms)
+        with open(fname, 'rb') as f:
+            self.expected(len(data), md.read(f, bufsize=777))
+        result = md.hexdigests()
+        for name in ['md5', 'sha1', 'sha256']:
+            self.expected(hashlib.new(name, data).hexdigest(), result[name])
+        self.expected("%08x" % (zlib.crc32(data) & 0xffffffff),
+                      result['crc32'])
+        self.expected("%08x" % (zlib.adler32(data) & 0xffffffff),
+                      result['adler32'])
+
+    # -------------------------------------------------------------------------
+    def test_unknown(self):
+        """
+        Asking for an algorithm we can't compute should raise an error
+        """
+        self.dbgfunc()
+        self.assertRaisesMsg(StandardError,
+                             MSG.digest_unknown_S % 'sha3',
+                             digest.MultiDigest, ['md5', 'sha3'])
+
+    # -------------------------------------------------------------------------
+    def test_hsi_digests(self):
+        """
+        hsi_digests() should stream a file out of the simulator and compute
+        the checksum the simulator has for it, and raise HSIerror for a file
+        that isn't there
+        """
+        self.dbgfunc()
+        ns = hsisim.Namespace()
+        path = '/sim/d00/f0003'
+        with self.simulator():
+            result = digest.hsi_digests(path, ['md5', 'sha256'])
+            self.assertRaisesRegex(hpss.HSIerror,
+                                   "hsi get of /sim/f0099 failed: " +
+                                   ".*HPSS_ENOENT",
+                                   digest.hsi_digests, '/sim/f0099', ['md5'])
+        self.expected(ns.digest(path), result['md5'])
+        self.expected(hashlib.sha256(ns.content(path)).hexdigest(),
+                      result['sha256'])
+
+    # -------------------------------------------------------------------------
+    def test_hsi_digests_breaker(self):
+        """
+        hsi_digests() should report a clean transfer or an error about the
+        file to the circuit breaker as a success and a failed transfer as a
+        failure, so a half open breaker closes again after a good probe
+        """
+        self.dbgfunc()
+        hpss.breaker.failure(now=time.time() - 3600)
+        hpss.breaker.failure(now=time.time() - 3600)
+        hpss.breaker.failure(now=time.time() - 3600)
+        with self.simulator():
+            digest.hsi_digests('/sim/d00/f0003', ['md5'])
+            self.expected(False, hpss.breaker.is_open())
+            self.expected(0, hpss.breaker.count)
+
+            self.assertRaises(hpss.HSIerror, digest.hsi_digests,
+                              '/sim/f0099', ['md5'])
+            self.expected(0, hpss.breaker.count)
+
+            with U.tmpenv('HSISIM_ERRORS', '1'):
+                self.assertRaises(hpss.HSIerror, digest.hsi_digests,
+                                  '/sim/d00/f0003', ['md5'])
+            self.expected(1, hpss.breaker.count)
+
+    # -------------------------------------------------------------------------
+    def test_stream_verify(self):
+        """
+        With verify_engine = stream, Checkable.verify() should match the
+        streamed md5 against the one hsi lists, record the other digests
+        asked for, and put the access time back with one touch
+        """
+        self.dbgfunc()
+        path = '/sim/d01/f0001'
+        Checkable.ex_nihilo()
+        with self.simulator():
+            h = hpss.HSI(reset_atime=True, hash_algorithm=None)
+            c = Checkable(path=path, type='f')
+            self.expected("matched", c.verify(h))
+            h.quit()
+
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rows = db.select(table='digests',
+                         fields=['algorithm', 'digest'],
+                         where='path = ?', data=(path,),
+                         orderby='algorithm')
+        db.close()
+        self.expected(['crc32', 'md5', 'sha1'], [x[0] for x in rows])
+        self.expected(hsisim.Namespace().digest(path), rows[1][1])
+
+        log = U.contents(self.tmpdir('log'))
+        self.expected(1, log.count(" get"))
+        self.expected(1, log.count(" touch"))
+        self.expected(0, log.count(" hashverify"))
@@ -0,0 +1,324 @@
+"""
+Tests for dirtab.py
+"""
+from hpssic.Checkable import Checkable
+from hpssic.Checkable import CheckableRecord
+from hpssic import CrawlConfig
+from hpssic import CrawlDBI
+from hpssic import cv_lib
+from hpssic import dbschem
+from hpssic import dirtab
+from hpssic import messages as MSG
+from hpssic import testhelp
+from hpssic import util as U
+import mock
+import pdb
+
+
+# -----------------------------------------------------------------------------
+class dirtabTest(testhelp.HelpedTestCase):
+    """
+    Tests for the normalized path layout of the checkables table
+    """
+    testdata = [('/', 'd', '', 0),
+                ('/abc', 'd', '', 17),
+                ('/xyz', 'f', '', 92),
+                ('/abc/foo', 'f', '', 5),
+                ('/abc/bar', 'f', '', 33)]
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Point the config at a fresh database with the normalized layout and
+        forget any directories from earlier tests
+        """
+        super(dirtabTest, self).setUp()
+        U.conditional_rm(self.dbname())
+        dirtab.forget()
+        self.cfg = {'dbi-crawler': {'dbtype': 'sqlite',
+                                    'dbname': self.dbname(),
+                                    'tbl_prefix': 'test'},
+                    'crawler': {'logpath': self.tmpdir('test.log')},
+                    'cv': {'fire': 'no',
+                           'path_layout': 'normalized'}}
+        CrawlConfig.add_config(close=True, dct=self.cfg)
+
+    # -------------------------------------------------------------------------
+    def layout(self, name):
+        """
+        Switch the config to path layout *name*
+        """
+        self.cfg['cv']['path_layout'] = name
+        CrawlConfig.add_config(close=True, dct=self.cfg)
+
+    # -------------------------------------------------------------------------
+    def load(self, db):
+        """
+        Put the test data in the table with dirtab.upsert()
+        """
+        dirtab.upsert(db,
+                      fields=['path', 'type', 'cos', 'last_check'],
+                      data=self.testdata)
+
+    # -------------------------------------------------------------------------
+    def test_split_join(self):
+        """
+        split() should give back the pieces join() puts together, for
+        absolute and relative paths alike
+        """
+        self.dbgfunc()
+        for (path, pieces) in [('/', ('', '/')),
+                               ('/abc', ('/', 'abc')),
+                               ('/abc/def/ghi', ('/abc/def', 'ghi')),
+                               ('abc', ('', 'abc')),
+                               ('abc/def', ('abc', 'def'))]:
+            self.expected(pieces, dirtab.split(path))
+            self.expected(path, dirtab.join(*pieces))
+
+    # -------------------------------------------------------------------------
+    def test_layout_unknown(self):
+        """
+        A path_layout we don't know should raise an error
+        """
+        self.dbgfunc()
+        self.layout('sideways')
+        self.assertRaisesMsg(StandardError,
+                             MSG.path_layout_unknown_S % 'sideways',
+                             dirtab.layout)
+
+    # -------------------------------------------------------------------------
+    def test_make_tables(self):
+        """
+        make_tables() should create directories and a checkables table with
+        dir_id and name in place of path, and refuse to use a table with the
+        other layout
+        """
+        self.dbgfunc()
+        self.expected("Created", dirtab.make_tables())
+        self.expected("Already", dirtab.make_tables())
+        db = CrawlDBI.DBI(dbtype='crawler')
+        cols = [x[1] for x in db.describe(table='checkables')]
+        self.assertTrue(db.table_exists(table='directories'))
+        db.close()
+        self.expected_in('dir_id', cols)
+        self.expected_in('name', cols)
+        self.assertFalse('path' in cols, "path is still in %s" % cols)
+
+        self.layout('flat')
+        self.assertRaisesMsg(StandardError, MSG.path_layout_normalized,
+                             dirtab.make_tables)
+
+    # -------------------------------------------------------------------------
+    def test_make_tables_flat(self):
+        """
+        A flat checkables table should not be used as a normalized one
+        """
+        self.dbgfunc()
+        self.layout('flat')
+        self.expected("Created", dirtab.make_tables())
+        self.layout('normalized')
+        self.assertRaisesMsg(StandardError, MSG.path_layout_flat,
+                             dirtab.make_tables)
+
+    # -------------------------------------------------------------------------
+    def test_select(self):
+        """
+        Rows stored by path should come back with their paths, whether
+        they're read all together, by path, or by rowid, and each directory
+        should be stored once
+        """
+        self.dbgfunc()
+        dirtab.make_tables()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        self.load(db)
+        fields = ['path', 'type', 'cos', 'last_check']
+        rows = dirtab.select(db, fields, orderby='rowid')
+        self.expected(self.testdata, rows)
+
+        rows = dirtab.select_paths(db, fields,
+                                   ['/abc/bar', '/xyz', '/nosuch/file'])
+        self.expected(sorted([self.testdata[2], self.testdata[4]]),
+                      sorted(rows))
+
+        rows = dirtab.select(db, ['rowid', 'path'], where='rowid = ?',
+                             data=(4,))
+        self.expected([(4, '/abc/foo')], rows)
+
+        rows = db.select(table='directories', fields=['parent', 'name'],
+                         orderby='rowid')
+        self.expected([(0, '/'), (1, 'abc')], rows)
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def test_update(self):
+        """
+        update() should find rows by 'path = ?', move them with 'path' among
+        the fields, skip paths in directories it doesn't know, and refuse
+        other uses of the path in the where clause
+        """
+        self.dbgfunc()
+        dirtab.make_tables()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        self.load(db)
+        dirtab.update(db, fields=['last_check'], where='path = ?',
+                      data=[(99, '/abc/foo'), (98, '/nosuch/file')])
+        dirtab.update(db, fields=['path'], where='rowid = ?',
+                      data=[('/new/dir/bar', 5)])
+        rows = dirtab.select(db, ['path', 'last_check'], where='rowid > 3',
+                             orderby='rowid')
+        self.expected([('/abc/foo', 99), ('/new/dir/bar', 33)], rows)
+        self.assertRaisesMsg(StandardError,
+                             MSG.path_where_S % 'path like ?',
+                             dirtab.update, db, ['last_check'],
+                             'path like ?', [(1, '/abc/%')])
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def test_select_like(self):
+        """
+        tpop_select_by_paths() should match the same rows in the normalized
+        layout as in the flat one
+        """
+        self.dbgfunc()
+        dirtab.make_tables()
+        td = [(unicode(z[0]), unicode(z[1]), None, None, z[-1])
+              for z in self.testdata]
+        with CrawlDBI.db_context(dbtype='crawler') as db:
+            self.load(db)
+            for (pattern, expected) in [('abc%', []),
+                                        ('%foo', [td[3]]),
+                                        ('%c/%', [td[3], td[4]]),
+                                        ('/abc/%', [td[3], td[4]]),
+                                        ('/abc/f%', [td[3]]),
+                                        ('/ab_/bar', [td[4]]),
+                                        ('/%', [td[2], td[3], td[4]]),
+                                        ('%', [td[2], td[3], td[4]])]:
+                r = cv_lib.tpop_select_by_paths([pattern], db)
+                self.expected(sorted(expected), sorted(r))
+
+    # -------------------------------------------------------------------------
+    def test_reset_path(self):
+        """
+        cv_lib.reset_path() should clear fails and reported on the row for
+        the path and leave the others alone
+        """
+        self.dbgfunc()
+        dirtab.make_tables()
+        with CrawlDBI.db_context(dbtype='crawler') as db:
+            self.load(db)
+            dirtab.update(db, fields=['fails', 'reported'], where='rowid > ?',
+                          data=[(3, 1, 0)])
+        cv_lib.reset_path('/abc/foo')
+        with CrawlDBI.db_context(dbtype='crawler') as db:
+            rows = dirtab.select(db, ['path', 'fails', 'reported'],
+                                 where='rowid > 3', orderby='rowid')
+        self.expected([('/abc/foo', 0, 0), ('/abc/bar', 3, 1)], rows)
+
+    # -------------------------------------------------------------------------
+    def test_checkable(self):
+        """
+        Checkables should be recorded and read back by path in the normalized
+        layout
+        """
+        self.dbgfunc()
+        Checkable.ex_nihilo(dataroot=['/home'])
+        Checkable.persist_records([CheckableRecord(path='/home/a', type='f'),
+                                   CheckableRecord(path='/home/b', type='d')])
+        x = Checkable(path='/home/a', type='f')
+        x.load()
+        self.assertTrue(x.in_db, "%s should be in the table" % x)
+        x.set('fails', 2)
+        x.persist()
+
+        y = Checkable(rowid=x.rowid)
+        y.load()
+        self.expected('/home/a', y.path)
+        self.expected(2, y.fails)
+        self.expected(['/home', '/home/a', '/home/b'],
+                      sorted([z.path for z in Checkable.get_list()]))
+
+    # -------------------------------------------------------------------------
+    def flat_table(self):
+        """
+        Make a flat checkables table from the test data with a gap in the
+        rowids and return its rows as migrate() should leave them
+        """
+        self.layout('flat')
+        dirtab.make_tables()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        self.load(db)
+        db.delete(table='checkables', where='rowid = 2')
+        rval = db.select(table='checkables',
+                         fields=['rowid', 'path', 'type', 'last_check'],
+                         orderby='rowid')
+        db.close()
+        return rval
+
+    # -------------------------------------------------------------------------
+    def migrated(self):
+        """
+        Return the rows of the normalized checkables table as flat_table()
+        does, checking that the holding table is gone
+        """
+        self.layout('normalized')
+        db = CrawlDBI.DBI(dbtype='crawler')
+        rval = dirtab.select(db, ['rowid', 'path', 'type', 'last_check'],
+                             orderby='rowid')
+        self.assertFalse(db.table_exists(table=dirtab.holding),
+                         "%s should be gone" % dirtab.holding)
+        db.close()
+        return rval
+
+    # -------------------------------------------------------------------------
+    def test_migrate(self):
+        """
+        migrate() should convert a flat table to the normalized layout,
+        keeping the rowids and paths, and do nothing when run again
+        """
+        self.dbgfunc()
+        before = self.flat_table()
+        self.expected(4, dirtab.migrate(chunk=3))
+        self.expected(before, self.migrated())
+        self.expected(0, dirtab.migrate())
+
+    # -------------------------------------------------------------------------
+    def test_migrate_resume(self):
+        """
+        A migration interrupted at any step should finish when migrate() is
+        run again, with no rows lost or copied twice
+        """
+        self.dbgfunc()
+        orig_rows = dirtab.migrate_rows
+
+        # ---------------------------------------------------------------------
+        def first_chunk(table):
+            """
+            Return a stand-in for migrate_rows() that dies after reading the
+            first chunk of *table*
+            """
+            # -----------------------------------------------------------------
+            def one_chunk(db, source, *args):
+                """
+                Yield the first chunk of *table*, then fail
+                """
+                for rows in orig_rows(db, source, *args):
+                    yield rows
+                    if source == table:
+                        raise KeyboardInterrupt()
+            return one_chunk
+
+        steps = [('migrate_rows', first_chunk('checkables')),
+                 ('forget', None),
+                 ('fields', None),
+                 ('migrate_rows', first_chunk(dirtab.holding))]
+        for (name, stand_in) in steps:
+            U.conditional_rm(self.dbname())
+            dirtab.forget()
+            before = self.flat_table()
+            kw = {'side_effect': KeyboardInterrupt()}
+            if stand_in is not None:
+                kw = {'new': stand_in}
+            with mock.patch.object(dirtab, name, **kw):
+                self.assertRaises(KeyboardInterrupt, dirtab.migrate, chunk=2)
+            dirtab.migrate(chunk=2)
+            self.expected(before, self.migrated())
@@ -5,7 +5,9 @@ import copy
 from hpssic import CrawlConfig
 import distutils
 from hpssic import hpss
+from hpssic import hsisim
 from hpssic import messages as MSG
+from hpssic.plugins import cv_plugin
 import os
 import pdb
 import pytest
@@ -33,6 +35,15 @@ class hpssBaseTest(testhelp.HelpedTestCase):
                          'hash_algorithm': 'md5'},
              }
 
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Give each test a closed circuit breaker that will read the current
+        config
+        """
+        super(hpssBaseTest, self).setUp()
+        hpss.breaker = hpss.CircuitBreaker()
+
 
 # -----------------------------------------------------------------------------
 def test_hsi_location():
@@ -48,6 +59,60 @@ def test_hsi_location():
     assert c == h, "location of hsi does not match location of crawl"
 
 
+# -----------------------------------------------------------------------------
+def test_atimes_parse():
+    """
+    atimes_parse() should find the access time of each path listed by 'ls
+    -lDTr', agreeing with atime_parse() on each line
+    """
+    lines = ["-rw-------  1 sim  sim  12 Jan 02 03:04:05 2014 /a/one",
+             "*** hpss_Lstat: No such file or directory [-2: HPSS_ENOENT]",
+             "-rw-------  1 sim  sim  12 Jul 22 13:14:15 2015 /a/two"]
+    times = hpss.atimes_parse("\r\n".join(lines))
+    assert sorted(times.keys()) == ['/a/one', '/a/two']
+    assert times['/a/one'] == hpss.atime_parse(lines[0])
+    assert times['/a/two'] == hpss.atime_parse(lines[2])
+    assert time.localtime(times['/a/two'])[:6] == (2015, 7, 22, 13, 14, 15)
+
+
+# -----------------------------------------------------------------------------
+def test_hashlist_parse():
+    """
+    hashlist_parse() should report which paths have checksums and which
+    don't, leaving out the ones hsi complained about, and hashlist_values()
+    should give the algorithm and digest of the ones that do
+    """
+    result = "\r\n".join(["hashlist /a/one /a/two /a/three /a/dir",
+                          "0123456789abcdef0123456789abcdef md5  " +
+                          "/a/one (hashlist)",
+                          "(none)  /a/two",
+                          "0123456789abcdef sha1 /a/three (hashlist)",
+                          "*** hashlist: /a/dir: Not a regular file",
+                          "O:[/home/tpb]: "])
+    assert hpss.hashlist_parse(result) == {'/a/one': True,
+                                           '/a/two': False,
+                                           '/a/three': True}
+    assert hpss.hashlist_values(result) == {
+        '/a/one': ('md5', '0123456789abcdef0123456789abcdef'),
+        '/a/three': ('sha1', '0123456789abcdef')}
+
+
+# -----------------------------------------------------------------------------
+def test_pathlist():
+    """
+    pathlist() should turn a string, unicode string, or list of paths into a
+    list of strings and name its caller when it gets anything else
+    """
+    assert hpss.pathlist("/a/one  /a/two") == ['/a/one', '/a/two']
+    assert hpss.pathlist(u"/a/one /a/two") == ['/a/one', '/a/two']
+    assert hpss.pathlist(['/a/one', u'/a/two']) == ['/a/one', '/a/two']
+    assert type(hpss.pathlist([u'/a/two'])[0]) == str
+    assert hpss.pathlist('') == []
+    with pytest.raises(hpss.HSIerror) as err:
+        hpss.pathlist(32)
+    assert "test_pathlist: Invalid argument" in str(err.value)
+
+
 # -----------------------------------------------------------------------------
 @pytest.fixture
 def muh_prep(request, tmpdir):
@@ -155,6 +220,26 @@ class hpssCtorTest(hpssBaseTest):
                             "Expected %s to have attribute '%s'" %
                             (a, attr))
 
+    # -------------------------------------------------------------------------
+    def test_ctor_logpath(self):
+        """
+        A verbose session's transcript should go next to the crawler log, or
+        to hsi_log if it's set, never to the current directory
+        """
+        self.dbgfunc()
+        cfg = copy.deepcopy(self.cfg_d)
+        cfg['crawler']['logpath'] = self.tmpdir('test.log')
+        binpath = hsisim.install(self.tmpdir('sim'))
+        with U.tmpenv('PATH', binpath + ":" + os.getenv('PATH')):
+            CrawlConfig.add_config(close=True, dct=cfg)
+            self.expected(self.tmpdir('hsi.out'),
+                          hpss.HSI(connect=False).logpath)
+
+            cfg['crawler']['hsi_log'] = self.tmpdir('session.log')
+            CrawlConfig.add_config(close=True, dct=cfg)
+            self.expected(self.tmpdir('session.log'),
+                          hpss.HSI(connect=False).logpath)
+
     # -------------------------------------------------------------------------
     def test_ctor_reset_atime_default(self):
         """
@@ -1085,6 +1170,92 @@ class hpssTest(hpssBaseTest):
                              h.connect)
 
 
+# -----------------------------------------------------------------------------
+class hpssBreakerTest(hpssBaseTest):
+    """
+    Tests for hpss.CircuitBreaker
+    """
+    # -------------------------------------------------------------------------
+    def breaker(self, failures='3', cooldown='60s', max_cooldown='200s'):
+        """
+        Return a CircuitBreaker configured with the arguments
+        """
+        cfg = copy.deepcopy(self.cfg_d)
+        cfg['crawler'].update({'logpath': self.tmpdir('test.log'),
+                               'hsi_breaker_failures': failures,
+                               'hsi_breaker_cooldown': cooldown,
+                               'hsi_breaker_max_cooldown': max_cooldown})
+        CrawlConfig.add_config(close=True, dct=cfg)
+        return hpss.CircuitBreaker()
+
+    # -------------------------------------------------------------------------
+    def test_breaker_trip(self):
+        """
+        The breaker should stay closed until hsi_breaker_failures failures in
+        a row, a success in between starting the count over
+        """
+        self.dbgfunc()
+        cb = self.breaker()
+        cb.failure(now=1000)
+        cb.failure(now=1001)
+        cb.success()
+        cb.failure(now=1002)
+        cb.failure(now=1003)
+        self.expected(True, cb.allow(now=1003))
+        self.expected(False, cb.is_open(now=1003))
+        cb.failure(now=1004)
+        self.expected(True, cb.is_open(now=1004))
+        self.expected(False, cb.allow(now=1004))
+        self.expected(30, cb.remaining(now=1034))
+        self.expected(False, cb.allow(now=1063))
+
+    # -------------------------------------------------------------------------
+    def test_breaker_reload(self):
+        """
+        When the configuration is reloaded, the breaker should pick up the
+        new settings at its next failure
+        """
+        self.dbgfunc()
+        cb = self.breaker()
+        cb.failure(now=1000)
+        self.expected(3, cb.failures)
+        self.breaker(failures='2', cooldown='10s')
+        cb.failure(now=1001)
+        self.expected(2, cb.failures)
+        self.expected(True, cb.is_open(now=1001))
+        self.expected(10, cb.remaining(now=1001))
+
+    # -------------------------------------------------------------------------
+    def test_breaker_probe(self):
+        """
+        After the cool-down, the breaker should let one probe through. A
+        failed probe should double the cool-down, up to
+        hsi_breaker_max_cooldown, and a successful one should close the
+        breaker.
+        """
+        self.dbgfunc()
+        cb = self.breaker(failures='1')
+        cb.failure(now=1000)
+        self.expected(False, cb.is_open(now=1060))
+        self.expected(True, cb.allow(now=1060))
+        self.expected(True, cb.is_open(now=1061))
+        self.expected(False, cb.allow(now=1061))
+
+        cb.failure(now=1062)
+        self.expected(120, cb.remaining(now=1062))
+        self.expected(False, cb.allow(now=1181))
+        self.expected(True, cb.allow(now=1182))
+        cb.failure(now=1183)
+        self.expected(200, cb.remaining(now=1183))
+
+        self.expected(True, cb.allow(now=1383))
+        cb.success()
+        self.expected(False, cb.is_open(now=1384))
+        self.expected(0, cb.remaining(now=1384))
+        cb.failure(now=1385)
+        self.expected(60, cb.remaining(now=1385))
+
+
 # -----------------------------------------------------------------------------
 @pytest.mark.jenkins_fail
 @pytest.mark.slow
@@ -1193,3 +1364,174 @@ class hpssHashAlgTest(hpssBaseTest):
         # verify that the hash created is of the proper type
         result = h.hashlist(testfile)
         self.expected_in(checkfor, result)
+
+
+# -----------------------------------------------------------------------------
+class hpssMuxTest(hpssBaseTest):
+    """
+    Tests for hpss.HSImux, run against a fake hsi that answers a few commands
+    after an optional delay
+    """
+    fake = "\n".join(["#!" + sys.executable,
+                      "BINARYVERSION='0.0'",
+                      "import os, sys, time",
+                      "delay = float(os.getenv('FAKE_HSI_DELAY', '0'))",
+                      "sys.stdout.write('fake hsi\\r\\nO:[/fake]: ')",
+                      "sys.stdout.flush()",
+                      "while True:",
+                      "    line = sys.stdin.readline()",
+                      "    if not line or line.startswith('quit'):",
+                      "        break",
+                      "    cmd = line.split()",
+                      "    if cmd[0] == 'sleep':",
+                      "        time.sleep(float(cmd[1]))",
+                      "    elif cmd[0] == 'fail':",
+                      "        sys.stdout.write('HPSS_ESYSTEM\\r\\n')",
+                      "    elif cmd[0] == 'hashverify':",
+                      "        time.sleep(delay)",
+                      "        sys.stdout.write('%s: (md5) OK\\r\\n' %",
+                      "                         cmd[1])",
+                      "    elif cmd[0] == 'ls':",
+                      "        for path in cmd[2:]:",
+                      "            sys.stdout.write('FILE\\t%s\\r\\n' % path)",
+                      "    sys.stdout.write('O:[/fake]: ')",
+                      "    sys.stdout.flush()",
+                      ""])
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Write the fake hsi in two places so maybe_update_hsi() finds a source
+        copy that matches the one in $PATH, and set up the config
+        """
+        super(hpssMuxTest, self).setUp()
+        bindir = self.tmpdir("bin")
+        srcdir = self.tmpdir("sources/hpss/bin")
+        for dname in [bindir, srcdir]:
+            os.makedirs(dname)
+            util.write_file(U.pathjoin(dname, 'hsi'), 0755, self.fake)
+        self.path = ":".join([bindir, srcdir, os.getenv('PATH')])
+        cfg = copy.deepcopy(self.cfg_d)
+        cfg['cv']['reset_atime'] = 'no'
+        cfg['crawler']['logpath'] = self.tmpdir('test.log')
+        CrawlConfig.add_config(close=True, dct=cfg)
+
+    # -------------------------------------------------------------------------
+    def test_mux_concurrent(self):
+        """
+        Several hashverify jobs on several sessions should run at the same
+        time, each getting its own output
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            with U.tmpenv('FAKE_HSI_DELAY', '1.0'):
+                mux = hpss.HSImux(sessions=4, timeout=10)
+                start = time.time()
+                jobs = mux.hashverify(self.plist + ["/home/tpb/another"])
+                done = list(mux.as_completed(jobs))
+                elapsed = time.time() - start
+                mux.quit()
+        self.expected(4, len(done))
+        self.expected(4, mux.opened)
+        for job in jobs:
+            path = job.steps[0][0].split()[1]
+            self.expected_in("%s: \(md5\) OK" % path, job.result())
+            self.expected('', job.error)
+        self.assertTrue(elapsed < 3.0,
+                        "Expected jobs to overlap, took %g s" % elapsed)
+
+    # -------------------------------------------------------------------------
+    def test_mux_error(self):
+        """
+        An hsi error message should mark the job with ERROR and leave the
+        session usable for the next job
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            mux = hpss.HSImux(sessions=1, timeout=10)
+            bad = mux.submit("fail")
+            good = mux.lsP(self.plist[0])
+            self.expected_in("HPSS_ESYSTEM", bad.result())
+            self.expected_in(" ERROR$", bad.result())
+            self.expected('ERROR', bad.error)
+            self.expected_in("FILE\t%s" % self.plist[0], good.result())
+            self.expected('', good.error)
+            mux.quit()
+        self.expected(1, mux.opened)
+
+    # -------------------------------------------------------------------------
+    def test_mux_timeout(self):
+        """
+        A command that produces no output within its timeout should finish
+        with TIMEOUT, and a new session should pick up the next job
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            mux = hpss.HSImux(sessions=1, timeout=10)
+            slow = mux.submit("sleep 5", timeout=0.5)
+            after = mux.hashlist(self.plist[0])
+            start = time.time()
+            self.expected_in(" TIMEOUT$", slow.result())
+            self.assertTrue(time.time() - start < 3.0,
+                            "Expected the timeout to fire in about 0.5s")
+            after.result()
+            self.expected('', after.error)
+            mux.quit()
+        self.expected(2, mux.opened)
+
+    # -------------------------------------------------------------------------
+    def test_mux_unavailable(self):
+        """
+        If hsi can't be started, queued jobs should fail with ERROR rather than
+        hang
+        """
+        self.dbgfunc()
+        with U.tmpenv('PATH', self.path):
+            for dname in ["bin", "sources/hpss/bin"]:
+                util.write_file(self.tmpdir(dname + "/hsi"), 0755,
+                                self.fake.replace("import os, sys, time",
+                                                  "import os, sys, time\n" +
+                                                  "sys.exit(1)"))
+            mux = hpss.HSImux(sessions=2, timeout=10)
+            job = mux.lsP(self.plist[0])
+            self.expected_in(" ERROR$", job.result(timeout=10))
+            self.expected(True, mux.unavailable)
+            mux.quit()
+
+    # -------------------------------------------------------------------------
+    def test_mux_breaker(self):
+        """
+        Once sessions have failed to connect hsi_breaker_failures times, new
+        sessions should fail at once without starting hsi, and the cv plugin
+        should skip its run
+        """
+        self.dbgfunc()
+        cfg = CrawlConfig.get_config()
+        cfg.set('crawler', 'hsi_breaker_failures', '2')
+        with U.tmpenv('PATH', self.path):
+            for dname in ["bin", "sources/hpss/bin"]:
+                util.write_file(self.tmpdir(dname + "/hsi"), 0755,
+                                self.fake.replace("import os, sys, time",
+                                                  "import os, sys, time\n" +
+                                                  "sys.exit(1)"))
+            for attempt in range(2):
+                mux = hpss.HSImux(sessions=1, timeout=10)
+                job = mux.lsP(self.plist[0])
+                self.expected_in(" ERROR$", job.result(timeout=10))
+                mux.quit()
+            self.expected(True, hpss.breaker.is_open())
+
+            h = hpss.HSI(connect=False)
+            start = time.time()
+            self.assertRaisesMsg(hpss.HSIerror,
+                                 MSG.hpss_unavailable,
+                                 h.connect)
+            self.expected(None, h.xobj)
+            mux = hpss.HSImux(sessions=1, timeout=10)
+            job = mux.lsP(self.plist[0])
+            self.expected_in(MSG.hpss_unavailable, job.result(timeout=10))
+            self.expected(0, mux.opened)
+            self.assertTrue(time.time() - start < 1.0,
+                            "Expected the open breaker to fail fast")
+
+        self.expected(0, cv_plugin.main(cfg))
@@ -0,0 +1,238 @@
+"""
+Tests for hsisim.py
+"""
+from hpssic import bench
+from hpssic import CrawlConfig
+from hpssic import hpss
+from hpssic import hsisim
+from hpssic import metrics
+from hpssic import testhelp
+from hpssic import util as U
+import hashlib
+import os
+import pdb
+import StringIO
+
+
+# -----------------------------------------------------------------------------
+class hsisimTest(testhelp.HelpedTestCase):
+    """
+    Tests for the hsi simulator
+    """
+    # -------------------------------------------------------------------------
+    def session(self, commands, **env):
+        """
+        Run *commands* through a simulated session with settings *env* and
+        return the output. Without a terminal echoing the commands, each
+        response would start on the prompt line, so we break the lines there.
+        """
+        s = hsisim.Session(env)
+        out = StringIO.StringIO()
+        s.run(StringIO.StringIO("".join([x + "\n" for x in commands])), out)
+        return out.getvalue().replace("]: ", "]:\n")
+
+    # -------------------------------------------------------------------------
+    def test_kind(self):
+        """
+        Namespace.kind() should recognize the directories and files in the
+        tree and nothing else
+        """
+        self.dbgfunc()
+        ns = hsisim.Namespace(root='/sim', depth=2, fanout=3, files=5)
+        self.expected('d', ns.kind('/sim'))
+        self.expected('d', ns.kind('/sim/d02/'))
+        self.expected('d', ns.kind('/sim/d02/d00'))
+        self.expected('f', ns.kind('/sim/d02/d00/f0004'))
+        self.expected('f', ns.kind('/sim/f0000'))
+        self.expected(None, ns.kind('/sim/d03'))
+        self.expected(None, ns.kind('/sim/d00/d00/d00'))
+        self.expected(None, ns.kind('/sim/f0005'))
+        self.expected(None, ns.kind('/sim/f0000/f0000'))
+        self.expected(None, ns.kind('/other'))
+
+    # -------------------------------------------------------------------------
+    def test_listing(self):
+        """
+        Namespace.listing() should give subdirectories above the bottom level
+        and files everywhere, and total() should agree with a full walk
+        """
+        self.dbgfunc()
+        ns = hsisim.Namespace(root='/sim', depth=2, fanout=3, files=5)
+        self.expected(8, len(ns.listing('/sim')))
+        self.expected(5, len(ns.listing('/sim/d01/d02')))
+
+        (dirs, files) = (0, 0)
+        todo = ['/sim']
+        while todo:
+            for (ftype, path) in ns.listing(todo.pop()):
+                if ftype == 'd':
+                    dirs += 1
+                    todo.append(path)
+                else:
+                    files += 1
+        self.expected((dirs, files), ns.total())
+        self.expected((12, 65), ns.total())
+
+    # -------------------------------------------------------------------------
+    def test_lsp(self):
+        """
+        'ls -P' output from the simulator should parse with lsp_columns()
+        """
+        self.dbgfunc()
+        out = self.session(["ls -P /sim/d00"], HSISIM_CARTS='yes')
+        cols = U.lsp_columns(out)
+        self.expected(14, len(cols['path']))
+        self.expected(['d'] * 4 + ['f'] * 10, cols['type'])
+        for (size, cart) in zip(cols['size'][4:], cols['cart'][4:]):
+            if size == 0:
+                self.expected('', cart)
+            else:
+                self.expected_in("^S\d{5}$", cart)
+
+        out = self.session(["ls -P /sim/d00"])
+        self.expected([None] * 4 + [''] * 10, U.lsp_columns(out)['cart'])
+
+    # -------------------------------------------------------------------------
+    def test_hashes(self):
+        """
+        A checksum created with hashcreate should show up in hashlist and pass
+        hashverify, and be seen by other sessions sharing the state directory
+        """
+        self.dbgfunc()
+        path = '/sim/d01/f0003'
+        out = self.session(["hashlist %s" % path,
+                            "hashverify %s" % path,
+                            "hashcreate -H md5 %s" % path,
+                            "hashlist %s" % path,
+                            "hashverify %s" % path],
+                           HSISIM_STATE=self.tmpdir())
+        self.expected_in("\(none\)  %s" % path, out)
+        self.expected_in("%s: no valid checksum found" % path, out)
+        self.expected_in("[0-9a-f]{32}\smd5\s%s \(hashlist\)" % path, out)
+        self.expected_in("%s: \(md5\) OK" % path, out)
+
+        out = self.session(["hashverify %s" % path],
+                           HSISIM_STATE=self.tmpdir())
+        self.expected_in("%s: \(md5\) OK" % path, out)
+
+        log = U.contents(self.tmpdir('log'))
+        self.expected(2, log.count(" start"))
+        self.expected(3, log.count(" hashverify"))
+
+    # -------------------------------------------------------------------------
+    def test_get(self):
+        """
+        'get - : path' given on the command line should write just the
+        file's content, whose md5 is the checksum hashlist shows, and a
+        missing file should go to the error output with a failing status
+        """
+        self.dbgfunc()
+        path = '/sim/d02/f0005'
+        s = hsisim.Session({'HSISIM_HASHED': '1'})
+        (out, err) = (StringIO.StringIO(), StringIO.StringIO())
+        self.expected(0, s.run_line("get - : %s" % path, out, err))
+        self.expected(hsisim.Namespace().content(path), out.getvalue())
+        self.expected("", err.getvalue())
+        self.expected_in("%s md5 %s" % (hashlib.md5(out.getvalue())
+                                        .hexdigest(), path),
+                         self.session(["hashlist %s" % path],
+                                      HSISIM_HASHED='1'))
+
+        (out, err) = (StringIO.StringIO(), StringIO.StringIO())
+        self.expected(1, s.run_line("get - : /sim/f0099", out, err))
+        self.expected("", out.getvalue())
+        self.expected_in("HPSS_ENOENT", err.getvalue())
+
+    # -------------------------------------------------------------------------
+    def test_semicolon(self):
+        """
+        Commands separated by ';' should all run before the next prompt
+        """
+        self.dbgfunc()
+        out = self.session(["ls -lDTr /sim/f0001 ; touch -a -t 1 /sim/f0001" +
+                            " ; hashlist /sim/f0001", "lscos"],
+                           HSISIM_STATE=self.tmpdir())
+        self.expected(3, out.count("]:"))
+        log = U.contents(self.tmpdir('log'))
+        self.expected(["start", "ls", "touch", "hashlist", "lscos", "quit"],
+                      [x.split()[1] for x in log.split("\n") if x])
+
+    # -------------------------------------------------------------------------
+    def test_atime_batch(self):
+        """
+        With reset_atime set, HSI.hashverify() on several files should
+        capture their access times with one 'ls -lDTr' and restore them with
+        one line of touch commands
+        """
+        self.dbgfunc()
+        CrawlConfig.add_config(close=True,
+                               dct={'crawler': {'logpath':
+                                                self.tmpdir('test.log')}})
+        paths = ['/sim/d01/f%04d' % x for x in range(5)]
+        binpath = hsisim.install(self.tmpdir('atime'))
+        with U.tmpenv('PATH', binpath + ":" + os.getenv('PATH')):
+            with U.tmpenv('HSISIM_STATE', self.tmpdir()):
+                with U.tmpenv('HSISIM_HASHED', '1'):
+                    h = hpss.HSI(reset_atime=True, hash_algorithm=None)
+                    sent = hpss.HSI.cmd_count
+                    out = h.hashverify(paths)
+                    sent = hpss.HSI.cmd_count - sent
+                    h.quit()
+        for path in paths:
+            self.expected_in("%s: \(md5\) OK" % path, out)
+        self.expected(7, sent)
+        log = U.contents(self.tmpdir('log'))
+        self.expected(1, log.count(" ls"))
+        self.expected(5, log.count(" hashverify"))
+        self.expected(1, log.count(" touch"))
+
+    # -------------------------------------------------------------------------
+    def test_errors(self):
+        """
+        With HSISIM_ERRORS=1, every transfer should fail with a message that
+        hpss.HSI recognizes as an error
+        """
+        self.dbgfunc()
+        out = self.session(["hashcreate /sim/f0001",
+                            "hashverify /sim/f0002"],
+                           HSISIM_ERRORS='1', HSISIM_HASHED='1')
+        self.expected(2, len([x for x in out.split("\n")
+                              if U.rgxin(hpss.HSI.hsierrs[4], x)]))
+
+    # -------------------------------------------------------------------------
+    def test_lscos(self):
+        """
+        'lscos' output should have a line for each COS between two rules
+        """
+        self.dbgfunc()
+        lines = self.session(["lscos"]).split("\n")
+        rules = [idx for (idx, line) in enumerate(lines) if '-----' in line]
+        self.expected(2, len(rules))
+        self.expected(len(hsisim.cos_list), rules[1] - rules[0] - 1)
+
+    # -------------------------------------------------------------------------
+    def test_bench_cv(self):
+        """
+        bench.cv_rounds() should run the cv plugin against the simulator
+        through hpss.HSI and report what it did, timing the hsi commands in
+        the metrics
+        """
+        self.dbgfunc()
+        stats = list(bench.cv_rounds(self.tmpdir('scratch'), 2, 4,
+                                     simenv={'HSISIM_SHAPE': '1,2,2',
+                                             'HSISIM_HASHED': '1'}))
+        self.expected([1, 2], [x['round'] for x in stats])
+        # the root's contents are found and checked in the first round
+        self.expected(4, stats[0]['items'])
+        self.expected(4, stats[1]['items'])
+        for x in stats:
+            self.assertTrue(0 < x['sessions'] <= x['commands'],
+                            "Expected some hsi sessions and commands: %s" % x)
+            self.assertTrue(0 < x['db_ops'],
+                            "Expected some database operations: %s" % x)
+
+        # the hsi commands should have been timed by name
+        text = metrics.render()
+        for cmd in ['ls', 'hashverify']:
+            self.expected_in('hpssic_hsi_command_seconds_count' +
+                             '{command="%s"} [1-9]' % cmd, text)
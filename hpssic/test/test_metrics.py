@@ -0,0 +1,143 @@
+"""
+Tests for metrics.py
+"""
+from hpssic import CrawlConfig
+from hpssic import CrawlDBI
+from hpssic import metrics
+from hpssic import testhelp
+from hpssic import util as U
+import os
+import pdb
+import urllib2
+
+
+# -----------------------------------------------------------------------------
+class metricsTest(testhelp.HelpedTestCase):
+    """
+    Tests for the metrics registry and exporter
+    """
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """
+        Start each test with no values and a config pointing the metrics file
+        into the test directory
+        """
+        super(metricsTest, self).setUp()
+        metrics.reset()
+        for attr in ['_server', '_written']:
+            if hasattr(metrics.export, attr):
+                delattr(metrics.export, attr)
+        self.mfile = self.tmpdir('crawl.prom')
+        U.conditional_rm(self.mfile)
+        U.conditional_rm(self.dbname())
+        cfg = {'crawler': {'logpath': self.tmpdir('test.log'),
+                           'metrics_file': self.mfile,
+                           'metrics_interval': '30s'},
+               'dbi-crawler': {'dbtype': 'sqlite',
+                               'dbname': self.dbname(),
+                               'tbl_prefix': 'test'}}
+        self.cfg = CrawlConfig.add_config(close=True, dct=cfg)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+        """
+        Stop any server a test started
+        """
+        server = getattr(metrics.export, '_server', None)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            del metrics.export._server
+
+    # -------------------------------------------------------------------------
+    def test_render(self):
+        """
+        render() should give each metric a HELP and TYPE line, then its
+        samples, with histogram buckets cumulative and escaped label values
+        """
+        self.dbgfunc()
+        metrics.inc('hpssic_items_total', 3, plugin='cv')
+        metrics.inc('hpssic_items_total', plugin='cv')
+        metrics.gauge('hpssic_queue_depth', 7, queue='hsimux')
+        metrics.observe('hpssic_hsi_command_seconds', 0.003, command='ls')
+        metrics.observe('hpssic_hsi_command_seconds', 0.2, command='ls')
+        metrics.observe('hpssic_hsi_command_seconds', 2000.0, command='ls')
+        metrics.inc('xyz_total', path='/a "b"\\c')
+        text = metrics.render()
+
+        self.expected_in("# TYPE hpssic_items_total counter\n" +
+                         "hpssic_items_total{plugin=\"cv\"} 4\n", text)
+        self.expected_in("hpssic_queue_depth{queue=\"hsimux\"} 7\n", text)
+        self.expected_in("# TYPE hpssic_hsi_command_seconds histogram", text)
+        ls = '{command="ls",le="%s"}'
+        self.expected_in("_bucket%s 0\n" % ls % '0.0025', text)
+        self.expected_in("_bucket%s 1\n" % ls % '0.005', text)
+        self.expected_in("_bucket%s 2\n" % ls % '0.25', text)
+        self.expected_in("_bucket%s 2\n" % ls % '900.0', text)
+        self.expected_in("_bucket%s 3\n" % ls % '\+Inf', text)
+        self.expected_in("hpssic_hsi_command_seconds_count{command=\"ls\"} 3",
+                         text)
+        self.expected_in("hpssic_hsi_command_seconds_sum{command=\"ls\"} " +
+                         "2000.203", text)
+        self.expected_in("# TYPE xyz_total untyped", text)
+        self.assertTrue('xyz_total{path="/a \\"b\\"\\\\c"} 1\n' in text,
+                        "Expected escaped label value in %s" % text)
+
+    # -------------------------------------------------------------------------
+    def test_dbi(self):
+        """
+        Database calls should be timed by dbtype, table, and operation
+        """
+        self.dbgfunc()
+        db = CrawlDBI.DBI(dbtype='crawler')
+        db.create(table='mtest', fields=['name text'])
+        db.insert(table='mtest', fields=['name'], data=[('one',), ('two',)])
+        db.select(table='mtest', fields=['name'])
+        db.close()
+        text = metrics.render()
+        for op in ['insert', 'select']:
+            self.expected_in('hpssic_db_query_seconds_count' +
+                             '{dbtype="crawler",operation="%s",' % op +
+                             'table="mtest"} 1', text)
+
+    # -------------------------------------------------------------------------
+    def test_export_file(self):
+        """
+        export() should write the metrics file when metrics_interval has
+        passed since it last did, and not in between
+        """
+        self.dbgfunc()
+        metrics.inc('hpssic_items_total', 5, plugin='tcc')
+        metrics.export(self.cfg, now=1000)
+        self.expected_in('hpssic_items_total{plugin="tcc"} 5',
+                         U.contents(self.mfile))
+
+        metrics.inc('hpssic_items_total', 5, plugin='tcc')
+        metrics.export(self.cfg, now=1020)
+        self.expected_in('hpssic_items_total{plugin="tcc"} 5',
+                         U.contents(self.mfile))
+        metrics.export(self.cfg, now=1030)
+        self.expected_in('hpssic_items_total{plugin="tcc"} 10',
+                         U.contents(self.mfile))
+        self.expected([os.path.basename(self.mfile)],
+                      [x for x in os.listdir(os.path.dirname(self.mfile))
+                       if x.startswith(os.path.basename(self.mfile))])
+
+    # -------------------------------------------------------------------------
+    def test_export_port(self):
+        """
+        With metrics_port set, export() should serve the metrics over HTTP,
+        answering other paths with 404
+        """
+        self.dbgfunc()
+        self.cfg.set('crawler', 'metrics_port', '0')
+        metrics.gauge('hpssic_queue_depth', 2, queue='hsimux')
+        metrics.export(self.cfg)
+        port = metrics.export._server.server_port
+        self.assertTrue(0 < port, "Expected a port to be assigned")
+
+        url = 'http://127.0.0.1:%d' % port
+        text = urllib2.urlopen(url + '/metrics').read()
+        self.expected_in('hpssic_queue_depth{queue="hsimux"} 2', text)
+        self.assertRaisesRegex(urllib2.HTTPError, "404",
+                               urllib2.urlopen, url + '/other')
@@ -51,6 +51,60 @@ class UtilTest(testhelp.HelpedTestCase):
         self.expected(['abc', ''], util.csv_list("  abc, "))
         self.expected(['a', 'b', 'c'], util.csv_list(" a,b ,  c  "))
 
+    # -------------------------------------------------------------------------
+    def test_cache(self):
+        """
+        A Cache should evict the least recently used entry when it's full,
+        expire entries ttl seconds after they were stored, drop entries on
+        request, and count what happened
+        """
+        self.dbgfunc()
+        c = util.Cache(size=2, ttl=10)
+        c.put('a', 1, now=100)
+        c.put('b', 2, now=100)
+        self.expected(1, c.get('a', now=101))
+        c.put('c', 3, now=102)
+        self.assertRaises(KeyError, c.get, 'b', now=102)
+        self.expected(3, c.get('c', now=111))
+        self.assertRaises(KeyError, c.get, 'a', now=110)
+        self.expected({'hits': 2, 'misses': 2, 'evictions': 1,
+                       'expirations': 1, 'entries': 1}, c.stats())
+
+        c.update({'x': 'one', 'y': 'two'})
+        c.invalidate('y')
+        self.assertTrue('x' in c and 'y' not in c and 'c' not in c,
+                        "Expected only x in the cache")
+        c.configure(size=1)
+        self.expected(1, len(c))
+        c.invalidate()
+        self.expected(0, len(c))
+
+    # -------------------------------------------------------------------------
+    def test_cached(self):
+        """
+        A function decorated with cached() should only be called once for
+        each set of arguments until its cache is invalidated
+        """
+        self.dbgfunc()
+        calls = []
+
+        @util.cached(size=10)
+        def add(a, b):
+            """
+            Record the call and add the arguments
+            """
+            calls.append((a, b))
+            return a + b
+
+        self.expected([3, 3, 4], [add(1, 2), add(1, 2), add(2, 2)])
+        self.expected([(1, 2), (2, 2)], calls)
+        add.cache.put((5, 5), 'preloaded')
+        self.expected('preloaded', add(5, 5))
+        add.cache.invalidate()
+        self.expected(3, add(1, 2))
+        self.expected(3, len(calls))
+        self.expected("add", add.__name__)
+
     # -------------------------------------------------------------------------
     def test_content_list(self):
         """
@@ -518,6 +572,28 @@ class UtilTest(testhelp.HelpedTestCase):
         self.assertFalse('.' in hn,
                          "Expected short hostname but got '%s'" % hn)
 
+    # -------------------------------------------------------------------------
+    def test_lazy_module(self):
+        """
+        A LazyModule should not import its module until an attribute is used,
+        then behave like the module. One for a module that isn't there should
+        raise ImportError at that point.
+        """
+        self.dbgfunc()
+        sys.modules.pop('colorsys', None)
+        cs = util.LazyModule('colorsys')
+        self.assertFalse(cs.loaded(), "Expected %r not to be loaded" % cs)
+        self.assertFalse('colorsys' in sys.modules,
+                         "Expected colorsys not to be imported yet")
+        self.expected((0.0, 0.0, 1.0), cs.rgb_to_hsv(1.0, 1.0, 1.0))
+        self.assertTrue(cs.loaded(), "Expected %r to be loaded" % cs)
+        self.assertTrue(cs._module is sys.modules['colorsys'],
+                        "Expected the proxy to hold the real module")
+
+        missing = util.LazyModule('no_such_module_xyz')
+        self.assertRaisesRegex(ImportError, "no_such_module_xyz",
+                               getattr, missing, 'anything')
+
     # -------------------------------------------------------------------------
     def test_line_quote(self):
         """
@@ -538,6 +614,52 @@ class UtilTest(testhelp.HelpedTestCase):
         act = util.line_quote('"abc"')
         self.expected(exp, act)
 
+    # -------------------------------------------------------------------------
+    def test_lsp_columns_empty(self):
+        """
+        lsp_columns on input with no FILE or DIRECTORY lines should return
+        empty columns
+        """
+        self.dbgfunc()
+        rv = util.lsp_columns(" ls -P\r\n*** HPSS Error: no such file\r\n")
+        for key in ['type', 'path', 'size', 'cart', 'cos', 'created',
+                    'modified']:
+            self.expected([], rv[key])
+
+    # -------------------------------------------------------------------------
+    def test_lsp_columns_mixed(self):
+        """
+        lsp_columns on a listing with a directory, a file on one cart, an empty
+        file, and a file with two copies, surrounded by cruft from an actual
+        hsi session. Fields are blank padded in various ways.
+        """
+        self.dbgfunc()
+        td_s = ("ls -P /home/tpb\r\n" +
+                "DIRECTORY\t       /home/tpb/apache\r\n" +
+                "FILE\t /home/tpb/LoadL_admin\t 88787\t   88787\t   " +
+                "3962+411820\t X0352700\t 5081\t 0\t 1\t       " +
+                "03/14/2003\t  07:12:43\t 03/19/2012\t 13:09:50\r\n" +
+                "FILE\t/home/tpb/empty\t 0\t 0\t   " +
+                "0\t        \t              6001\t    0\t       1\t  " +
+                "05/15/2007\t   03:06:39\t  02/11/2009\t  11:06:31\r\n" +
+                "FILE\t/home/tpb/two copies\t2369\t2369\t19625+0\t" +
+                "X1605700,X1605800\t6002\t0\t2\t09/16/2014\t16:50:45\t" +
+                "09/16/2014\t16:50:57\r\n" +
+                "\r\n\r\rO:[/home/tpb")
+        rv = util.lsp_columns(td_s)
+        self.expected(['d', 'f', 'f', 'f'], rv['type'])
+        self.expected(['/home/tpb/apache', '/home/tpb/LoadL_admin',
+                       '/home/tpb/empty', '/home/tpb/two copies'],
+                      rv['path'])
+        self.expected([None, 88787, 0, 2369], rv['size'])
+        self.expected([None, 'X0352700', '', 'X1605700,X1605800'],
+                      rv['cart'])
+        self.expected(['', '5081', '6001', '6002'], rv['cos'])
+        self.expected([None, '03/14/2003 07:12:43', '05/15/2007 03:06:39',
+                       '09/16/2014 16:50:45'], rv['created'])
+        self.expected([None, '03/19/2012 13:09:50', '02/11/2009 11:06:31',
+                       '09/16/2014 16:50:57'], rv['modified'])
+
     # -------------------------------------------------------------------------
     def test_lsp_parse_bogus(self):
         """
@@ -650,6 +772,22 @@ class UtilTest(testhelp.HelpedTestCase):
         self.expected(td_l[5], rv[2])
         self.expected(td_l[6], rv[3])
 
+    # -------------------------------------------------------------------------
+    def test_module_available(self):
+        """
+        module_available() should say whether a module, dotted or not, can be
+        imported
+        """
+        self.dbgfunc()
+        self.assertTrue(util.module_available('sqlite3'),
+                        "Expected sqlite3 to be available")
+        self.assertTrue(util.module_available('email.mime.text'),
+                        "Expected email.mime.text to be available")
+        self.assertFalse(util.module_available('no_such_module_xyz'),
+                         "Expected no_such_module_xyz not to be available")
+        self.assertFalse(util.module_available('email.no_such_module'),
+                         "Expected email.no_such_module not to be available")
+
     # -------------------------------------------------------------------------
     def test_my_name(self):
         """
@@ -660,6 +798,43 @@ class UtilTest(testhelp.HelpedTestCase):
         expected = 'test_my_name'
         self.expected(expected, actual)
 
+    # -------------------------------------------------------------------------
+    def test_percentile(self):
+        """
+        percentile() should pick the nearest rank, handle the ends of the
+        range, and return None for no values
+        """
+        self.dbgfunc()
+        vals = [15, 20, 35, 40, 50]
+        self.expected(20, util.percentile(vals, 30))
+        self.expected(35, util.percentile(list(reversed(vals)), 50))
+        self.expected(50, util.percentile(vals, 99))
+        self.expected(50, util.percentile(vals, 100))
+        self.expected(15, util.percentile(vals, 0))
+        self.expected(None, util.percentile([], 50))
+
+    # -------------------------------------------------------------------------
+    def test_retry_policy(self):
+        """
+        RetryPolicy.wait() should double the wait up to max_delay, take up to
+        jitter of it off, and return None after max_attempts tries or once
+        the timeout has passed
+        """
+        self.dbgfunc()
+        rp = util.RetryPolicy(delay=0.5, max_delay=3.0, jitter=0.0,
+                              max_attempts=6, timeout=100)
+        self.expected([0.5, 1.0, 2.0, 3.0, 3.0, None],
+                      [rp.wait(x, 0) for x in range(1, 7)])
+        self.expected(1.5, rp.wait(3, 98.5))
+        self.expected(None, rp.wait(1, 100))
+
+        rp = util.RetryPolicy(delay=1.0, max_delay=8.0, jitter=0.5)
+        waits = [rp.wait(4, 0) for x in range(50)]
+        self.assertTrue(all([4.0 <= x <= 8.0 for x in waits]),
+                        "Expected waits between 4 and 8: %s" % waits)
+        self.assertTrue(1 < len(set(waits)), "Expected the waits to vary")
+        self.expected(None, util.RetryPolicy().wait(10**6, 3600))
+
     # -------------------------------------------------------------------------
     def test_pop0(self):
         """
@@ -1,7 +1,11 @@
+import collections
 import contextlib
 import copy
+import functools
+import imp
 import logging
 import logging.handlers as logh
+import math
 import messages as MSG
 import os
 import pdb
@@ -11,6 +15,7 @@ import shutil
 import socket
 import string
 import sys
+import threading
 import time
 import traceback as tb
 
@@ -220,6 +225,284 @@ class RRfile(object):
         return rval
 
 
+# -----------------------------------------------------------------------------
+class RetryPolicy(object):
+    """
+    How long to wait between tries of an operation failing with a transient
+    error. The wait before the n'th retry is *delay* * 2**(n-1) seconds, up
+    to *max_delay*, less a random fraction of up to *jitter* of that, so
+    that processes knocked over by the same outage don't all come back at
+    once. We give up after *max_attempts* tries (0 for no limit) or once
+    *timeout* seconds have passed.
+    """
+    # ------------------------------------------------------------------------
+    def __init__(self, delay=0.1, max_delay=10.0, jitter=0.5, max_attempts=0,
+                 timeout=3600):
+        """
+        Set the parameters
+        """
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    # ------------------------------------------------------------------------
+    def wait(self, attempt, elapsed):
+        """
+        Return how many seconds to wait after try number *attempt* failed,
+        *elapsed* seconds after the first try started, or None if it's time to
+        give up
+        """
+        if 0 < self.max_attempts <= attempt or self.timeout <= elapsed:
+            return None
+        rval = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        rval -= random.uniform(0, self.jitter * rval)
+        return min(rval, self.timeout - elapsed)
+
+
+# -----------------------------------------------------------------------------
+class Cache(object):
+    """
+    A dict-like cache holding at most *size* entries (0 for no limit), each
+    good for *ttl* seconds after it was stored (0 for as long as it stays in
+    the cache). When the cache is full, storing a new entry evicts the one
+    least recently used. Hits, misses, evictions, and expirations are
+    counted for stats(). A lock makes it safe to share between threads.
+    """
+    # ------------------------------------------------------------------------
+    def __init__(self, size=0, ttl=0):
+        """
+        Set the bounds and start empty
+        """
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counts = dict.fromkeys(['hits', 'misses', 'evictions',
+                                     'expirations'], 0)
+
+    # ------------------------------------------------------------------------
+    def __contains__(self, key):
+        """
+        Return True if *key* has an unexpired entry, without counting a hit or
+        miss or making it recently used
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and not self.expired(entry, time.time())
+
+    # ------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Return the number of entries, expired or not
+        """
+        return len(self.entries)
+
+    # ------------------------------------------------------------------------
+    def configure(self, size=None, ttl=None):
+        """
+        Change the bounds. Entries over a smaller size are evicted.
+        """
+        with self.lock:
+            if size is not None:
+                self.size = size
+            if ttl is not None:
+                self.ttl = ttl
+            self.trim()
+
+    # ------------------------------------------------------------------------
+    def expired(self, entry, now):
+        """
+        Return True if *entry* (a (value, stored time) tuple) is too old
+        """
+        return 0 < self.ttl and entry[1] + self.ttl <= now
+
+    # ------------------------------------------------------------------------
+    def get(self, key, now=None):
+        """
+        Return the value stored for *key*, raising KeyError if there isn't
+        one or it has expired
+        """
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and self.expired(entry, now):
+                self.counts['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                raise KeyError(key)
+            self.entries[key] = entry
+            self.counts['hits'] += 1
+            return entry[0]
+
+    # ------------------------------------------------------------------------
+    def invalidate(self, key=None):
+        """
+        Drop the entry for *key*, or all the entries if *key* is None
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    # ------------------------------------------------------------------------
+    def put(self, key, value, now=None):
+        """
+        Store *value* for *key*, evicting the least recently used entries if
+        there are too many
+        """
+        now = now or time.time()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now)
+            self.trim()
+
+    # ------------------------------------------------------------------------
+    def stats(self):
+        """
+        Return a dict of the counts and the current number of entries
+        """
+        with self.lock:
+            rval = dict(self.counts)
+            rval['entries'] = len(self.entries)
+        return rval
+
+    # ------------------------------------------------------------------------
+    def trim(self):
+        """
+        Evict the least recently used entries until there are no more than
+        size. The caller holds the lock.
+        """
+        while 0 < self.size < len(self.entries):
+            self.entries.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    # ------------------------------------------------------------------------
+    def update(self, items, now=None):
+        """
+        Store each (key, value) pair in dict or list *items*, as for preloading
+        the cache from one query
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        for (key, value) in items:
+            self.put(key, value, now)
+
+
+# -----------------------------------------------------------------------------
+def cached(size=0, ttl=0):
+    """
+    Like memoize(), but the results are kept in a Cache with the *size* and
+    *ttl* given, keyed on all the positional arguments, and the cache is
+    available as the function's cache attribute for configuring, preloading,
+    invalidating, and getting stats:
+
+        @util.cached(size=1000, ttl=3600)
+        def lookup(a, b):
+            ...
+
+        lookup.cache.configure(ttl=600)
+        lookup.cache.put((1, 2), 'preloaded')
+        lookup.cache.invalidate()
+
+    A function taking one argument is keyed on that argument alone, so
+    lookup.cache.put('x', ...) works for it. Keyword arguments are not
+    supported.
+    """
+    # -------------------------------------------------------------------------
+    def decorator(f):
+        """
+        Wrap *f* with a cache
+        """
+        cache = Cache(size, ttl)
+
+        # ---------------------------------------------------------------------
+        @functools.wraps(f)
+        def wrapper(*args):
+            """
+            Return the cached result for *args*, calling *f* if there isn't
+            one
+            """
+            key = args[0] if len(args) == 1 else args
+            try:
+                return cache.get(key)
+            except KeyError:
+                rval = f(*args)
+                cache.put(key, rval)
+                return rval
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+# -----------------------------------------------------------------------------
+class LazyModule(object):
+    """
+    Stands in for a module that is expensive to import and not needed on
+    every run. The module is imported the first time one of its attributes is
+    used, so
+
+        pexpect = util.LazyModule('pexpect')
+        ...
+        proc = pexpect.spawn(cmd)
+
+    only pays for pexpect if spawn() is reached. Once imported, attributes
+    are looked up on the module itself, so anything that patches the module
+    (fakesmtp, for example) is seen through the proxy.
+    """
+    # -------------------------------------------------------------------------
+    def __init__(self, name):
+        """
+        Remember which module we stand for
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    # -------------------------------------------------------------------------
+    def __getattr__(self, attr):
+        """
+        Import the module if that hasn't happened yet and look up *attr* on it
+        """
+        return getattr(self._load(), attr)
+
+    # -------------------------------------------------------------------------
+    def __setattr__(self, attr, value):
+        """
+        Set *attr* on the module rather than on the proxy
+        """
+        setattr(self._load(), attr, value)
+
+    # -------------------------------------------------------------------------
+    def __repr__(self):
+        """
+        Show whether the module has been loaded yet
+        """
+        return "<LazyModule %s (%s)>" % (self._name,
+                                         'loaded' if self.loaded()
+                                         else 'not loaded')
+
+    # -------------------------------------------------------------------------
+    def _load(self):
+        """
+        Import the module (raising ImportError if it isn't there) and return
+        it
+        """
+        if self._module is None:
+            __import__(self._name)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return self._module
+
+    # -------------------------------------------------------------------------
+    def loaded(self):
+        """
+        Return True if the module has been imported
+        """
+        return self._module is not None
+
+
 # -----------------------------------------------------------------------------
 def abspath(relpath):
     """
@@ -574,6 +857,64 @@ def lineno():
     return sys._getframe(1).f_lineno
 
 
+# -----------------------------------------------------------------------------
+def lsp_columns(lspout):
+    """
+    We assume *lspout* is the complete output of one or more hsi 'ls -P'
+    commands and parse all of it in one pass, returning a dict of parallel
+    lists (columns), one element per FILE or DIRECTORY line:
+
+        'type'      'f' or 'd'
+        'path'      the name of the file or directory
+        'size'      file size in bytes (None for directories)
+        'cart'      cartridge name (comma separated if the file is on more
+                    than one cart, '' for an empty file, None for directories)
+        'cos'       class of service ('' for directories)
+        'created'   'mm/dd/yyyy hh:mm:ss' (None if not present)
+        'modified'  'mm/dd/yyyy hh:mm:ss' (None if not present)
+
+    Other lines (prompts, banners, error messages) are ignored. The fields in
+    a line are separated by '\t' and may be padded with blanks, or empty.
+    """
+    try:
+        rgx = lsp_columns.rgx
+    except AttributeError:
+        # a blank padded field; matching words and blanks alternately rather
+        # than with a non-greedy match keeps the regex engine from
+        # backtracking on every character
+        fld = "[ ]*([^\t\r\n ]*(?:[ ]+[^\t\r\n ]+)*)[ ]*"
+        skip = "[^\t\r\n]*"
+        lsp_columns.rgx = re.compile("^(FILE|DIRECTORY)\t" + fld +
+                                     "(?:\t" + fld +
+                                     "\t" + skip + "\t" + skip +
+                                     "\t" + fld + "(?:\t" + fld +
+                                     "(?:\t" + skip + "\t" + skip +
+                                     "\t" + fld + "\t" + fld +
+                                     "\t" + fld + "\t" + fld +
+                                     ")?)?)?[ \t]*\r?$",
+                                     re.MULTILINE)
+        rgx = lsp_columns.rgx
+
+    rows = rgx.findall(lspout)
+    if rows:
+        (ftype, path, size, cart, cos, cdate, ctime, mdate, mtime) = zip(*rows)
+    else:
+        (ftype, path, size, cart, cos, cdate, ctime, mdate, mtime) = [()] * 9
+
+    isfile = [x == 'FILE' for x in ftype]
+    rval = {'type': ['f' if x else 'd' for x in isfile],
+            'path': list(path),
+            'size': [int(s) if s.isdigit() else None for s in size],
+            'cart': [c if f else None for (c, f) in zip(cart, isfile)],
+            'cos': list(cos),
+            'created': [(d + ' ' + t) if d else None
+                        for (d, t) in zip(cdate, ctime)],
+            'modified': [(d + ' ' + t) if d else None
+                         for (d, t) in zip(mdate, mtime)],
+            }
+    return rval
+
+
 # -----------------------------------------------------------------------------
 def lsp_parse(lspout):
     """
@@ -685,6 +1026,24 @@ def memoize(f):
     return helper
 
 
+# -----------------------------------------------------------------------------
+def module_available(name):
+    """
+    Return True if module *name* could be imported, without importing it.
+    For a dotted name, the parent package is imported to find it.
+    """
+    (parent, _, leaf) = name.rpartition('.')
+    try:
+        if parent:
+            __import__(parent)
+            imp.find_module(leaf, sys.modules[parent].__path__)
+        else:
+            imp.find_module(leaf)
+        return True
+    except (ImportError, AttributeError):
+        return False
+
+
 # -------------------------------------------------------------------------
 @memoize
 def month_dict(arg=None):
@@ -708,6 +1067,19 @@ def my_name():
     return sys._getframe(1).f_code.co_name
 
 
+# -----------------------------------------------------------------------------
+def percentile(values, pct):
+    """
+    Return the *pct* percentile of the numbers in *values* by the nearest rank
+    method, or None if *values* is empty
+    """
+    if not values:
+        return None
+    svals = sorted(values)
+    rank = int(math.ceil(pct * len(svals) / 100.0))
+    return svals[min(max(rank, 1), len(svals)) - 1]
+
+
 # -----------------------------------------------------------------------------
 def pop0(list):
     """
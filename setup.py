@@ -11,7 +11,8 @@ setup(name='hpssic',
       author='Tom Barron',
       author_email='tbarron@ornl.gov',
       url='https://github.com/ORNL-TechInt/hpss-crawler',
-      scripts=['bin/cv',
+      scripts=['bin/bench',
+               'bin/cv',
                'bin/crawl',
                'bin/html',
                'bin/hsi',